@@ -44,8 +44,56 @@ class Annotator(object):
         # Map from key => number of nexts that will be built from this key
         self._num_needed_children = {}
         self._annotations_cache = {}
+        # Map from key => number of texts annotated in the longest line of
+        # ancestors leading to key, i.e. how expensive it was to annotate
+        self._annotation_depths = {}
         self._heads_provider = None
+        self._use_ancestry_index = False
         self._ann_tuple_cache = {}
+        self._annotation_cache = None
+        # Keys whose annotations were loaded from _annotation_cache, rather
+        # than computed from their parents
+        self._cached_keys = set()
+        self._special_keys = set()
+
+    def set_annotation_cache(self, cache):
+        """Use a persistent cache of annotations.
+
+        Graph walks stop at texts found in the cache, and annotate_flat()
+        stores its results there for later runs.
+
+        :param cache: An object with the interface of
+            breezy.bzr.annotation_cache.AnnotationCache.
+        """
+        self._annotation_cache = cache
+
+    def enable_ancestry_index(self):
+        """Resolve the heads of line candidates with an ancestry index.
+
+        Building the index costs a walk of the whole graph, which pays off
+        when many lines of the annotated texts have several candidates, e.g.
+        in files with a lot of merged history.
+        """
+        self._use_ancestry_index = True
+        self._heads_provider = None
+
+    def _seed_from_cache(self, key):
+        """Load the annotations for key from the annotation cache.
+
+        :return: True if key was found in the cache.
+        """
+        entry = self._annotation_cache.get(key)
+        if entry is None:
+            return False
+        lines, annotations = entry
+        # We don't need to walk past this key, its real parents are only
+        # looked up when resolving heads.
+        self._parent_map[key] = ()
+        self._text_cache[key] = lines
+        self._annotations_cache[key] = annotations
+        self._annotation_depths[key] = 0
+        self._cached_keys.add(key)
+        return True
 
     def _update_needed_children(self, key, parent_keys):
         for parent_key in parent_keys:
@@ -57,6 +105,17 @@ class Annotator(object):
     def _get_needed_keys(self, key):
         """Determine the texts we need to get from the backing vf.
 
+        :return: (vf_keys_needed, ann_keys_needed)
+            as for _get_needed_keys_many.
+        """
+        return self._get_needed_keys_many([key])
+
+    def _get_needed_keys_many(self, keys):
+        """Determine the texts we need to get from the backing vf.
+
+        The graphs of all keys are walked together, so each step needs only
+        a single get_parent_map call.
+
         :return: (vf_keys_needed, ann_keys_needed)
             vf_keys_needed  These are keys that we need to get from the vf
             ann_keys_needed Texts which we have in self._text_cache but we
@@ -65,16 +124,21 @@ class Annotator(object):
                             annotations.
         """
         parent_map = self._parent_map
-        # We need 1 extra copy of the node we will be looking at when we are
+        # We need 1 extra copy of the nodes we will be looking at when we are
         # done
-        self._num_needed_children[key] = 1
+        for key in keys:
+            self._num_needed_children[key] = 1
         vf_keys_needed = set()
         ann_keys_needed = set()
-        needed_keys = {key}
+        needed_keys = set(keys)
         while needed_keys:
             parent_lookup = []
             next_parent_map = {}
             for key in needed_keys:
+                if (self._annotation_cache is not None
+                        and key not in self._parent_map
+                        and self._seed_from_cache(key)):
+                    continue
                 if key in self._parent_map:
                     # We don't need to lookup this key in the vf
                     if key not in self._text_cache:
@@ -111,7 +175,17 @@ class Annotator(object):
             matcher object we are using. Currently it is always 'lines' but
             future improvements may change this to a simple text string.
         """
-        keys, ann_keys = self._get_needed_keys(key)
+        return self._get_needed_texts_many([key], pb=pb)
+
+    def _get_needed_texts_many(self, keys, pb=None):
+        """Get the texts we need to properly annotate all of keys.
+
+        The texts for all keys are extracted using a single record stream.
+
+        :param keys: Keys that are present in self._vf
+        :return: Yield (this_key, text, num_lines) as for _get_needed_texts.
+        """
+        keys, ann_keys = self._get_needed_keys_many(keys)
         if pb is not None:
             pb.update('getting stream', 0, len(keys))
         stream = self._vf.get_record_stream(keys, 'topological', True)
@@ -210,12 +284,16 @@ class Annotator(object):
 
     def _record_annotation(self, key, parent_keys, annotations):
         self._annotations_cache[key] = annotations
+        self._annotation_depths[key] = 1 + max(
+            [self._annotation_depths[parent] for parent in parent_keys],
+            default=0)
         for parent_key in parent_keys:
             num = self._num_needed_children[parent_key]
             num -= 1
             if num == 0:
                 del self._text_cache[parent_key]
                 del self._annotations_cache[parent_key]
+                del self._annotation_depths[parent_key]
                 # Do we want to clean up _num_needed_children at this point as
                 # well?
             self._num_needed_children[parent_key] = num
@@ -246,6 +324,7 @@ class Annotator(object):
         """
         self._parent_map[key] = parent_keys
         self._text_cache[key] = osutils.split_lines(text)
+        self._special_keys.add(key)
         self._heads_provider = None
 
     def annotate(self, key):
@@ -269,9 +348,33 @@ class Annotator(object):
 
     def _get_heads_provider(self):
         if self._heads_provider is None:
-            self._heads_provider = _mod_graph.KnownGraph(self._parent_map)
+            parent_map = self._parent_map
+            if self._cached_keys:
+                parent_map = self._get_full_parent_map()
+            self._heads_provider = _mod_graph.KnownGraph(parent_map)
+            if self._use_ancestry_index:
+                self._heads_provider.build_ancestry_index()
         return self._heads_provider
 
+    def _get_full_parent_map(self):
+        """Get the parent map, including the ancestry of cached texts.
+
+        Annotations loaded from the cache may refer to any ancestor, so
+        resolving heads needs the graph beyond where the text walk stopped.
+        """
+        parent_map = dict(self._parent_map)
+        pending = self._cached_keys
+        while pending:
+            next_parent_map = self._vf.get_parent_map(pending)
+            pending = set()
+            for key, parent_keys in next_parent_map.items():
+                if parent_keys is None:  # No graph versionedfile
+                    parent_keys = ()
+                parent_map[key] = parent_keys
+                pending.update(parent_keys)
+            pending.difference_update(parent_map)
+        return parent_map
+
     def _resolve_annotation_tie(self, the_heads, line, tiebreaker):
         if tiebreaker is None:
             head = sorted(the_heads)[0]
@@ -292,8 +395,49 @@ class Annotator(object):
         :return: [(ann_key, line)]
             A list of tuples with a single annotation key for each line.
         """
-        custom_tiebreaker = annotate._break_annotation_tie
         annotations, lines = self.annotate(key)
+        return self._flatten_and_cache(key, annotations, lines)
+
+    def _flatten_and_cache(self, key, annotations, lines):
+        out = self._flatten_annotations(annotations, lines)
+        if (self._annotation_cache is not None
+                and key not in self._cached_keys
+                and key not in self._special_keys):
+            # The annotations are cached before being flattened, so that
+            # the texts annotated from them get the same candidates as
+            # without the cache.
+            self._annotation_cache.put(
+                key, lines, annotations, self._annotation_depths[key])
+        return out
+
+    def annotate_flat_many(self, keys):
+        """Determine the single-best-revision for each line of many texts.
+
+        This is like calling annotate_flat() for every key, but the graph
+        walk and the extraction of texts are shared between all of them,
+        which is much cheaper when the keys have history in common or live
+        in the same groups (e.g. all files of one revision).
+
+        :param keys: An iterable of keys to annotate.
+        :return: An iterator over (key, [(ann_key, line)]), in the order of
+            keys.
+        """
+        keys = list(keys)
+        with ui.ui_factory.nested_progress_bar() as pb:
+            for text_key, text, num_lines in self._get_needed_texts_many(
+                    keys, pb=pb):
+                self._annotate_one(text_key, text, num_lines)
+        for key in keys:
+            try:
+                annotations = self._annotations_cache[key]
+            except KeyError:
+                raise errors.RevisionNotPresent(key, self._vf)
+            yield key, self._flatten_and_cache(
+                key, annotations, self._text_cache[key])
+
+    def _flatten_annotations(self, annotations, lines):
+        """Pick a single annotation for each line, see annotate_flat()."""
+        custom_tiebreaker = annotate._break_annotation_tie
         out = []
         heads = self._get_heads_provider().heads
         append = out.append
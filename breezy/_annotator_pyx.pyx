@@ -277,17 +277,13 @@ class Annotator(_annotator_py.Annotator):
         _merge_annotations(this_annotation, annotations, parent_annotations,
                            matching_blocks, self._ann_tuple_cache)
 
-    def annotate_flat(self, key):
-        """Determine the single-best-revision to source for each line.
-
-        This is meant as a compatibility thunk to how annotate() used to work.
-        """
+    def _flatten_annotations(self, annotations, lines):
+        """Pick a single annotation for each line, see annotate_flat()."""
         cdef Py_ssize_t pos, num_lines
 
         from . import annotate
 
         custom_tiebreaker = annotate._break_annotation_tie
-        annotations, lines = self.annotate(key)
         num_lines = len(lines)
         out = []
         heads = self._get_heads_provider().heads
@@ -21,12 +21,20 @@ try:
     from collections.abc import deque
 except ImportError:  # python < 3.7
     from collections import deque
+from bisect import bisect_right
+import itertools
+
 from . import (
     errors,
     revision,
     )
 
 
+# The default bound on the size of an ancestry index, in intervals. That is
+# enough for histories of about a million revisions.
+DEFAULT_MAX_ANCESTRY_INTERVALS = 2000000
+
+
 class _KnownGraphNode(object):
     """Represents a single object in the known graph."""
 
@@ -57,6 +65,95 @@ class _MergeSortNode(object):
         self.end_of_merge = end_of_merge
 
 
+class _AncestryIndex(object):
+    """Interval labels answering ancestry queries without walking the graph.
+
+    Every node is numbered in depth-first post order, visiting parents before
+    children.  The ancestry of a node is then stored as a sorted, flattened
+    tuple of half-open ``[start, end)`` intervals of those numbers.  For
+    typical revision graphs most nodes need only one or two intervals.
+    """
+
+    def __init__(self, parent_map, tips, max_intervals=None):
+        """Build the index.
+
+        :param parent_map: A dict mapping every key to its parent keys, or to
+            None for ghosts.
+        :param tips: Keys to start numbering from, most distant first; any
+            keys not reachable from them are numbered afterwards.
+        :param max_intervals: If not None, give up by raising MemoryError
+            once more than this many intervals would be stored.
+        """
+        offsets = {}
+        intervals = {}
+        entered = set()
+        counter = 0
+        total = 0
+        for tip in itertools.chain(tips, parent_map):
+            if tip in entered:
+                continue
+            entered.add(tip)
+            pending = [(tip, counter, iter(parent_map[tip] or ()))]
+            while pending:
+                key, start, parents = pending[-1]
+                for parent_key in parents:
+                    if parent_key not in entered:
+                        entered.add(parent_key)
+                        pending.append((parent_key, counter,
+                                        iter(parent_map[parent_key] or ())))
+                        break
+                else:
+                    pending.pop()
+                    offsets[key] = counter
+                    counter += 1
+                    ranges = [(start, counter)]
+                    for parent_key in parent_map[key] or ():
+                        # Missing entries only happen for cycles.
+                        flat = intervals.get(parent_key, ())
+                        ranges.extend(zip(flat[::2], flat[1::2]))
+                    flat = self._merge_ranges(ranges)
+                    total += len(flat) // 2
+                    if max_intervals is not None and total > max_intervals:
+                        raise MemoryError(
+                            'ancestry index exceeds %d intervals'
+                            % (max_intervals,))
+                    intervals[key] = flat
+        self._offsets = offsets
+        self._intervals = intervals
+        self.num_intervals = total
+
+    @staticmethod
+    def _merge_ranges(ranges):
+        if len(ranges) == 1:
+            return ranges[0]
+        ranges.sort()
+        flat = list(ranges[0])
+        for start, end in ranges[1:]:
+            if start <= flat[-1]:
+                if end > flat[-1]:
+                    flat[-1] = end
+            else:
+                flat.append(start)
+                flat.append(end)
+        return tuple(flat)
+
+    def is_ancestor(self, ancestor, key):
+        """Is ancestor reachable from key (or the same node)?"""
+        return bisect_right(self._intervals[key], self._offsets[ancestor]) & 1
+
+    def heads(self, keys):
+        """Return the keys that are not ancestors of any other key."""
+        offsets = [(key, self._offsets[key]) for key in keys]
+        intervals = self._intervals
+        not_heads = set()
+        for key in keys:
+            flat = intervals[key]
+            for other_key, offset in offsets:
+                if other_key != key and bisect_right(flat, offset) & 1:
+                    not_heads.add(other_key)
+        return frozenset(keys).difference(not_heads)
+
+
 class KnownGraph(object):
     """This is a class which assumes we already know the full graph."""
 
@@ -69,6 +166,7 @@ class KnownGraph(object):
         # Maps {frozenset(revision_id, revision_id): heads}
         self._known_heads = {}
         self.do_cache = do_cache
+        self._ancestry_index = None
         self._initialize_nodes(parent_map)
         self._find_gdfo()
 
@@ -169,6 +267,7 @@ class KnownGraph(object):
         else:
             node = _KnownGraphNode(key, parent_keys)
             nodes[key] = node
+        self._ancestry_index = None
         parent_gdfo = 0
         for parent_key in parent_keys:
             try:
@@ -232,6 +331,11 @@ class KnownGraph(object):
             return heads
         except KeyError:
             pass
+        if self._ancestry_index is not None:
+            heads = self._ancestry_index.heads(heads_key)
+            if self.do_cache:
+                self._known_heads[heads_key] = heads
+            return heads
         # Let's compute the heads
         seen = set()
         pending = []
@@ -258,6 +362,33 @@ class KnownGraph(object):
             self._known_heads[heads_key] = heads
         return heads
 
+    def build_ancestry_index(self,
+                             max_intervals=DEFAULT_MAX_ANCESTRY_INTERVALS):
+        """Precompute ancestry labels so that heads() avoids graph walks.
+
+        This is worthwhile when heads() is going to be called many times on
+        the same graph, e.g. during merge planning or annotate. The index is
+        dropped again if add_node() changes the graph.
+
+        :param max_intervals: Upper bound on the size of the index. Each
+            interval costs roughly as much memory as a graph node; typical
+            histories need one or two per node. None for no bound.
+        :return: True if the index was built, False if it would have exceeded
+            max_intervals, in which case heads() keeps walking the graph.
+        """
+        parent_map = dict((node.key, node.parent_keys)
+                          for node in self._nodes.values())
+        # Numbering from the furthest tip first keeps the mainline contiguous.
+        tips = [node.key for node in sorted(
+            self._find_tips(), key=lambda n: n.gdfo, reverse=True)]
+        try:
+            self._ancestry_index = _AncestryIndex(
+                parent_map, tips, max_intervals)
+        except MemoryError:
+            self._ancestry_index = None
+            return False
+        return True
+
     def topo_sort(self):
         """Return the nodes in topological order.
 
@@ -60,6 +60,10 @@ import collections
 import gc
 
 from . import errors, revision
+from ._known_graph_py import (
+    DEFAULT_MAX_ANCESTRY_INTERVALS,
+    _AncestryIndex,
+    )
 
 cdef object NULL_REVISION
 NULL_REVISION = revision.NULL_REVISION
@@ -200,6 +204,7 @@ cdef class KnownGraph:
     cdef public object _nodes
     cdef public object _known_heads
     cdef public int do_cache
+    cdef public object _ancestry_index
 
     def __init__(self, parent_map, do_cache=True):
         """Create a new KnownGraph instance.
@@ -211,6 +216,7 @@ cdef class KnownGraph:
         # Maps {sorted(revision_id, revision_id): heads}
         self._known_heads = {}
         self.do_cache = int(do_cache)
+        self._ancestry_index = None
         # TODO: consider disabling gc since we are allocating a lot of nodes
         #       that won't be collectable anyway. real world testing has not
         #       shown a specific impact, yet.
@@ -389,6 +395,7 @@ cdef class KnownGraph:
             node = _KnownGraphNode(key)
             PyDict_SetItem(self._nodes, key, node)
             self._populate_parents(node, parent_keys)
+        self._ancestry_index = None
         parent_gdfo = 0
         for parent_node in node.parents:
             if parent_node.gdfo == -1:
@@ -460,6 +467,11 @@ cdef class KnownGraph:
             heads_key = frozenset(candidate_nodes)
         if PyDict_Size(candidate_nodes) < 2:
             return heads_key
+        if self._ancestry_index is not None:
+            heads = self._ancestry_index.heads(heads_key)
+            if self.do_cache:
+                PyDict_SetItem(self._known_heads, heads_key, heads)
+            return heads
 
         cleanup = []
         pending = []
@@ -510,6 +522,43 @@ cdef class KnownGraph:
             PyDict_SetItem(self._known_heads, heads_key, heads)
         return heads
 
+    def build_ancestry_index(self,
+                             max_intervals=DEFAULT_MAX_ANCESTRY_INTERVALS):
+        """Precompute ancestry labels so that heads() avoids graph walks.
+
+        This is worthwhile when heads() is going to be called many times on
+        the same graph, e.g. during merge planning or annotate. The index is
+        dropped again if add_node() changes the graph.
+
+        :param max_intervals: Upper bound on the size of the index. Each
+            interval costs roughly as much memory as a graph node; typical
+            histories need one or two per node. None for no bound.
+        :return: True if the index was built, False if it would have exceeded
+            max_intervals, in which case heads() keeps walking the graph.
+        """
+        cdef PyObject *temp_node
+        cdef _KnownGraphNode node
+        cdef Py_ssize_t pos
+
+        parent_map = {}
+        tips = []
+        pos = 0
+        while PyDict_Next(self._nodes, &pos, NULL, &temp_node):
+            node = <_KnownGraphNode>temp_node
+            PyDict_SetItem(parent_map, node.key, node.parent_keys)
+            if not node.children:
+                PyList_Append(tips, node)
+        # Numbering from the furthest tip first keeps the mainline contiguous.
+        tips = [node.key for node in sorted(
+            tips, key=lambda n: n.gdfo, reverse=True)]
+        try:
+            self._ancestry_index = _AncestryIndex(
+                parent_map, tips, max_intervals)
+        except MemoryError:
+            self._ancestry_index = None
+            return False
+        return True
+
     def topo_sort(self):
         """Return the nodes in topological order.
 
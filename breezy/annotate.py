@@ -222,6 +222,60 @@ def _expand_annotations(annotations, branch, current_rev=None):
         yield (revno_str, author, date_str, origin, text)
 
 
+def annotate_flat_many(repository, text_keys, jobs=1):
+    """Annotate many file texts of a repository.
+
+    The texts are annotated together, so that their graph walks and the
+    extraction of their ancestor texts are shared. With more than one job
+    the keys are split between worker processes, each of which opens the
+    repository itself, so the repository must be reachable by URL.
+
+    :param repository: The repository holding the texts. It must store
+        its texts in versioned files (i.e. be a bzr repository).
+    :param text_keys: A list of (file_id, revision_id) keys to annotate.
+    :param jobs: The number of processes to use, or None to use
+        osutils.local_concurrency().
+    :return: An iterator over (text_key, [(revision_id, line)]), in the order
+        of text_keys.
+    """
+    text_keys = list(text_keys)
+    if jobs is None:
+        jobs = osutils.local_concurrency()
+    if jobs <= 1 or len(text_keys) < 2:
+        with repository.lock_read():
+            for key, annotations in _annotate_flat_many(
+                    repository, text_keys):
+                yield key, annotations
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    # Several chunks per process, so that one slow file doesn't hold up a
+    # whole share of the work.
+    num_chunks = min(len(text_keys), jobs * 4)
+    chunk_size = -(-len(text_keys) // num_chunks)
+    chunks = [text_keys[i:i + chunk_size]
+              for i in range(0, len(text_keys), chunk_size)]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(
+            _annotate_flat_chunk, [repository.user_url] * len(chunks), chunks)
+        for chunk_result in results:
+            for key, annotations in chunk_result:
+                yield key, annotations
+
+
+def _annotate_flat_many(repository, text_keys):
+    annotator = repository._get_annotator()
+    for key, annotations in annotator.annotate_flat_many(text_keys):
+        yield key, [(ann_key[-1], line) for ann_key, line in annotations]
+
+
+def _annotate_flat_chunk(url, text_keys):
+    """Worker process side of annotate_flat_many."""
+    from .repository import Repository
+    repository = Repository.open(url)
+    with repository.lock_read():
+        return list(_annotate_flat_many(repository, text_keys))
+
+
 def reannotate(parents_lines, new_lines, new_revision_id,
                _left_matching_blocks=None,
                heads_provider=None):
@@ -5636,20 +5636,35 @@ class cmd_serve(Command):
                ),
         Option('client-timeout', type=float,
                help='Override the default idle client timeout (5min).'),
+        Option('stats-port', type=int,
+               help='Publish the statistics of the server over HTTP on '
+                    'nominated port of the local host (see '
+                    'serve.stats_listen).  Only supported by the bzr '
+                    'protocol.'),
         ]
 
     def run(self, listen=None, port=None, inet=False, directory=None,
-            allow_writes=False, protocol=None, client_timeout=None):
+            allow_writes=False, protocol=None, client_timeout=None,
+            stats_port=None):
         from . import location, transport
         if directory is None:
             directory = osutils.getcwd()
         if protocol is None:
             protocol = transport.transport_server_registry.get()
+        if stats_port is not None:
+            from .bzr.smart import server as smart_server
+            if protocol is not smart_server.serve_bzr:
+                raise errors.CommandError(gettext(
+                    '--stats-port is only supported by the bzr protocol.'))
         url = location.location_to_url(directory)
         if not allow_writes:
             url = 'readonly+' + url
         t = transport.get_transport_from_url(url)
-        protocol(t, listen, port, inet, client_timeout)
+        if stats_port is None:
+            protocol(t, listen, port, inet, client_timeout)
+        else:
+            protocol(t, listen, port, inet, client_timeout,
+                     stats_port=stats_port)
 
 
 class cmd_join(Command):
@@ -0,0 +1,205 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A persistent cache of annotations for selected texts.
+
+The Annotator can seed its graph walk from the nearest cached ancestor of a
+text, rather than reconstructing and diffing the whole history of a file.
+
+Entries live in a directory per file (the key minus its last element), with
+one file per text. Both names are sha1 hex digests, so that arbitrary key
+elements are safe to use as file names. An entry is a zlib compressed
+bencoded dict with the lines of the text, the distinct annotation keys and
+for every line the indices of the keys it may be annotated with.
+
+The cache of a repository lives in the user cache directory rather than in the
+repository, which is only read locked while annotating.
+
+The annotations are kept as Annotator.annotate() returns them, before ties are
+resolved, so that annotating from the cache gives the same results as without.
+
+Only the texts that took annotating a long line of ancestors are stored, the
+others are cheap enough to annotate again. Once the cache grows over its
+maximum size, the oldest entries are removed.
+"""
+
+import zlib
+
+import fastbencode as bencode
+
+from .. import (
+    errors,
+    osutils,
+    trace,
+    transport as _mod_transport,
+    )
+
+
+def cache_transport(repository):
+    """Return the transport to keep the annotation cache of repository on.
+
+    There is a directory per repository location, as the annotations of a
+    text depend on which of its ancestors are present.
+    """
+    from .. import bedding
+    return _mod_transport.get_transport_from_path(osutils.pathjoin(
+        bedding.cache_dir(), 'annotations',
+        osutils.sha_string(repository.user_url.encode('utf-8')).decode(
+            'ascii')))
+
+
+class AnnotationCache(object):
+    """Annotations for selected texts, stored on a transport.
+
+    :ivar min_depth: The number of texts that must have been annotated in a
+        line to get the annotations of a text for them to be stored.
+    :ivar max_size: The size in bytes over which the oldest entries are
+        removed, or None for no limit.
+    """
+
+    def __init__(self, transport, min_depth=0, max_size=None):
+        self._transport = transport
+        self.min_depth = min_depth
+        self.max_size = max_size
+        # Map from directory name => set of cached entry names
+        self._listings = {}
+        # The total size of the entries, once they were looked at
+        self._size = None
+
+    def _names(self, key):
+        return (osutils.sha_string(b'\x00'.join(key[:-1])).decode('ascii'),
+                osutils.sha_string(key[-1]).decode('ascii'))
+
+    def _listing(self, dirname):
+        try:
+            return self._listings[dirname]
+        except KeyError:
+            pass
+        try:
+            listing = set(self._transport.list_dir(dirname))
+        except (_mod_transport.NoSuchFile, errors.TransportNotPossible):
+            listing = set()
+        self._listings[dirname] = listing
+        return listing
+
+    def __contains__(self, key):
+        dirname, name = self._names(key)
+        return name in self._listing(dirname)
+
+    def get(self, key):
+        """Return the cached (lines, annotations) for key, or None."""
+        dirname, name = self._names(key)
+        if name not in self._listing(dirname):
+            return None
+        try:
+            data = bencode.bdecode(zlib.decompress(
+                self._transport.get_bytes(dirname + '/' + name)))
+            keys = [tuple(ann_key) for ann_key in data[b'keys']]
+            lines = data[b'lines']
+            annotations = [tuple(keys[idx] for idx in indices)
+                           for indices in data[b'annotations']]
+        except (_mod_transport.NoSuchFile, zlib.error, ValueError, KeyError,
+                IndexError, TypeError) as e:
+            trace.mutter('ignoring bad annotation cache entry for %r: %s',
+                         key, e)
+            return None
+        if len(lines) != len(annotations):
+            return None
+        return lines, annotations
+
+    def put(self, key, lines, annotations, depth):
+        """Store the annotation of a text, if it was expensive to compute.
+
+        Failing to write, e.g. to a read-only directory, is not an error.
+
+        :param key: The key of the annotated text.
+        :param lines: The lines of the text.
+        :param annotations: For each line, the tuple of the keys that may have
+            last modified it, as returned by Annotator.annotate().
+        :param depth: The number of texts annotated in the longest line of
+            ancestors leading to the text.
+        """
+        if depth < self.min_depth:
+            return
+        dirname, name = self._names(key)
+        keys = []
+        key_index = {}
+        indices = []
+        for annotation in annotations:
+            line_indices = []
+            for ann_key in annotation:
+                idx = key_index.get(ann_key)
+                if idx is None:
+                    idx = key_index[ann_key] = len(keys)
+                    keys.append(list(ann_key))
+                line_indices.append(idx)
+            indices.append(line_indices)
+        data = zlib.compress(bencode.bencode(
+            {b'keys': keys, b'lines': list(lines), b'annotations': indices}))
+        try:
+            try:
+                self._transport.put_bytes(dirname + '/' + name, data)
+            except _mod_transport.NoSuchFile:
+                self._transport.create_prefix()
+                self._transport.mkdir(dirname)
+                self._transport.put_bytes(dirname + '/' + name, data)
+        except (errors.TransportNotPossible, errors.PermissionDenied,
+                errors.LockContention, _mod_transport.FileExists) as e:
+            trace.mutter('unable to write annotation cache entry: %s', e)
+            return
+        self._listing(dirname).add(name)
+        if self.max_size is not None:
+            if self._size is None:
+                self._size = self._prune()
+            else:
+                self._size += len(data)
+                if self._size > self.max_size:
+                    self._size = self._prune()
+
+    def _prune(self):
+        """Remove the oldest entries until the cache fits in max_size.
+
+        :return: The size of the entries left.
+        """
+        entries = []
+        try:
+            dirnames = self._transport.list_dir('.')
+        except (_mod_transport.NoSuchFile, errors.TransportNotPossible):
+            return 0
+        for dirname in dirnames:
+            for name in self._listing(dirname):
+                try:
+                    st = self._transport.stat(dirname + '/' + name)
+                except _mod_transport.NoSuchFile:
+                    continue
+                entries.append((getattr(st, 'st_mtime', 0), dirname, name,
+                                st.st_size))
+        entries.sort()
+        size = sum(entry[3] for entry in entries)
+        for mtime, dirname, name, entry_size in entries:
+            if size <= self.max_size:
+                break
+            try:
+                self._transport.delete(dirname + '/' + name)
+            except _mod_transport.NoSuchFile:
+                pass
+            except (errors.TransportNotPossible,
+                    errors.PermissionDenied) as e:
+                trace.mutter('unable to prune annotation cache: %s', e)
+                break
+            self._listing(dirname).discard(name)
+            size -= entry_size
+        return size
@@ -22,6 +22,7 @@ from io import BytesIO
 from ..lazy_import import lazy_import
 lazy_import(globals(), """
 import bisect
+import collections
 import math
 import tempfile
 import zlib
@@ -55,6 +56,12 @@ _PAGE_SIZE = 4096
 # 4K per page: 4MB - 1000 entries
 _NODE_CACHE_SIZE = 1000
 
+# Big reads of nodes from transports running requests concurrently are split
+# into requests of this many pages, so that the next requests are in flight
+# while the nodes of one are parsed.
+_READ_BATCH_PAGES = 64
+_READ_BATCHES_AHEAD = 2
+
 
 class _BuilderRow(object):
     """The stored state accumulated while writing out a row in the index.
@@ -1513,7 +1520,7 @@ class BTreeGraphIndex(object):
             data_ranges = [(start, bytes[start:start + size])
                            for start, size in ranges]
         elif self._file is None:
-            data_ranges = self._transport.readv(self._name, ranges)
+            data_ranges = self._read_ranges(ranges)
         else:
             data_ranges = []
             for offset, size in ranges:
@@ -1536,6 +1543,43 @@ class BTreeGraphIndex(object):
                 raise AssertionError("Unknown node type for %r" % bytes)
             yield offset // _PAGE_SIZE, node
 
+    def _read_ranges(self, ranges):
+        """Read ranges of the index file from the transport.
+
+        When the transport can run requests concurrently, more than
+        _READ_BATCH_PAGES ranges are read by several overlapping requests.
+
+        :return: An iterator over (offset, data) tuples, in the order of
+            ranges.
+        """
+        if len(ranges) > _READ_BATCH_PAGES:
+            async_transport = self._transport.get_async()
+            if async_transport.concurrent:
+                return self._read_ranges_batched(ranges, async_transport)
+            async_transport.close()
+        return self._transport.readv(self._name, ranges)
+
+    def _read_ranges_batched(self, ranges, async_transport):
+        batches = iter([ranges[i:i + _READ_BATCH_PAGES]
+                        for i in range(0, len(ranges), _READ_BATCH_PAGES)])
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(async_transport.readv(self._name, batch))
+                if len(pending) > _READ_BATCHES_AHEAD:
+                    break
+            while pending:
+                result = pending.popleft().result()
+                for batch in batches:
+                    pending.append(async_transport.readv(self._name, batch))
+                    break
+                for offset, data in result:
+                    yield offset, data
+        finally:
+            for future in pending:
+                future.cancel()
+            async_transport.close()
+
     def _signature(self):
         """The file signature for this index type."""
         return _BTSIGNATURE
@@ -36,6 +36,7 @@ from breezy.bzr import (
 """)
 from .. import (
     errors,
+    osutils,
     ui,
     )
 from ..i18n import gettext
@@ -122,7 +123,8 @@ class RepoFetcher(object):
             from_format = self.from_repository._format
             pb.update("Inserting stream")
             resume_tokens, missing_keys = self.sink.insert_stream(
-                stream, from_format, [])
+                stream, from_format, [],
+                upload_id=self._upload_id(search, from_format))
             if missing_keys:
                 pb.update("Missing keys")
                 stream = source.get_stream_for_missing_keys(missing_keys)
@@ -140,6 +142,19 @@ class RepoFetcher(object):
             pb.update("Finishing stream")
             self.sink.finished()
 
+    def _upload_id(self, search, from_format):
+        """Identify the upload of the revisions of search.
+
+        Fetching the same revisions again gives the same identifier, which
+        lets sinks that keep interrupted uploads carry on where they stopped.
+        """
+        lines = [from_format.network_name()]
+        for part in search.get_network_struct():
+            # The keys of searches are sets, their order is arbitrary
+            lines.extend(b' '.join(sorted(line.split(b' ')))
+                         for line in part.split(b'\n'))
+        return osutils.sha_strings(line + b'\n' for line in lines)
+
     def _revids_to_fetch(self):
         """Determines the exact revisions needed from self.from_repository to
         install self._last_revision in self.to_repository.
@@ -1121,7 +1121,7 @@ class InventoryRevisionTree(RevisionTree, InventoryTree):
         """See Tree.annotate_iter"""
         file_id = self.path2id(path)
         text_key = (file_id, self.get_file_revision(path))
-        annotator = self._repository.texts.get_annotator()
+        annotator = self._repository._get_annotator()
         annotations = annotator.annotate_flat(text_key)
         return [(key[-1], line) for key, line in annotations]
 
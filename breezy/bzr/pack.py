@@ -263,6 +263,20 @@ class ReadVFile(object):
         return result
 
 
+def readv_blocks(requested_records):
+    """Return the offsets to read for selected records of a container.
+
+    A ContainerReader over the result of reading them (see ReadVFile) yields
+    the selected records.
+
+    :param requested_records: The record offset, length tuples as returned
+        by add_bytes_record for the desired records.
+    """
+    blocks = [(0, len(FORMAT_ONE) + 1)]
+    blocks.extend(requested_records)
+    return blocks
+
+
 def make_readv_reader(transport, filename, requested_records):
     """Create a ContainerReader that will read selected records only.
 
@@ -271,10 +285,8 @@ def make_readv_reader(transport, filename, requested_records):
     :param requested_records: The record offset, length tuples as returned
         by add_bytes_record for the desired records.
     """
-    readv_blocks = [(0, len(FORMAT_ONE) + 1)]
-    readv_blocks.extend(requested_records)
     result = ContainerReader(ReadVFile(
-        transport.readv(filename, readv_blocks)))
+        transport.readv(filename, readv_blocks(requested_records))))
     return result
 
 
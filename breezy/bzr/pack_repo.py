@@ -19,6 +19,7 @@ import sys
 
 from ..lazy_import import lazy_import
 lazy_import(globals(), """
+import collections
 import contextlib
 import time
 
@@ -1891,6 +1892,7 @@ class PackRepository(MetaDirVersionedFileRepository):
 
         if not self.is_locked():
             self._unstacked_provider.disable_cache()
+            self._revision_cache.clear()
             for repo in self._fallback_repositories:
                 repo.unlock()
 
@@ -1992,6 +1994,13 @@ class RetryPackOperations(RetryWithNewPacks):
 class _DirectPackAccess(object):
     """Access to data in one or more packs with less translation."""
 
+    # When the transport can run requests concurrently, get_raw_records reads
+    # at most this many bytes in one request, and keeps up to _max_readv_ahead
+    # such requests in flight while it parses records, possibly from several
+    # packs.
+    _max_readv_bytes = 4 * 1024 * 1024
+    _max_readv_ahead = 4
+
     def __init__(self, index_to_packs, reload_func=None, flush_func=None):
         """Create a _DirectPackAccess object.
 
@@ -2081,32 +2090,134 @@ class _DirectPackAccess(object):
         # handle the last entry
         if current_index is not None:
             request_lists.append((current_index, current_list))
-        for index, offsets in request_lists:
+        async_transport = None
+        if len(request_lists) > 1 or (
+                request_lists and
+                sum(length for offset, length in request_lists[0][1]) >
+                self._max_readv_bytes):
             try:
-                transport, path = self._indices[index]
+                transport = self._indices[request_lists[0][0]][0]
             except KeyError:
-                # A KeyError here indicates that someone has triggered an index
-                # reload, and this index has gone missing, we need to start
-                # over.
-                if self._reload_func is None:
-                    # If we don't have a _reload_func there is nothing that can
-                    # be done
-                    raise
-                raise RetryWithNewPacks(index,
-                                        reload_occurred=True,
-                                        exc_info=sys.exc_info())
-            try:
-                reader = pack.make_readv_reader(transport, path, offsets)
-                for names, read_func in reader.iter_records():
-                    yield read_func(None)
-            except _mod_transport.NoSuchFile:
-                # A NoSuchFile error indicates that a pack file has gone
-                # missing on disk, we need to trigger a reload, and start over.
-                if self._reload_func is None:
-                    raise
-                raise RetryWithNewPacks(transport.abspath(path),
-                                        reload_occurred=False,
-                                        exc_info=sys.exc_info())
+                # Reported when reading the records
+                pass
+            else:
+                async_transport = transport.get_async()
+                if not async_transport.concurrent:
+                    # Splitting the reads would only add round trips
+                    async_transport.close()
+                    async_transport = None
+        if async_transport is None:
+            yield from self._iter_raw_records(request_lists)
+        else:
+            yield from self._iter_raw_records_ahead(
+                request_lists, transport, async_transport)
+
+    def _get_pack(self, index):
+        """Return the transport and path of the pack for index."""
+        try:
+            return self._indices[index]
+        except KeyError:
+            # A KeyError here indicates that someone has triggered an index
+            # reload, and this index has gone missing, we need to start
+            # over.
+            if self._reload_func is None:
+                # If we don't have a _reload_func there is nothing that can
+                # be done
+                raise
+            raise RetryWithNewPacks(index,
+                                    reload_occurred=True,
+                                    exc_info=sys.exc_info())
+
+    def _iter_records(self, transport, path, readv):
+        """Parse the records of a pack.
+
+        :param readv: A callable returning the readv result to parse.
+        """
+        try:
+            reader = pack.ContainerReader(pack.ReadVFile(readv()))
+            for names, read_func in reader.iter_records():
+                yield read_func(None)
+        except _mod_transport.NoSuchFile:
+            # A NoSuchFile error indicates that a pack file has gone
+            # missing on disk, we need to trigger a reload, and start over.
+            if self._reload_func is None:
+                raise
+            raise RetryWithNewPacks(transport.abspath(path),
+                                    reload_occurred=False,
+                                    exc_info=sys.exc_info())
+
+    def _iter_raw_records(self, request_lists):
+        """Read the records of each pack with a single readv."""
+        for index, offsets in request_lists:
+            transport, path = self._get_pack(index)
+            yield from self._iter_records(
+                transport, path,
+                lambda: transport.readv(path, pack.readv_blocks(offsets)))
+
+    def _iter_raw_records_ahead(self, request_lists, transport,
+                                async_transport):
+        """Read the records with concurrent requests, reading ahead.
+
+        Reads are split in requests of at most _max_readv_bytes, and up to
+        _max_readv_ahead of them are kept in flight while records are parsed,
+        possibly from several packs.
+        """
+        async_transports = {id(transport): async_transport}
+        # (request list number, future) for the reads in flight
+        started = collections.deque()
+
+        def iter_chunks():
+            for i, (index, offsets) in enumerate(request_lists):
+                try:
+                    transport, path = self._indices[index]
+                except KeyError:
+                    # Reported when this request is reached
+                    return
+                chunk = []
+                size = 0
+                for offset in pack.readv_blocks(offsets):
+                    if chunk and size + offset[1] > self._max_readv_bytes:
+                        yield i, transport, path, chunk
+                        chunk = []
+                        size = 0
+                    chunk.append(offset)
+                    size += offset[1]
+                yield i, transport, path, chunk
+        chunks = iter_chunks()
+
+        def start_reads():
+            while len(started) < self._max_readv_ahead:
+                for i, transport, path, chunk in chunks:
+                    break
+                else:
+                    return
+                async_transport = async_transports.get(id(transport))
+                if async_transport is None:
+                    async_transport = transport.get_async()
+                    async_transports[id(transport)] = async_transport
+                started.append((i, async_transport.readv(path, chunk)))
+
+        def iter_readv_result(i):
+            while True:
+                start_reads()
+                if not started or started[0][0] != i:
+                    return
+                future = started.popleft()[1]
+                # Keep the next reads in flight while this one is parsed
+                start_reads()
+                for item in future.result():
+                    yield item
+
+        try:
+            for i, (index, offsets) in enumerate(request_lists):
+                transport, path = self._get_pack(index)
+                yield from self._iter_records(
+                    transport, path, lambda: iter_readv_result(i))
+        finally:
+            for i, future in started:
+                future.cancel()
+            for async_transport in async_transports.values():
+                async_transport.close()
 
     def set_writer(self, writer, index, transport_packname):
         """Set a writer to use for adding data."""
@@ -15,6 +15,7 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import bz2
+import itertools
 import os
 import re
 import sys
@@ -65,11 +66,19 @@ from ..revision import NULL_REVISION
 from ..repository import RepositoryWriteLockResult, _LazyListJoin
 from .serializer import format_registry as serializer_format_registry
 from ..trace import mutter, note, warning, log_exception_quietly
-from .versionedfile import FulltextContentFactory
+from .versionedfile import (
+    ChunkedContentFactory,
+    FulltextContentFactory,
+    )
 
 
 _DEFAULT_SEARCH_DEPTH = 100
 
+# How many times a RemoteBranch was write locked in this process. Branches
+# don't use the state read when they were opened once another branch may have
+# changed it.
+_branch_write_locks = 0
+
 
 class UnknownErrorFromSmartServer(errors.BzrError):
     """An ErrorFromSmartServer could not be translated into a typical breezy
@@ -857,11 +866,57 @@ class RemoteBzrDir(_mod_bzrdir.BzrDir, _RpcHelper):
             result = self._next_open_branch_result
             self._next_open_branch_result = None
             return result
+        result = self._open_branch_v4(name, ignore_fallbacks,
+                                      possible_transports)
+        if result is not None:
+            return result
         response = self._get_branch_reference()
         return self._open_branch(name, response[0], response[1],
                                  possible_transports=possible_transports,
                                  ignore_fallbacks=ignore_fallbacks)
 
+    def _open_branch_v4(self, name, ignore_fallbacks, possible_transports):
+        """Open the branch, reading its state in the same round trip.
+
+        :return: The branch, or None if the server is too old.
+        """
+        medium = self._client._medium
+        if medium._is_remote_before((3, 3)):
+            return None
+        path = self._path_for_remote_call(self._client)
+        try:
+            response, handler = self._call_expecting_body(
+                b'BzrDir.open_branchV4', path)
+        except errors.UnknownSmartMethod:
+            medium._remember_remote_is_before((3, 3))
+            return None
+        if response[0] == b'ref':
+            handler.cancel_read_body()
+            return self._open_branch(name, 'ref', response[1],
+                                     possible_transports=possible_transports,
+                                     ignore_fallbacks=ignore_fallbacks)
+        if response[0] != b'branch' or len(response) != 10:
+            handler.cancel_read_body()
+            raise errors.UnexpectedSmartServerResponse(response)
+        config, tags = bencode.bdecode(handler.read_body_bytes())
+        (branch_format_name, revno, revision_id, stacked_on_url,
+         repo_path) = response[1:6]
+        if repo_path == b'':
+            # The repository is in this bzrdir.
+            repo_format = response_tuple_to_repo_format(response[6:10])
+            repo_format._creating_bzrdir = self
+            repository = RemoteRepository(self, repo_format)
+            repo_format._creating_repo = repository
+        else:
+            repository = self.find_repository()
+        format = RemoteBranchFormat(network_name=branch_format_name)
+        state = ((int(revno), revision_id), stacked_on_url.decode('utf-8'),
+                 config, tags)
+        return RemoteBranch(self, repository, format=format,
+                            setup_stacking=not ignore_fallbacks, name=name,
+                            possible_transports=possible_transports,
+                            _prefetched_state=state)
+
     def _open_repo_v1(self, path):
         verb = b'BzrDir.find_repository'
         response = self._call(verb, path)
@@ -1254,6 +1309,12 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
     Repository objects.
     """
 
+    # The (compressed) size of the parents asked for in the first and later
+    # Repository.walk_to_common calls: the revisions to fetch are usually
+    # few, but when they aren't, fewer larger responses are faster.
+    _walk_to_common_initial_size = 65536
+    _walk_to_common_max_size = 1024 * 1024
+
     def __init__(self, remote_bzrdir, format, real_repository=None, _client=None):
         """Create a RemoteRepository instance.
 
@@ -1583,6 +1644,10 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
         parents_provider = self._make_parents_provider(other_repository)
         return graph.Graph(parents_provider)
 
+    def _get_annotator(self):
+        """Return an Annotator for the file texts in this repository."""
+        return self.texts.get_annotator()
+
     def get_known_graph_ancestry(self, revision_ids):
         """Return the known graph for a set of revision ids and their ancestors.
         """
@@ -2483,27 +2548,124 @@ class RemoteRepository(_mod_repository.Repository, _RpcHelper,
             response_handler.cancel_read_body()
             raise errors.UnexpectedSmartServerResponse(response_tuple)
         if response_tuple[0] == b'ok':
-            coded = bz2.decompress(response_handler.read_body_bytes())
-            if coded == b'':
-                # no revisions found
-                return {}
-            lines = coded.split(b'\n')
-            revision_graph = {}
-            for line in lines:
-                d = tuple(line.split())
-                if len(d) > 1:
-                    revision_graph[d[0]] = d[1:]
-                else:
-                    # No parents:
-                    if d[0].startswith(b'missing:'):
-                        revid = d[0][8:]
-                        self._unstacked_provider.note_missing_key(revid)
-                    else:
-                        # no parents - so give the Graph result
-                        # (NULL_REVISION,).
-                        revision_graph[d[0]] = (NULL_REVISION,)
+            revision_graph, missing = self._deserialise_parent_map(
+                response_handler.read_body_bytes())
+            for revid in missing:
+                self._unstacked_provider.note_missing_key(revid)
             return revision_graph
 
+    def _deserialise_parent_map(self, body):
+        """Parse the bz2 compressed parents sent by the server.
+
+        :return: (parent_map, missing), where missing is the set of the
+            revision ids the server reported as absent.
+        """
+        coded = bz2.decompress(body)
+        revision_graph = {}
+        missing = set()
+        if coded == b'':
+            # no revisions found
+            return revision_graph, missing
+        lines = coded.split(b'\n')
+        for line in lines:
+            d = tuple(line.split())
+            if len(d) > 1:
+                revision_graph[d[0]] = d[1:]
+            else:
+                # No parents:
+                if d[0].startswith(b'missing:'):
+                    missing.add(d[0][8:])
+                else:
+                    # no parents - so give the Graph result
+                    # (NULL_REVISION,).
+                    revision_graph[d[0]] = (NULL_REVISION,)
+        return revision_graph, missing
+
+    def _walk_to_common_rpc(self, heads, haves, max_size):
+        """Ask the server for the ancestry of heads not in that of haves.
+
+        :return: (complete, parent_map, missing) where complete is False if
+            the server sent only the part of the ancestry nearest to heads,
+            or None if the server does not support Repository.walk_to_common.
+        """
+        medium = self._client._medium
+        if medium._is_remote_before((3, 3)):
+            return None
+        path = self.controldir._path_for_remote_call(self._client)
+        body = b' '.join(sorted(heads)) + b'\n' + b' '.join(sorted(haves))
+        try:
+            response_tuple, response_handler = (
+                self._call_with_body_bytes_expecting_body(
+                    b'Repository.walk_to_common', (path, b'%d' % max_size),
+                    body))
+        except errors.UnknownSmartMethod:
+            medium._remember_remote_is_before((3, 3))
+            return None
+        if response_tuple[0] not in (b'ok', b'partial'):
+            response_handler.cancel_read_body()
+            raise errors.UnexpectedSmartServerResponse(response_tuple)
+        parent_map, missing = self._deserialise_parent_map(
+            response_handler.read_body_bytes())
+        return response_tuple[0] == b'ok', parent_map, missing
+
+    def _find_missing_revisions(self, revision_ids, if_present_ids, target):
+        """Find the ancestry of some revisions that target does not have.
+
+        The server walks the graph, in chunks of bounded size, stopping at
+        the revisions we found in target so far. This takes a round trip or
+        two when the ancestries differ by a few revisions, and a few more when
+        they differ by thousands. The parents found are cached.
+
+        :param revision_ids: The revisions whose ancestry to search. A
+            NoSuchRevision is raised if any is absent from both repositories.
+        :param if_present_ids: Like revision_ids, but absent revisions are
+            ignored.
+        :param target: The repository to compare with.
+        :return: A set of revision ids, or None if the server can't help and
+            the client should walk the graph itself.
+        """
+        if (self._fallback_repositories or
+                self._unstacked_provider.get_cached_map() is None):
+            # The server can't see revisions in our fallbacks, and we can't
+            # keep the parents it sends without a lock.
+            return None
+        heads = set(revision_ids).union(if_present_ids or ())
+        heads.discard(NULL_REVISION)
+        target_graph = target.get_graph()
+        parent_map = {}
+        present = set()
+        haves = set()
+        max_size = self._walk_to_common_initial_size
+        while heads:
+            result = self._walk_to_common_rpc(heads, haves, max_size)
+            if result is None:
+                return None
+            complete, found, missing = result
+            self._unstacked_provider.note_parent_map(found)
+            for revid in missing:
+                self._unstacked_provider.note_missing_key(revid)
+            parent_map.update(found)
+            ghosts = missing.intersection(revision_ids)
+            present.update(target_graph.get_parent_map(ghosts.union(found)))
+            ghosts.difference_update(present)
+            if ghosts:
+                # One of the caller's revision_ids is a ghost in both the
+                # source and the target.
+                raise errors.NoSuchRevision(self, ghosts.pop())
+            if complete:
+                break
+            # Carry on from the parents the server did not send, stopping at
+            # the ancestry of the revisions target has.
+            parents = set(itertools.chain.from_iterable(
+                parent_map[revid] for revid in found if revid not in present))
+            present_parents = set(itertools.chain.from_iterable(
+                parent_map[revid] for revid in present if revid in parent_map))
+            haves = present.difference(present_parents)
+            heads = parents.difference(parent_map, present, missing)
+            heads.discard(NULL_REVISION)
+            max_size = self._walk_to_common_max_size
+        return set(parent_map).difference(present)
+
     def get_signature_text(self, revision_id):
         with self.lock_read():
             path = self.controldir._path_for_remote_call(self._client)
@@ -2951,7 +3113,8 @@ class RemoteStreamSink(vf_repository.StreamSink):
         return self.insert_stream_without_locking(stream,
                                                   self.target_repo._format)
 
-    def insert_stream(self, stream, src_format, resume_tokens):
+    def insert_stream(self, stream, src_format, resume_tokens,
+                      upload_id=None):
         target = self.target_repo
         target._unstacked_provider.missing_keys.clear()
         candidate_calls = [(b'Repository.insert_stream_1.19', (1, 19))]
@@ -2965,6 +3128,13 @@ class RemoteStreamSink(vf_repository.StreamSink):
         client = target._client
         medium = client._medium
         path = target.controldir._path_for_remote_call(client)
+        checkpoint = None
+        if upload_id is not None and not resume_tokens:
+            checkpoint_size = _mod_config.GlobalStack().get(
+                'smart.insert_checkpoint_size')
+            if checkpoint_size:
+                checkpoint = self._get_insert_checkpoint(
+                    path, upload_id, lock_args)
         # Probe for the verb to use with an empty stream before sending the
         # real stream to it.  We do this both to avoid the risk of sending a
         # large request that is then rejected, and because we don't want to
@@ -2973,9 +3143,10 @@ class RemoteStreamSink(vf_repository.StreamSink):
         for verb, required_version in candidate_calls:
             if medium._is_remote_before(required_version):
                 continue
-            if resume_tokens:
+            if resume_tokens or checkpoint is not None:
                 # We've already done the probing (and set _is_remote_before) on
-                # a previous insert.
+                # a previous insert, or the server supports checkpoints which
+                # are newer than the first verb.
                 found_verb = True
                 break
             byte_stream = smart_repo._stream_to_byte_stream([], src_format)
@@ -2998,8 +3169,13 @@ class RemoteStreamSink(vf_repository.StreamSink):
             # deltas we'll interrupt the smart insert_stream request and
             # fallback to VFS.
             stream = self._stop_stream_if_inventory_delta(stream)
-        byte_stream = smart_repo._stream_to_byte_stream(
-            stream, src_format)
+        if checkpoint is not None and checkpoint[0] is not None:
+            resume_tokens, byte_stream = self._insert_checkpoints(
+                stream, src_format, upload_id, checkpoint, checkpoint_size,
+                path, lock_args)
+        else:
+            byte_stream = smart_repo._stream_to_byte_stream(
+                stream, src_format)
         resume_tokens = b' '.join([token.encode('utf-8')
                                    for token in resume_tokens])
         response = client.call_with_body_stream(
@@ -3020,6 +3196,113 @@ class RemoteStreamSink(vf_repository.StreamSink):
             self.target_repo.refresh_data()
             return [], set()
 
+    def _get_insert_checkpoint(self, path, upload_id, lock_args):
+        """Ask the server what it kept of an interrupted upload.
+
+        :return: None if the server is too old to keep checkpoints, or a tuple
+            of the resume tokens of the checkpoint of the upload and a dict of
+            the keys the server holds, by kind. The tokens are None if the
+            repository can't keep checkpoints.
+        """
+        client = self.target_repo._client
+        medium = client._medium
+        if medium._is_remote_before((3, 3)):
+            return None
+        try:
+            response, handler = client.call_expecting_body(
+                b'Repository.get_insert_checkpoint', path, upload_id,
+                *lock_args)
+        except errors.UnknownSmartMethod:
+            medium._remember_remote_is_before((3, 3))
+            return None
+        body = handler.read_body_bytes()
+        if response[0] == b'unsupported':
+            return None, {}
+        elif response[0] == b'no-checkpoint':
+            return [], {}
+        elif response[0] != b'ok':
+            raise errors.UnexpectedSmartServerResponse(response)
+        tokens = [token.decode('utf-8')
+                  for token in bencode.bdecode(response[1])]
+        held_keys = {}
+        for key in bencode.bdecode_as_tuple(zlib.decompress(body)):
+            held_keys.setdefault(key[0].decode('utf-8'), set()).add(key[1:])
+        return tokens, held_keys
+
+    def _insert_checkpoints(self, stream, src_format, upload_id, checkpoint,
+                            checkpoint_size, path, lock_args):
+        """Send a stream to be kept by the server as it goes.
+
+        Each part of checkpoint_size bytes of the stream is inserted with
+        Repository.insert_stream_checkpoint, which suspends the write group
+        and records its tokens under the upload id.  If the push is
+        interrupted, running it again only sends what the checkpoint doesn't
+        hold.  Unless an earlier attempt was kept, the first part is held
+        until the stream turns out to be bigger than one part; a smaller
+        stream is left to be inserted at once.
+
+        :return: The resume tokens and the byte stream to finish the insert
+            with.
+        """
+        client = self.target_repo._client
+        tokens, held_keys = checkpoint
+        if held_keys:
+            stream = self._skip_held_records(stream, held_keys)
+        segments = smart_repo._stream_to_byte_stream_segments(
+            stream, src_format, checkpoint_size)
+        if not tokens:
+            first = list(next(segments, []))
+            if not first:
+                return tokens, smart_repo._stream_to_byte_stream(
+                    [], src_format)
+            following = next(segments, None)
+            if following is None:
+                return tokens, first
+            segments = itertools.chain([first, following], segments)
+        for byte_stream in segments:
+            response = client.call_with_body_stream(
+                (b'Repository.insert_stream_checkpoint', path, upload_id,
+                 b' '.join(token.encode('utf-8') for token in tokens)) +
+                lock_args, byte_stream)
+            if response[0][0] != b'ok':
+                raise errors.UnexpectedSmartServerResponse(response)
+            tokens = [token.decode('utf-8')
+                      for token in bencode.bdecode(response[0][1])]
+        return tokens, smart_repo._stream_to_byte_stream([], src_format)
+
+    def _skip_held_records(self, stream, held_keys):
+        """Leave out of a stream the records the server already holds.
+
+        Records sharing the wire representation of a record left out are sent
+        as fulltexts instead.
+        """
+        for substream_kind, substream in stream:
+            if substream_kind == 'inventory-deltas':
+                held = held_keys.get('inventories', ())
+            else:
+                held = held_keys.get(substream_kind, ())
+            yield substream_kind, self._skip_held_substream(substream, held)
+
+    def _skip_held_substream(self, substream, held):
+        leader_skipped = False
+        for record in substream:
+            if not record.storage_kind.endswith('-ref'):
+                # This may carry the wire representation of the '-ref'
+                # records following it.
+                leader_skipped = record.key in held
+                if leader_skipped:
+                    continue
+            elif not leader_skipped:
+                # Sent along with its leader, even if held.
+                pass
+            elif record.key in held:
+                continue
+            else:
+                record = ChunkedContentFactory(
+                    record.key, record.parents, record.sha1,
+                    record.get_bytes_as('chunked'))
+            yield record
+
     def _resume_stream_with_vfs(self, response, src_format):
         """Resume sending a stream via VFS, first resending the record and
         substream that couldn't be sent via an insert_stream verb.
@@ -3432,11 +3715,16 @@ class RemoteBranchStore(_mod_config.IniFileStore):
         self.branch = branch
         self.id = "branch"
         self._real_store = None
+        # Read by RemoteBranch._prefetch_tip_and_config
+        self._prefetched_content = None
 
     def external_url(self):
         return urlutils.join(self.branch.user_url, 'branch.conf')
 
     def _load_content(self):
+        if self._prefetched_content is not None:
+            content, self._prefetched_content = self._prefetched_content, None
+            return content
         path = self.branch._remote_path()
         try:
             response, handler = self.branch._call_expecting_body(
@@ -3476,7 +3764,7 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
 
     def __init__(self, remote_bzrdir, remote_repository, real_branch=None,
                  _client=None, format=None, setup_stacking=True, name=None,
-                 possible_transports=None):
+                 possible_transports=None, _prefetched_state=None):
         """Create a RemoteBranch instance.
 
         :param real_branch: An optional local implementation of the branch
@@ -3489,6 +3777,9 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
             stacked (or not) status of the branch. If False assume the branch
             is not stacked.
         :param name: Colocated branch name
+        :param _prefetched_state: Private parameter, the ((revno, revision_id),
+            stacked_on_url, config_bytes, tags_bytes) of the branch as read by
+            BzrDir.open_branchV4.
         """
         # We intentionally don't call the parent class's __init__, because it
         # will try to assign to self.tags, which is a property in this subclass.
@@ -3524,6 +3815,16 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
         self._lock_count = 0
         self._leave_lock = False
         self.conf_store = None
+        # The tip and tags read when opening the branch, used as the cached
+        # state of the first read lock.
+        self._prefetched_state = None
+        stacked_on_url = None
+        if _prefetched_state is not None:
+            (last_revision_info, stacked_on_url, config,
+             tags_bytes) = _prefetched_state
+            self._prefetched_state = (last_revision_info, tags_bytes,
+                                      _branch_write_locks)
+            self._get_config_store()._prefetched_content = config
         # Setup a format: note that we cannot call _ensure_real until all the
         # attributes above are set: This code cannot be moved higher up in this
         # function.
@@ -3549,16 +3850,22 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
             hook(self)
         self._is_stacked = False
         if setup_stacking:
-            self._setup_stacking(possible_transports)
+            self._setup_stacking(possible_transports,
+                                 stacked_on_url=stacked_on_url)
 
-    def _setup_stacking(self, possible_transports):
+    def _setup_stacking(self, possible_transports, stacked_on_url=None):
         # configure stacking into the remote repository, by reading it from
-        # the vfs branch.
-        try:
-            fallback_url = self.get_stacked_on_url()
-        except (errors.NotStacked, branch.UnstackableBranchFormat,
-                errors.UnstackableRepositoryFormat) as e:
-            return
+        # the vfs branch, unless we already know it.
+        if stacked_on_url is not None:
+            if not stacked_on_url:
+                return
+            fallback_url = stacked_on_url
+        else:
+            try:
+                fallback_url = self.get_stacked_on_url()
+            except (errors.NotStacked, branch.UnstackableBranchFormat,
+                    errors.UnstackableRepositoryFormat) as e:
+                return
         self._is_stacked = True
         if possible_transports is None:
             possible_transports = []
@@ -3633,6 +3940,7 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
     def _clear_cached_state(self):
         super(RemoteBranch, self)._clear_cached_state()
         self._tags_bytes = None
+        self._prefetched_state = None
         if self._real_branch is not None:
             self._real_branch._clear_cached_state()
 
@@ -3647,6 +3955,7 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
         too, in fact doing so might harm performance.
         """
         super(RemoteBranch, self)._clear_cached_state()
+        self._prefetched_state = None
 
     @property
     def control_files(self):
@@ -3760,6 +4069,13 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
             self._note_lock('r')
             self._lock_mode = 'r'
             self._lock_count = 1
+            if self._prefetched_state is not None:
+                (last_revision_info, tags_bytes,
+                 write_locks) = self._prefetched_state
+                self._prefetched_state = None
+                if write_locks == _branch_write_locks:
+                    self._last_revision_info_cache = last_revision_info
+                    self._tags_bytes = tags_bytes
             if self._real_branch is not None:
                 self._real_branch.lock_read()
         else:
@@ -3790,8 +4106,12 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
         return branch_token, repo_token
 
     def lock_write(self, token=None):
+        global _branch_write_locks
         if not self._lock_mode:
             self._note_lock('w')
+            # The branch may have changed since it was opened.
+            self._prefetched_state = None
+            _branch_write_locks += 1
             # Lock the branch and repo in one remote call.
             remote_tokens = self._remote_lock_write(token)
             self._lock_token, self._repo_lock_token = remote_tokens
@@ -3911,6 +4231,9 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
     def _read_last_revision_info(self):
         response = self._call(
             b'Branch.last_revision_info', self._remote_path())
+        return self._parse_last_revision_info(response)
+
+    def _parse_last_revision_info(self, response):
         if response[0] != b'ok':
             raise SmartProtocolError(
                 'unexpected response code %s' % (response,))
@@ -4152,7 +4475,9 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
             # is the default one (tip + tags).  In this case it's cheaper to
             # just use the default implementation rather than a special RPC as
             # the tip and tags data is cached.
-            return branch.Branch.heads_to_fetch(self)
+            with self.lock_read():
+                self._prefetch_tip_and_config()
+                return branch.Branch.heads_to_fetch(self)
         medium = self._client._medium
         if medium._is_remote_before((2, 4)):
             return self._vfs_heads_to_fetch()
@@ -4162,6 +4487,33 @@ class RemoteBranch(branch.Branch, _RpcHelper, lock._RelockDebugMixin):
             medium._remember_remote_is_before((2, 4))
             return self._vfs_heads_to_fetch()
 
+    def _prefetch_tip_and_config(self):
+        """Read the tip and the configuration of the branch in one go.
+
+        The requests are pipelined, costing a single round trip. The results
+        are cached, so the branch must be locked.
+        """
+        path = self._remote_path()
+        calls = []
+        if self._last_revision_info_cache is None:
+            calls.append((b'Branch.last_revision_info', (path,), False))
+        store = self._get_config_store()
+        if not store.is_loaded():
+            calls.append((b'Branch.get_config_file', (path,), True))
+        if len(calls) < 2:
+            return
+        results = self._client.call_pipelined(calls)
+        for (verb, args, expect_body), result in zip(calls, results):
+            if isinstance(result, Exception):
+                # Leave it to the usual code path to deal with.
+                continue
+            response, body = result
+            if verb == b'Branch.last_revision_info':
+                self._last_revision_info_cache = (
+                    self._parse_last_revision_info(response))
+            elif response[:1] == (b'ok',):
+                store._prefetched_content = body
+
     def _rpc_heads_to_fetch(self):
         response = self._call(b'Branch.heads_to_fetch', self._remote_path())
         if len(response) != 2:
@@ -0,0 +1,497 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A smart server serving its connections from an asyncio event loop.
+
+SmartTCPServer runs a thread for every connection, so many clients (or many
+idle clients) mean many threads. AsyncSmartTCPServer instead reads from all
+its connections on a single event loop, and only hands a connection to a
+bounded pool of worker threads once a request starts arriving on it. Idle
+connections cost no thread at all.
+
+The server applies backpressure: it stops reading from a client that sent
+more than ``_MAX_BUFFER`` bytes its request has not consumed yet, and a
+worker writing a response waits for the client to read it before sending
+more. It can also limit how many requests of a single client host are served
+at once, so one client cannot take all the workers.
+"""
+
+import asyncio
+import collections
+from concurrent import futures
+import socket
+import sys
+import threading
+
+from ... import (
+    debug,
+    errors,
+    osutils,
+    trace,
+    )
+from ...i18n import gettext
+from . import (
+    medium,
+    request,
+    server,
+    signals,
+    )
+
+
+class SmartServerEventLoopMedium(medium.SmartServerStreamMedium,
+                                 asyncio.Protocol):
+    """A connection of an AsyncSmartTCPServer.
+
+    The event loop feeds the bytes received into this medium, and a worker
+    thread serves one request at a time from them.
+    """
+
+    def __init__(self, smart_server, backing_transport, root_client_path='/',
+                 timeout=None):
+        medium.SmartServerStreamMedium.__init__(
+            self, backing_transport, root_client_path=root_client_path,
+            timeout=timeout)
+        self._server = smart_server
+        self._loop = smart_server._loop
+        self._transport = None
+        self._client_info = '<unknown>'
+        self._cond = threading.Condition()
+        self._chunks = collections.deque()
+        self._buffered = 0
+        self._eof = False
+        self._closed = False
+        self._reading_paused = False
+        self._drain_waiter = None
+        self._idle_handle = None
+        # Whether a request of this connection is being served, or waiting
+        # for a worker. Only used from the event loop.
+        self.scheduled = False
+
+    def __str__(self):
+        return '%s(client=%s)' % (self.__class__.__name__, self._client_info)
+
+    def __repr__(self):
+        return '%s.%s(client=%s)' % (self.__module__, self.__class__.__name__,
+                                     self._client_info)
+
+    @property
+    def client_host(self):
+        if isinstance(self._client_info, tuple):
+            return self._client_info[0]
+        return self._client_info
+
+    # The asyncio.Protocol interface, called from the event loop.
+
+    def connection_made(self, transport):
+        self._transport = transport
+        peername = transport.get_extra_info('peername')
+        if peername is not None:
+            self._client_info = peername
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (OSError, AttributeError):
+                pass
+        self._server._connection_made(self)
+
+    def data_received(self, data):
+        with self._cond:
+            self._chunks.append(data)
+            self._buffered += len(data)
+            self._cond.notify_all()
+            pause = (self._buffered > self._server._MAX_BUFFER and
+                     not self._reading_paused)
+            if pause:
+                self._reading_paused = True
+        if pause:
+            self._transport.pause_reading()
+        self._server._data_received(self)
+
+    def eof_received(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+        # Keep the connection open to send the response to a request in
+        # progress, the server closes it once that is done.
+        return self.scheduled
+
+    def connection_lost(self, exc):
+        with self._cond:
+            self._eof = True
+            self._closed = True
+            self._cond.notify_all()
+        self._wake_writer()
+        self._server._connection_lost(self)
+
+    def pause_writing(self):
+        if self._drain_waiter is None:
+            self._drain_waiter = self._loop.create_future()
+
+    def resume_writing(self):
+        self._wake_writer()
+
+    def _wake_writer(self):
+        waiter, self._drain_waiter = self._drain_waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def has_input(self):
+        """Are there bytes left to serve?"""
+        with self._cond:
+            return bool(self._chunks) or self._push_back_buffer is not None
+
+    def close(self, abort=False):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+        if self._transport is not None:
+            if abort:
+                self._transport.abort()
+            else:
+                self._transport.close()
+
+    def wait_for_request(self):
+        """Hang up if no request arrives within the client timeout."""
+        self._idle_handle = self._loop.call_later(
+            self._client_timeout, self._idle_timeout)
+
+    def request_arrived(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _idle_timeout(self):
+        self._idle_handle = None
+        e = errors.ConnectionTimeout(
+            'disconnecting client after %.1f seconds'
+            % (self._client_timeout,))
+        trace.note('%s' % (e,))
+        self.close()
+
+    async def _write(self, data):
+        if self._closed or self._transport.is_closing():
+            raise errors.ConnectionReset(
+                'Error writing to %s' % (self,), 'connection closed')
+        self._transport.write(data)
+        if self._drain_waiter is not None:
+            await self._drain_waiter
+
+    # The SmartServerStreamMedium interface, called from a worker thread.
+
+    def serve_one(self):
+        """Serve one request of the client."""
+        try:
+            protocol = self._build_protocol()
+            self._serve_one_request(protocol)
+        except errors.ConnectionTimeout as e:
+            trace.note('%s' % (e,))
+            trace.log_exception_quietly()
+            self.finished = True
+
+    def _serve_one_request_unguarded(self, protocol):
+        while protocol.next_read_size():
+            bytes = self.read_bytes(osutils.MAX_SOCKET_CHUNK)
+            if bytes == b'':
+                self.finished = True
+                return
+            protocol.accept_bytes(bytes)
+
+        self._push_back(protocol.unused_data)
+
+    def _wait_for_bytes_with_timeout(self, timeout_seconds):
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._chunks or self._eof or self.finished,
+                    timeout_seconds):
+                raise errors.ConnectionTimeout(
+                    'disconnecting client after %.1f seconds'
+                    % (timeout_seconds,))
+
+    def _read_bytes(self, desired_count):
+        with self._cond:
+            # A client stalling in the middle of a request must not hold a
+            # worker forever.
+            if not self._cond.wait_for(lambda: self._chunks or self._eof,
+                                       self._client_timeout):
+                raise errors.ConnectionTimeout(
+                    'disconnecting client after %.1f seconds'
+                    % (self._client_timeout,))
+            if not self._chunks:
+                return b''
+            data = self._chunks.popleft()
+            if len(data) > desired_count:
+                self._chunks.appendleft(data[desired_count:])
+                data = data[:desired_count]
+            self._buffered -= len(data)
+            resume = (self._reading_paused and
+                      self._buffered <= self._server._MAX_BUFFER // 2)
+            if resume:
+                self._reading_paused = False
+        if resume:
+            self._loop.call_soon_threadsafe(self._resume_reading)
+        self._report_activity(len(data), 'read')
+        return data
+
+    def _resume_reading(self):
+        if not self._transport.is_closing():
+            self._transport.resume_reading()
+
+    def _write_out(self, bytes):
+        tstart = osutils.perf_counter()
+        future = asyncio.run_coroutine_threadsafe(self._write(bytes),
+                                                  self._loop)
+        while True:
+            try:
+                future.result(self._client_poll_timeout)
+            except futures.TimeoutError:
+                if self._closed:
+                    future.cancel()
+                    raise errors.ConnectionReset(
+                        'Error writing to %s' % (self,), 'connection closed')
+            else:
+                break
+        self._report_activity(len(bytes), 'write')
+        if 'hpss' in debug.debug_flags:
+            trace.mutter('%12s: [%s] %d bytes to the socket in %.3fs'
+                         % ('wrote', threading.current_thread().name,
+                            len(bytes), osutils.perf_counter() - tstart))
+
+    def _disconnect_client(self):
+        self._loop.call_soon_threadsafe(self.close)
+
+    def terminate_due_to_error(self):
+        self.finished = True
+        self._disconnect_client()
+
+
+class AsyncSmartTCPServer(server.SmartTCPServer):
+    """Listens on a TCP socket and serves smart clients from an event loop.
+
+    The requests are served by a pool of at most max_workers threads.
+    """
+
+    # The number of bytes received from a client that are not consumed by
+    # its request yet, above which we stop reading from it.
+    _MAX_BUFFER = 1024 * 1024
+    _BACKLOG = 128
+
+    def __init__(self, backing_transport, root_client_path='/',
+                 client_timeout=None, max_workers=16,
+                 max_requests_per_client=None):
+        """Construct a new server.
+
+        :param max_workers: The number of threads serving requests.
+        :param max_requests_per_client: The number of requests from a single
+            client host that are served at once, or None for no limit.
+        """
+        super(AsyncSmartTCPServer, self).__init__(
+            backing_transport, root_client_path=root_client_path,
+            client_timeout=client_timeout)
+        self.max_workers = max_workers
+        self.max_requests_per_client = max_requests_per_client
+        self._loop = None
+        self._connections = set()
+        # Requests being served, per client host
+        self._running = {}
+        # Connections with a request waiting for the per client limit
+        self._waiting = {}
+        self._requests_done = None
+
+    def _make_medium(self):
+        return SmartServerEventLoopMedium(
+            self, self.backing_transport, self.root_client_path,
+            timeout=self._client_timeout)
+
+    def serve(self, thread_name_suffix=''):
+        # See SmartTCPServer.serve for why we keep a reference to the method.
+        stop_gracefully = self._stop_gracefully
+        signals.register_on_hangup(id(self), stop_gracefully)
+        self._should_terminate = False
+        self._loop = asyncio.new_event_loop()
+        self._executor = futures.ThreadPoolExecutor(
+            self.max_workers,
+            thread_name_prefix='smart-server-worker' + thread_name_suffix)
+        try:
+            self._loop.run_until_complete(self._serve())
+        except KeyboardInterrupt:
+            # dont log when CTRL-C'd.
+            raise
+        except Exception:
+            trace.report_exception(sys.exc_info(), sys.stderr)
+            raise
+        finally:
+            for conn in list(self._connections):
+                conn.finished = True
+                conn.close(abort=True)
+            # Let the connections see they are closed
+            self._loop.run_until_complete(asyncio.sleep(0))
+            self._loop.close()
+            self._executor.shutdown()
+        self._fully_stopped.set()
+
+    async def _serve(self):
+        self._stop_requested = asyncio.Event()
+        self._requests_done = asyncio.Event()
+        self._requests_done.set()
+        listener = await self._loop.create_server(
+            self._make_medium, sock=self._server_socket,
+            backlog=self._BACKLOG)
+        try:
+            if not self._should_terminate:
+                self.run_server_started_hooks()
+                self._started.set()
+                await self._stop_requested.wait()
+        finally:
+            listener.close()
+            self._stopped.set()
+            signals.unregister_on_hangup(id(self))
+            self.run_server_stopped_hooks()
+        if self._gracefully_stopping:
+            await self._wait_for_requests()
+
+    async def _wait_for_requests(self):
+        if self._requests_done.is_set():
+            return
+        trace.note(gettext('Waiting for %d client(s) to finish')
+                   % (self._active_requests(),))
+        while True:
+            try:
+                await asyncio.wait_for(self._requests_done.wait(),
+                                       self._LOG_WAITING_TIMEOUT)
+            except asyncio.TimeoutError:
+                trace.note(gettext('Still waiting for %d client(s) to finish')
+                           % (self._active_requests(),))
+            else:
+                break
+
+    def _active_requests(self):
+        return (sum(self._running.values()) +
+                sum(len(waiting) for waiting in self._waiting.values()))
+
+    def _request_stop(self, gracefully):
+        for conn in list(self._connections):
+            if gracefully:
+                conn._stop_gracefully()
+            else:
+                conn.finished = True
+            if not conn.scheduled:
+                conn.close()
+        self._stop_requested.set()
+
+    def _stop_gracefully(self):
+        trace.note(gettext('Requested to stop gracefully'))
+        self._should_terminate = True
+        self._gracefully_stopping = True
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._request_stop, True)
+
+    def stop_background_thread(self):
+        self._should_terminate = True
+        if self._loop is not None and not self._loop.is_closed():
+            try:
+                self._loop.call_soon_threadsafe(self._request_stop, False)
+            except RuntimeError:
+                # The loop closed meanwhile
+                pass
+        self._server_thread.join()
+
+    def start_background_thread(self, thread_name_suffix=''):
+        self._started.clear()
+        self._server_thread = threading.Thread(
+            None, self.serve, args=(thread_name_suffix,),
+            name='server-' + self.get_url(),
+            daemon=True)
+        self._server_thread.start()
+        # Wait for the server to start, or to fail starting.
+        while not self._started.wait(0.1):
+            if not self._server_thread.is_alive():
+                break
+
+    # Called from the event loop
+
+    def _connection_made(self, conn):
+        self._connections.add(conn)
+        if request.server_stats is not None:
+            request.server_stats.connection_opened()
+        if self._should_terminate:
+            conn.close()
+        else:
+            conn.wait_for_request()
+
+    def _connection_lost(self, conn):
+        self._connections.discard(conn)
+        if request.server_stats is not None:
+            request.server_stats.connection_closed()
+        conn.request_arrived()
+        waiting = self._waiting.get(conn.client_host)
+        if waiting and conn in waiting:
+            waiting.remove(conn)
+            self._check_requests_done()
+
+    def _data_received(self, conn):
+        conn.request_arrived()
+        if not conn.scheduled:
+            self._schedule(conn)
+
+    def _schedule(self, conn):
+        conn.scheduled = True
+        self._requests_done.clear()
+        host = conn.client_host
+        if (self._waiting.get(host) or (
+                self.max_requests_per_client is not None and
+                self._running.get(host, 0) >= self.max_requests_per_client)):
+            self._waiting.setdefault(host, collections.deque()).append(conn)
+        else:
+            self._submit(conn)
+
+    def _submit(self, conn):
+        host = conn.client_host
+        self._running[host] = self._running.get(host, 0) + 1
+        future = self._loop.run_in_executor(self._executor, conn.serve_one)
+        future.add_done_callback(
+            lambda future: self._request_finished(conn, future))
+
+    def _request_finished(self, conn, future):
+        host = conn.client_host
+        self._running[host] -= 1
+        if not self._running[host]:
+            del self._running[host]
+        conn.scheduled = False
+        if not future.cancelled() and future.exception() is not None:
+            e = future.exception()
+            trace.mutter('%s terminating on exception %s' % (conn, e))
+            conn.finished = True
+        waiting = self._waiting.get(host)
+        while waiting and (
+                self.max_requests_per_client is None or
+                self._running.get(host, 0) < self.max_requests_per_client):
+            self._submit(waiting.popleft())
+        if not waiting:
+            self._waiting.pop(host, None)
+        if conn.finished or conn._closed:
+            conn.close()
+        elif conn.has_input():
+            self._schedule(conn)
+        elif conn._eof:
+            conn.close()
+        else:
+            conn.wait_for_request()
+        self._check_requests_done()
+
+    def _check_requests_done(self):
+        if not self._active_requests():
+            self._requests_done.set()
@@ -212,6 +212,11 @@ class SmartServerRequestRevisionHistory(SmartServerBranchRequest):
 
 class SmartServerBranchRequestLastRevisionInfo(SmartServerBranchRequest):
 
+    def cache_generation(self, path):
+        # Only branches storing their tip in last-revision are cached, as
+        # the tip of older branches is their whole revision history.
+        return self._control_file_generation(path, '.bzr/branch/last-revision')
+
     def do_with_branch(self, branch):
         """Return branch.last_revision_info().
 
@@ -22,6 +22,7 @@ from ... import (
     branch,
     errors,
     repository,
+    transport as _mod_transport,
     urlutils,
     )
 from .. import (
@@ -622,8 +623,7 @@ class SmartServerRequestOpenBranchV3(SmartServerRequestBzrDir):
             reference_url = self._bzrdir.get_branch_reference()
             if reference_url is None:
                 br = self._bzrdir.open_branch(ignore_fallbacks=True)
-                format = br._format.network_name()
-                return SuccessfulSmartServerResponse((b'branch', format))
+                return self._branch_response(br)
             else:
                 return SuccessfulSmartServerResponse((b'ref', reference_url.encode('utf-8')))
         except errors.NotBranchError as e:
@@ -637,3 +637,53 @@ class SmartServerRequestOpenBranchV3(SmartServerRequestBzrDir):
                     detail = detail[2:]
                 resp += (detail.encode('utf-8'),)
             return FailedSmartServerResponse(resp)
+
+    def _branch_response(self, br):
+        format = br._format.network_name()
+        return SuccessfulSmartServerResponse((b'branch', format))
+
+
+class SmartServerRequestOpenBranchV4(SmartServerRequestOpenBranchV3):
+
+    def _branch_response(self, br):
+        """Return what opening the branch for a pull or a push needs.
+
+        New in 3.3.
+
+        Differences to SmartServerRequestOpenBranchV3: the 'branch' response
+        also has everything the client would otherwise ask with separate
+        requests once the branch is opened.
+
+        :return: ('branch', branch_network_name, revno, revision_id,
+            stacked_on_url, repo_relpath, rich_root, tree_ref,
+            external_lookup, repo_network_name), with a body of the bencoded
+            list [config_bytes, tags_bytes]. stacked_on_url is empty if the
+            branch is not stacked, tags_bytes is empty if the branch does not
+            support tags.
+        """
+        with br.lock_read():
+            revno, last_revision = br.last_revision_info()
+            try:
+                stacked_on_url = br.get_stacked_on_url()
+            except (errors.NotStacked, branch.UnstackableBranchFormat,
+                    errors.UnstackableRepositoryFormat):
+                stacked_on_url = ''
+            try:
+                config = br.control_transport.get_bytes('branch.conf')
+            except _mod_transport.NoSuchFile:
+                config = b''
+            if br.supports_tags():
+                tags = br._get_tags_bytes()
+            else:
+                tags = b''
+        repo_path = self._repo_relpath(self._bzrdir.root_transport,
+                                       br.repository)
+        rich_root, tree_ref, external_lookup = self._format_to_capabilities(
+            br.repository._format)
+        return SuccessfulSmartServerResponse((
+            b'branch', br._format.network_name(),
+            str(revno).encode('ascii'), last_revision,
+            stacked_on_url.encode('utf-8'), repo_path.encode('utf-8'),
+            rich_root, tree_ref, external_lookup,
+            br.repository._format.network_name()),
+            body=bencode.bencode([config, tags]))
@@ -16,6 +16,7 @@
 
 from ... import lazy_import
 lazy_import.lazy_import(globals(), """
+from breezy import config
 from breezy.bzr.smart import request as _mod_request
 """)
 
@@ -40,6 +41,8 @@ class _SmartClient(object):
         if headers is None:
             self._headers = {
                 b'Software version': breezy.__version__.encode('utf-8')}
+            if config.GlobalStack().get('smart.body_compression'):
+                self._headers[b'Accept-Encoding'] = protocol.BODY_ENCODINGS
         else:
             self._headers = dict(headers)
 
@@ -107,6 +110,86 @@ class _SmartClient(object):
             expect_response_body=False)
         return (response, response_handler)
 
+    def call_pipelined(self, calls):
+        """Make several independent calls, sending them all at once.
+
+        On mediums supporting it, all the requests are sent before reading
+        the responses, which the server sends back in order. The calls then
+        take a single round trip rather than one each. Otherwise, the calls
+        are made one after the other.
+
+        :param calls: A sequence of (method, args, expect_body) tuples. No
+            call may depend on the result of another one.
+        :return: A list with, for each call, either the (response_tuple,
+            body_bytes) it got, body_bytes being None if expect_body was
+            False, or the ErrorFromSmartServer or UnknownSmartMethod it
+            failed with.
+        """
+        calls = list(calls)
+        results = []
+        medium = self._medium
+        if calls and medium._remote_supports_pipelining is None:
+            # The first call finds out whether the server supports pipelining
+            results.append(self._call_for_pipeline(*calls.pop(0)))
+        if (len(calls) < 2 or not medium.supports_pipelining or
+                not medium._remote_supports_pipelining or
+                medium._protocol_version != 3):
+            results.extend(self._call_for_pipeline(*call) for call in calls)
+            return results
+        handlers = []
+        pipelined_results = []
+        try:
+            with medium.pipeline():
+                for method, args, expect_body in calls:
+                    request = _SmartClientRequest(self, method, args)
+                    request._run_call_hooks()
+                    encoder, response_handler = request._construct_protocol(
+                        3)
+                    request._send_no_retry(encoder)
+                    handlers.append(response_handler)
+            for response_handler, call in zip(handlers, calls):
+                pipelined_results.append(
+                    self._read_pipelined_response(response_handler, call[2]))
+        except errors.ConnectionReset:
+            medium.reset()
+            remaining = calls[len(pipelined_results):]
+            if 'noretry' in debug.debug_flags or not all(
+                    _SmartClientRequest(self, method, args)
+                    ._is_safe_to_send_twice()
+                    for method, args, expect_body in remaining):
+                raise
+            trace.warning('ConnectionReset during pipelined calls, retrying')
+            trace.log_exception_quietly()
+            pipelined_results.extend(
+                self._call_for_pipeline(*call) for call in remaining)
+        except BaseException:
+            # The responses left unread are in the way of the next requests.
+            medium.reset()
+            raise
+        return results + pipelined_results
+
+    def _call_for_pipeline(self, method, args, expect_body):
+        try:
+            if expect_body:
+                response, response_handler = self.call_expecting_body(
+                    method, *args)
+                return response, response_handler.read_body_bytes()
+            return self.call(method, *args), None
+        except (errors.ErrorFromSmartServer,
+                errors.UnknownSmartMethod) as e:
+            return e
+
+    def _read_pipelined_response(self, response_handler, expect_body):
+        try:
+            response = response_handler.read_response_tuple(
+                expect_body=expect_body)
+        except (errors.ErrorFromSmartServer,
+                errors.UnknownSmartMethod) as e:
+            return e
+        if expect_body:
+            return response, response_handler.read_body_bytes()
+        return response, None
+
     def remote_path_from_transport(self, transport):
         """Convert transport into a path suitable for using in a request.
 
@@ -242,6 +325,10 @@ class _SmartClientRequest(object):
         request = self.client._medium.get_request()
         if version == 3:
             request_encoder = protocol.ProtocolThreeRequester(request)
+            if b'Accept-Encoding' in self.client._headers:
+                # Clients that accept compressed bodies compress theirs too.
+                request_encoder.negotiate_body_encoding(
+                    self.client._medium._remote_accept_encoding)
             response_handler = message.ConventionalResponseHandler()
             response_proto = protocol.ProtocolThreeDecoder(
                 response_handler, expect_version_marker=True)
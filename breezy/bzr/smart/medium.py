@@ -24,6 +24,8 @@ over SSH), and pass them to and from the protocol logic.  See the overview in
 breezy/transport/smart/__init__.py.
 """
 
+import collections
+import contextlib
 import errno
 import io
 import os
@@ -242,11 +244,20 @@ class SmartServerStreamMedium(SmartMedium):
         self._client_poll_timeout = min(timeout / 10.0, 1.0)
         SmartMedium.__init__(self)
 
+    def _report_activity(self, bytes, direction):
+        SmartMedium._report_activity(self, bytes, direction)
+        stats = request.server_stats
+        if stats is not None:
+            stats.bytes_transferred(bytes, direction)
+
     def serve(self):
         """Serve requests until the client disconnects."""
         # Keep a reference to stderr because the sys module's globals get set to
         # None during interpreter shutdown.
         from sys import stderr
+        stats = request.server_stats
+        if stats is not None:
+            stats.connection_opened()
         try:
             while not self.finished:
                 server_protocol = self._build_protocol()
@@ -260,6 +271,9 @@ class SmartServerStreamMedium(SmartMedium):
         except Exception as e:
             stderr.write("%s terminating on exception %s\n" % (self, e))
             raise
+        finally:
+            if stats is not None:
+                stats.connection_closed()
         self._disconnect_client()
 
     def _stop_gracefully(self):
@@ -294,7 +308,10 @@ class SmartServerStreamMedium(SmartMedium):
 
         :returns: a SmartServerRequestProtocol.
         """
-        self._wait_for_bytes_with_timeout(self._client_timeout)
+        if self._push_back_buffer is None:
+            # Otherwise a pipelined request was read along with the previous
+            # one, there may be nothing more to read from the client.
+            self._wait_for_bytes_with_timeout(self._client_timeout)
         if self.finished:
             # We're stopping, so don't try to do any more work
             return None
@@ -749,6 +766,10 @@ _vfs_refuser = None
 class SmartClientMedium(SmartMedium):
     """Smart client is a medium for sending smart protocol requests over."""
 
+    # Whether requests can be sent before the responses to the previous ones
+    # are read, see SmartClientStreamMedium.pipeline.
+    supports_pipelining = False
+
     def __init__(self, base):
         super(SmartClientMedium, self).__init__()
         self.base = base
@@ -760,6 +781,12 @@ class SmartClientMedium(SmartMedium):
         # _remote_version_is_before tracks the bzr version the remote side
         # can be based on what we've seen so far.
         self._remote_version_is_before = None
+        # Whether the server serves requests sent before it answered the
+        # previous ones, None until a response told us.
+        self._remote_supports_pipelining = None
+        # The body encodings the server can decode, as in the Accept-Encoding
+        # header of its responses.
+        self._remote_accept_encoding = None
         # Install debug hook function if debug flag is set.
         if 'hpss' in debug.debug_flags:
             global _debug_counter
@@ -878,13 +905,34 @@ class SmartClientStreamMedium(SmartClientMedium):
     receive bytes.
     """
 
+    # The server answers the requests sent on a stream in order.
+    supports_pipelining = True
+
     def __init__(self, base):
         SmartClientMedium.__init__(self, base)
         self._current_request = None
+        # Requests sent while _current_request is being read, see pipeline()
+        self._pipelined_requests = collections.deque()
+        self._pipelining = False
 
     def accept_bytes(self, bytes):
         self._accept_bytes(bytes)
 
+    @contextlib.contextmanager
+    def pipeline(self):
+        """Allow sending requests before the responses to the previous ones.
+
+        Within this context, a new request can be started once the previous
+        one finished writing. The responses must still be read in the order
+        the requests were sent, each request reading its response once the
+        previous one finished reading.
+        """
+        self._pipelining = True
+        try:
+            yield
+        finally:
+            self._pipelining = False
+
     def __del__(self):
         """The SmartClientStreamMedium knows how to close the stream when it is
         finished with it.
@@ -899,6 +947,11 @@ class SmartClientStreamMedium(SmartClientMedium):
         """
         raise NotImplementedError(self._flush)
 
+    def _last_request(self):
+        if self._pipelined_requests:
+            return self._pipelined_requests[-1]
+        return self._current_request
+
     def get_request(self):
         """See SmartClientMedium.get_request().
 
@@ -914,6 +967,8 @@ class SmartClientStreamMedium(SmartClientMedium):
         """
         self.disconnect()
         self._current_request = None
+        self._pipelined_requests.clear()
+        self._push_back_buffer = None
 
 
 class SmartSimplePipesClientMedium(SmartClientStreamMedium):
@@ -1199,9 +1254,13 @@ class SmartClientStreamMediumRequest(SmartClientMediumRequest):
         # assert should be moved to SmartClientStreamMedium.get_request,
         # and the setting/unsetting of _current_request likewise moved into
         # that class : but its unneeded overhead for now. RBC 20060922
-        if self._medium._current_request is not None:
+        if self._medium._current_request is None:
+            self._medium._current_request = self
+        elif (self._medium._pipelining and
+                self._medium._last_request()._state != "writing"):
+            self._medium._pipelined_requests.append(self)
+        else:
             raise TooManyConcurrentRequests(self._medium)
-        self._medium._current_request = self
 
     def _accept_bytes(self, bytes):
         """See SmartClientMediumRequest._accept_bytes.
@@ -1219,7 +1278,19 @@ class SmartClientStreamMediumRequest(SmartClientMediumRequest):
         """
         if self._medium._current_request is not self:
             raise AssertionError()
-        self._medium._current_request = None
+        if self._medium._pipelined_requests:
+            self._medium._current_request = (
+                self._medium._pipelined_requests.popleft())
+        else:
+            self._medium._current_request = None
+
+    def _read_bytes(self, count):
+        if self._medium._current_request is not self:
+            # The response of an earlier pipelined request comes first.
+            raise AssertionError(
+                '%r reading before the response of %r was read'
+                % (self, self._medium._current_request))
+        return self._medium.read_bytes(count)
 
     def _finished_writing(self):
         """See SmartClientMediumRequest._finished_writing.
@@ -107,6 +107,11 @@ class ConventionalRequestHandler(MessageHandler):
         self._should_finish_body = False
         self._response_sent = False
 
+    def headers_received(self, headers):
+        MessageHandler.headers_received(self, headers)
+        self.responder.negotiate_body_encoding(
+            headers.get(b'Accept-Encoding'))
+
     def protocol_error(self, exception):
         if self.responder.response_sent:
             # We can only send one response to a request, no matter how many
@@ -231,6 +236,14 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
         self._protocol_decoder = protocol_decoder
         self._medium_request = medium_request
 
+    def headers_received(self, headers):
+        MessageHandler.headers_received(self, headers)
+        medium = getattr(self._medium_request, '_medium', None)
+        if medium is not None:
+            medium._remote_supports_pipelining = (
+                headers.get(b'Pipelining') == b'yes')
+            medium._remote_accept_encoding = headers.get(b'Accept-Encoding')
+
     def byte_part_received(self, byte):
         if not isinstance(byte, bytes):
             raise TypeError(byte)
@@ -281,6 +294,10 @@ class ConventionalResponseHandler(MessageHandler, ResponseHandler):
         next_read_size = self._protocol_decoder.next_read_size()
         if next_read_size == 0:
             # a complete request has been read.
+            unused_data = self._protocol_decoder.unused_data
+            if unused_data:
+                # The start of the response to the next pipelined request.
+                self._medium_request._medium._push_back(unused_data)
             self.finished_reading = True
             self._medium_request.finished_reading()
             return
@@ -0,0 +1,312 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""A smart server serving its clients from several worker processes.
+
+A single server process cannot use more than one core for CPU heavy requests,
+such as Repository.get_stream, because of the GIL. PreforkSmartTCPServer
+forks worker processes which all accept connections on the listening socket
+of the server, and serve them like SmartTCPServer does.
+
+The parent process keeps the configured number of workers running:
+
+ * A worker that served its maximum number of requests stops accepting
+   connections, finishes serving its clients and exits, and is replaced.
+ * SIGUSR1 reloads the workers in the same way: they finish serving their
+   clients while new workers, forked from the parent, take the new
+   connections.
+ * SIGHUP stops the server gracefully, workers finishing their clients first.
+
+This needs os.fork, so it is not available on Windows.
+"""
+
+import errno
+import os
+import signal
+import sys
+import threading
+import time
+
+from ... import (
+    errors,
+    trace,
+    )
+from ...i18n import gettext
+from . import (
+    medium,
+    server,
+    signals,
+    )
+
+
+class PreforkNotSupported(errors.BzrError):
+
+    _fmt = "Serving with worker processes is not supported on %(platform)s."
+
+    def __init__(self, platform):
+        errors.BzrError.__init__(self, platform=platform)
+
+
+class _WorkerSocketStreamMedium(medium.SmartServerSocketStreamMedium):
+    """A connection of a worker, counting the requests it serves."""
+
+    def __init__(self, worker, sock, backing_transport, root_client_path='/',
+                 timeout=None):
+        super(_WorkerSocketStreamMedium, self).__init__(
+            sock, backing_transport, root_client_path=root_client_path,
+            timeout=timeout)
+        self._worker = worker
+
+    def _serve_one_request(self, protocol):
+        super(_WorkerSocketStreamMedium, self)._serve_one_request(protocol)
+        if protocol is not None:
+            self._worker._request_served()
+
+
+class _PreforkWorker(server.SmartTCPServer):
+    """The server running in a worker process.
+
+    It accepts connections on the listening socket of the parent server.
+    """
+
+    def __init__(self, parent, max_requests=None):
+        super(_PreforkWorker, self).__init__(
+            parent.backing_transport, root_client_path=parent.root_client_path,
+            client_timeout=parent._client_timeout)
+        self._ACCEPT_TIMEOUT = parent._ACCEPT_TIMEOUT
+        self._server_socket = parent._server_socket
+        self._sockname = parent._sockname
+        self.port = parent.port
+        self._socket_error = parent._socket_error
+        self._socket_timeout = parent._socket_timeout
+        self._started = threading.Event()
+        self._stopped = threading.Event()
+        self._fully_stopped = threading.Event()
+        self.max_requests = max_requests
+        self.requests_served = 0
+        self._lock = threading.Lock()
+
+    def serve(self, thread_name_suffix=''):
+        """Serve clients until asked to stop or retired.
+
+        Unlike SmartTCPServer.serve, this serves the connections accepted
+        while stopping, as other workers are still listening: the clients
+        are connected and should not be turned away.
+        """
+        self._should_terminate = False
+        self._started.set()
+        while not self._should_terminate:
+            try:
+                conn, client_addr = self._server_socket.accept()
+            except self._socket_timeout:
+                pass
+            except self._socket_error as e:
+                if e.args[0] not in (errno.EBADF, errno.EINTR):
+                    trace.warning(gettext("listening socket error: %s")
+                                  % (e,))
+            else:
+                self.serve_conn(conn, thread_name_suffix)
+                if self._gracefully_stopping:
+                    handler, _ = self._active_connections[-1]
+                    handler._stop_gracefully()
+            self._poll_active_connections()
+        self._server_socket.close()
+        self._stopped.set()
+        self._wait_for_clients_to_disconnect()
+        self._fully_stopped.set()
+
+    def _make_handler(self, conn):
+        return _WorkerSocketStreamMedium(
+            self, conn, self.backing_transport, self.root_client_path,
+            timeout=self._client_timeout)
+
+    def _request_served(self):
+        with self._lock:
+            self.requests_served += 1
+            if (self.max_requests is None or
+                    self.requests_served < self.max_requests or
+                    self._should_terminate):
+                return
+        trace.mutter('worker %d served %d requests, retiring'
+                     % (os.getpid(), self.requests_served))
+        self.retire()
+
+    def retire(self):
+        """Accept no more connections, and exit once our clients are done."""
+        self._should_terminate = True
+
+
+class PreforkSmartTCPServer(server.SmartTCPServer):
+    """Listens on a TCP socket, serving clients from worker processes."""
+
+    # How often the parent checks on its workers.
+    _POLL_INTERVAL = 0.5
+    _BACKLOG = 128
+
+    def __init__(self, backing_transport, root_client_path='/',
+                 client_timeout=None, workers=2, max_requests=None):
+        """Construct a new server.
+
+        :param workers: The number of worker processes.
+        :param max_requests: The number of requests a worker serves before it
+            is replaced by a new one, or None to keep workers forever.
+        """
+        if getattr(os, 'fork', None) is None:
+            raise PreforkNotSupported(sys.platform)
+        super(PreforkSmartTCPServer, self).__init__(
+            backing_transport, root_client_path=root_client_path,
+            client_timeout=client_timeout)
+        self.workers = workers
+        self.max_requests = max_requests
+        # The workers accepting connections
+        self._workers = set()
+        # The workers finishing their clients before exiting
+        self._retiring = set()
+        self._reload_requested = False
+
+    def start_server(self, host, port):
+        super(PreforkSmartTCPServer, self).start_server(host, port)
+        # Connections queue up while workers are being replaced
+        self._server_socket.listen(self._BACKLOG)
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self._workers.add(pid)
+            trace.mutter('started smart server worker %d' % (pid,))
+            return pid
+        status = 0
+        try:
+            self._run_worker()
+        except BaseException:
+            trace.log_exception_quietly()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        """Serve clients until asked to stop or recycled, in the worker."""
+        worker = _PreforkWorker(self, max_requests=self.max_requests)
+
+        def stop_gracefully(signum, frame):
+            worker._stop_gracefully()
+
+        def retire(signum, frame):
+            worker.retire()
+        signal.signal(signal.SIGHUP, stop_gracefully)
+        signal.signal(signal.SIGUSR1, retire)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        worker.serve('-worker-%d' % (os.getpid(),))
+
+    def _reap_workers(self):
+        for pid in list(self._workers | self._retiring):
+            try:
+                finished, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                finished, status = pid, 0
+            if finished:
+                self._workers.discard(pid)
+                self._retiring.discard(pid)
+                trace.mutter('smart server worker %d exited with status %d'
+                             % (pid, status))
+
+    def _signal_workers(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _retire_workers(self, signum):
+        self._signal_workers(self._workers, signum)
+        self._retiring.update(self._workers)
+        self._workers.clear()
+
+    def reload(self):
+        """Replace the workers, letting them finish serving their clients."""
+        self._reload_requested = True
+
+    def _stop_gracefully(self):
+        trace.note(gettext('Requested to stop gracefully'))
+        self._should_terminate = True
+        self._gracefully_stopping = True
+
+    def _install_reload_handler(self):
+        if (getattr(signal, 'SIGUSR1', None) is None or
+                threading.current_thread() is not threading.main_thread()):
+            return None
+
+        def reload(signum, frame):
+            trace.note(gettext('Requested to reload the workers'))
+            self.reload()
+        return signal.signal(signal.SIGUSR1, reload)
+
+    def serve(self, thread_name_suffix=''):
+        # See SmartTCPServer.serve for why we keep a reference to the method.
+        stop_gracefully = self._stop_gracefully
+        signals.register_on_hangup(id(self), stop_gracefully)
+        old_reload_handler = self._install_reload_handler()
+        self._should_terminate = False
+        self.run_server_started_hooks()
+        self._started.set()
+        try:
+            while not self._should_terminate:
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self._retire_workers(signal.SIGUSR1)
+                self._reap_workers()
+                while (len(self._workers) < self.workers and
+                       not self._should_terminate):
+                    self._spawn_worker()
+                time.sleep(self._POLL_INTERVAL)
+        finally:
+            if old_reload_handler is not None:
+                signal.signal(signal.SIGUSR1, old_reload_handler)
+            try:
+                self._server_socket.close()
+            except self._socket_error:
+                pass
+            if self._gracefully_stopping:
+                self._retire_workers(signal.SIGHUP)
+            else:
+                self._signal_workers(self._workers | self._retiring,
+                                     signal.SIGTERM)
+                self._retiring.update(self._workers)
+                self._workers.clear()
+            self._stopped.set()
+            signals.unregister_on_hangup(id(self))
+            self.run_server_stopped_hooks()
+        self._wait_for_workers()
+        self._fully_stopped.set()
+
+    def _wait_for_workers(self):
+        self._reap_workers()
+        if not self._retiring:
+            return
+        trace.note(gettext('Waiting for %d worker(s) to finish')
+                   % (len(self._retiring),))
+        t_next_log = self._timer() + self._LOG_WAITING_TIMEOUT
+        while self._retiring:
+            now = self._timer()
+            if now >= t_next_log:
+                trace.note(gettext('Still waiting for %d worker(s) to finish')
+                           % (len(self._retiring),))
+                t_next_log = now + self._LOG_WAITING_TIMEOUT
+            time.sleep(self._POLL_INTERVAL / 10.0)
+            self._reap_workers()
@@ -25,10 +25,12 @@ except ImportError:  # python < 3.7
     from collections import deque
 
 from io import BytesIO
+import itertools
 import struct
 import sys
 import _thread
 import time
+import zlib
 
 from fastbencode import bdecode_as_tuple, bencode
 
@@ -51,6 +53,19 @@ RESPONSE_VERSION_TWO = b'bzr response 2\n'
 MESSAGE_VERSION_THREE = b'bzr message 3 (bzr 1.6)\n'
 RESPONSE_VERSION_THREE = REQUEST_VERSION_THREE = MESSAGE_VERSION_THREE
 
+# The encodings the bodies of version three messages can be compressed with,
+# as listed in their Accept-Encoding header.
+BODY_ENCODINGS = b'zlib'
+
+# The largest size a compressed body part may decompress to. Bigger bodies are
+# sent uncompressed or in several parts, so that a peer can't make us inflate
+# a small part into gigabytes.
+MAX_DECOMPRESSED_BODY_PART = 64 * 1024 * 1024
+
+# How much of a streamed response body is compressed on its own to decide
+# whether compressing the whole stream is worthwhile.
+BODY_STREAM_SAMPLE_SIZE = 64 * 1024
+
 
 class SmartMessageHandlerError(errors.InternalBzrError):
 
@@ -352,53 +367,71 @@ class _StatefulDecoder(object):
     See ProtocolThreeDecoder for an example subclass.
     """
 
+    # Consumed bytes are only dropped from the front of the input buffer once
+    # there are this many of them, and they are most of the buffer.
+    _in_buffer_compact_size = 64 * 1024
+
     def __init__(self):
         self.finished_reading = False
-        self._in_buffer_list = []
-        self._in_buffer_len = 0
+        # The bytes received are appended to _in_buffer, the ones before
+        # _in_buffer_offset have been consumed.
+        self._in_buffer = bytearray()
+        self._in_buffer_offset = 0
         self.unused_data = b''
         self.bytes_left = None
         self._number_needed_bytes = None
 
+    @property
+    def _in_buffer_len(self):
+        return len(self._in_buffer) - self._in_buffer_offset
+
     def _get_in_buffer(self):
-        if len(self._in_buffer_list) == 1:
-            return self._in_buffer_list[0]
-        in_buffer = b''.join(self._in_buffer_list)
-        if len(in_buffer) != self._in_buffer_len:
-            raise AssertionError(
-                "Length of buffer did not match expected value: %s != %s"
-                % self._in_buffer_len, len(in_buffer))
-        self._in_buffer_list = [in_buffer]
-        return in_buffer
+        """Return a copy of the unconsumed bytes, without consuming them."""
+        return bytes(self._in_buffer[self._in_buffer_offset:])
 
     def _get_in_bytes(self, count):
         """Grab X bytes from the input_buffer.
 
         Callers should have already checked that self._in_buffer_len is >
         count. Note, this does not consume the bytes from the buffer. The
-        caller will still need to call _get_in_buffer() and then
-        _set_in_buffer() if they actually need to consume the bytes.
+        caller will still need to call _consume_in_bytes() if they actually
+        need to consume the bytes.
         """
-        # check if we can yield the bytes from just the first entry in our list
-        if len(self._in_buffer_list) == 0:
+        if self._in_buffer_len == 0:
             raise AssertionError('Callers must be sure we have buffered bytes'
                                  ' before calling _get_in_bytes')
-        if len(self._in_buffer_list[0]) > count:
-            return self._in_buffer_list[0][:count]
-        # We can't yield it from the first buffer, so collapse all buffers, and
-        # yield it from that
-        in_buf = self._get_in_buffer()
-        return in_buf[:count]
-
-    def _set_in_buffer(self, new_buf):
-        if new_buf is not None:
-            if not isinstance(new_buf, bytes):
-                raise TypeError(new_buf)
-            self._in_buffer_list = [new_buf]
-            self._in_buffer_len = len(new_buf)
-        else:
-            self._in_buffer_list = []
-            self._in_buffer_len = 0
+        offset = self._in_buffer_offset
+        return bytes(self._in_buffer[offset:offset + count])
+
+    def _find_in_buffer(self, sub):
+        """Return the position of sub in the unconsumed bytes, or -1."""
+        pos = self._in_buffer.find(sub, self._in_buffer_offset)
+        if pos == -1:
+            return pos
+        return pos - self._in_buffer_offset
+
+    def _consume_in_bytes(self, count):
+        """Consume and return the next count bytes of the input buffer."""
+        offset = self._in_buffer_offset
+        with memoryview(self._in_buffer) as view:
+            result = bytes(view[offset:offset + count])
+        self._skip_in_bytes(len(result))
+        return result
+
+    def _skip_in_bytes(self, count):
+        """Consume the next count bytes of the input buffer."""
+        self._in_buffer_offset += count
+        if self._in_buffer_offset >= len(self._in_buffer):
+            self._in_buffer = bytearray()
+            self._in_buffer_offset = 0
+        elif (self._in_buffer_offset >= self._in_buffer_compact_size and
+              self._in_buffer_offset * 2 >= len(self._in_buffer)):
+            del self._in_buffer[:self._in_buffer_offset]
+            self._in_buffer_offset = 0
+
+    def _consume_in_buffer(self):
+        """Consume and return all the bytes of the input buffer."""
+        return self._consume_in_bytes(self._in_buffer_len)
 
     def accept_bytes(self, new_buf):
         """Decode as much of bytes as possible.
@@ -413,10 +446,7 @@ class _StatefulDecoder(object):
             raise TypeError(new_buf)
         # accept_bytes is allowed to change the state
         self._number_needed_bytes = None
-        # lsprof puts a very large amount of time on this specific call for
-        # large readv arrays
-        self._in_buffer_list.append(new_buf)
-        self._in_buffer_len += len(new_buf)
+        self._in_buffer += new_buf
         try:
             # Run the function for the current state.
             current_state = self.state_accept
@@ -478,21 +508,18 @@ class ChunkedBodyDecoder(_StatefulDecoder):
             return None
 
     def _extract_line(self):
-        in_buf = self._get_in_buffer()
-        pos = in_buf.find(b'\n')
+        pos = self._find_in_buffer(b'\n')
         if pos == -1:
             # We haven't read a complete line yet, so request more bytes before
             # we continue.
             raise _NeedMoreBytes(1)
-        line = in_buf[:pos]
-        # Trim the prefix (including '\n' delimiter) from the _in_buffer.
-        self._set_in_buffer(in_buf[pos + 1:])
+        line = self._consume_in_bytes(pos)
+        # Trim the '\n' delimiter from the _in_buffer.
+        self._skip_in_bytes(1)
         return line
 
     def _finished(self):
-        self.unused_data = self._get_in_buffer()
-        self._in_buffer_list = []
-        self._in_buffer_len = 0
+        self.unused_data = self._consume_in_buffer()
         self.state_accept = self._state_accept_reading_unused
         if self.error:
             error_args = tuple(self.error_in_progress)
@@ -523,28 +550,27 @@ class ChunkedBodyDecoder(_StatefulDecoder):
             return
         else:
             self.bytes_left = int(prefix, 16)
-            self.chunk_in_progress = b''
+            # The parts of the chunk read so far
+            self.chunk_in_progress = []
             self.state_accept = self._state_accept_reading_chunk
 
     def _state_accept_reading_chunk(self):
-        in_buf = self._get_in_buffer()
-        in_buffer_len = len(in_buf)
-        self.chunk_in_progress += in_buf[:self.bytes_left]
-        self._set_in_buffer(in_buf[self.bytes_left:])
-        self.bytes_left -= in_buffer_len
+        part = self._consume_in_bytes(self.bytes_left)
+        self.chunk_in_progress.append(part)
+        self.bytes_left -= len(part)
         if self.bytes_left <= 0:
             # Finished with chunk
             self.bytes_left = None
+            chunk = b''.join(self.chunk_in_progress)
             if self.error:
-                self.error_in_progress.append(self.chunk_in_progress)
+                self.error_in_progress.append(chunk)
             else:
-                self.chunks.append(self.chunk_in_progress)
+                self.chunks.append(chunk)
             self.chunk_in_progress = None
             self.state_accept = self._state_accept_expecting_length
 
     def _state_accept_reading_unused(self):
-        self.unused_data += self._get_in_buffer()
-        self._in_buffer_list = []
+        self.unused_data += self._consume_in_buffer()
 
 
 class LengthPrefixedBodyDecoder(_StatefulDecoder):
@@ -554,7 +580,7 @@ class LengthPrefixedBodyDecoder(_StatefulDecoder):
         _StatefulDecoder.__init__(self)
         self.state_accept = self._state_accept_expecting_length
         self.state_read = self._state_read_no_data
-        self._body = b''
+        self._body = []
         self._trailer_buffer = b''
 
     def next_read_size(self):
@@ -578,31 +604,26 @@ class LengthPrefixedBodyDecoder(_StatefulDecoder):
         return self.state_read()
 
     def _state_accept_expecting_length(self):
-        in_buf = self._get_in_buffer()
-        pos = in_buf.find(b'\n')
+        pos = self._find_in_buffer(b'\n')
         if pos == -1:
             return
-        self.bytes_left = int(in_buf[:pos])
-        self._set_in_buffer(in_buf[pos + 1:])
+        self.bytes_left = int(self._consume_in_bytes(pos))
+        self._skip_in_bytes(1)
         self.state_accept = self._state_accept_reading_body
         self.state_read = self._state_read_body_buffer
 
     def _state_accept_reading_body(self):
-        in_buf = self._get_in_buffer()
-        self._body += in_buf
-        self.bytes_left -= len(in_buf)
-        self._set_in_buffer(None)
+        # The bytes following the body are left for the trailer.
+        part = self._consume_in_bytes(self.bytes_left)
+        self._body.append(part)
+        self.bytes_left -= len(part)
         if self.bytes_left <= 0:
             # Finished with body
-            if self.bytes_left != 0:
-                self._trailer_buffer = self._body[self.bytes_left:]
-                self._body = self._body[:self.bytes_left]
             self.bytes_left = None
             self.state_accept = self._state_accept_reading_trailer
 
     def _state_accept_reading_trailer(self):
-        self._trailer_buffer += self._get_in_buffer()
-        self._set_in_buffer(None)
+        self._trailer_buffer += self._consume_in_buffer()
         # TODO: what if the trailer does not match "done\n"?  Should this raise
         # a ProtocolViolation exception?
         if self._trailer_buffer.startswith(b'done\n'):
@@ -611,15 +632,14 @@ class LengthPrefixedBodyDecoder(_StatefulDecoder):
             self.finished_reading = True
 
     def _state_accept_reading_unused(self):
-        self.unused_data += self._get_in_buffer()
-        self._set_in_buffer(None)
+        self.unused_data += self._consume_in_buffer()
 
     def _state_read_no_data(self):
         return b''
 
     def _state_read_body_buffer(self):
-        result = self._body
-        self._body = b''
+        result = b''.join(self._body)
+        self._body = []
         return result
 
 
@@ -924,6 +944,7 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             self._number_needed_bytes = 4
         self.decoding_failed = False
         self.request_handler = self.message_handler = message_handler
+        self._body_decompressor = None
 
     def accept_bytes(self, bytes):
         self._number_needed_bytes = None
@@ -970,10 +991,8 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             # are.
             raise _NeedMoreBytes(end_of_bytes)
         # Extract the bytes from the buffer.
-        in_buf = self._get_in_buffer()
-        bytes = in_buf[4:end_of_bytes]
-        self._set_in_buffer(in_buf[end_of_bytes:])
-        return bytes
+        self._skip_in_bytes(4)
+        return self._consume_in_bytes(length)
 
     def _extract_prefixed_bencoded_data(self):
         prefixed_bytes = self._extract_length_prefixed_bytes()
@@ -988,14 +1007,11 @@ class ProtocolThreeDecoder(_StatefulDecoder):
         if self._in_buffer_len == 0:
             # The buffer is empty
             raise _NeedMoreBytes(1)
-        in_buf = self._get_in_buffer()
-        one_byte = in_buf[0:1]
-        self._set_in_buffer(in_buf[1:])
-        return one_byte
+        return self._consume_in_bytes(1)
 
     def _state_accept_expecting_protocol_version(self):
         needed_bytes = len(MESSAGE_VERSION_THREE) - self._in_buffer_len
-        in_buf = self._get_in_buffer()
+        in_buf = self._get_in_bytes(len(MESSAGE_VERSION_THREE))
         if needed_bytes > 0:
             # We don't have enough bytes to check if the protocol version
             # marker is right.  But we can check if it is already wrong by
@@ -1011,7 +1027,7 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             raise _NeedMoreBytes(len(MESSAGE_VERSION_THREE))
         if not in_buf.startswith(MESSAGE_VERSION_THREE):
             raise errors.UnexpectedProtocolVersionMarker(in_buf)
-        self._set_in_buffer(in_buf[len(MESSAGE_VERSION_THREE):])
+        self._skip_in_bytes(len(MESSAGE_VERSION_THREE))
         self.state_accept = self._state_accept_expecting_headers
 
     def _state_accept_expecting_headers(self):
@@ -1019,6 +1035,12 @@ class ProtocolThreeDecoder(_StatefulDecoder):
         if not isinstance(decoded, dict):
             raise errors.SmartProtocolError(
                 'Header object %r is not a dict' % (decoded,))
+        body_encoding = decoded.get(b'Body-Encoding')
+        if body_encoding is not None:
+            if body_encoding != b'zlib':
+                raise errors.SmartProtocolError(
+                    'Unknown body encoding %r' % (body_encoding,))
+            self._body_decompressor = zlib.decompressobj()
         self.state_accept = self._state_accept_expecting_message_part
         try:
             self.message_handler.headers_received(decoded)
@@ -1051,6 +1073,13 @@ class ProtocolThreeDecoder(_StatefulDecoder):
         # XXX: this should not buffer whole message part, but instead deliver
         # the bytes as they arrive.
         prefixed_bytes = self._extract_length_prefixed_bytes()
+        if self._body_decompressor is not None:
+            prefixed_bytes = self._body_decompressor.decompress(
+                prefixed_bytes, MAX_DECOMPRESSED_BODY_PART)
+            if self._body_decompressor.unconsumed_tail:
+                raise errors.SmartProtocolError(
+                    'Body part decompresses to more than %d bytes'
+                    % (MAX_DECOMPRESSED_BODY_PART,))
         self.state_accept = self._state_accept_expecting_message_part
         try:
             self.message_handler.bytes_part_received(prefixed_bytes)
@@ -1066,8 +1095,7 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             raise SmartMessageHandlerError(sys.exc_info())
 
     def done(self):
-        self.unused_data = self._get_in_buffer()
-        self._set_in_buffer(None)
+        self.unused_data = self._consume_in_buffer()
         self.state_accept = self._state_accept_reading_unused
         try:
             self.message_handler.end_received()
@@ -1075,8 +1103,7 @@ class ProtocolThreeDecoder(_StatefulDecoder):
             raise SmartMessageHandlerError(sys.exc_info())
 
     def _state_accept_reading_unused(self):
-        self.unused_data += self._get_in_buffer()
-        self._set_in_buffer(None)
+        self.unused_data += self._consume_in_buffer()
 
     def next_read_size(self):
         if self.state_accept == self._state_accept_reading_unused:
@@ -1103,6 +1130,18 @@ class _ProtocolThreeEncoder(object):
         self._buf = []
         self._buf_len = 0
         self._real_write_func = write_func
+        self._body_compressor = None
+
+    def negotiate_body_encoding(self, accept_encoding):
+        """Compress the body of the message if the peer can decode it.
+
+        :param accept_encoding: the Accept-Encoding header of the peer, a comma
+            separated list of the body encodings it can decode, or None.
+        """
+        if accept_encoding and b'zlib' in accept_encoding.split(b','):
+            self._body_compressor = zlib.compressobj()
+        else:
+            self._body_compressor = None
 
     def _write_func(self, bytes):
         # TODO: Another possibility would be to turn this into an async model.
@@ -1137,6 +1176,9 @@ class _ProtocolThreeEncoder(object):
         self._write_func(bytes)
 
     def _write_headers(self, headers):
+        if self._body_compressor is not None:
+            headers = dict(headers)
+            headers[b'Body-Encoding'] = b'zlib'
         self._write_prefixed_bencode(headers)
 
     def _write_structure(self, args):
@@ -1158,6 +1200,70 @@ class _ProtocolThreeEncoder(object):
         self._write_func(struct.pack('!L', len(bytes)))
         self._write_func(bytes)
 
+    def _compress_body_part(self, bytes):
+        # Every part is flushed, so that the peer can decode each part as it
+        # is received, while the parts still share the compression history.
+        return (self._body_compressor.compress(bytes) +
+                self._body_compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def _prepare_body(self, bytes):
+        """Prepare a body sent as a single part, before writing the headers.
+
+        The body is not compressed if that would not make it smaller, or if
+        it is too big for the peer to decompress it.
+
+        :return: the body part to write.
+        """
+        if self._body_compressor is None:
+            return bytes
+        if len(bytes) > MAX_DECOMPRESSED_BODY_PART:
+            self._body_compressor = None
+            return bytes
+        compressed = self._compress_body_part(bytes)
+        if len(compressed) >= len(bytes):
+            self._body_compressor = None
+            return bytes
+        return compressed
+
+    def _sample_body_stream(self, body_stream):
+        """Check whether compressing a streamed body is worthwhile.
+
+        Like _prepare_body does for single part bodies, the stream is not
+        compressed if that would not make it smaller. This is decided on the
+        first BODY_STREAM_SAMPLE_SIZE bytes of the stream, which are read
+        ahead: streams of already compressed data, like the groupcompress
+        blocks sent by get_stream, are then sent as they are.
+
+        :param body_stream: an iterator of (exc_info, chunk) tuples, see
+            _iter_with_errors.
+        :return: an iterator over the whole of body_stream.
+        """
+        sample = []
+        size = 0
+        for exc_info, chunk in body_stream:
+            sample.append((exc_info, chunk))
+            if exc_info is not None or not isinstance(chunk, bytes):
+                break
+            size += len(chunk)
+            if size >= BODY_STREAM_SAMPLE_SIZE:
+                break
+        sample_bytes = b''.join(
+            chunk for exc_info, chunk in sample
+            if exc_info is None and isinstance(chunk, bytes))
+        if (sample_bytes and
+                len(zlib.compress(sample_bytes)) >= len(sample_bytes)):
+            self._body_compressor = None
+        return itertools.chain(sample, body_stream)
+
+    def _write_body_part(self, bytes):
+        """Write a part of a streamed body."""
+        if self._body_compressor is None:
+            self._write_prefixed_body(bytes)
+            return
+        for start in range(0, max(len(bytes), 1), MAX_DECOMPRESSED_BODY_PART):
+            self._write_prefixed_body(self._compress_body_part(
+                bytes[start:start + MAX_DECOMPRESSED_BODY_PART]))
+
     def _write_chunked_body_start(self):
         self._write_func(b'oC')
 
@@ -1174,7 +1280,12 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
         _ProtocolThreeEncoder.__init__(self, write_func)
         self.response_sent = False
         self._headers = {
-            b'Software version': breezy.__version__.encode('utf-8')}
+            b'Software version': breezy.__version__.encode('utf-8'),
+            # Requests sent before their predecessors are answered are served
+            # in order.
+            b'Pipelining': b'yes',
+            # Request bodies can be compressed.
+            b'Accept-Encoding': BODY_ENCODINGS}
         if 'hpss' in debug.debug_flags:
             self._thread_id = _thread.get_ident()
             self._response_start_time = None
@@ -1208,6 +1319,7 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
         if 'hpss' in debug.debug_flags:
             self._trace('error', str(exception))
         self.response_sent = True
+        self._body_compressor = None
         self._write_protocol_version()
         self._write_headers(self._headers)
         self._write_error_status()
@@ -1221,6 +1333,14 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
                 "send_response(%r) called, but response already sent."
                 % (response,))
         self.response_sent = True
+        if response.body is not None:
+            body = self._prepare_body(response.body)
+        elif response.body_stream is None:
+            self._body_compressor = None
+        else:
+            body_stream = _iter_with_errors(response.body_stream)
+            if self._body_compressor is not None:
+                body_stream = self._sample_body_stream(body_stream)
         self._write_protocol_version()
         self._write_headers(self._headers)
         if response.is_successful():
@@ -1231,14 +1351,14 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
             self._trace('response', repr(response.args))
         self._write_structure(response.args)
         if response.body is not None:
-            self._write_prefixed_body(response.body)
+            self._write_prefixed_body(body)
             if 'hpss' in debug.debug_flags:
                 self._trace('body', '%d bytes' % (len(response.body),),
                             response.body, include_time=True)
         elif response.body_stream is not None:
             count = num_bytes = 0
             first_chunk = None
-            for exc_info, chunk in _iter_with_errors(response.body_stream):
+            for exc_info, chunk in body_stream:
                 count += 1
                 if exc_info is not None:
                     self._write_error_status()
@@ -1253,7 +1373,7 @@ class ProtocolThreeResponder(_ProtocolThreeEncoder):
                     num_bytes += len(chunk)
                     if first_chunk is None:
                         first_chunk = chunk
-                    self._write_prefixed_body(chunk)
+                    self._write_body_part(chunk)
                     self.flush()
                     if 'hpssdetail' in debug.debug_flags:
                         # Not worth timing separately, as _write_func is
@@ -1327,6 +1447,7 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
             if base is not None:
                 mutter('             (to %s)', base)
             self._request_start_time = osutils.perf_counter()
+        self._body_compressor = None
         self._write_protocol_version()
         self._write_headers(self._headers)
         self._write_structure(args)
@@ -1345,6 +1466,7 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
                 mutter('                  (to %s)', path)
             mutter('              %d bytes', len(body))
             self._request_start_time = osutils.perf_counter()
+        body = self._prepare_body(body)
         self._write_protocol_version()
         self._write_headers(self._headers)
         self._write_structure(args)
@@ -1364,12 +1486,13 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
             if path is not None:
                 mutter('                  (to %s)', path)
             self._request_start_time = osutils.perf_counter()
-        self._write_protocol_version()
-        self._write_headers(self._headers)
-        self._write_structure(args)
         readv_bytes = self._serialise_offsets(body)
         if 'hpss' in debug.debug_flags:
             mutter('              %d bytes in readv request', len(readv_bytes))
+        readv_bytes = self._prepare_body(readv_bytes)
+        self._write_protocol_version()
+        self._write_headers(self._headers)
+        self._write_structure(args)
         self._write_prefixed_body(readv_bytes)
         self._write_end()
         self._medium_request.finished_writing()
@@ -1407,7 +1530,7 @@ class ProtocolThreeRequester(_ProtocolThreeEncoder, Requester):
                 finally:
                     del exc_info
             else:
-                self._write_prefixed_body(part)
+                self._write_body_part(part)
                 self.flush()
         self._write_end()
         self._medium_request.finished_writing()
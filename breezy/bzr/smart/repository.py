@@ -20,6 +20,7 @@ import bz2
 import itertools
 import os
 import queue
+import re
 import sys
 import tempfile
 import threading
@@ -51,6 +52,7 @@ from ...repository import (
     network_format_registry,
     )
 from ... import revision as _mod_revision
+from ...transport import NoSuchFile
 from ..versionedfile import (
     ChunkedContentFactory,
     NetworkRecordStream,
@@ -80,6 +82,16 @@ class SmartServerRepositoryRequest(SmartServerRequest):
         self._repository = bzrdir.open_repository()
         return self.do_repository_request(self._repository, *args)
 
+    def _pack_names_generation(self, path):
+        """Return a cache generation for the repository at path.
+
+        Packs are never modified, so the pack-names index changes whenever the
+        contents of a pack repository do, e.g. when a write group is committed.
+        Other repositories are not cached.
+        """
+        return self._control_file_generation(
+            path, '.bzr/repository/pack-names')
+
     def do_repository_request(self, repository, *args):
         """Override to provide an implementation for a verb."""
         # No-op for verbs that take bodies (None as a result indicates a body
@@ -166,6 +178,9 @@ class SmartServerRepositoryGetParentMap(SmartServerRepositoryRequest):
 
     no_extra_results = False
 
+    def cache_generation(self, path, *revision_ids):
+        return self._pack_names_generation(path)
+
     def do_repository_request(self, repository, *revision_ids):
         """Get parent details for some revisions.
 
@@ -276,6 +291,97 @@ class SmartServerRepositoryGetParentMap(SmartServerRepositoryRequest):
             (b'ok', ), bz2.compress(b'\n'.join(lines)))
 
 
+class SmartServerRepositoryWalkToCommon(SmartServerRepositoryRequest):
+    """Find the ancestry of some revisions that the client does not have.
+
+    This lets a client find what to fetch in one round trip, rather than
+    walking the graph with Repository.get_parent_map a step at a time.
+
+    New in 3.3.
+    """
+
+    # The most (compressed) parent data sent in a single response.
+    max_size = 1024 * 1024
+
+    def cache_generation(self, path, max_size):
+        return self._pack_names_generation(path)
+
+    def do_repository_request(self, repository, max_size):
+        """Walk the graph from some heads to the revisions the client has.
+
+        The verb takes a body of two lines: the space separated heads whose
+        ancestry the client wants, and the space separated revisions the
+        client already has, whose ancestry is excluded.
+
+        :param max_size: The size the client would like the compressed parent
+            data to stay within, capped by self.max_size.
+        """
+        self._max_size = min(int(max_size), self.max_size)
+        return None  # Signal that we want a body.
+
+    def do_body(self, body_bytes):
+        """Return the parents of the revisions the client lacks.
+
+        :return: A smart server response ('ok',) when the body holds every
+            revision in the ancestry of the heads but not of the client's
+            revisions, or ('partial',) when that did not fit in max_size. The
+            body holds the parents in the Repository.get_parent_map format,
+            bz2 compressed, breadth first from the heads. Ghosts are included
+            with a prefix of 'missing:'.
+        """
+        lines = body_bytes.split(b'\n')
+        if len(lines) != 2:
+            return FailedSmartServerResponse((b'BadSearch',))
+        heads = set(lines[0].split())
+        heads.discard(_mod_revision.NULL_REVISION)
+        haves = set(lines[1].split())
+        with self._repository.lock_read():
+            lines, complete = self._walk_to_common(
+                self._repository.get_graph(), heads, haves)
+        if complete:
+            status = b'ok'
+        else:
+            status = b'partial'
+        return SuccessfulSmartServerResponse(
+            (status, ), bz2.compress(b'\n'.join(lines)))
+
+    def _walk_to_common(self, repo_graph, heads, haves):
+        if haves:
+            unique = repo_graph.find_all_unique_ancestors(heads, haves)
+            pending = heads.intersection(unique)
+        else:
+            # Everything is unique; don't walk the whole graph up front when
+            # only the part nearest the heads will fit in the response.
+            unique = None
+            pending = heads
+        estimator = estimate_compressed_size.ZLibEstimator(self._max_size)
+        lines = []
+        seen = set(pending)
+        while pending:
+            parent_map = repo_graph.get_parent_map(pending)
+            next_revs = set()
+            for revision_id in sorted(pending):
+                parents = parent_map.get(revision_id)
+                if parents is None:
+                    line = b'missing:' + revision_id
+                else:
+                    # adjust for the wire
+                    if parents == (_mod_revision.NULL_REVISION,):
+                        parents = ()
+                    line = b' '.join((revision_id, ) + tuple(parents))
+                    next_revs.update(parents)
+                lines.append(line)
+                estimator.add_content(line + b'\n')
+            if unique is not None:
+                next_revs.intersection_update(unique)
+            next_revs.difference_update(seen)
+            seen.update(next_revs)
+            if next_revs and estimator.full():
+                return lines, False
+            pending = next_revs
+        return lines, True
+
+
 class SmartServerRepositoryGetRevisionGraph(SmartServerRepositoryReadLocked):
 
     def do_readlocked_repository_request(self, repository, revision_id):
@@ -315,6 +421,9 @@ class SmartServerRepositoryGetRevisionGraph(SmartServerRepositoryReadLocked):
 
 class SmartServerRepositoryGetRevIdForRevno(SmartServerRepositoryReadLocked):
 
+    def cache_generation(self, path, revno, known_pair):
+        return self._pack_names_generation(path)
+
     def do_readlocked_repository_request(self, repository, revno,
                                          known_pair):
         """Find the revid for a given revno, given a known revno/revid pair.
@@ -521,6 +630,9 @@ class SmartServerRepositoryLockWrite(SmartServerRepositoryRequest):
 
 class SmartServerRepositoryGetStream(SmartServerRepositoryRequest):
 
+    def cache_generation(self, path, to_network_name):
+        return self._pack_names_generation(path)
+
     def do_repository_request(self, repository, to_network_name):
         """Get a stream for inserting into a to_format repository.
 
@@ -620,11 +732,8 @@ class SmartServerRepositoryGetStream_1_19(SmartServerRepositoryGetStream):
         return False
 
 
-def _stream_to_byte_stream(stream, src_format):
-    """Convert a record stream to a self delimited byte stream."""
-    pack_writer = pack.ContainerSerialiser()
-    yield pack_writer.begin()
-    yield pack_writer.bytes_record(src_format.network_name(), b'')
+def _iter_wire_records(stream):
+    """Yield the substream type and wire bytes of the records of a stream."""
     for substream_type, substream in stream:
         for record in substream:
             if record.storage_kind in ('chunked', 'fulltext'):
@@ -637,10 +746,48 @@ def _stream_to_byte_stream(stream, src_format):
                 # Some streams embed the whole stream into the wire
                 # representation of the first record, which means that
                 # later records have no wire representation: we skip them.
-                yield pack_writer.bytes_record(serialised, [(substream_type.encode('ascii'),)])
+                yield substream_type.encode('ascii'), serialised
+
+
+def _stream_to_byte_stream(stream, src_format):
+    """Convert a record stream to a self delimited byte stream."""
+    pack_writer = pack.ContainerSerialiser()
+    yield pack_writer.begin()
+    yield pack_writer.bytes_record(src_format.network_name(), b'')
+    for substream_type, serialised in _iter_wire_records(stream):
+        yield pack_writer.bytes_record(serialised, [(substream_type,)])
     yield pack_writer.end()
 
 
+def _stream_to_byte_stream_segments(stream, src_format, segment_size):
+    """Convert a record stream to a series of self delimited byte streams.
+
+    Each byte stream yields chunks like _stream_to_byte_stream does, for the
+    records following those of the previous one. A byte stream ends with the
+    record that takes its records over segment_size bytes. The records are
+    only read from stream as the byte streams are consumed, so each byte
+    stream has to be consumed before the next one is started.
+    """
+    wire_records = _iter_wire_records(stream)
+    # The next record to send, read ahead to know whether another byte stream
+    # is needed.
+    pending = [next(wire_records, None)]
+
+    def byte_stream():
+        pack_writer = pack.ContainerSerialiser()
+        yield pack_writer.begin()
+        yield pack_writer.bytes_record(src_format.network_name(), b'')
+        size = 0
+        while pending[0] is not None and size < segment_size:
+            substream_type, serialised = pending[0]
+            yield pack_writer.bytes_record(serialised, [(substream_type,)])
+            size += len(serialised)
+            pending[0] = next(wire_records, None)
+        yield pack_writer.end()
+    while pending[0] is not None:
+        yield byte_stream()
+
+
 class _ByteStreamDecoder(object):
     """Helper for _byte_stream_to_stream.
 
@@ -928,6 +1075,8 @@ class SmartServerRepositoryInsertStreamLocked(SmartServerRepositoryRequest):
             self.repository.unlock()
             return SuccessfulSmartServerResponse((b'missing-basis', bytes))
         else:
+            if self.tokens:
+                _remove_checkpoints(self.repository, self.tokens)
             self.repository.unlock()
             return SuccessfulSmartServerResponse((b'ok', ))
 
@@ -965,6 +1114,175 @@ class SmartServerRepositoryInsertStream(SmartServerRepositoryInsertStreamLocked)
         self.do_insert_stream_request(repository, resume_tokens)
 
 
+def _checkpoint_transport(repository):
+    """Return the transport to keep insert stream checkpoints on, or None.
+
+    Only pack repositories can suspend the write groups of checkpoints.
+    """
+    pack_collection = getattr(repository, '_pack_collection', None)
+    if pack_collection is None:
+        return None
+    return pack_collection._upload_transport
+
+
+def _checkpoint_name(upload_id):
+    if re.fullmatch(b'[0-9a-f]{40}', upload_id) is None:
+        raise errors.BzrError('Malformed upload id %r' % (upload_id,))
+    return upload_id.decode('ascii') + '.checkpoint'
+
+
+def _remove_checkpoints(repository, tokens):
+    """Remove the checkpoints of the write group committed from tokens."""
+    transport = _checkpoint_transport(repository)
+    if transport is None:
+        return
+    tokens = {token.encode('ascii') for token in tokens}
+    for name in transport.list_dir('.'):
+        if not name.endswith('.checkpoint'):
+            continue
+        try:
+            if tokens.intersection(transport.get_bytes(name).split()):
+                transport.delete(name)
+        except NoSuchFile:
+            # Removed by a concurrent request
+            pass
+
+
+class SmartServerRepositoryGetInsertCheckpoint(SmartServerRepositoryRequest):
+    """Describe what an interrupted resumable insert stream left behind.
+
+    New in 3.3.
+    """
+
+    def do_repository_request(self, repository, upload_id, lock_token=None):
+        """Return the resume tokens and keys of the checkpoint of an upload.
+
+        :param upload_id: The identifier the client gave the upload to
+            Repository.insert_stream_checkpoint.
+        :return: ('ok', tokens) with a body of the keys the suspended write
+            group holds, bencoded by kind as for the 'missing-basis' response
+            of Repository.insert_stream, and zlib compressed; ('no-checkpoint',)
+            when there is nothing to resume; or ('unsupported',) if the
+            repository can't suspend write groups.
+        """
+        transport = _checkpoint_transport(repository)
+        if transport is None:
+            return SuccessfulSmartServerResponse((b'unsupported', ), b'')
+        name = _checkpoint_name(upload_id)
+        try:
+            tokens = transport.get_bytes(name).split()
+        except NoSuchFile:
+            return SuccessfulSmartServerResponse((b'no-checkpoint', ), b'')
+        repository.lock_write(token=lock_token)
+        try:
+            try:
+                repository.resume_write_group(
+                    [token.decode('ascii') for token in tokens])
+            except errors.UnresumableWriteGroup:
+                # The upload was completed or abandoned since.
+                transport.delete(name)
+                return SuccessfulSmartServerResponse((b'no-checkpoint', ), b'')
+            try:
+                keys = self._held_keys(repository._pack_collection)
+            finally:
+                repository.suspend_write_group()
+        finally:
+            repository.unlock()
+        return SuccessfulSmartServerResponse(
+            (b'ok', bencode.bencode(tokens)),
+            zlib.compress(bencode.bencode(keys)))
+
+    def _held_keys(self, pack_collection):
+        keys = []
+        for pack in pack_collection._resumed_packs:
+            indices = [
+                (b'revisions', pack.revision_index),
+                (b'inventories', pack.inventory_index),
+                (b'texts', pack.text_index),
+                (b'signatures', pack.signature_index),
+                ]
+            if pack.chk_index is not None:
+                indices.append((b'chk_bytes', pack.chk_index))
+            for kind, index in indices:
+                keys.extend((kind, ) + tuple(entry[1])
+                            for entry in index.iter_all_entries())
+        return sorted(keys)
+
+
+class SmartServerRepositoryInsertStreamCheckpoint(
+        SmartServerRepositoryInsertStreamLocked):
+    """Insert part of a record stream, keeping it to insert more later.
+
+    This is like Repository.insert_stream_1.19, except that the write group is
+    always suspended rather than committed, and its resume tokens recorded
+    under an identifier of the upload chosen by the client. A client whose
+    upload is interrupted can ask Repository.get_insert_checkpoint what was
+    kept, and carry on from there rather than start over.
+
+    New in 3.3.
+    """
+
+    def do_repository_request(self, repository, upload_id, resume_tokens,
+                              lock_token=None):
+        """Insert a part of a record stream into a repository."""
+        self._checkpoint_transport = _checkpoint_transport(repository)
+        if self._checkpoint_transport is None:
+            return FailedSmartServerResponse((b'UnsuspendableWriteGroup', ))
+        self._checkpoint_name = _checkpoint_name(upload_id)
+        SmartServerRepositoryInsertStreamLocked.do_repository_request(
+            self, repository, resume_tokens, lock_token)
+
+    def _inserter_thread(self):
+        try:
+            src_format, stream = _byte_stream_to_stream(
+                self.blocking_byte_stream())
+            self.insert_result = self._insert_and_suspend(stream, src_format)
+            self.insert_ok = True
+        except:
+            self.insert_exception = sys.exc_info()
+            self.insert_ok = False
+
+    def _insert_and_suspend(self, stream, src_format):
+        repository = self.repository
+        if self.tokens:
+            repository.resume_write_group(self.tokens)
+        else:
+            repository.start_write_group()
+        try:
+            # Missing keys are looked for again when the upload is committed
+            repository._get_sink().insert_stream_without_locking(
+                stream, src_format, bool(self.tokens))
+        except BaseException:
+            # Keep what was inserted, the client can resume from there.
+            try:
+                self._checkpoint(repository.suspend_write_group())
+            except BaseException:
+                repository.abort_write_group(suppress_errors=True)
+            raise
+        tokens = repository.suspend_write_group()
+        self._checkpoint(tokens)
+        return tokens
+
+    def _checkpoint(self, tokens):
+        self._checkpoint_transport.put_bytes(
+            self._checkpoint_name,
+            b''.join(token.encode('ascii') + b'\n' for token in tokens))
+
+    def do_end(self):
+        self.queue.put(StopIteration)
+        if self.insert_thread is not None:
+            self.insert_thread.join()
+        self.repository.unlock()
+        if not self.insert_ok:
+            (exc_type, exc_val, exc_tb) = self.insert_exception
+            try:
+                raise exc_val
+            finally:
+                del self.insert_exception
+        tokens = [token.encode('ascii') for token in self.insert_result]
+        return SuccessfulSmartServerResponse((b'ok', bencode.bencode(tokens)))
+
+
 class SmartServerRepositoryAddSignatureText(SmartServerRepositoryRequest):
     """Add a revision signature text.
 
@@ -24,6 +24,10 @@ Interesting module attributes:
       transports placed in jail_info.transports.  The jail_info is reset on
       every call into a request handler (which can happen an arbitrary number
       of times during a request).
+    * The response_cache is the SmartServerResponseCache used by the request
+      handlers, or None when responses are not cached.
+    * The server_stats is the breezy.bzr.smart.stats.SmartServerStats the
+      request handlers record the requests they serve in, or None.
 """
 
 # XXX: The class names are a little confusing: the protocol will instantiate a
@@ -38,6 +42,7 @@ from ... import (
     branch as _mod_branch,
     debug,
     errors,
+    lru_cache,
     osutils,
     registry,
     revision,
@@ -57,6 +62,10 @@ import tempfile
 jail_info = threading.local()
 jail_info.transports = None
 
+response_cache = None
+
+server_stats = None
+
 
 class DisabledMethod(errors.InternalBzrError):
 
@@ -130,6 +139,32 @@ class SmartServerRequest(object):
         """Raises DisabledMethod if this method is disabled."""
         pass
 
+    def cache_generation(self, *args):
+        """Describe the state the response to this request depends on.
+
+        Requests whose response only depends on their arguments, their body
+        and the state of the branch or repository they act on can return a
+        bytestring here that changes whenever that state does, so that their
+        responses can be cached by the SmartServerRequestHandler.
+
+        :param args: the arguments of the request.
+        :return: a bytestring, or None if the response must not be cached.
+        """
+        return None
+
+    def _control_file_generation(self, client_path, relpath):
+        """Return the sha1 of a control file, or None if it does not exist.
+
+        :param client_path: the path of the control directory, as received
+            from the client.
+        :param relpath: the path of the file relative to client_path.
+        """
+        transport = self.transport_from_client_path(client_path)
+        try:
+            return osutils.sha_string(transport.get_bytes(relpath))
+        except _mod_transport.NoSuchFile:
+            return None
+
     def do(self, *args):
         """Mandatory extension point for SmartServerRequest subclasses.
 
@@ -269,6 +304,104 @@ class SuccessfulSmartServerResponse(SmartServerResponse):
         return True
 
 
+def _cached_response_size(value):
+    args, body, body_chunks = value
+    # Arguments can be integers too, their size is negligible.
+    size = sum(len(arg) for arg in args if isinstance(arg, bytes))
+    if body is not None:
+        size += len(body)
+    if body_chunks is not None:
+        size += sum(map(len, body_chunks))
+    return size
+
+
+class SmartServerResponseCache(object):
+    """A cache of the successful responses to cacheable requests.
+
+    Responses are cached under the verb, arguments and body of their request
+    together with the generation of the request (see
+    SmartServerRequest.cache_generation). Once the branch or repository
+    changes, requests have a new generation and the older responses are no
+    longer used: they expire as newer responses are added.
+
+    The cache is shared by all the connections of a server, so it is safe to
+    use from several threads.
+    """
+
+    def __init__(self, max_size):
+        """Constructor.
+
+        :param max_size: the number of bytes of responses to keep.
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._cache = lru_cache.LRUSizeCache(
+            max_size=max_size, compute_size=_cached_response_size)
+
+    def get(self, key):
+        """Return a response for key, or None if none is cached."""
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                return None
+            self.hits += 1
+        args, body, body_chunks = value
+        if body_chunks is None:
+            return SuccessfulSmartServerResponse(args, body=body)
+        return SuccessfulSmartServerResponse(
+            args, body_stream=iter(body_chunks))
+
+    def add(self, key, response, is_current=None):
+        """Cache response under key.
+
+        Streamed bodies are cached once they have been completely sent, so
+        the response to send in place of response is returned.
+
+        :param is_current: if not None, a callable telling whether the
+            generation in key is still the current one. It is called once the
+            response has been computed and the response is not cached if it
+            returns False.
+        """
+        with self._lock:
+            self.misses += 1
+        if not response.is_successful():
+            return response
+        if response.body_stream is None:
+            self._store(key, (response.args, response.body, None), is_current)
+            return response
+        return SuccessfulSmartServerResponse(
+            response.args,
+            body_stream=self._recording_stream(
+                key, response.args, response.body_stream, is_current))
+
+    def _store(self, key, value, is_current):
+        if is_current is not None and not is_current():
+            # The response may reflect a newer state than the one key was
+            # computed for, and that state can become current again.
+            return
+        with self._lock:
+            self._cache[key] = value
+
+    def _recording_stream(self, key, args, body_stream, is_current):
+        body_chunks = []
+        size = 0
+        for chunk in body_stream:
+            if body_chunks is not None:
+                # Errors can be sent in the middle of a stream, and streams
+                # too big for the cache are not worth keeping in memory.
+                if (isinstance(chunk, bytes) and
+                        size + len(chunk) <= self.max_size):
+                    body_chunks.append(chunk)
+                    size += len(chunk)
+                else:
+                    body_chunks = None
+            yield chunk
+        if body_chunks is not None:
+            self._store(key, (args, None, tuple(body_chunks)), is_current)
+
+
 class SmartServerRequestHandler(object):
     """Protocol logic for smart server.
 
@@ -293,6 +426,9 @@ class SmartServerRequestHandler(object):
         :param backing_transport: a Transport to handle requests for.
         :param commands: a registry mapping command names to SmartServerRequest
             subclasses. e.g. breezy.transport.smart.vfs.vfs_commands.
+
+        The responses are cached in the module's response_cache, if set, and
+        the requests recorded in its server_stats, if set.
         """
         self._backing_transport = backing_transport
         self._root_client_path = root_client_path
@@ -303,6 +439,14 @@ class SmartServerRequestHandler(object):
         self.response = None
         self.finished_reading = False
         self._command = None
+        self._response_cache = response_cache
+        # The key of the response to the current request in the response
+        # cache, without the request body, if it can be cached.
+        self._cache_key = None
+        self._cache_body_chunks = []
+        self._stats = server_stats
+        # The verb of the current request, until it is recorded in _stats.
+        self._stats_verb = None
         if 'hpss' in debug.debug_flags:
             self._request_start_time = osutils.perf_counter()
             self._thread_id = get_ident()
@@ -330,6 +474,8 @@ class SmartServerRequestHandler(object):
         if self._command is None:
             # no active command object, so ignore the event.
             return
+        if self._cache_key is not None:
+            self._cache_body_chunks.append(bytes)
         self._run_handler_code(self._command.do_chunk, (bytes,), {})
         if 'hpss' in debug.debug_flags:
             self._trace('accept body',
@@ -337,7 +483,8 @@ class SmartServerRequestHandler(object):
 
     def end_of_body(self):
         """No more body data will be received."""
-        self._run_handler_code(self._command.do_end, (), {})
+        self._end_of_request()
+        self._record_response()
         # cannot read after this.
         self.finished_reading = True
         if 'hpss' in debug.debug_flags:
@@ -398,13 +545,100 @@ class SmartServerRequestHandler(object):
             self._trace(action, '%s %s' % (cmd, repr(args)[1:-1]))
         self._command = command(
             self._backing_transport, self._root_client_path, self._jail_root)
+        if self._stats is not None:
+            self._stats_verb = cmd
+            self._stats_start_time = osutils.perf_counter()
+        if self._response_cache is not None:
+            self._cache_key = self._get_cache_key(cmd, args)
+        if self._cache_key is not None:
+            response = self._response_cache.get(self._cache_key + (None,))
+            if response is not None:
+                self._send_cached_response(response)
+                self._record_response()
+                return
         self._run_handler_code(self._command.execute, args, {})
+        if self._cache_key is not None and self.response is not None:
+            self.response = self._response_cache.add(
+                self._cache_key + (None,), self.response,
+                self._cache_key_is_current)
+        self._record_response()
+
+    def _get_cache_key(self, cmd, args):
+        try:
+            generation = self._command.cache_generation(*args)
+        except Exception:
+            # Leave reporting bad arguments to the request itself.
+            return None
+        if generation is None:
+            return None
+        return (cmd, args, generation)
+
+    def _cache_key_is_current(self):
+        """Check the generation of the request once it has been answered.
+
+        The branch or repository may have changed while the response was
+        computed, the response must then not be cached under the generation
+        read before.
+        """
+        return self._get_cache_key(*self._cache_key[:2]) == self._cache_key
+
+    def _send_cached_response(self, response):
+        if 'hpss' in debug.debug_flags:
+            self._trace('hpss cached', 'response')
+        self.response = response
+        self.finished_reading = True
+
+    def _end_of_request(self):
+        if self._cache_key is None or self.response is not None:
+            self._run_handler_code(self._command.do_end, (), {})
+            return
+        key = self._cache_key + (b''.join(self._cache_body_chunks),)
+        self._cache_body_chunks = None
+        response = self._response_cache.get(key)
+        if response is not None:
+            self._send_cached_response(response)
+            return
+        self._run_handler_code(self._command.do_end, (), {})
+        if self.response is not None:
+            self.response = self._response_cache.add(
+                key, self.response, self._cache_key_is_current)
+
+    def _record_response(self):
+        """Record the request in the server statistics, once answered.
+
+        Streamed bodies are recorded once they have been completely sent, so
+        the response is replaced by one timing its body stream.
+        """
+        if self._stats_verb is None or self.response is None:
+            return
+        verb = self._stats_verb
+        self._stats_verb = None
+        response = self.response
+        if response.body_stream is None:
+            self._stats.request_served(
+                verb, osutils.perf_counter() - self._stats_start_time,
+                _response_error(response))
+            return
+        self.response = response.__class__(
+            response.args, body_stream=self._recording_stream(verb, response))
+
+    def _recording_stream(self, verb, response):
+        error = _response_error(response)
+        try:
+            for chunk in response.body_stream:
+                if isinstance(chunk, FailedSmartServerResponse):
+                    error = _response_error(chunk)
+                yield chunk
+        finally:
+            self._stats.request_served(
+                verb, osutils.perf_counter() - self._stats_start_time, error)
 
     def end_received(self):
         if self._command is None:
             # no active command object, so ignore the event.
             return
-        self._run_handler_code(self._command.do_end, (), {})
+        self._end_of_request()
+        self._record_response()
         if 'hpss' in debug.debug_flags:
             self._trace('end', '', include_time=True)
 
@@ -413,6 +647,15 @@ class SmartServerRequestHandler(object):
         pass
 
 
+def _response_error(response):
+    """Return the error name of a failed response, or None."""
+    if response.is_successful():
+        return None
+    if response.args:
+        return response.args[0]
+    return b''
+
+
 def _translate_error(err):
     if isinstance(err, _mod_transport.NoSuchFile):
         return (b'NoSuchFile', err.path.encode('utf-8'))
@@ -665,6 +908,9 @@ request_handlers.register_lazy(
 request_handlers.register_lazy(
     b'BzrDir.open_branchV3', 'breezy.bzr.smart.bzrdir',
     'SmartServerRequestOpenBranchV3', info='read')
+request_handlers.register_lazy(
+    b'BzrDir.open_branchV4', 'breezy.bzr.smart.bzrdir',
+    'SmartServerRequestOpenBranchV4', info='read')
 request_handlers.register_lazy(
     b'delete', 'breezy.bzr.smart.vfs', 'DeleteRequest', info='semivfs')
 request_handlers.register_lazy(
@@ -710,6 +956,9 @@ request_handlers.register_lazy(
 request_handlers.register_lazy(
     b'Repository.gather_stats', 'breezy.bzr.smart.repository',
     'SmartServerRepositoryGatherStats', info='read')
+request_handlers.register_lazy(
+    b'Repository.get_insert_checkpoint', 'breezy.bzr.smart.repository',
+    'SmartServerRepositoryGetInsertCheckpoint', info='mutate')
 request_handlers.register_lazy(
     b'Repository.get_parent_map', 'breezy.bzr.smart.repository',
     'SmartServerRepositoryGetParentMap', info='read')
@@ -731,6 +980,9 @@ request_handlers.register_lazy(
 request_handlers.register_lazy(
     b'Repository.insert_stream_1.19', 'breezy.bzr.smart.repository',
     'SmartServerRepositoryInsertStream_1_19', info='stream')
+request_handlers.register_lazy(
+    b'Repository.insert_stream_checkpoint', 'breezy.bzr.smart.repository',
+    'SmartServerRepositoryInsertStreamCheckpoint', info='stream')
 request_handlers.register_lazy(
     b'Repository.insert_stream_locked', 'breezy.bzr.smart.repository',
     'SmartServerRepositoryInsertStreamLocked', info='stream')
@@ -794,6 +1046,9 @@ request_handlers.register_lazy(
 request_handlers.register_lazy(
     b'Repository.tarball', 'breezy.bzr.smart.repository',
     'SmartServerRepositoryTarball', info='read')
+request_handlers.register_lazy(
+    b'Repository.walk_to_common', 'breezy.bzr.smart.repository',
+    'SmartServerRepositoryWalkToCommon', info='read')
 request_handlers.register_lazy(
     b'VersionedFileRepository.get_serializer_format', 'breezy.bzr.smart.repository',
     'SmartServerRepositoryGetSerializerFormat', info='read')
@@ -34,6 +34,7 @@ from ...lazy_import import lazy_import
 lazy_import(globals(), """
 from breezy.bzr.smart import (
     medium,
+    request,
     signals,
     )
 from breezy.transport import (
@@ -434,8 +435,8 @@ class BzrServerFactory(object):
         return sys.stdin.buffer, sys.stdout.buffer
 
     def _make_smart_server(self, host, port, inet, timeout):
+        c = config.GlobalStack()
         if timeout is None:
-            c = config.GlobalStack()
             timeout = c.get('serve.client_timeout')
         if inet:
             stdin, stdout = self._get_stdin_stdout()
@@ -446,8 +447,24 @@ class BzrServerFactory(object):
                 host = medium.BZR_DEFAULT_INTERFACE
             if port is None:
                 port = medium.BZR_DEFAULT_PORT
-            smart_server = SmartTCPServer(self.transport,
-                                          client_timeout=timeout)
+            max_workers = c.get('serve.max_workers')
+            worker_processes = c.get('serve.worker_processes')
+            if worker_processes:
+                from .prefork import PreforkSmartTCPServer
+                smart_server = PreforkSmartTCPServer(
+                    self.transport, client_timeout=timeout,
+                    workers=worker_processes,
+                    max_requests=c.get('serve.worker_max_requests'))
+            elif max_workers:
+                from .async_server import AsyncSmartTCPServer
+                smart_server = AsyncSmartTCPServer(
+                    self.transport, client_timeout=timeout,
+                    max_workers=max_workers,
+                    max_requests_per_client=c.get(
+                        'serve.max_requests_per_client'))
+            else:
+                smart_server = SmartTCPServer(self.transport,
+                                              client_timeout=timeout)
             smart_server.start_server(host, port)
             trace.note(gettext('listening on port: %s'),
                        str(smart_server.port))
@@ -468,32 +485,82 @@ class BzrServerFactory(object):
         self.cleanups.append(restore_default_ui_factory_and_lockdir_timeout)
         ui.ui_factory = ui.SilentUIFactory()
         lockdir._DEFAULT_TIMEOUT_SECONDS = 0
+        response_cache_size = config.GlobalStack().get(
+            'serve.response_cache_size')
+        if response_cache_size:
+            old_response_cache = request.response_cache
+
+            def restore_response_cache():
+                request.response_cache = old_response_cache
+            self.cleanups.append(restore_response_cache)
+            request.response_cache = request.SmartServerResponseCache(
+                response_cache_size)
         orig = signals.install_sighup_handler()
 
         def restore_signals():
             signals.restore_sighup_handler(orig)
         self.cleanups.append(restore_signals)
 
-    def set_up(self, transport, host, port, inet, timeout):
+    def _start_stats_server(self, inet, stats_port):
+        """Publish the statistics of the server on stats_port, if set.
+
+        They are published on the serve.stats_listen interface rather than the
+        one the server listens on, as anyone can read them.
+
+        The pipe server of --inet serves a single client, and the worker
+        processes of a prefork server each keep their own statistics, so they
+        are not published for these.
+        """
+        conf = config.GlobalStack()
+        if stats_port is None:
+            stats_port = conf.get('serve.stats_port')
+        if stats_port is None or inet:
+            return
+        from .prefork import PreforkSmartTCPServer
+        if isinstance(self.smart_server, PreforkSmartTCPServer):
+            trace.warning(gettext(
+                'Statistics are not available with worker processes.'))
+            return
+        from .stats import SmartServerStats, SmartServerStatsServer
+        old_server_stats = request.server_stats
+
+        def restore_server_stats():
+            request.server_stats = old_server_stats
+        self.cleanups.append(restore_server_stats)
+        request.server_stats = SmartServerStats()
+        self.stats_server = SmartServerStatsServer(request.server_stats)
+        self.stats_server.start_server(conf.get('serve.stats_listen'),
+                                       stats_port)
+        self.cleanups.append(self.stats_server.stop_server)
+        trace.note(gettext('statistics on port: %s'),
+                   str(self.stats_server.port))
+
+    def set_up(self, transport, host, port, inet, timeout, stats_port=None):
         self._make_backing_transport(transport)
         self._make_smart_server(host, port, inet, timeout)
         self._change_globals()
+        self._start_stats_server(inet, stats_port)
 
     def tear_down(self):
         for cleanup in reversed(self.cleanups):
             cleanup()
 
 
-def serve_bzr(transport, host=None, port=None, inet=False, timeout=None):
+def serve_bzr(transport, host=None, port=None, inet=False, timeout=None,
+              stats_port=None):
     """This is the default implementation of 'bzr serve'.
 
     It creates a TCP or pipe smart server on 'transport, and runs it.  The
     transport will be decorated with a chroot and pathfilter (using
     os.path.expanduser).
+
+    :param stats_port: The TCP port to publish the statistics of the server
+        on, or None to use the serve.stats_port option.
     """
     bzr_server = BzrServerFactory()
     try:
-        bzr_server.set_up(transport, host, port, inet, timeout)
+        bzr_server.set_up(transport, host, port, inet, timeout,
+                          stats_port=stats_port)
         bzr_server.smart_server.serve()
     except:
         hook_caught_exception = False
@@ -0,0 +1,252 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Statistics about the requests served by a smart server.
+
+While breezy.bzr.smart.request.server_stats is set to a SmartServerStats,
+the request handlers record the verb, duration and outcome of every request
+they serve in it, and the server media the bytes they transfer and the
+connections they serve.
+
+SmartServerStatsServer publishes them over HTTP in the Prometheus text
+exposition format, see 'brz serve --stats-port'.
+"""
+
+import bisect
+from http import server as http_server
+import threading
+
+from ... import (
+    errors,
+    trace,
+    )
+
+
+class _VerbStats(object):
+    """The statistics of the requests of a single verb."""
+
+    __slots__ = ('requests', 'errors', 'lock_contentions', 'seconds',
+                 'bucket_counts')
+
+    def __init__(self, bucket_count):
+        self.requests = 0
+        self.errors = 0
+        self.lock_contentions = 0
+        self.seconds = 0.0
+        # The number of requests in each latency bucket, and above them.
+        self.bucket_counts = [0] * (bucket_count + 1)
+
+
+class SmartServerStats(object):
+    """Counters of the activity of a smart server.
+
+    They are shared by all the connections of a server, so it is safe to
+    update them from several threads.
+    """
+
+    # The upper bounds, in seconds, of the request duration histogram.
+    latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                       5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._verbs = {}
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.connections = 0
+        self.active_connections = 0
+
+    def request_served(self, verb, seconds, error=None):
+        """Record a request.
+
+        :param verb: the verb of the request.
+        :param seconds: how long it took to serve the request, including
+            sending its response.
+        :param error: the error name of the failed response, or None if the
+            request succeeded.
+        """
+        bucket = bisect.bisect_left(self.latency_buckets, seconds)
+        with self._lock:
+            stats = self._verbs.get(verb)
+            if stats is None:
+                stats = self._verbs[verb] = _VerbStats(
+                    len(self.latency_buckets))
+            stats.requests += 1
+            stats.seconds += seconds
+            stats.bucket_counts[bucket] += 1
+            if error is not None:
+                stats.errors += 1
+                if error == b'LockContention':
+                    stats.lock_contentions += 1
+
+    def bytes_transferred(self, count, direction):
+        """Record bytes read from or written to a client.
+
+        :param direction: 'read' or 'write', as for
+            SmartMedium._report_activity.
+        """
+        with self._lock:
+            if direction == 'read':
+                self.bytes_received += count
+            elif direction == 'write':
+                self.bytes_sent += count
+
+    def connection_opened(self):
+        with self._lock:
+            self.connections += 1
+            self.active_connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def verb_stats(self, verb):
+        """Return (requests, errors, lock contentions, seconds) for verb."""
+        with self._lock:
+            stats = self._verbs.get(verb)
+            if stats is None:
+                return (0, 0, 0, 0.0)
+            return (stats.requests, stats.errors, stats.lock_contentions,
+                    stats.seconds)
+
+    def to_prometheus(self, response_cache=None):
+        """Render the statistics in the Prometheus text exposition format.
+
+        :param response_cache: the SmartServerResponseCache of the server, to
+            report its hits and misses, or None.
+        :return: a text string.
+        """
+        with self._lock:
+            verbs = sorted(
+                (_escape_label(verb), stats.requests, stats.errors,
+                 stats.lock_contentions, stats.seconds,
+                 list(stats.bucket_counts))
+                for verb, stats in self._verbs.items())
+            totals = [
+                ('received_bytes_total', 'counter',
+                 'Bytes received from clients.', self.bytes_received),
+                ('sent_bytes_total', 'counter',
+                 'Bytes sent to clients.', self.bytes_sent),
+                ('connections_total', 'counter',
+                 'Client connections accepted.', self.connections),
+                ('active_connections', 'gauge',
+                 'Client connections being served.',
+                 self.active_connections),
+                ]
+        if response_cache is not None:
+            totals.extend([
+                ('response_cache_hits_total', 'counter',
+                 'Requests answered from the response cache.',
+                 response_cache.hits),
+                ('response_cache_misses_total', 'counter',
+                 'Cacheable requests not found in the response cache.',
+                 response_cache.misses),
+                ])
+        lines = []
+
+        def header(name, kind, description):
+            lines.append('# HELP bzr_smart_%s %s' % (name, description))
+            lines.append('# TYPE bzr_smart_%s %s' % (name, kind))
+
+        for name, index, description in [
+                ('requests_total', 1, 'Requests served.'),
+                ('request_errors_total', 2, 'Requests that failed.'),
+                ('lock_contentions_total', 3,
+                 'Requests that failed to take a lock held by another '
+                 'client.'),
+                ]:
+            header(name, 'counter', description)
+            for verb in verbs:
+                lines.append('bzr_smart_%s{verb="%s"} %d'
+                             % (name, verb[0], verb[index]))
+        header('request_duration_seconds', 'histogram',
+               'Time taken to serve requests, including sending the '
+               'response.')
+        for verb, requests, _, _, seconds, bucket_counts in verbs:
+            cumulative = 0
+            bounds = ['%g' % bound for bound in self.latency_buckets]
+            for bound, count in zip(bounds + ['+Inf'], bucket_counts):
+                cumulative += count
+                lines.append(
+                    'bzr_smart_request_duration_seconds_bucket'
+                    '{verb="%s",le="%s"} %d' % (verb, bound, cumulative))
+            lines.append('bzr_smart_request_duration_seconds_sum{verb="%s"}'
+                         ' %.6f' % (verb, seconds))
+            lines.append('bzr_smart_request_duration_seconds_count'
+                         '{verb="%s"} %d' % (verb, requests))
+        for name, kind, description, value in totals:
+            header(name, kind, description)
+            lines.append('bzr_smart_%s %d' % (name, value))
+        return ''.join(line + '\n' for line in lines)
+
+
+def _escape_label(verb):
+    value = verb.decode('utf-8', 'replace')
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class _StatsRequestHandler(http_server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        from . import request
+        body = self.server.stats.to_prometheus(
+            response_cache=request.response_cache).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        trace.mutter('smart server stats: %s - %s'
+                     % (self.address_string(), format % args))
+
+
+class SmartServerStatsServer(object):
+    """Serves the statistics of a smart server over HTTP, in a thread."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._server = None
+        self._thread = None
+
+    def start_server(self, host, port):
+        """Start serving the statistics.
+
+        :param host: Name of the interface to listen on.
+        :param port: TCP port to listen on, or 0 to allocate a transient port.
+        """
+        try:
+            self._server = http_server.ThreadingHTTPServer(
+                (host, port), _StatsRequestHandler)
+        except OSError as e:
+            raise errors.CannotBindAddress(host, port, e)
+        self._server.daemon_threads = True
+        self._server.stats = self.stats
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = threading.Thread(
+            None, self._server.serve_forever, name='smart-server-stats',
+            daemon=True)
+        self._thread.start()
+
+    def stop_server(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
@@ -61,6 +61,7 @@ def load_tests(loader, basic_tests, pattern):
         'test__rio',
         'test__simple_set',
         'test__static_tuple',
+        'test_annotation_cache',
         'test_btree_index',
         'test_bundle',
         'test_bzrdir',
@@ -83,6 +84,7 @@ def load_tests(loader, basic_tests, pattern):
         'test_smart',
         'test_smart_request',
         'test_smart_signals',
+        'test_smart_stats',
         'test_smart_transport',
         'test_serializer',
         'test_tag',
@@ -0,0 +1,97 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the persistent annotation cache."""
+
+import os
+
+from ... import (
+    tests,
+    transport,
+    )
+from .. import (
+    annotation_cache,
+    )
+
+
+class TestAnnotationCache(tests.TestCaseWithMemoryTransport):
+
+    def make_cache(self):
+        return annotation_cache.AnnotationCache(
+            self.get_transport().clone('cache'))
+
+    def test_missing(self):
+        cache = self.make_cache()
+        self.assertIs(None, cache.get((b'f-id', b'rev-1')))
+        self.assertFalse((b'f-id', b'rev-1') in cache)
+
+    def test_put_get(self):
+        cache = self.make_cache()
+        annotations = [((b'f-id', b'rev-1'),),
+                       ((b'f-id', b'rev-2'), (b'f-id', b'rev-1b')),
+                       ((b'f-id', b'rev-1'),)]
+        cache.put((b'f-id', b'rev-2'), [b'one\n', b'two\n', b'three\n'],
+                  annotations, 2)
+        self.assertTrue((b'f-id', b'rev-2') in cache)
+        expected = ([b'one\n', b'two\n', b'three\n'], annotations)
+        self.assertEqual(expected, cache.get((b'f-id', b'rev-2')))
+        # A fresh instance reads the stored entry
+        self.assertEqual(expected,
+                         self.make_cache().get((b'f-id', b'rev-2')))
+
+    def test_corrupt_entry_ignored(self):
+        cache = self.make_cache()
+        cache.put((b'f-id', b'rev-1'), [b'one\n'], [((b'f-id', b'rev-1'),)],
+                  1)
+        dirname, name = cache._names((b'f-id', b'rev-1'))
+        self.get_transport('cache').put_bytes(
+            dirname + '/' + name, b'garbage')
+        self.assertIs(None, cache.get((b'f-id', b'rev-1')))
+
+    def test_cheap_texts_not_stored(self):
+        cache = self.make_cache()
+        cache.min_depth = 3
+        cache.put((b'f-id', b'rev-2'), [b'one\n'], [((b'f-id', b'rev-1'),)],
+                  2)
+        self.assertFalse((b'f-id', b'rev-2') in cache)
+        cache.put((b'f-id', b'rev-3'), [b'one\n'], [((b'f-id', b'rev-1'),)],
+                  3)
+        self.assertTrue((b'f-id', b'rev-3') in cache)
+
+
+class TestAnnotationCachePruning(tests.TestCaseInTempDir):
+
+    def make_cache(self):
+        return annotation_cache.AnnotationCache(
+            transport.get_transport_from_path('cache'))
+
+    def put(self, cache, revision):
+        cache.put((b'f-id', revision), [b'one\n'],
+                  [((b'f-id', b'rev-1'),)], 1)
+        return os.path.join('cache', *cache._names((b'f-id', revision)))
+
+    def test_oldest_entries_removed(self):
+        cache = self.make_cache()
+        path = self.put(cache, b'rev-1')
+        os.utime(path, (1000, 1000))
+        cache = self.make_cache()
+        cache.max_size = 2 * os.path.getsize(path)
+        os.utime(self.put(cache, b'rev-2'), (2000, 2000))
+        self.put(cache, b'rev-3')
+        self.assertEqual(
+            [False, True, True],
+            [(b'f-id', revision) in self.make_cache()
+             for revision in (b'rev-1', b'rev-2', b'rev-3')])
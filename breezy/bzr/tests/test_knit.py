@@ -28,6 +28,7 @@ from ... import (
     tests,
     transport as _mod_transport,
     )
+from ...transport import trace
 from .. import (
     knit,
     pack,
@@ -286,18 +287,28 @@ class MockTransport(object):
         else:
             return BytesIO(b"\n".join(self.file_lines))
 
-    def readv(self, relpath, offsets):
+    def readv(self, relpath, offsets, adjust_for_latency=False,
+              upper_limit=None):
         fp = self.get(relpath)
         for offset, size in offsets:
             fp.seek(offset)
             yield offset, fp.read(size)
 
+    def get_async(self):
+        return _mod_transport.AsyncTransport(self)
+
     def __getattr__(self, name):
         def queue_call(*args, **kwargs):
             self.calls.append((name, args, kwargs))
         return queue_call
 
 
+class ConcurrentAsyncTransport(_mod_transport.AsyncTransport):
+    """An AsyncTransport claiming to run its requests concurrently."""
+
+    concurrent = True
+
+
 class MockReadvFailingTransport(MockTransport):
     """Fail in the middle of a readv() result.
 
@@ -305,7 +316,8 @@ class MockReadvFailingTransport(MockTransport):
     raise NoSuchFile for the rest.
     """
 
-    def readv(self, relpath, offsets):
+    def readv(self, relpath, offsets, adjust_for_latency=False,
+              upper_limit=None):
         count = 0
         for result in MockTransport.readv(self, relpath, offsets):
             count += 1
@@ -523,6 +535,45 @@ class TestPackKnitAccess(TestCaseWithMemoryTransport, KnitRecordAccessTestsMixin
         self.assertEqual([b'1234567890', b'alpha'],
                          list(access.get_raw_records(memos[0:1] + memos[2:3])))
 
+    def make_traced_access(self):
+        """Make an access to two packs over a trace transport."""
+        access, writer = self._get_access()
+        memos = []
+        memos.extend(access.add_raw_records(
+            [(b'key', 10), (b'key2', 5)], [b'1234567890', b'abcde']))
+        writer.end()
+        access, writer = self._get_access('pack2', 'FOOBAR')
+        memos.extend(access.add_raw_records([(b'key', 5)], [b'12345']))
+        writer.end()
+        transport = self.get_transport()
+        transport = trace.TransportTraceDecorator(
+            'trace+' + transport.base, _decorated=transport)
+        access = pack_repo._DirectPackAccess({"FOO": (transport, 'packfile'),
+                                              "FOOBAR": (transport, 'pack2')})
+        self.overrideAttr(access, '_max_readv_bytes', 10)
+        self.overrideAttr(access, '_max_readv_ahead', 2)
+        return access, transport, memos
+
+    def test_read_ahead_in_chunks(self):
+        access, transport, memos = self.make_traced_access()
+        transport.get_async = lambda: ConcurrentAsyncTransport(transport)
+        self.assertEqual([b'1234567890', b'abcde', b'12345'],
+                         list(access.get_raw_records(memos)))
+        # Each record is read by its own request
+        self.assertEqual(
+            [('packfile', 1), ('packfile', 1), ('packfile', 1),
+             ('pack2', 1), ('pack2', 1)],
+            [(call[1], len(call[2])) for call in transport._activity])
+
+    def test_no_chunks_without_concurrency(self):
+        access, transport, memos = self.make_traced_access()
+        self.assertEqual([b'1234567890', b'abcde', b'12345'],
+                         list(access.get_raw_records(memos)))
+        # Requests can't overlap, each pack is read by a single request
+        self.assertEqual(
+            [('packfile', 3), ('pack2', 2)],
+            [(call[1], len(call[2])) for call in transport._activity])
+
     def test_set_writer(self):
         """The writer should be settable post construction."""
         access = pack_repo._DirectPackAccess({})
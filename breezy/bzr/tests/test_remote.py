@@ -457,7 +457,7 @@ class TestBzrDirCloningMetaDir(TestRemote):
             b'BzrDir.cloning_metadir', (b'quack/', b'False'),
             b'error', (b'BranchReference',)),
         client.add_expected_call(
-            b'BzrDir.open_branchV3', (b'quack/',),
+            b'BzrDir.open_branchV4', (b'quack/',),
             b'success', (b'ref', self.get_url('referenced').encode('utf-8'))),
         a_controldir = RemoteBzrDir(transport, RemoteBzrDirFormat(),
                                     _client=client)
@@ -713,12 +713,40 @@ class TestBzrDirOpenBranch(TestRemote):
         self.make_branch('.')
         a_dir = BzrDir.open(self.get_url('.'))
         self.reset_smart_call_log()
-        verb = b'BzrDir.open_branchV3'
-        self.disable_verb(verb)
+        for verb in [b'BzrDir.open_branchV4', b'BzrDir.open_branchV3']:
+            self.disable_verb(verb)
         a_dir.open_branch()
-        call_count = len([call for call in self.hpss_calls if
-                          call.call.method == verb])
-        self.assertEqual(1, call_count)
+        for verb in [b'BzrDir.open_branchV4', b'BzrDir.open_branchV3']:
+            call_count = len([call for call in self.hpss_calls if
+                              call.call.method == verb])
+            self.assertEqual(1, call_count)
+
+    def test_single_round_trip(self):
+        self.setup_smart_server_with_call_log()
+        local_branch = self.make_branch('.')
+        local_branch.tags.set_tag('tag-1', b'rev-1')
+        a_dir = BzrDir.open(self.get_url('.'))
+        self.reset_smart_call_log()
+        branch = a_dir.open_branch()
+        with branch.lock_read():
+            self.assertEqual((0, b'null:'), branch.last_revision_info())
+            self.assertEqual({'tag-1': b'rev-1'}, branch.tags.get_tag_dict())
+        self.assertEqual(
+            None, branch.get_config_stack().get('parent_location'))
+        self.assertEqual(
+            [b'BzrDir.open_branchV4'],
+            [call.call.method for call in self.hpss_calls])
+
+    def test_tip_not_used_once_changed(self):
+        self.setup_smart_server_with_call_log()
+        builder = self.make_branch_builder('.')
+        builder.build_commit(message="Commit.")
+        branch = BzrDir.open(self.get_url('.')).open_branch()
+        other = BzrDir.open(self.get_url('.')).open_branch()
+        with other.lock_write():
+            other.set_last_revision_info(0, b'null:')
+        with branch.lock_read():
+            self.assertEqual((0, b'null:'), branch.last_revision_info())
 
     def test_branch_present(self):
         reference_format = self.get_repo_format()
@@ -728,6 +756,84 @@ class TestBzrDirOpenBranch(TestRemote):
         transport.mkdir('quack')
         transport = transport.clone('quack')
         client = FakeClient(transport.base)
+        client.add_expected_call(
+            b'BzrDir.open_branchV4', (b'quack/',),
+            b'success', (b'branch', branch_network_name, b'1', b'rev-tip',
+                         b'', b'', b'no', b'no', b'no', network_name),
+            bencode.bencode([b'parent_location = /parent\n', b'']))
+        bzrdir = RemoteBzrDir(transport, RemoteBzrDirFormat(),
+                              _client=client)
+        result = bzrdir.open_branch()
+        self.assertIsInstance(result, RemoteBranch)
+        self.assertEqual(bzrdir, result.controldir)
+        self.assertEqual(network_name,
+                         result.repository._format.network_name())
+        self.assertEqual((1, b'rev-tip'), result.last_revision_info())
+        self.assertEqual(
+            '/parent', result.get_config_stack().get('parent_location'))
+        self.assertFinished(client)
+
+    def test_branch_present_in_shared_repository(self):
+        network_name = self.get_repo_format().network_name()
+        branch_network_name = self.get_branch_format().network_name()
+        transport = MemoryTransport()
+        transport.mkdir('quack')
+        transport = transport.clone('quack')
+        client = FakeClient(transport.base)
+        client.add_expected_call(
+            b'BzrDir.open_branchV4', (b'quack/',),
+            b'success', (b'branch', branch_network_name, b'1', b'rev-tip',
+                         b'', b'..', b'no', b'no', b'no', network_name),
+            bencode.bencode([b'', b'']))
+        bzrdir = RemoteBzrDir(transport, RemoteBzrDirFormat(),
+                              _client=client)
+        # The repository is found as usual.
+        found = []
+        bzrdir.find_repository = lambda: found.append(True) or 'repo'
+        result = bzrdir.open_branch()
+        self.assertEqual('repo', result.repository)
+        self.assertEqual([True], found)
+        self.assertFinished(client)
+
+    def test_tip_not_used_once_write_locked(self):
+        network_name = self.get_repo_format().network_name()
+        branch_network_name = self.get_branch_format().network_name()
+        transport = MemoryTransport()
+        transport.mkdir('quack')
+        transport = transport.clone('quack')
+        client = FakeClient(transport.base)
+        client.add_expected_call(
+            b'BzrDir.open_branchV4', (b'quack/',),
+            b'success', (b'branch', branch_network_name, b'1', b'rev-tip',
+                         b'', b'', b'no', b'no', b'no', network_name),
+            bencode.bencode([b'', b'']))
+        client.add_expected_call(
+            b'Branch.lock_write', (b'quack/', b'', b''),
+            b'success', (b'ok', b'branch token', b'repo token'))
+        client.add_expected_call(
+            b'Branch.last_revision_info', (b'quack/',),
+            b'success', (b'ok', b'2', b'rev-new-tip'))
+        client.add_expected_call(
+            b'Branch.unlock', (b'quack/', b'branch token', b'repo token'),
+            b'success', (b'ok',))
+        bzrdir = RemoteBzrDir(transport, RemoteBzrDirFormat(),
+                              _client=client)
+        branch = bzrdir.open_branch()
+        with branch.lock_write():
+            self.assertEqual((2, b'rev-new-tip'), branch.last_revision_info())
+        self.assertFinished(client)
+
+    def test_branch_present_old_server(self):
+        reference_format = self.get_repo_format()
+        network_name = reference_format.network_name()
+        branch_network_name = self.get_branch_format().network_name()
+        transport = MemoryTransport()
+        transport.mkdir('quack')
+        transport = transport.clone('quack')
+        client = FakeClient(transport.base)
+        client.add_expected_call(
+            b'BzrDir.open_branchV4', (b'quack/',),
+            b'unknown', (b'BzrDir.open_branchV4',))
         client.add_expected_call(
             b'BzrDir.open_branchV3', (b'quack/',),
             b'success', (b'branch', branch_network_name))
@@ -754,7 +860,7 @@ class TestBzrDirOpenBranch(TestRemote):
                               _client=client)
         self.assertRaises(errors.NotBranchError, bzrdir.open_branch)
         self.assertEqual(
-            [('call', b'BzrDir.open_branchV3', (b'quack/',))],
+            [('call_expecting_body', b'BzrDir.open_branchV4', (b'quack/',))],
             client._calls)
 
     def test__get_tree_branch(self):
@@ -785,14 +891,10 @@ class TestBzrDirOpenBranch(TestRemote):
         network_name = reference_format.network_name()
         branch_network_name = self.get_branch_format().network_name()
         client.add_expected_call(
-            b'BzrDir.open_branchV3', (b'~hello/',),
-            b'success', (b'branch', branch_network_name))
-        client.add_expected_call(
-            b'BzrDir.find_repositoryV3', (b'~hello/',),
-            b'success', (b'ok', b'', b'no', b'no', b'no', network_name))
-        client.add_expected_call(
-            b'Branch.get_stacked_on_url', (b'~hello/',),
-            b'error', (b'NotStacked',))
+            b'BzrDir.open_branchV4', (b'~hello/',),
+            b'success', (b'branch', branch_network_name, b'0', b'null:',
+                         b'', b'', b'no', b'no', b'no', network_name),
+            bencode.bencode([b'', b'']))
         bzrdir = RemoteBzrDir(transport, RemoteBzrDirFormat(),
                               _client=client)
         bzrdir.open_branch()
@@ -1414,6 +1516,35 @@ class TestBranchHeadsToFetch(RemoteBranchTestCase):
         self.assertFinished(client)
         self.assertEqual(({b'rev-tip'}, set()), result)
 
+    def test_pipelines_last_revision_info_and_config(self):
+        transport = MemoryTransport()
+        client = FakeClient(transport.base)
+        client.add_expected_call(
+            b'Branch.get_stacked_on_url', (b'quack/',),
+            b'error', (b'NotStacked',))
+        client.add_expected_call(
+            b'Branch.last_revision_info', (b'quack/',),
+            b'success', (b'ok', b'1', b'rev-tip'))
+        client.add_expected_call(
+            b'Branch.get_config_file', (b'quack/',),
+            b'success', (b'ok',), b'')
+        transport.mkdir('quack')
+        transport = transport.clone('quack')
+        branch = self.make_remote_branch(transport, client)
+        pipelined = []
+        call_pipelined = client.call_pipelined
+
+        def record_call_pipelined(calls):
+            pipelined.append([verb for verb, args, expect_body in calls])
+            return call_pipelined(calls)
+        client.call_pipelined = record_call_pipelined
+        result = branch.heads_to_fetch()
+        self.assertFinished(client)
+        self.assertEqual(({b'rev-tip'}, set()), result)
+        self.assertEqual(
+            [[b'Branch.last_revision_info', b'Branch.get_config_file']],
+            pipelined)
+
     def test_uses_last_revision_info_and_tags_when_set(self):
         transport = MemoryTransport()
         client = FakeClient(transport.base)
@@ -1576,6 +1707,9 @@ class TestBranch_get_stacked_on_url(TestRemote):
         stacked_branch.set_stacked_on_url('../base')
         client = FakeClient(self.get_url())
         branch_network_name = self.get_branch_format().network_name()
+        client.add_expected_call(
+            b'BzrDir.open_branchV4', (b'stacked/',),
+            b'unknown', (b'BzrDir.open_branchV4',))
         client.add_expected_call(
             b'BzrDir.open_branchV3', (b'stacked/',),
             b'success', (b'branch', branch_network_name))
@@ -1613,15 +1747,12 @@ class TestBranch_get_stacked_on_url(TestRemote):
         client = FakeClient(self.get_url())
         branch_network_name = self.get_branch_format().network_name()
         client.add_expected_call(
-            b'BzrDir.open_branchV3', (b'stacked/',),
-            b'success', (b'branch', branch_network_name))
-        client.add_expected_call(
-            b'BzrDir.find_repositoryV3', (b'stacked/',),
-            b'success', (b'ok', b'', b'yes', b'no', b'yes', network_name))
-        # called twice, once from constructor and then again by us
-        client.add_expected_call(
-            b'Branch.get_stacked_on_url', (b'stacked/',),
-            b'success', (b'ok', b'../base'))
+            b'BzrDir.open_branchV4', (b'stacked/',),
+            b'success', (b'branch', branch_network_name, b'0', b'null:',
+                         b'../base', b'', b'yes', b'no', b'yes',
+                         network_name),
+            bencode.bencode([b'', b'']))
+        # the constructor knows the stacked on url from open_branchV4
         client.add_expected_call(
             b'Branch.get_stacked_on_url', (b'stacked/',),
             b'success', (b'ok', b'../base'))
@@ -2832,6 +2963,120 @@ class TestGetParentMapAllowsNew(tests.TestCaseWithTransport):
                          graph.get_parent_map([b'rev1']))
 
 
+class TestRepositoryFindMissingRevisions(TestRemoteRepository):
+
+    def test_unknown_method(self):
+        repo, client = self.setup_fake_client_and_repository('quack')
+        client.add_unknown_method_response(b'Repository.walk_to_common')
+        target = self.make_repository('target')
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual(
+            None, repo._find_missing_revisions({b'rev1'}, None, target))
+        self.assertEqual(
+            [('call_with_body_bytes_expecting_body',
+              b'Repository.walk_to_common', (b'quack/', b'65536'),
+              b'rev1\n')],
+            client._calls)
+        self.assertTrue(client._medium._is_remote_before((3, 3)))
+        # The server is not asked again
+        self.assertEqual(
+            None, repo._find_missing_revisions({b'rev1'}, None, target))
+        self.assertLength(1, client._calls)
+
+    def test_unlocked(self):
+        repo, client = self.setup_fake_client_and_repository('quack')
+        target = self.make_repository('target')
+        self.assertEqual(
+            None, repo._find_missing_revisions({b'rev1'}, None, target))
+        self.assertEqual([], client._calls)
+
+    def make_source_and_target(self, revision_count, target_revision_count):
+        """Make a remote repository and a local one with part of its history.
+        """
+        self.setup_smart_server_with_call_log()
+        builder = self.make_branch_builder('source')
+        builder.start_series()
+        revids = []
+        parents = None
+        for i in range(revision_count):
+            revid = b'rev%d' % (i + 1,)
+            if parents is None:
+                actions = [('add', ('', b'root-id', 'directory', ''))]
+            else:
+                actions = []
+            builder.build_snapshot(parents, actions, revision_id=revid)
+            parents = [revid]
+            revids.append(revid)
+        builder.finish_series()
+        source = builder.get_branch().repository
+        self.assertIsInstance(source, RemoteRepository)
+        target = BzrDir.create(self.get_vfs_only_url('target'))
+        target = target.create_repository()
+        if target_revision_count:
+            target.fetch(source, revids[target_revision_count - 1])
+        source.lock_read()
+        self.addCleanup(source.unlock)
+        target.lock_read()
+        self.addCleanup(target.unlock)
+        self.reset_smart_call_log()
+        return source, target, revids
+
+    def test_one_round_trip(self):
+        source, target, revids = self.make_source_and_target(10, 5)
+        self.assertEqual(
+            set(revids[5:]),
+            source._find_missing_revisions({revids[-1]}, None, target))
+        self.assertEqual(
+            [b'Repository.walk_to_common'],
+            [call.call.method for call in self.hpss_calls])
+        # The parents are cached
+        self.assertEqual(
+            {revids[5]: (revids[4],)}, source.get_parent_map([revids[5]]))
+        self.assertLength(1, self.hpss_calls)
+
+    def test_several_round_trips(self):
+        self.overrideAttr(RemoteRepository, '_walk_to_common_initial_size', 1)
+        self.overrideAttr(RemoteRepository, '_walk_to_common_max_size', 1)
+        source, target, revids = self.make_source_and_target(10, 5)
+        self.assertEqual(
+            set(revids[5:]),
+            source._find_missing_revisions({revids[-1]}, None, target))
+        # Each response holds a single revision, until the one the target
+        # has.
+        self.assertLength(6, self.hpss_calls)
+
+    def test_nothing_missing(self):
+        source, target, revids = self.make_source_and_target(3, 3)
+        self.assertEqual(
+            set(), source._find_missing_revisions({revids[-1]}, None, target))
+
+    def test_empty_target(self):
+        source, target, revids = self.make_source_and_target(3, 0)
+        self.assertEqual(
+            set(revids),
+            source._find_missing_revisions({revids[-1]}, None, target))
+
+    def test_absent_revision(self):
+        source, target, revids = self.make_source_and_target(3, 0)
+        self.assertRaises(
+            errors.NoSuchRevision, source._find_missing_revisions,
+            {b'absent'}, None, target)
+        self.assertEqual(
+            set(revids),
+            source._find_missing_revisions(
+                {revids[-1]}, {b'absent'}, target))
+
+    def test_search_missing_revision_ids(self):
+        source, target, revids = self.make_source_and_target(10, 5)
+        result = target.search_missing_revision_ids(
+            source, revision_ids=[revids[-1]], find_ghosts=False)
+        self.assertEqual(set(revids[5:]), result.get_keys())
+        self.assertEqual(
+            [b'Repository.walk_to_common'],
+            [call.call.method for call in self.hpss_calls])
+
+
 class TestRepositoryGetRevisions(TestRemoteRepository):
 
     def test_hpss_missing_revision(self):
@@ -3598,6 +3843,194 @@ class TestRepositoryInsertStream_1_19(TestRepositoryInsertStreamBase):
         self.checkInsertEmptyStream(repo, client)
 
 
+class TestRepositoryInsertStreamCheckpoints(TestRepositoryInsertStreamBase):
+
+    upload_id = b'a' * 40
+
+    def insert_empty_stream(self, repo):
+        sink = repo._get_sink()
+        fmt = repository.format_registry.get_default()
+        return sink.insert_stream([], fmt, [], upload_id=self.upload_id)
+
+    def set_checkpoint_size(self, size):
+        self.overrideAttr(
+            config, 'GlobalStack',
+            lambda: config.MemoryStack(
+                b'smart.insert_checkpoint_size=%d' % (size,)))
+
+    def test_unknown_method(self):
+        repo, client = self.setup_fake_client_and_repository('quack')
+        client.add_expected_call(
+            b'Repository.get_insert_checkpoint', (b'quack/', self.upload_id),
+            b'unknown', (b'Repository.get_insert_checkpoint',))
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b''),
+            b'success', (b'ok',))
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b''),
+            b'success', (b'ok',))
+        self.assertEqual(([], set()), self.insert_empty_stream(repo))
+        self.assertFinished(client)
+        self.assertTrue(client._medium._is_remote_before((3, 3)))
+
+    def test_no_checkpoint(self):
+        repo, client = self.setup_fake_client_and_repository('quack')
+        client.add_expected_call(
+            b'Repository.get_insert_checkpoint', (b'quack/', self.upload_id),
+            b'success', (b'no-checkpoint',), b'')
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b''),
+            b'success', (b'ok',))
+        self.assertEqual(([], set()), self.insert_empty_stream(repo))
+        self.assertFinished(client)
+
+    def test_unsupported(self):
+        repo, client = self.setup_fake_client_and_repository('quack')
+        client.add_expected_call(
+            b'Repository.get_insert_checkpoint', (b'quack/', self.upload_id),
+            b'success', (b'unsupported',), b'')
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b''),
+            b'success', (b'ok',))
+        self.assertEqual(([], set()), self.insert_empty_stream(repo))
+        self.assertFinished(client)
+
+    def test_disabled(self):
+        self.set_checkpoint_size(0)
+        repo, client = self.setup_fake_client_and_repository('quack')
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b''),
+            b'success', (b'ok',))
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b''),
+            b'success', (b'ok',))
+        self.assertEqual(([], set()), self.insert_empty_stream(repo))
+        self.assertFinished(client)
+
+    def test_commits_checkpoint(self):
+        repo, client = self.setup_fake_client_and_repository('quack')
+        client.add_expected_call(
+            b'Repository.get_insert_checkpoint', (b'quack/', self.upload_id),
+            b'success', (b'ok', bencode.bencode([b'token'])),
+            zlib.compress(bencode.bencode([])))
+        client.add_expected_call(
+            b'Repository.insert_stream_1.19', (b'quack/', b'token'),
+            b'success', (b'ok',))
+        self.assertEqual(([], set()), self.insert_empty_stream(repo))
+        self.assertFinished(client)
+
+    def test_skip_held_records(self):
+        sink = remote.RemoteStreamSink(None)
+
+        class FakeRefRecord(object):
+            storage_kind = 'groupcompress-block-ref'
+            parents = None
+            sha1 = None
+
+            def __init__(self, key):
+                self.key = key
+
+            def get_bytes_as(self, storage_kind):
+                return [b'content of ', self.key[0]]
+
+        def block(*keys):
+            records = [versionedfile.FulltextContentFactory(
+                keys[0], None, None, b'block')]
+            records[0].storage_kind = 'groupcompress-block'
+            records.extend(FakeRefRecord(key) for key in keys[1:])
+            return records
+        stream = [('texts', block((b'a',), (b'b',), (b'c',)) +
+                   block((b'd',), (b'e',))),
+                  ('inventory-deltas', block((b'rev1',)))]
+        held_keys = {'texts': {(b'a',), (b'c',), (b'e',)},
+                     'inventories': {(b'rev1',)}}
+        records = [
+            (kind, [(record.key, record.storage_kind) for record in substream])
+            for kind, substream in sink._skip_held_records(stream, held_keys)]
+        self.assertEqual(
+            [('texts', [((b'b',), 'chunked'),
+                        ((b'd',), 'groupcompress-block'),
+                        ((b'e',), 'groupcompress-block-ref')]),
+             ('inventory-deltas', [])], records)
+
+    def make_source_and_target(self):
+        self.setup_smart_server_with_call_log()
+        builder = self.make_branch_builder('source')
+        builder.start_series()
+        builder.build_snapshot(
+            None, [('add', ('', b'root-id', 'directory', '')),
+                   ('add', ('a', b'a-id', 'file', b'a\n'))],
+            revision_id=b'rev1')
+        builder.build_snapshot(
+            [b'rev1'], [('add', ('b', b'b-id', 'file', b'b\n'))],
+            revision_id=b'rev2')
+        builder.finish_series()
+        source = repository.Repository.open(self.get_vfs_only_url('source'))
+        target = self.make_repository('target')
+        self.assertIsInstance(target, RemoteRepository)
+        self.reset_smart_call_log()
+        return source, target
+
+    def insert_calls(self):
+        """Return the verbs of the calls made to insert the stream."""
+        methods = [call.call.method for call in self.hpss_calls]
+        start = methods.index(b'Repository.get_insert_checkpoint')
+        end = methods.index(b'Repository.insert_stream_1.19', start)
+        return methods[start:end + 1]
+
+    def test_insert_in_checkpoints(self):
+        self.set_checkpoint_size(1)
+        source, target = self.make_source_and_target()
+        target.fetch(source, b'rev2')
+        self.assertTrue(target.has_revision(b'rev2'))
+        # Each record is inserted in its own checkpoint
+        self.assertEqual(
+            [b'Repository.get_insert_checkpoint'] +
+            [b'Repository.insert_stream_checkpoint'] * 11 +
+            [b'Repository.insert_stream_1.19'], self.insert_calls())
+
+    def test_resume_interrupted_insert(self):
+        self.set_checkpoint_size(1)
+        source, target = self.make_source_and_target()
+
+        class Interrupted(Exception):
+            pass
+
+        def interrupted_stream(stream):
+            for i, (kind, substream) in enumerate(stream):
+                if i == 2:
+                    raise Interrupted()
+                yield kind, substream
+        real_get_source = source._get_source
+
+        def get_source(to_format):
+            stream_source = real_get_source(to_format)
+            get_stream = stream_source.get_stream
+            stream_source.get_stream = (
+                lambda search: interrupted_stream(get_stream(search)))
+            return stream_source
+        source._get_source = get_source
+        self.assertRaises(Interrupted, target.fetch, source, b'rev2')
+        del source._get_source
+        # The part being sent was abandoned without reading the response, as
+        # if the connection had been lost.
+        target._client._medium.reset()
+        self.assertFalse(target.has_revision(b'rev1'))
+        self.assertEqual(
+            [b'Repository.get_insert_checkpoint',
+             b'Repository.insert_stream_checkpoint'],
+            [call.call.method for call in self.hpss_calls][2:4])
+        self.reset_smart_call_log()
+        target.fetch(source, b'rev2')
+        self.assertTrue(target.has_revision(b'rev2'))
+        # The records kept by the checkpoint, including the one sent in the
+        # abandoned part, are not sent again
+        self.assertEqual(
+            [b'Repository.get_insert_checkpoint'] +
+            [b'Repository.insert_stream_checkpoint'] * 9 +
+            [b'Repository.insert_stream_1.19'], self.insert_calls())
+
+
 class TestRepositoryTarball(TestRemoteRepository):
 
     # This is a canned tarball reponse we can validate against
@@ -43,12 +43,14 @@ from breezy.bzr import (
     )
 from breezy.bzr.btree_index import BTreeBuilder, BTreeGraphIndex
 from breezy.bzr.index import GraphIndex
+from breezy.graph import CallableToParentsProviderAdapter
 from breezy.repository import RepositoryFormat
 from breezy.tests import (
     TestCase,
     TestCaseWithTransport,
     )
 from breezy import (
+    config,
     controldir,
     errors,
     osutils,
@@ -58,6 +60,7 @@ from breezy import (
     workingtree,
     )
 from breezy.bzr import (
+    annotation_cache,
     groupcompress_repo,
     knitrepo,
     knitpack_repo,
@@ -1004,6 +1007,93 @@ class TestWithBrokenRepo(TestCaseWithTransport):
         self.assertEqual(b'line\n', text.get_bytes_as('fulltext'))
 
 
+class TestRevisionCache(TestCaseWithTransport):
+
+    def test_cached_while_locked(self):
+        tree = self.make_branch_and_tree('.')
+        revid = tree.commit('message')
+        repo = tree.branch.repository
+        repo.lock_read()
+        rev = repo.get_revision(revid)
+        self.assertEqual(1, len(repo._revision_cache))
+        self.assertEqual(rev, repo.get_revision(revid))
+        repo.unlock()
+        self.assertEqual(0, len(repo._revision_cache))
+
+    def test_cached_revisions_are_copies(self):
+        tree = self.make_branch_and_tree('.')
+        revid = tree.commit('message')
+        repo = tree.branch.repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        rev = repo.get_revision(revid)
+        rev.properties['changed'] = 'value'
+        rev.parent_ids.append(b'other')
+        rev.message = 'changed'
+        cached = repo.get_revision(revid)
+        self.assertIsNot(rev, cached)
+        self.assertNotIn('changed', cached.properties)
+        self.assertEqual([], cached.parent_ids)
+        self.assertEqual('message', cached.message)
+
+    def test_absent_not_cached(self):
+        tree = self.make_branch_and_tree('.')
+        repo = tree.branch.repository
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        self.assertEqual([(b'missing', None)],
+                         list(repo.iter_revisions([b'missing'])))
+        self.assertEqual(0, len(repo._revision_cache))
+
+    def test_not_cached_in_write_group(self):
+        tree = self.make_branch_and_tree('.')
+        revid = tree.commit('message')
+        repo = tree.branch.repository
+        repo.lock_write()
+        self.addCleanup(repo.unlock)
+        repo.start_write_group()
+        self.addCleanup(repo.abort_write_group)
+        repo.get_revision(revid)
+        self.assertEqual(0, len(repo._revision_cache))
+
+
+class TestAnnotationCacheOption(TestCaseWithTransport):
+
+    def test_disabled_by_default(self):
+        repo = self.make_repository('.')
+        self.assertIs(None, repo._get_annotator()._annotation_cache)
+        self.assertFalse(repo._get_annotator()._use_ancestry_index)
+
+    def test_ancestry_index(self):
+        repo = self.make_repository('.')
+        config.LocationStack(repo.user_url).set(
+            'repository.annotation_ancestry_index', True)
+        self.assertTrue(repo._get_annotator()._use_ancestry_index)
+
+    def test_annotate_stores_in_cache_dir(self):
+        tree = self.make_branch_and_tree('.')
+        self.build_tree_contents([('a', b'one\ntwo\n')])
+        tree.add(['a'], ids=[b'a-id'])
+        revid = tree.commit('one')
+        repo = tree.branch.repository
+        stack = config.LocationStack(repo.user_url)
+        stack.set('repository.annotation_cache', True)
+        stack.set('repository.annotation_cache.min_depth', '1')
+        repo.lock_read()
+        self.addCleanup(repo.unlock)
+        ann = repo._get_annotator()
+        self.assertEqual(1, ann._annotation_cache.min_depth)
+        self.assertEqual(50 * 10**6, ann._annotation_cache.max_size)
+        ann.annotate_flat((b'a-id', revid))
+        # Nothing is written to the read locked repository
+        self.assertFalse(repo._transport.has('annotation-cache'))
+        self.assertTrue(annotation_cache.cache_transport(repo).has('.'))
+        self.assertEqual(
+            ([b'one\n', b'two\n'],
+             [((b'a-id', revid),), ((b'a-id', revid),)]),
+            repo._get_annotator()._annotation_cache.get((b'a-id', revid)))
+
+
 class TestRepositoryPackCollection(TestCaseWithTransport):
 
     def get_format(self):
@@ -1655,6 +1745,68 @@ class TestGCCHKPacker(TestCaseWithTransport):
                               r"We are missing inventories for revisions: .*'A'")
 
 
+class TestWalkToCommonRevisions(TestCaseWithTransport):
+
+    def make_source_and_target(self, revision_count, target_revision_count):
+        builder = self.make_branch_builder('source')
+        builder.start_series()
+        revids = []
+        parents = None
+        for i in range(revision_count):
+            revid = b'rev%d' % (i + 1,)
+            if parents is None:
+                actions = [('add', ('', b'root-id', 'directory', ''))]
+            else:
+                actions = []
+            builder.build_snapshot(parents, actions, revision_id=revid)
+            parents = [revid]
+            revids.append(revid)
+        builder.finish_series()
+        source = builder.get_branch().repository
+        target = self.make_repository('target')
+        if target_revision_count:
+            target.fetch(source, revids[target_revision_count - 1])
+        return source, target, revids
+
+    def record_target_queries(self, target):
+        queries = []
+        make_parents_provider = target._make_parents_provider
+
+        def make_recording_parents_provider():
+            provider = make_parents_provider()
+
+            def get_parent_map(keys):
+                queries.append(len(keys))
+                return provider.get_parent_map(keys)
+            return CallableToParentsProviderAdapter(get_parent_map)
+        self.overrideAttr(target, '_make_parents_provider',
+                          make_recording_parents_provider)
+        return queries
+
+    def test_batch_size_grows(self):
+        self.overrideAttr(vf_repository.InterVersionedFileRepository,
+                          '_walk_to_common_revisions_batch_size', 1)
+        self.overrideAttr(vf_repository.InterVersionedFileRepository,
+                          '_walk_to_common_revisions_max_batch_size', 4)
+        source, target, revids = self.make_source_and_target(20, 0)
+        queries = self.record_target_queries(target)
+        result = target.search_missing_revision_ids(
+            source, revision_ids=[revids[-1]], find_ghosts=False)
+        self.assertEqual(set(revids), result.get_keys())
+        # The walk ends with the null revision
+        self.assertEqual([1, 2, 4, 4, 4, 4, 2], queries)
+
+    def test_batch_size_kept_when_target_has_revisions(self):
+        self.overrideAttr(vf_repository.InterVersionedFileRepository,
+                          '_walk_to_common_revisions_batch_size', 1)
+        source, target, revids = self.make_source_and_target(20, 18)
+        queries = self.record_target_queries(target)
+        result = target.search_missing_revision_ids(
+            source, revision_ids=[revids[-1]], find_ghosts=False)
+        self.assertEqual(set(revids[18:]), result.get_keys())
+        self.assertEqual([1, 2], queries)
+
+
 class TestCrossFormatPacks(TestCaseWithTransport):
 
     def log_pack(self, hint=None):
@@ -140,6 +140,51 @@ class TestByteStreamToStream(tests.TestCase):
         self.assertLength(2, streams[0][1])
 
 
+class TestStreamToByteStreamSegments(tests.TestCase):
+
+    def test_segments(self):
+        stream = [
+            ('texts', [versionedfile.FulltextContentFactory(
+                (key,), None, None, b'content') for key in (b'k1', b'k2')]),
+            ('revisions', [versionedfile.FulltextContentFactory(
+                (b'k3',), None, None, b'content')])]
+        fmt = controldir.format_registry.get('pack-0.92')().repository_format
+        # Segments end with the record taking them over the size
+        size = len(versionedfile.record_to_fulltext_bytes(stream[0][1][0])) + 1
+        segments = []
+        for byte_stream in smart_repo._stream_to_byte_stream_segments(
+                stream, fmt, size):
+            fmt, substreams = smart_repo._byte_stream_to_stream(byte_stream)
+            segments.append(
+                [(kind, [record.key for record in substream])
+                 for kind, substream in substreams])
+        self.assertEqual(
+            [[('texts', [(b'k1',), (b'k2',)])],
+             [('revisions', [(b'k3',)])]], segments)
+
+    def test_records_read_lazily(self):
+        read = []
+
+        def substream():
+            for key in (b'k1', b'k2'):
+                read.append(key)
+                yield versionedfile.FulltextContentFactory(
+                    (key,), None, None, b'content')
+        fmt = controldir.format_registry.get('pack-0.92')().repository_format
+        segments = smart_repo._stream_to_byte_stream_segments(
+            [('texts', substream())], fmt, 1)
+        byte_stream = next(segments)
+        # Only the first record was read ahead
+        self.assertEqual([b'k1'], read)
+        list(byte_stream)
+        self.assertEqual([b'k1', b'k2'], read)
+
+    def test_empty_stream(self):
+        fmt = controldir.format_registry.get('pack-0.92')().repository_format
+        self.assertEqual(
+            [], list(smart_repo._stream_to_byte_stream_segments([], fmt, 30)))
+
+
 class TestSmartServerResponse(tests.TestCase):
 
     def test__eq__(self):
@@ -820,6 +865,77 @@ class TestSmartServerRequestOpenBranchV3(TestCaseWithChrootedTransport):
             request.execute(b''))
 
 
+class TestSmartServerRequestOpenBranchV4(TestCaseWithChrootedTransport):
+
+    def test_no_branch(self):
+        """When there is no branch, ('nobranch', ) is returned."""
+        backing = self.get_transport()
+        self.make_controldir('.')
+        request = smart_dir.SmartServerRequestOpenBranchV4(backing)
+        self.assertEqual(smart_req.SmartServerResponse((b'nobranch',)),
+                         request.execute(b''))
+
+    def test_branch(self):
+        """The branch state is returned along with its format."""
+        backing = self.get_transport()
+        tree = self.make_branch_and_memory_tree('.')
+        with tree.lock_write():
+            tree.add('')
+            rev_id = tree.commit('first')
+        tree.branch.tags.set_tag('tag-1', rev_id)
+        tree.branch.set_parent('http://example.com/parent')
+        branch = tree.branch
+        repo_format = branch.repository._format
+        request = smart_dir.SmartServerRequestOpenBranchV4(backing)
+        self.assertEqual(smart_req.SuccessfulSmartServerResponse(
+            (b'branch', branch._format.network_name(), b'1', rev_id, b'',
+             b'', b'yes', b'yes', b'yes', repo_format.network_name()),
+            bencode.bencode([
+                branch.control_transport.get_bytes('branch.conf'),
+                branch._get_tags_bytes()])),
+            request.execute(b''))
+
+    def test_branch_in_shared_repository(self):
+        backing = self.get_transport()
+        repo = self.make_repository('repo', shared=True)
+        self.make_controldir('repo/branch').create_branch()
+        request = smart_dir.SmartServerRequestOpenBranchV4(backing)
+        response = request.execute(b'repo/branch')
+        self.assertEqual((b'..', repo._format.network_name()),
+                         response.args[5:10:4])
+
+    def test_stacked_branch(self):
+        """The stacked on url is returned, without opening it."""
+        trunk = self.make_branch('trunk')
+        feature = self.make_branch('feature')
+        feature.set_stacked_on_url(trunk.base)
+        opened_branches = []
+        _mod_branch.Branch.hooks.install_named_hook(
+            'open', opened_branches.append, None)
+        backing = self.get_transport()
+        request = smart_dir.SmartServerRequestOpenBranchV4(backing)
+        request.setup_jail()
+        try:
+            response = request.execute(b'feature')
+        finally:
+            request.teardown_jail()
+        self.assertEqual(trunk.base.encode('utf-8'), response.args[4])
+        self.assertLength(1, opened_branches)
+
+    def test_branch_reference(self):
+        """When there is a branch reference, the reference URL is returned."""
+        self.vfs_transport_factory = test_server.LocalURLServer
+        backing = self.get_transport()
+        request = smart_dir.SmartServerRequestOpenBranchV4(backing)
+        branch = self.make_branch('branch')
+        checkout = branch.create_checkout('reference', lightweight=True)
+        reference_url = _mod_bzrbranch.BranchReferenceFormat().get_reference(
+            checkout.controldir).encode('utf-8')
+        self.assertEqual(smart_req.SuccessfulSmartServerResponse(
+            (b'ref', reference_url)),
+            request.execute(b'reference'))
+
+
 class TestSmartServerRequestRevisionHistory(tests.TestCaseWithMemoryTransport):
 
     def test_empty(self):
@@ -908,6 +1024,24 @@ class TestSmartServerBranchRequestLastRevisionInfo(
             request.execute(b''))
 
 
+    def test_cache_generation_follows_the_tip(self):
+        backing = self.get_transport()
+        request = smart_branch.SmartServerBranchRequestLastRevisionInfo(
+            backing)
+        branch = self.make_branch('.')
+        generation = request.cache_generation(b'')
+        self.assertIsNot(None, generation)
+        self.assertEqual(generation, request.cache_generation(b''))
+        branch.set_last_revision_info(1, b'rev-1')
+        self.assertNotEqual(generation, request.cache_generation(b''))
+
+    def test_cache_generation_without_last_revision(self):
+        backing = self.get_transport()
+        request = smart_branch.SmartServerBranchRequestLastRevisionInfo(
+            backing)
+        self.make_branch('.', format='knit')
+        self.assertEqual(None, request.cache_generation(b''))
+
 class TestSmartServerBranchRequestRevisionIdToRevno(
         tests.TestCaseWithMemoryTransport):
 
@@ -1737,6 +1871,75 @@ class TestSmartServerRepositoryGetParentMap(tests.TestCaseWithMemoryTransport):
             request.do_body(b'\n\n0\n'))
 
 
+class TestSmartServerRepositoryWalkToCommon(
+        tests.TestCaseWithMemoryTransport):
+
+    def make_tree_with_history(self):
+        tree = self.make_branch_and_memory_tree('.')
+        tree.lock_write()
+        tree.add('')
+        for revid in [b'rev1', b'rev2', b'rev3']:
+            tree.commit(revid.decode('ascii'), rev_id=revid)
+        tree.unlock()
+        return tree
+
+    def walk_to_common(self, body, max_size=b'65536'):
+        request = smart_repo.SmartServerRepositoryWalkToCommon(
+            self.get_transport())
+        self.assertEqual(None, request.execute(b'', max_size))
+        return request.do_body(body)
+
+    def test_no_haves(self):
+        self.make_tree_with_history()
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(
+                (b'ok', ), bz2.compress(b'rev3 rev2\nrev2 rev1\nrev1')),
+            self.walk_to_common(b'rev3\n'))
+
+    def test_stops_at_haves(self):
+        self.make_tree_with_history()
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(
+                (b'ok', ), bz2.compress(b'rev3 rev2')),
+            self.walk_to_common(b'rev3\nrev2'))
+
+    def test_head_in_haves_ancestry(self):
+        self.make_tree_with_history()
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(
+                (b'ok', ), bz2.compress(b'')),
+            self.walk_to_common(b'rev2\nrev3'))
+
+    def test_missing_head(self):
+        self.make_tree_with_history()
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(
+                (b'ok', ), bz2.compress(b'missing:ghost\nrev3 rev2')),
+            self.walk_to_common(b'rev3 ghost\nrev2'))
+
+    def test_partial(self):
+        self.make_tree_with_history()
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(
+                (b'partial', ), bz2.compress(b'rev3 rev2')),
+            self.walk_to_common(b'rev3\n', max_size=b'1'))
+
+    def test_bad_body(self):
+        self.make_tree_with_history()
+        self.assertEqual(
+            smart_req.FailedSmartServerResponse((b'BadSearch', )),
+            self.walk_to_common(b'rev3'))
+
+    def test_max_size_capped(self):
+        self.make_tree_with_history()
+        self.overrideAttr(
+            smart_repo.SmartServerRepositoryWalkToCommon, 'max_size', 1)
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse(
+                (b'partial', ), bz2.compress(b'rev3 rev2')),
+            self.walk_to_common(b'rev3\n'))
+
+
 class TestSmartServerRepositoryGetRevisionGraph(
         tests.TestCaseWithMemoryTransport):
 
@@ -1835,6 +2038,25 @@ class TestSmartServerRepositoryGetRevIdForRevno(
             request.execute(b'stacked', 1, (3, r3)))
 
 
+    def test_cache_generation_follows_pack_names(self):
+        backing = self.get_transport()
+        request = smart_repo.SmartServerRepositoryGetRevIdForRevno(backing)
+        tree = self.make_branch_and_memory_tree('.')
+        generation = request.cache_generation(b'', 1, (1, b'rev-1'))
+        self.assertIsNot(None, generation)
+        with tree.lock_write():
+            tree.add('')
+            tree.commit('1st commit', rev_id=b'rev-1')
+        self.assertNotEqual(
+            generation, request.cache_generation(b'', 1, (1, b'rev-1')))
+
+    def test_cache_generation_without_pack_names(self):
+        backing = self.get_transport()
+        request = smart_repo.SmartServerRepositoryGetRevIdForRevno(backing)
+        self.make_repository('.', format='knit')
+        self.assertEqual(
+            None, request.cache_generation(b'', 1, (1, b'rev-1')))
+
 class TestSmartServerRepositoryIterRevisions(
         tests.TestCaseWithMemoryTransport):
 
@@ -2260,6 +2482,155 @@ class TestSmartServerRepositoryInsertStreamLocked(TestInsertStreamBase):
                 b'wrong-token')
 
 
+class TestCheckpointBase(TestInsertStreamBase):
+
+    upload_id = b'a' * 40
+
+    def make_stream_bytes(self, repository, revision_ids=(b'rev1', )):
+        tree = self.make_branch_and_memory_tree('source')
+        tree.lock_write()
+        tree.add('')
+        for revision_id in revision_ids:
+            tree.commit('one', rev_id=revision_id)
+        tree.unlock()
+        source = tree.branch.repository
+        self.addCleanup(source.lock_read().unlock)
+        return [
+            b''.join(smart_repo._stream_to_byte_stream(
+                source._get_source(repository._format).get_stream(
+                    source.revision_ids_to_search_result({revision_id})),
+                source._format))
+            for revision_id in revision_ids]
+
+    def commit_checkpoint(self, repository, tokens):
+        request = smart_repo.SmartServerRepositoryInsertStream_1_19(
+            self.get_transport())
+        self.assertEqual(None, request.execute(b'target/', tokens))
+        request.do_chunk(self.make_empty_byte_stream(repository))
+        return request.do_end()
+
+    def insert_checkpoint(self, byte_stream, resume_tokens=b''):
+        request = smart_repo.SmartServerRepositoryInsertStreamCheckpoint(
+            self.get_transport())
+        self.assertEqual(
+            None, request.execute(b'target/', self.upload_id, resume_tokens))
+        self.assertEqual(None, request.do_chunk(byte_stream))
+        return request.do_end()
+
+    def get_insert_checkpoint(self):
+        request = smart_repo.SmartServerRepositoryGetInsertCheckpoint(
+            self.get_transport())
+        return request.execute(b'target/', self.upload_id)
+
+
+class TestSmartServerRepositoryInsertStreamCheckpoint(TestCheckpointBase):
+
+    def test_insert_suspends_write_group(self):
+        repository = self.make_repository('target')
+        response = self.insert_checkpoint(
+            self.make_stream_bytes(repository)[0])
+        self.assertEqual(b'ok', response.args[0])
+        tokens = bencode.bdecode(response.args[1])
+        self.assertLength(1, tokens)
+        self.assertEqual(
+            tokens[0] + b'\n',
+            repository._pack_collection._upload_transport.get_bytes(
+                'a' * 40 + '.checkpoint'))
+        self.assertFalse(repository.has_revision(b'rev1'))
+
+    def test_commit_checkpoint(self):
+        repository = self.make_repository('target')
+        response = self.insert_checkpoint(
+            self.make_stream_bytes(repository)[0])
+        tokens = b' '.join(bencode.bdecode(response.args[1]))
+        self.assertEqual(
+            smart_req.SmartServerResponse((b'ok', )),
+            self.commit_checkpoint(repository, tokens))
+        self.assertTrue(repository.has_revision(b'rev1'))
+        self.assertFalse(
+            repository._pack_collection._upload_transport.has(
+                'a' * 40 + '.checkpoint'))
+
+    def test_commit_checkpoint_in_parts(self):
+        repository = self.make_repository('target')
+        first, second = self.make_stream_bytes(
+            repository, [b'rev1', b'rev2'])
+        tokens = self.insert_checkpoint(first).args[1]
+        response = self.insert_checkpoint(
+            second, b' '.join(bencode.bdecode(tokens)))
+        tokens = bencode.bdecode(response.args[1])
+        self.assertLength(2, tokens)
+        self.assertEqual(
+            smart_req.SmartServerResponse((b'ok', )),
+            self.commit_checkpoint(repository, b' '.join(tokens)))
+        self.assertFalse(
+            repository._pack_collection._upload_transport.has(
+                'a' * 40 + '.checkpoint'))
+        repository = repository.controldir.open_repository()
+        with repository.lock_read():
+            self.assertEqual(
+                {b'rev1', b'rev2'}, set(repository.all_revision_ids()))
+
+    def test_unsuspendable_repository(self):
+        self.make_repository('target', format='knit')
+        request = smart_repo.SmartServerRepositoryInsertStreamCheckpoint(
+            self.get_transport())
+        self.assertEqual(
+            smart_req.FailedSmartServerResponse(
+                (b'UnsuspendableWriteGroup', )),
+            request.execute(b'target/', self.upload_id, b''))
+
+    def test_malformed_upload_id(self):
+        self.make_repository('target')
+        request = smart_repo.SmartServerRepositoryInsertStreamCheckpoint(
+            self.get_transport())
+        self.assertRaises(
+            errors.BzrError, request.execute, b'target/', b'../foo', b'')
+
+
+class TestSmartServerRepositoryGetInsertCheckpoint(TestCheckpointBase):
+
+    def test_no_checkpoint(self):
+        self.make_repository('target')
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse((b'no-checkpoint', ), b''),
+            self.get_insert_checkpoint())
+
+    def test_checkpoint(self):
+        repository = self.make_repository('target')
+        tokens = self.insert_checkpoint(
+            self.make_stream_bytes(repository)[0]).args[1]
+        response = self.get_insert_checkpoint()
+        self.assertEqual((b'ok', tokens), response.args)
+        keys = bencode.bdecode_as_tuple(zlib.decompress(response.body))
+        self.assertIn((b'revisions', b'rev1'), keys)
+        self.assertIn((b'inventories', b'rev1'), keys)
+        # The checkpoint is still there
+        self.assertEqual(response, self.get_insert_checkpoint())
+
+    def test_committed_checkpoint(self):
+        repository = self.make_repository('target')
+        tokens = self.insert_checkpoint(
+            self.make_stream_bytes(repository)[0]).args[1]
+        repository.lock_write()
+        repository.resume_write_group(
+            [token.decode('ascii') for token in bencode.bdecode(tokens)])
+        repository.commit_write_group()
+        repository.unlock()
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse((b'no-checkpoint', ), b''),
+            self.get_insert_checkpoint())
+        self.assertFalse(
+            repository._pack_collection._upload_transport.has(
+                'a' * 40 + '.checkpoint'))
+
+    def test_unsupported(self):
+        self.make_repository('target', format='knit')
+        self.assertEqual(
+            smart_req.SuccessfulSmartServerResponse((b'unsupported', ), b''),
+            self.get_insert_checkpoint())
+
+
 class TestSmartServerRepositoryUnlock(tests.TestCaseWithMemoryTransport):
 
     def test_unlock_on_locked_repo(self):
@@ -2598,6 +2969,8 @@ class TestHandlers(tests.TestCase):
                                 smart_dir.SmartServerRequestOpenBranchV2)
         self.assertHandlerEqual(b'BzrDir.open_branchV3',
                                 smart_dir.SmartServerRequestOpenBranchV3)
+        self.assertHandlerEqual(b'BzrDir.open_branchV4',
+                                smart_dir.SmartServerRequestOpenBranchV4)
         self.assertHandlerEqual(b'PackRepository.autopack',
                                 smart_packrepo.SmartServerPackRepositoryAutopack)
         self.assertHandlerEqual(b'Repository.add_signature_text',
@@ -2608,6 +2981,8 @@ class TestHandlers(tests.TestCase):
                                 smart_repo.SmartServerRepositoryBreakLock)
         self.assertHandlerEqual(b'Repository.gather_stats',
                                 smart_repo.SmartServerRepositoryGatherStats)
+        self.assertHandlerEqual(b'Repository.get_insert_checkpoint',
+                                smart_repo.SmartServerRepositoryGetInsertCheckpoint)
         self.assertHandlerEqual(b'Repository.get_parent_map',
                                 smart_repo.SmartServerRepositoryGetParentMap)
         self.assertHandlerEqual(b'Repository.get_physical_lock_status',
@@ -2628,6 +3003,8 @@ class TestHandlers(tests.TestCase):
                                 smart_repo.SmartServerRequestHasRevision)
         self.assertHandlerEqual(b'Repository.insert_stream',
                                 smart_repo.SmartServerRepositoryInsertStream)
+        self.assertHandlerEqual(b'Repository.insert_stream_checkpoint',
+                                smart_repo.SmartServerRepositoryInsertStreamCheckpoint)
         self.assertHandlerEqual(b'Repository.insert_stream_locked',
                                 smart_repo.SmartServerRepositoryInsertStreamLocked)
         self.assertHandlerEqual(b'Repository.is_shared',
@@ -2646,6 +3023,8 @@ class TestHandlers(tests.TestCase):
                                 smart_repo.SmartServerRepositoryTarball)
         self.assertHandlerEqual(b'Repository.unlock',
                                 smart_repo.SmartServerRepositoryUnlock)
+        self.assertHandlerEqual(b'Repository.walk_to_common',
+                                smart_repo.SmartServerRepositoryWalkToCommon)
         self.assertHandlerEqual(b'Repository.start_write_group',
                                 smart_repo.SmartServerRepositoryStartWriteGroup)
         self.assertHandlerEqual(b'Repository.check_write_group',
@@ -23,7 +23,7 @@ from breezy import (
     transport,
     )
 from breezy.bzr.bzrdir import BzrDir
-from breezy.bzr.smart import request
+from breezy.bzr.smart import request, stats
 from breezy.tests import TestCase, TestCaseWithMemoryTransport
 
 
@@ -90,6 +90,81 @@ class CheckJailRequest(request.SmartServerRequest):
         self.jail_transports_log.append(request.jail_info.transports)
 
 
+class CacheableRequest(request.SmartServerRequest):
+    """A request whose responses can be cached, counting its executions."""
+
+    generation = b'generation-1'
+    executed = 0
+
+    def cache_generation(self, *args):
+        return self.generation
+
+    def do(self, *args):
+        CacheableRequest.executed += 1
+        return request.SuccessfulSmartServerResponse(
+            (b'ok', str(CacheableRequest.executed).encode('ascii')))
+
+
+class GenerationChangingRequest(CacheableRequest):
+    """A cacheable request during which its generation changes."""
+
+    def do(self, *args):
+        response = super(GenerationChangingRequest, self).do(*args)
+        CacheableRequest.generation = b'generation-2'
+        return response
+
+
+class CacheableBodyRequest(CacheableRequest):
+    """A cacheable request taking a body."""
+
+    def do(self, *args):
+        return None
+
+    def do_body(self, body_bytes):
+        CacheableRequest.executed += 1
+        return request.SuccessfulSmartServerResponse(
+            (b'ok', str(CacheableRequest.executed).encode('ascii')),
+            body=body_bytes)
+
+
+class CacheableStreamRequest(CacheableRequest):
+    """A cacheable request streaming its response."""
+
+    chunks = [b'chunk-1', b'chunk-2']
+
+    def do(self, *args):
+        CacheableRequest.executed += 1
+        return request.SuccessfulSmartServerResponse(
+            (b'ok',), body_stream=iter(self.chunks))
+
+
+class CacheableIntegerRequest(CacheableRequest):
+    """A cacheable request with integers in its response."""
+
+    def do(self, *args):
+        CacheableRequest.executed += 1
+        return request.SuccessfulSmartServerResponse(
+            (b'ok', CacheableRequest.executed))
+
+
+class UncacheableRequest(CacheableRequest):
+
+    generation = None
+
+
+class FailingCacheableRequest(CacheableRequest):
+
+    def do(self, *args):
+        CacheableRequest.executed += 1
+        return request.FailedSmartServerResponse((b'error',))
+
+
+class LockContentionRequest(request.SmartServerRequest):
+
+    def do(self):
+        raise errors.LockContention('lock')
+
+
 class TestErrors(TestCase):
 
     def test_disabled_method(self):
@@ -183,6 +258,191 @@ class TestSmartRequestHandlerErrorTranslation(TestCase):
             handler.response)
 
 
+class TestSmartServerResponseCache(TestCase):
+
+    def setUp(self):
+        super(TestSmartServerResponseCache, self).setUp()
+        self.cache = request.SmartServerResponseCache(1024)
+        self.overrideAttr(request, 'response_cache', self.cache)
+        self.overrideAttr(CacheableRequest, 'executed', 0)
+
+    def call(self, request_class, *args, **kwargs):
+        body = kwargs.pop('body', None)
+        handler = request.SmartServerRequestHandler(
+            None, {b'foo': request_class}, '/')
+        handler.args_received((b'foo',) + args)
+        if body is not None:
+            handler.accept_body(body)
+        handler.end_received()
+        return handler.response
+
+    def consume(self, response):
+        return b''.join(response.body_stream)
+
+    def test_not_cached_without_cache(self):
+        self.overrideAttr(request, 'response_cache', None)
+        self.assertEqual((b'ok', b'1'), self.call(CacheableRequest).args)
+        self.assertEqual((b'ok', b'2'), self.call(CacheableRequest).args)
+
+    def test_cached(self):
+        self.assertEqual((b'ok', b'1'), self.call(CacheableRequest).args)
+        self.assertEqual((b'ok', b'1'), self.call(CacheableRequest).args)
+        self.assertEqual(1, CacheableRequest.executed)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+
+    def test_cached_with_integers(self):
+        self.assertEqual((b'ok', 1), self.call(CacheableIntegerRequest).args)
+        self.assertEqual((b'ok', 1), self.call(CacheableIntegerRequest).args)
+
+    def test_keyed_by_arguments(self):
+        self.assertEqual((b'ok', b'1'), self.call(CacheableRequest, b'a').args)
+        self.assertEqual((b'ok', b'2'), self.call(CacheableRequest, b'b').args)
+        self.assertEqual((b'ok', b'1'), self.call(CacheableRequest, b'a').args)
+
+    def test_keyed_by_generation(self):
+        self.assertEqual((b'ok', b'1'), self.call(CacheableRequest).args)
+        self.overrideAttr(CacheableRequest, 'generation', b'generation-2')
+        self.assertEqual((b'ok', b'2'), self.call(CacheableRequest).args)
+
+    def test_not_cached_if_generation_changed(self):
+        self.overrideAttr(CacheableRequest, 'generation', b'generation-1')
+        self.assertEqual(
+            (b'ok', b'1'), self.call(GenerationChangingRequest).args)
+        # The state before the change can become current again
+        CacheableRequest.generation = b'generation-1'
+        self.assertEqual((b'ok', b'2'), self.call(CacheableRequest).args)
+        self.assertEqual((0, 2), (self.cache.hits, self.cache.misses))
+
+    def test_stream_not_cached_if_generation_changed(self):
+        self.overrideAttr(CacheableRequest, 'generation', b'generation-1')
+
+        def chunks():
+            yield b'chunk-1'
+            CacheableRequest.generation = b'generation-2'
+            yield b'chunk-2'
+        self.overrideAttr(CacheableStreamRequest, 'chunks', chunks())
+        self.assertEqual(b'chunk-1chunk-2',
+                         self.consume(self.call(CacheableStreamRequest)))
+        CacheableRequest.generation = b'generation-1'
+        CacheableStreamRequest.chunks = [b'chunk-3']
+        self.assertEqual(b'chunk-3',
+                         self.consume(self.call(CacheableStreamRequest)))
+        self.assertEqual(2, CacheableRequest.executed)
+
+    def test_uncacheable_request(self):
+        self.assertEqual((b'ok', b'1'), self.call(UncacheableRequest).args)
+        self.assertEqual((b'ok', b'2'), self.call(UncacheableRequest).args)
+        self.assertEqual((0, 0), (self.cache.hits, self.cache.misses))
+
+    def test_failures_not_cached(self):
+        self.call(FailingCacheableRequest)
+        self.call(FailingCacheableRequest)
+        self.assertEqual(2, CacheableRequest.executed)
+
+    def test_keyed_by_body(self):
+        response = self.call(CacheableBodyRequest, body=b'body-a')
+        self.assertEqual(((b'ok', b'1'), b'body-a'),
+                         (response.args, response.body))
+        response = self.call(CacheableBodyRequest, body=b'body-b')
+        self.assertEqual(((b'ok', b'2'), b'body-b'),
+                         (response.args, response.body))
+        response = self.call(CacheableBodyRequest, body=b'body-a')
+        self.assertEqual(((b'ok', b'1'), b'body-a'),
+                         (response.args, response.body))
+
+    def test_stream_cached_once_sent(self):
+        response = self.call(CacheableStreamRequest)
+        self.assertEqual(b'chunk-1chunk-2', self.consume(response))
+        response = self.call(CacheableStreamRequest)
+        self.assertEqual(b'chunk-1chunk-2', self.consume(response))
+        self.assertEqual(1, CacheableRequest.executed)
+
+    def test_interrupted_stream_not_cached(self):
+        response = self.call(CacheableStreamRequest)
+        next(response.body_stream)
+        response.body_stream.close()
+        self.assertEqual(b'chunk-1chunk-2',
+                         self.consume(self.call(CacheableStreamRequest)))
+        self.assertEqual(2, CacheableRequest.executed)
+
+    def test_stream_with_error_not_cached(self):
+        error = request.FailedSmartServerResponse((b'error',))
+        self.overrideAttr(CacheableStreamRequest, 'chunks', [b'chunk', error])
+        self.assertEqual([b'chunk', error],
+                         list(self.call(CacheableStreamRequest).body_stream))
+        self.call(CacheableStreamRequest)
+        self.assertEqual(2, CacheableRequest.executed)
+
+    def test_stream_too_big_not_cached(self):
+        self.overrideAttr(CacheableStreamRequest, 'chunks', [b'x' * 2048])
+        self.consume(self.call(CacheableStreamRequest))
+        self.consume(self.call(CacheableStreamRequest))
+        self.assertEqual(2, CacheableRequest.executed)
+
+
+class TestSmartServerRequestStats(TestCase):
+
+    def setUp(self):
+        super(TestSmartServerRequestStats, self).setUp()
+        self.stats = stats.SmartServerStats()
+        self.overrideAttr(request, 'server_stats', self.stats)
+
+    def call(self, request_class, body=None):
+        handler = request.SmartServerRequestHandler(
+            None, {b'foo': request_class}, '/')
+        handler.args_received((b'foo',))
+        if body is not None:
+            handler.accept_body(body)
+        handler.end_received()
+        return handler.response
+
+    def assertVerbStats(self, expected, verb=b'foo'):
+        self.assertEqual(expected, self.stats.verb_stats(verb)[:3])
+
+    def test_not_recorded_without_stats(self):
+        self.overrideAttr(request, 'server_stats', None)
+        self.call(NoBodyRequest)
+        self.assertVerbStats((0, 0, 0))
+
+    def test_request_recorded(self):
+        self.call(NoBodyRequest)
+        self.call(NoBodyRequest)
+        self.assertVerbStats((2, 0, 0))
+
+    def test_request_with_body_recorded(self):
+        self.assertEqual(b'body',
+                         self.call(CacheableBodyRequest, body=b'body').body)
+        self.assertVerbStats((1, 0, 0))
+
+    def test_failure_recorded(self):
+        self.call(DoErrorRequest)
+        self.call(EndErrorRequest)
+        self.assertVerbStats((2, 2, 0))
+
+    def test_lock_contention_recorded(self):
+        self.call(LockContentionRequest)
+        self.assertVerbStats((1, 1, 1))
+
+    def test_stream_recorded_once_sent(self):
+        response = self.call(CacheableStreamRequest)
+        self.assertVerbStats((0, 0, 0))
+        self.assertEqual([b'chunk-1', b'chunk-2'], list(response.body_stream))
+        self.assertVerbStats((1, 0, 0))
+
+    def test_stream_with_error_recorded(self):
+        error = request.FailedSmartServerResponse((b'error',))
+        self.overrideAttr(CacheableStreamRequest, 'chunks', [b'chunk', error])
+        list(self.call(CacheableStreamRequest).body_stream)
+        self.assertVerbStats((1, 1, 0))
+
+    def test_cached_response_recorded(self):
+        self.overrideAttr(request, 'response_cache',
+                          request.SmartServerResponseCache(1024))
+        self.call(CacheableRequest)
+        self.call(CacheableRequest)
+        self.assertVerbStats((2, 0, 0))
+
+
 class TestRequestHanderErrorTranslation(TestCase):
     """Tests for breezy.bzr.smart.request._translate_error."""
 
@@ -0,0 +1,143 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for smart server statistics (breezy.bzr.smart.stats)."""
+
+from urllib import error as urllib_error
+from urllib import request as urllib_request
+
+from breezy.bzr.smart import request, stats
+from breezy.tests import TestCase
+
+
+class TestSmartServerStats(TestCase):
+
+    def setUp(self):
+        super(TestSmartServerStats, self).setUp()
+        self.stats = stats.SmartServerStats()
+
+    def test_request_served(self):
+        self.stats.request_served(b'get', 0.5)
+        self.stats.request_served(b'get', 1.5, b'NoSuchFile')
+        self.stats.request_served(b'Branch.lock_write', 0.001,
+                                  b'LockContention')
+        self.assertEqual((2, 1, 0, 2.0), self.stats.verb_stats(b'get'))
+        self.assertEqual((1, 1, 1, 0.001),
+                         self.stats.verb_stats(b'Branch.lock_write'))
+        self.assertEqual((0, 0, 0, 0.0), self.stats.verb_stats(b'put'))
+
+    def test_bytes_transferred(self):
+        self.stats.bytes_transferred(10, 'read')
+        self.stats.bytes_transferred(20, 'write')
+        self.stats.bytes_transferred(30, None)
+        self.assertEqual((10, 20),
+                         (self.stats.bytes_received, self.stats.bytes_sent))
+
+    def test_connections(self):
+        self.stats.connection_opened()
+        self.stats.connection_opened()
+        self.stats.connection_closed()
+        self.assertEqual((2, 1), (self.stats.connections,
+                                  self.stats.active_connections))
+
+    def test_to_prometheus(self):
+        self.overrideAttr(stats.SmartServerStats, 'latency_buckets',
+                          (0.1, 1.0))
+        self.stats.request_served(b'get', 0.05)
+        self.stats.request_served(b'get', 0.5, b'NoSuchFile')
+        self.stats.request_served(b'get', 5.0)
+        self.stats.bytes_transferred(100, 'read')
+        self.stats.bytes_transferred(2000, 'write')
+        self.stats.connection_opened()
+        self.assertEqualDiff("""\
+# HELP bzr_smart_requests_total Requests served.
+# TYPE bzr_smart_requests_total counter
+bzr_smart_requests_total{verb="get"} 3
+# HELP bzr_smart_request_errors_total Requests that failed.
+# TYPE bzr_smart_request_errors_total counter
+bzr_smart_request_errors_total{verb="get"} 1
+# HELP bzr_smart_lock_contentions_total Requests that failed to take a lock \
+held by another client.
+# TYPE bzr_smart_lock_contentions_total counter
+bzr_smart_lock_contentions_total{verb="get"} 0
+# HELP bzr_smart_request_duration_seconds Time taken to serve requests, \
+including sending the response.
+# TYPE bzr_smart_request_duration_seconds histogram
+bzr_smart_request_duration_seconds_bucket{verb="get",le="0.1"} 1
+bzr_smart_request_duration_seconds_bucket{verb="get",le="1"} 2
+bzr_smart_request_duration_seconds_bucket{verb="get",le="+Inf"} 3
+bzr_smart_request_duration_seconds_sum{verb="get"} 5.550000
+bzr_smart_request_duration_seconds_count{verb="get"} 3
+# HELP bzr_smart_received_bytes_total Bytes received from clients.
+# TYPE bzr_smart_received_bytes_total counter
+bzr_smart_received_bytes_total 100
+# HELP bzr_smart_sent_bytes_total Bytes sent to clients.
+# TYPE bzr_smart_sent_bytes_total counter
+bzr_smart_sent_bytes_total 2000
+# HELP bzr_smart_connections_total Client connections accepted.
+# TYPE bzr_smart_connections_total counter
+bzr_smart_connections_total 1
+# HELP bzr_smart_active_connections Client connections being served.
+# TYPE bzr_smart_active_connections gauge
+bzr_smart_active_connections 1
+""", self.stats.to_prometheus())
+
+    def test_to_prometheus_with_response_cache(self):
+        cache = request.SmartServerResponseCache(1024)
+        cache.hits = 3
+        cache.misses = 4
+        text = self.stats.to_prometheus(response_cache=cache)
+        self.assertContainsRe(
+            text, '\nbzr_smart_response_cache_hits_total 3\n')
+        self.assertContainsRe(
+            text, '\nbzr_smart_response_cache_misses_total 4\n')
+
+    def test_verbs_escaped(self):
+        self.stats.request_served(b'a"b\\c\n', 0.5)
+        self.assertContainsRe(
+            self.stats.to_prometheus(),
+            '\nbzr_smart_requests_total{verb="a\\\\"b\\\\\\\\c\\\\n"} 1\n')
+
+
+class TestSmartServerStatsServer(TestCase):
+
+    def setUp(self):
+        super(TestSmartServerStatsServer, self).setUp()
+        self.stats = stats.SmartServerStats()
+        self.overrideAttr(request, 'response_cache', None)
+        self.server = stats.SmartServerStatsServer(self.stats)
+        self.server.start_server('127.0.0.1', 0)
+        self.addCleanup(self.server.stop_server)
+
+    def get(self, path):
+        return urllib_request.urlopen(
+            'http://127.0.0.1:%d%s' % (self.server.port, path), timeout=10)
+
+    def test_metrics(self):
+        self.stats.request_served(b'get', 0.5)
+        response = self.get('/metrics')
+        try:
+            self.assertEqual(
+                'text/plain; version=0.0.4', response.headers['Content-Type'])
+            self.assertEqual(self.stats.to_prometheus().encode('utf-8'),
+                             response.read())
+        finally:
+            response.close()
+
+    def test_unknown_path(self):
+        e = self.assertRaises(urllib_error.HTTPError, self.get, '/other')
+        e.close()
+        self.assertEqual(404, e.code)
@@ -17,20 +17,24 @@
 """Tests for smart transport"""
 
 # all of this deals with byte strings so this is safe
+import asyncio
 import doctest
 import errno
 from io import BytesIO
 import os
 import socket
+import struct
 import subprocess
 import sys
 import threading
 import time
+import zlib
 
 from testtools.matchers import DocTestMatches
 
 import breezy
 from ... import (
+    config,
     controldir,
     debug,
     errors,
@@ -44,12 +48,15 @@ from .. import (
     )
 from ..remote import UnknownErrorFromSmartServer
 from ..smart import (
+    async_server,
     client,
     medium,
     message,
+    prefork,
     protocol,
     request as _mod_request,
     server as _mod_server,
+    stats as _mod_stats,
     vfs,
     )
 from ...tests import (
@@ -779,6 +786,38 @@ class TestSmartClientStreamMediumRequest(tests.TestCase):
                 raise
         req = client_medium.get_request()
 
+    def test_pipelined_requests(self):
+        input = BytesIO(b'12')
+        output = BytesIO()
+        client_medium = medium.SmartSimplePipesClientMedium(
+            input, output, 'base')
+        with client_medium.pipeline():
+            request1 = client_medium.get_request()
+            request1.accept_bytes(b'a')
+            request1.finished_writing()
+            request2 = client_medium.get_request()
+            request2.accept_bytes(b'b')
+            request2.finished_writing()
+        self.assertEqual(b'ab', output.getvalue())
+        self.assertRaises(medium.TooManyConcurrentRequests,
+                          client_medium.get_request)
+        # The responses are read in order
+        self.assertRaises(AssertionError, request2.read_bytes, 1)
+        self.assertEqual(b'1', request1.read_bytes(1))
+        request1.finished_reading()
+        self.assertIs(request2, client_medium._current_request)
+        self.assertEqual(b'2', request2.read_bytes(1))
+        request2.finished_reading()
+        self.assertIs(None, client_medium._current_request)
+
+    def test_pipelined_request_after_previous_finished_writing(self):
+        client_medium = medium.SmartSimplePipesClientMedium(
+            None, BytesIO(), 'base')
+        with client_medium.pipeline():
+            client_medium.get_request()
+            self.assertRaises(medium.TooManyConcurrentRequests,
+                              client_medium.get_request)
+
 
 class RemoteTransportTests(test_smart.TestCaseWithSmartMedium):
 
@@ -1042,6 +1081,20 @@ class TestSmartServerStreamMedium(tests.TestCase):
         server._disconnect_client()
         self.assertEqual(b'', client_sock.recv(1))
 
+    def test_socket_stream_builds_protocol_for_pipelined_request(self):
+        # The second request was read along with the first one: building its
+        # protocol must not wait for more bytes from the client.
+        sample_request_bytes = protocol.REQUEST_VERSION_TWO + b'hello\n'
+        server, client_sock = self.create_socket_context(None, timeout=0.1)
+        client_sock.sendall(sample_request_bytes * 2)
+        server._serve_one_request(server._build_protocol())
+        server._serve_one_request(server._build_protocol())
+        expected_response = (
+            protocol.RESPONSE_VERSION_TWO + b'success\nok\x012\n')
+        self.assertEqual(expected_response * 2,
+                         client_sock.recv(len(expected_response) * 2))
+        server._disconnect_client()
+
     def test_pipe_like_stream_error_handling(self):
         # Use plain python BytesIO so we can monkey-patch the close method to
         # not discard the contents.
@@ -1521,14 +1574,17 @@ class SmartTCPTests(tests.TestCase):
             self.real_backing_transport = self.backing_transport
             self.backing_transport = _mod_transport.get_transport_from_url(
                 "readonly+" + self.backing_transport.abspath('.'))
-        self.server = _mod_server.SmartTCPServer(self.backing_transport,
-                                                 client_timeout=4.0)
+        self.server = self.make_tcp_server(self.backing_transport)
         self.server.start_server('127.0.0.1', 0)
         self.server.start_background_thread('-' + self.id())
         self.transport = remote.RemoteTCPTransport(self.server.get_url())
         self.addCleanup(self.stop_server)
         self.permit_url(self.server.get_url())
 
+    def make_tcp_server(self, backing_transport):
+        return _mod_server.SmartTCPServer(backing_transport,
+                                          client_timeout=4.0)
+
     def stop_server(self):
         """Disconnect the client and stop the server.
 
@@ -1539,6 +1595,9 @@ class SmartTCPTests(tests.TestCase):
             self.transport.disconnect()
             del self.transport
         if getattr(self, 'server', None):
+            # The server threads may still be returning from sending the last
+            # response, they would be reported as leaking otherwise.
+            self.server._poll_active_connections(timeout=4.0)
             self.server.stop_background_thread()
             del self.server
 
@@ -1746,6 +1805,471 @@ class TestServerHooks(SmartTCPTests):
 # server-stopped hook.
 
 
+class TestPipelinedCalls(SmartTCPTests):
+
+    def setUp(self):
+        super(TestPipelinedCalls, self).setUp()
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+        self.start_server()
+        self.backing_transport.put_bytes('foo', b'contents of foo\n')
+        self.client_medium = self.transport.get_smart_medium()
+        self.smart_client = client._SmartClient(self.client_medium)
+
+    def record_io(self):
+        """Record in self.io whether the medium wrote or read."""
+        self.io = []
+        accept_bytes = self.client_medium._accept_bytes
+        read_bytes = self.client_medium._read_bytes
+
+        def _accept_bytes(bytes):
+            self.io.append('write')
+            return accept_bytes(bytes)
+
+        def _read_bytes(count):
+            self.io.append('read')
+            return read_bytes(count)
+        self.client_medium._accept_bytes = _accept_bytes
+        self.client_medium._read_bytes = _read_bytes
+
+    def test_call_pipelined(self):
+        self.smart_client.call(b'hello')
+        self.record_io()
+        results = self.smart_client.call_pipelined([
+            (b'get', (b'/foo',), True),
+            (b'has', (b'/foo',), False),
+            (b'get', (b'/missing',), True),
+            (b'has', (b'/missing',), False),
+            ])
+        self.assertEqual(((b'ok',), b'contents of foo\n'), results[0])
+        self.assertEqual(((b'yes',), None), results[1])
+        self.assertIsInstance(results[2], errors.ErrorFromSmartServer)
+        self.assertEqual(b'NoSuchFile', results[2].error_verb)
+        self.assertEqual(((b'no',), None), results[3])
+        # All the requests were sent before reading the first response.
+        first_read = self.io.index('read')
+        self.assertNotIn('write', self.io[first_read:])
+        # The medium is ready for the next calls
+        self.assertEqual((b'yes',), self.smart_client.call(b'has', b'/foo'))
+
+    def test_call_pipelined_determines_pipelining_support(self):
+        self.assertIs(None, self.client_medium._remote_supports_pipelining)
+        results = self.smart_client.call_pipelined([
+            (b'has', (b'/foo',), False),
+            (b'has', (b'/missing',), False),
+            (b'has', (b'/foo',), False),
+            ])
+        self.assertTrue(self.client_medium._remote_supports_pipelining)
+        self.assertEqual(
+            [((b'yes',), None), ((b'no',), None), ((b'yes',), None)],
+            results)
+
+    def test_call_pipelined_without_server_support(self):
+        self.smart_client.call(b'hello')
+        # Like a server predating pipelining
+        self.client_medium._remote_supports_pipelining = False
+        self.record_io()
+        results = self.smart_client.call_pipelined([
+            (b'has', (b'/foo',), False),
+            (b'has', (b'/missing',), False),
+            ])
+        self.assertEqual([((b'yes',), None), ((b'no',), None)], results)
+        # The second request was sent after reading the first response.
+        self.assertEqual('write', self.io[0])
+        self.assertLess(self.io.index('read'), self.io.index('write', 1))
+
+    def test_call_pipelined_unknown_method(self):
+        self.smart_client.call(b'hello')
+        results = self.smart_client.call_pipelined([
+            (b'no-such-verb', (), False),
+            (b'has', (b'/foo',), False),
+            ])
+        self.assertIsInstance(results[0], errors.UnknownSmartMethod)
+        self.assertEqual(((b'yes',), None), results[1])
+
+
+class TestBodyCompression(SmartTCPTests):
+
+    def setUp(self):
+        super(TestBodyCompression, self).setUp()
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+        self.start_server()
+        self.content = b'highly compressible content\n' * 1000
+        self.backing_transport.put_bytes('foo', self.content)
+        self.client_medium = self.transport.get_smart_medium()
+        self.io = {'write': 0, 'read': 0}
+        accept_bytes = self.client_medium._accept_bytes
+        read_bytes = self.client_medium._read_bytes
+
+        def _accept_bytes(bytes):
+            self.io['write'] += len(bytes)
+            return accept_bytes(bytes)
+
+        def _read_bytes(count):
+            bytes = read_bytes(count)
+            self.io['read'] += len(bytes)
+            return bytes
+        self.client_medium._accept_bytes = _accept_bytes
+        self.client_medium._read_bytes = _read_bytes
+
+    def make_client(self, accept_encoding):
+        return client._SmartClient(
+            self.client_medium, headers={b'Accept-Encoding': accept_encoding})
+
+    def test_compressed_response_body(self):
+        smart_client = self.make_client(b'zlib')
+        response, handler = smart_client.call_expecting_body(b'get', b'/foo')
+        self.assertEqual((b'ok',), response)
+        self.assertEqual(self.content, handler.read_body_bytes())
+        self.assertLess(self.io['read'], len(self.content) // 10)
+
+    def test_compressed_request_body(self):
+        smart_client = self.make_client(b'zlib')
+        self.assertEqual((b'yes',), smart_client.call(b'has', b'/foo'))
+        self.assertEqual(b'zlib', self.client_medium._remote_accept_encoding)
+        self.assertEqual(
+            (b'ok',), smart_client.call_with_body_bytes(
+                b'put', (b'/bar', b''), self.content))
+        self.assertLess(self.io['write'], len(self.content) // 10)
+        self.assertEqual(self.content, self.backing_transport.get_bytes('bar'))
+
+    def test_unsupported_encoding(self):
+        smart_client = self.make_client(b'unknown-encoding')
+        response, handler = smart_client.call_expecting_body(b'get', b'/foo')
+        self.assertEqual(self.content, handler.read_body_bytes())
+        self.assertGreater(self.io['read'], len(self.content))
+
+    def test_not_compressed_by_default(self):
+        smart_client = client._SmartClient(self.client_medium)
+        self.assertNotIn(b'Accept-Encoding', smart_client._headers)
+        response, handler = smart_client.call_expecting_body(b'get', b'/foo')
+        self.assertEqual(self.content, handler.read_body_bytes())
+        self.assertGreater(self.io['read'], len(self.content))
+
+    def test_enabled_by_configuration(self):
+        self.overrideAttr(config, 'GlobalStack', lambda: config.MemoryStack(
+            b'smart.body_compression = True\n'))
+        smart_client = client._SmartClient(self.client_medium)
+        self.assertEqual(
+            protocol.BODY_ENCODINGS, smart_client._headers[b'Accept-Encoding'])
+
+
+class TestServerStats(SmartTCPTests):
+
+    def setUp(self):
+        super(TestServerStats, self).setUp()
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+        self.stats = _mod_stats.SmartServerStats()
+        self.overrideAttr(_mod_request, 'server_stats', self.stats)
+        self.start_server()
+        self.content = b'content\n' * 1000
+        self.backing_transport.put_bytes('foo', self.content)
+
+    def wait_for(self, condition):
+        """Wait for the server to record the requests answered."""
+        deadline = time.time() + 10.0
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_requests_recorded(self):
+        self.assertEqual(self.content, self.transport.get_bytes('foo'))
+        self.assertEqual(self.content, self.transport.get_bytes('foo'))
+        self.assertRaises(_mod_transport.NoSuchFile,
+                          self.transport.get_bytes, 'bar')
+        self.wait_for(lambda: self.stats.verb_stats(b'get')[0] == 3)
+        requests, failures, lock_contentions, seconds = (
+            self.stats.verb_stats(b'get'))
+        self.assertEqual((1, 0), (failures, lock_contentions))
+        self.assertGreater(seconds, 0.0)
+
+    def test_bytes_transferred(self):
+        self.transport.get_bytes('foo')
+        self.wait_for(lambda: self.stats.bytes_sent > len(self.content))
+        self.assertGreater(self.stats.bytes_received, 0)
+
+    def test_connections(self):
+        self.transport.get_bytes('foo')
+        self.assertEqual((1, 1), (self.stats.connections,
+                                  self.stats.active_connections))
+        self.transport.disconnect()
+        self.wait_for(lambda: self.stats.active_connections == 0)
+        self.assertEqual(1, self.stats.connections)
+
+
+class AsyncServerStats(TestServerStats):
+
+    def make_tcp_server(self, backing_transport):
+        return async_server.AsyncSmartTCPServer(
+            backing_transport, client_timeout=4.0, max_workers=2)
+
+
+class AsyncPipelinedCalls(TestPipelinedCalls):
+
+    def make_tcp_server(self, backing_transport):
+        return async_server.AsyncSmartTCPServer(
+            backing_transport, client_timeout=4.0, max_workers=2)
+
+
+class AsyncServerSocketUsage(TestServerSocketUsage):
+
+    def make_tcp_server(self, backing_transport):
+        return async_server.AsyncSmartTCPServer(
+            backing_transport, client_timeout=4.0, max_workers=2)
+
+
+class AsyncWritableEndToEndTests(WritableEndToEndTests):
+
+    def make_tcp_server(self, backing_transport):
+        return async_server.AsyncSmartTCPServer(
+            backing_transport, client_timeout=4.0, max_workers=2)
+
+
+class TestAsyncSmartTCPServer(SmartTCPTests):
+
+    max_requests_per_client = None
+    client_timeout = 4.0
+
+    def make_tcp_server(self, backing_transport):
+        return async_server.AsyncSmartTCPServer(
+            backing_transport, client_timeout=self.client_timeout,
+            max_workers=2,
+            max_requests_per_client=self.max_requests_per_client)
+
+    def connect_to_server(self):
+        client_sock = socket.socket()
+        client_sock.connect(self.server._sockname)
+        self.addCleanup(client_sock.close)
+        return client_sock
+
+    def say_hello(self, client_sock):
+        client_sock.send(b'hello\n')
+        self.assertEqual(b'ok\x012\n', client_sock.recv(5))
+
+    def count_concurrent_requests(self):
+        """Record the most requests served at once in self.max_concurrent."""
+        lock = threading.Lock()
+        self.concurrent = self.max_concurrent = 0
+        serve_one = async_server.SmartServerEventLoopMedium.serve_one
+
+        def slow_serve_one(medium):
+            with lock:
+                self.concurrent += 1
+                self.max_concurrent = max(self.max_concurrent,
+                                          self.concurrent)
+            try:
+                time.sleep(0.05)
+                return serve_one(medium)
+            finally:
+                with lock:
+                    self.concurrent -= 1
+        self.overrideAttr(async_server.SmartServerEventLoopMedium,
+                          'serve_one', slow_serve_one)
+
+    def make_concurrent_requests(self, count):
+        errors_seen = []
+
+        def request():
+            t = remote.RemoteTCPTransport(self.server.get_url())
+            try:
+                t.has('foo')
+            except Exception as e:
+                errors_seen.append(e)
+            finally:
+                t.disconnect()
+        threads = [threading.Thread(target=request) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors_seen)
+
+    def test_requests_run_on_bounded_pool(self):
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+        self.start_server()
+        self.count_concurrent_requests()
+        idle_socks = [self.connect_to_server() for i in range(5)]
+        self.make_concurrent_requests(6)
+        self.assertEqual(2, self.max_concurrent)
+        self.assertEqual(2, len(self.server._executor._threads))
+        # Idle connections are still served
+        self.say_hello(idle_socks[0])
+
+    def test_max_requests_per_client(self):
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+        self.max_requests_per_client = 1
+        self.start_server()
+        self.count_concurrent_requests()
+        self.make_concurrent_requests(4)
+        self.assertEqual(1, self.max_concurrent)
+
+    def test_idle_client_disconnected(self):
+        self.client_timeout = 0.1
+        self.start_server()
+        client_sock = self.connect_to_server()
+        self.say_hello(client_sock)
+        self.assertEqual(b'', client_sock.recv(1))
+        self.assertContainsRe(self.get_log(),
+                              'disconnecting client after 0.1 seconds')
+
+    def test_graceful_stop_finishes_requests(self):
+        self.start_server()
+        self.backing_transport.put_bytes('bigfile', b'a' * 1024 * 1024)
+        client_sock = self.connect_to_server()
+        client_medium = medium.SmartClientAlreadyConnectedSocketMedium(
+            'base', client_sock)
+        smart_client = client._SmartClient(client_medium)
+        resp, response_handler = smart_client.call_expecting_body(
+            b'get', b'bigfile')
+        self.assertEqual((b'ok',), resp)
+        self.server._stop_gracefully()
+        self.server._stopped.wait()
+        self.assertRaises(socket.error, self.connect_to_server)
+        self.assertEqual(b'a' * 1024 * 1024,
+                         response_handler.read_body_bytes())
+        self.server._server_thread.join()
+        self.assertTrue(self.server._fully_stopped.is_set())
+        self.assertEqual(b'', client_sock.recv(1))
+
+
+class TestPreforkSmartTCPServer(tests.TestCaseInTempDir):
+
+    def setUp(self):
+        super(TestPreforkSmartTCPServer, self).setUp()
+        if getattr(os, 'fork', None) is None:
+            raise tests.TestNotApplicable('os.fork is not available')
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+        self.build_tree_contents([('foo', b'contents of foo\n')])
+
+    def start_server(self, max_requests=None):
+        self.server = prefork.PreforkSmartTCPServer(
+            _mod_transport.get_transport_from_path('.'), client_timeout=4.0,
+            workers=2, max_requests=max_requests)
+        self.server._ACCEPT_TIMEOUT = 0.1
+        self.server._POLL_INTERVAL = 0.02
+        self.spawned = []
+        spawn_worker = self.server._spawn_worker
+
+        def _spawn_worker():
+            pid = spawn_worker()
+            self.spawned.append(pid)
+            return pid
+        self.server._spawn_worker = _spawn_worker
+        self.server.start_server('127.0.0.1', 0)
+        self.server.start_background_thread('-' + self.id())
+        self.addCleanup(self.stop_server)
+
+    def stop_server(self):
+        if not self.server._fully_stopped.is_set():
+            self.server.stop_background_thread()
+
+    def get_foo(self):
+        t = remote.RemoteTCPTransport(self.server.get_url())
+        try:
+            return t.get_bytes('foo')
+        finally:
+            t.disconnect()
+
+    def wait_for(self, condition):
+        for i in range(500):
+            if condition():
+                return
+            time.sleep(0.01)
+        self.fail('timed out waiting for %r' % (condition,))
+
+    def test_workers_serve_clients(self):
+        self.start_server()
+        for i in range(4):
+            self.assertEqual(b'contents of foo\n', self.get_foo())
+        self.assertEqual(2, len(self.spawned))
+        self.assertEqual(set(self.spawned), self.server._workers)
+
+    def test_workers_replaced_after_max_requests(self):
+        self.start_server(max_requests=1)
+        for i in range(4):
+            self.assertEqual(b'contents of foo\n', self.get_foo())
+        # Each worker retires after its first request, although a retiring
+        # worker still serves the clients it accepted meanwhile.
+        self.wait_for(lambda: len(self.spawned) >= 4)
+        self.wait_for(lambda: len(self.server._workers) == 2)
+        self.assertEqual(b'contents of foo\n', self.get_foo())
+
+    def test_reload(self):
+        self.start_server()
+        self.wait_for(lambda: len(self.server._workers) == 2)
+        old_workers = set(self.server._workers)
+        self.server.reload()
+        self.wait_for(lambda: len(self.spawned) == 4)
+        self.wait_for(lambda: not self.server._retiring)
+        self.assertEqual(set(), old_workers & self.server._workers)
+        self.assertEqual(b'contents of foo\n', self.get_foo())
+
+    def test_stop_gracefully_waits_for_workers(self):
+        self.start_server()
+        self.assertEqual(b'contents of foo\n', self.get_foo())
+        self.server._stop_gracefully()
+        self.server._server_thread.join()
+        self.assertTrue(self.server._fully_stopped.is_set())
+        self.assertEqual(set(), self.server._workers)
+        self.assertEqual(set(), self.server._retiring)
+
+
+class TestSmartServerEventLoopMedium(tests.TestCase):
+
+    def setUp(self):
+        super(TestSmartServerEventLoopMedium, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.calls = []
+        test = self
+
+        class FakeServer(object):
+            _MAX_BUFFER = 10
+            _loop = self.loop
+
+            def _data_received(self, conn):
+                test.calls.append('data')
+
+            def _connection_made(self, conn):
+                pass
+
+        class FakeTransport(object):
+
+            def get_extra_info(self, name):
+                return None
+
+            def pause_reading(self):
+                test.calls.append('pause')
+
+            def resume_reading(self):
+                test.calls.append('resume')
+
+            def is_closing(self):
+                return False
+
+        self.medium = async_server.SmartServerEventLoopMedium(
+            FakeServer(), None, timeout=4.0)
+        self.medium.connection_made(FakeTransport())
+
+    def test_pauses_reading_when_buffer_full(self):
+        self.medium.data_received(b'a' * 6)
+        self.assertEqual(['data'], self.calls)
+        self.medium.data_received(b'b' * 6)
+        self.assertEqual(['data', 'pause', 'data'], self.calls)
+        self.assertEqual(b'aaaaaa', self.medium.read_bytes(100))
+        self.assertEqual(b'bb', self.medium.read_bytes(2))
+        # Resuming happens on the event loop
+        self.assertEqual(['data', 'pause', 'data'], self.calls)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(['data', 'pause', 'data', 'resume'], self.calls)
+        self.assertEqual(b'bbbb', self.medium.read_bytes(100))
+
+    def test_read_bytes_at_eof(self):
+        self.medium.data_received(b'abc')
+        self.medium.eof_received()
+        self.assertEqual(b'abc', self.medium.read_bytes(100))
+        self.assertEqual(b'', self.medium.read_bytes(100))
+
+
 class SmartServerCommandTests(tests.TestCaseWithTransport):
     """Tests that call directly into the command objects, bypassing the network
     and the request dispatching.
@@ -2795,7 +3319,7 @@ class TestVersionOneFeaturesInProtocolThree(
     def test_construct_version_three_server_protocol(self):
         smart_protocol = protocol.ProtocolThreeDecoder(None)
         self.assertEqual(b'', smart_protocol.unused_data)
-        self.assertEqual([], smart_protocol._in_buffer_list)
+        self.assertEqual(b'', smart_protocol._get_in_buffer())
         self.assertEqual(0, smart_protocol._in_buffer_len)
         self.assertFalse(smart_protocol._has_dispatched)
         # The protocol starts by expecting four bytes, a length prefix for the
@@ -3189,6 +3713,25 @@ class TestClientDecodingProtocolThree(TestSmartProtocol):
             errors.UnknownSmartMethod, response_handler.read_response_tuple)
         self.assertEqual(b'method-name', error.verb)
 
+    def test_unknown_body_encoding(self):
+        headers = b'\0\0\0\x17d13:Body-Encoding3:fooe'
+        decoder, response_handler = self.make_logging_response_decoder()
+        decoder.accept_bytes(headers)
+        self.assertTrue(decoder.decoding_failed)
+        self.assertEqual('protocol_error', response_handler.event_log[0][0])
+
+    def test_compressed_body_part_too_big(self):
+        self.overrideAttr(protocol, 'MAX_DECOMPRESSED_BODY_PART', 1000)
+        headers = b'\0\0\0\x16d13:Body-Encoding4:zlibe'
+        compressor = zlib.compressobj()
+        part = (compressor.compress(b'x' * 1001)
+                + compressor.flush(zlib.Z_SYNC_FLUSH))
+        decoder, response_handler = self.make_logging_response_decoder()
+        decoder.accept_bytes(headers + b'oS' + b'b'
+                             + struct.pack('!L', len(part)) + part)
+        self.assertTrue(decoder.decoding_failed)
+        self.assertEqual('protocol_error', response_handler.event_log[-1][0])
+
     def test_read_response_tuple_error(self):
         """If the response has an error, it is raised as an exception."""
         headers = b'\0\0\0\x02de'  # length-prefixed, bencoded empty dict
@@ -3352,6 +3895,75 @@ class TestClientEncodingProtocolThree(TestSmartProtocol):
             b'e', output.getvalue())
         self.assertEqual([False, True, True], flush_called)
 
+    def decode_request(self, request_bytes):
+        handler = LoggingMessageHandler()
+        decoder = protocol.ProtocolThreeDecoder(
+            handler, expect_version_marker=True)
+        decoder.accept_bytes(request_bytes)
+        self.assertEqual(0, decoder.next_read_size())
+        return handler.event_log
+
+    def test_call_with_compressed_body_bytes(self):
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.negotiate_body_encoding(b'other,zlib')
+        body = b'compressible body ' * 100
+        requester.call_with_body_bytes((b'one arg',), body)
+        self.assertLess(len(output.getvalue()), len(body))
+        self.assertEqual(
+            [('headers', {b'Body-Encoding': b'zlib'}),
+             ('structure', (b'one arg',)),
+             ('bytes', body),
+             ('end',)],
+            self.decode_request(output.getvalue()))
+
+    def test_call_with_incompressible_body_bytes(self):
+        """Bodies that compression would not make smaller are sent as is."""
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.negotiate_body_encoding(b'zlib')
+        requester.call_with_body_bytes((b'one arg',), b'body')
+        self.assertEqual(
+            b'bzr message 3 (bzr 1.6)\n'  # protocol version
+            b'\x00\x00\x00\x02de'  # headers
+            b's\x00\x00\x00\x0bl7:one arge'  # args
+            b'b\x00\x00\x00\x04body'  # the prefixed body
+            b'e',  # end
+            output.getvalue())
+
+    def test_call_with_compressed_body_stream(self):
+        """Compressed body chunks are decoded to the original chunks."""
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.negotiate_body_encoding(b'zlib')
+        stream = [b'chunk 1' * 10, b'', b'chunk two' * 10]
+        requester.call_with_body_stream((b'one arg',), stream)
+        self.assertEqual(
+            [('headers', {b'Body-Encoding': b'zlib'}),
+             ('structure', (b'one arg',))] +
+            [('bytes', chunk) for chunk in stream] +
+            [('end',)],
+            self.decode_request(output.getvalue()))
+
+    def test_body_encoding_not_accepted(self):
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.negotiate_body_encoding(b'other')
+        requester.call_with_body_stream((b'one arg',), [b'chunk'])
+        self.assertEqual(
+            [('headers', {}), ('structure', (b'one arg',)),
+             ('bytes', b'chunk'), ('end',)],
+            self.decode_request(output.getvalue()))
+
+    def test_call_without_body_not_compressed(self):
+        requester, output = self.make_client_encoder_and_output()
+        requester.set_headers({})
+        requester.negotiate_body_encoding(b'zlib')
+        requester.call(b'one arg')
+        self.assertEqual(
+            [('headers', {}), ('structure', (b'one arg',)), ('end',)],
+            self.decode_request(output.getvalue()))
+
 
 class StubMediumRequest(object):
     """A stub medium request that tracks the number of times accept_bytes is
@@ -3419,6 +4031,109 @@ class TestResponseEncodingProtocolThree(tests.TestCase):
             + interrupted_body_stream)
         self.assertEqual(expected_response, out_stream.getvalue())
 
+    def decode_response(self, response_bytes):
+        handler = LoggingMessageHandler()
+        decoder = protocol.ProtocolThreeDecoder(
+            handler, expect_version_marker=True)
+        decoder.accept_bytes(response_bytes)
+        self.assertEqual(0, decoder.next_read_size())
+        return handler.event_log
+
+    def test_send_compressed_body_stream(self):
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+        chunks = [b'compressible chunk' * 10, b'another chunk' * 10]
+        encoder.send_response(_mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body_stream=iter(chunks)))
+        self.assertEqual(
+            [('headers', {b'Body-Encoding': b'zlib'}), ('byte', b'S'),
+             ('structure', (b'args',))] +
+            [('bytes', chunk) for chunk in chunks] +
+            [('end',)],
+            self.decode_response(out_stream.getvalue()))
+
+    def test_send_incompressible_body_stream(self):
+        self.overrideAttr(protocol, 'BODY_STREAM_SAMPLE_SIZE', 1000)
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+        # Already compressed data, like groupcompress blocks
+        chunks = [os.urandom(100) for i in range(100)]
+        encoder.send_response(_mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body_stream=iter(chunks)))
+        self.assertEqual(
+            [('headers', {}), ('byte', b'S'), ('structure', (b'args',))] +
+            [('bytes', chunk) for chunk in chunks] +
+            [('end',)],
+            self.decode_response(out_stream.getvalue()))
+
+    def test_send_broken_body_stream_compressed(self):
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+
+        def stream_that_fails():
+            yield b'compressible chunk' * 10
+            raise Exception('Boom!')
+        encoder.send_response(_mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body_stream=stream_that_fails()))
+        self.assertEqual(
+            [('headers', {b'Body-Encoding': b'zlib'}), ('byte', b'S'),
+             ('structure', (b'args',)),
+             ('bytes', b'compressible chunk' * 10), ('byte', b'E'),
+             ('structure', (b'error', b'Exception', b'Boom!')), ('end',)],
+            self.decode_response(out_stream.getvalue()))
+
+    def test_send_compressed_body(self):
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+        body = b'compressible body' * 100
+        encoder.send_response(_mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body=body))
+        self.assertLess(len(out_stream.getvalue()), len(body))
+        self.assertEqual(
+            [('headers', {b'Body-Encoding': b'zlib'}), ('byte', b'S'),
+             ('structure', (b'args',)), ('bytes', body), ('end',)],
+            self.decode_response(out_stream.getvalue()))
+
+    def test_send_compressed_body_stream_big_chunk(self):
+        """Chunks bigger than the peer decompresses are split."""
+        self.overrideAttr(protocol, 'MAX_DECOMPRESSED_BODY_PART', 100)
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+        chunk = b'compressible chunk' * 10
+        encoder.send_response(_mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body_stream=iter([chunk])))
+        self.assertEqual(
+            [('headers', {b'Body-Encoding': b'zlib'}), ('byte', b'S'),
+             ('structure', (b'args',)), ('bytes', chunk[:100]),
+             ('bytes', chunk[100:]), ('end',)],
+            self.decode_response(out_stream.getvalue()))
+
+    def test_send_big_body_not_compressed(self):
+        self.overrideAttr(protocol, 'MAX_DECOMPRESSED_BODY_PART', 100)
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+        body = b'compressible body' * 100
+        encoder.send_response(_mod_request.SuccessfulSmartServerResponse(
+            (b'args',), body=body))
+        self.assertEqual(
+            [('headers', {}), ('byte', b'S'), ('structure', (b'args',)),
+             ('bytes', body), ('end',)],
+            self.decode_response(out_stream.getvalue()))
+
+    def test_send_error_not_compressed(self):
+        encoder, out_stream = self.make_response_encoder()
+        encoder._headers = {}
+        encoder.negotiate_body_encoding(b'zlib')
+        encoder.send_error(Exception('An exception string.'))
+        self.assertEqual(
+            ('headers', {}), self.decode_response(out_stream.getvalue())[0])
+
 
 class TestResponseEncoderBufferingProtocolThree(tests.TestCase):
     """Tests for buffering of responses.
@@ -4201,6 +4916,34 @@ class TestChunkedBodyDecoder(tests.TestCase):
         self.assertRaises(
             errors.SmartProtocolError, decoder.accept_bytes, b'bad header\n')
 
+    def test_large_chunk_in_many_parts(self):
+        """A chunk received in many small parts is decoded correctly."""
+        decoder = protocol.ChunkedBodyDecoder()
+        decoder.accept_bytes(b'chunked\n')
+        chunk_content = b''.join(b'%07d\n' % i for i in range(32 * 1024))
+        encoded = b'%x\n' % len(chunk_content) + chunk_content + b'END\n'
+        for i in range(0, len(encoded), 1000):
+            decoder.accept_bytes(encoded[i:i + 1000])
+        self.assertTrue(decoder.finished_reading)
+        self.assertEqual(chunk_content, decoder.read_next_chunk())
+        self.assertEqual(None, decoder.read_next_chunk())
+        self.assertEqual(b'', decoder.unused_data)
+
+    def test_consumed_bytes_are_dropped(self):
+        """The bytes decoded are dropped from the input buffer."""
+        decoder = protocol.ChunkedBodyDecoder()
+        decoder.accept_bytes(b'chunked\n')
+        chunk = b'a' * 100
+        encoded = (b'%x\n' % len(chunk) + chunk) * 1000
+        # The length of the next chunk is incomplete, so it stays buffered.
+        decoder.accept_bytes(encoded + b'6')
+        self.assertEqual(1000, len(decoder.chunks))
+        self.assertEqual(1, decoder._in_buffer_len)
+        self.assertLess(len(decoder._in_buffer), len(encoded))
+        decoder.accept_bytes(b'4\n' + chunk + b'END\n')
+        self.assertTrue(decoder.finished_reading)
+        self.assertEqual(1001, len(decoder.chunks))
+
 
 class TestSuccessfulSmartServerResponse(tests.TestCase):
 
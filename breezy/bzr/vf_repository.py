@@ -16,6 +16,7 @@
 
 """Repository formats built around versioned files."""
 
+import copy
 from io import BytesIO
 
 from ..lazy_import import lazy_import
@@ -587,6 +588,15 @@ class VersionedFileCommitBuilder(CommitBuilder):
             nostore_sha=nostore_sha, random_id=self.random_revid)[0:2]
 
 
+def _copy_revision(rev):
+    """Copy a cached revision, with its mutable attributes."""
+    result = copy.copy(rev)
+    result.properties = dict(rev.properties)
+    result.parent_ids = copy.copy(rev.parent_ids)
+    result.parent_sha1s = copy.copy(rev.parent_sha1s)
+    return result
+
+
 class VersionedFileRepository(Repository):
     """Repository holding history for one or more branches.
 
@@ -675,6 +685,7 @@ class VersionedFileRepository(Repository):
         super(VersionedFileRepository, self).unlock()
         if self.control_files._lock_count == 0:
             self._inventory_entry_cache.clear()
+            self._revision_cache.clear()
 
     def add_inventory(self, revision_id, inv, parents):
         """Add the inventory inv to the repository as revision_id.
@@ -933,6 +944,10 @@ class VersionedFileRepository(Repository):
         # Is it safe to return inventory entries directly from the entry cache,
         # rather copying them?
         self._safe_to_return_from_cache = False
+        # Deserialised Revision objects, kept while the repository is locked
+        # so that repeated lookups (e.g. from log and its formatters) don't
+        # have to reparse the revision texts.
+        self._revision_cache = lru_cache.LRUCache(1000)
 
     def fetch(self, source, revision_id=None, find_ghosts=False,
               fetch_spec=None, lossy=False):
@@ -1117,13 +1132,26 @@ class VersionedFileRepository(Repository):
             repositories only referenced ones will be returned.
         :return: An iterator of (revid, revision) tuples. Absent revisions (
             those asked for but not available) are returned as (revid, None).
+            The revisions are copies of the cached ones, callers can modify
+            them.
         """
         with self.lock_read():
             for rev_id in revision_ids:
                 if not rev_id or not isinstance(rev_id, bytes):
                     raise errors.InvalidRevisionId(
                         revision_id=rev_id, branch=self)
-            keys = [(key,) for key in revision_ids]
+            keys = []
+            for revid in revision_ids:
+                rev = self._revision_cache.get(revid)
+                if rev is not None:
+                    yield (revid, _copy_revision(rev))
+                else:
+                    keys.append((revid,))
+            if not keys:
+                return
+            # Revisions added in an uncommitted write group may vanish again,
+            # so don't cache them.
+            cache = not self.is_in_write_group()
             stream = self.revisions.get_record_stream(keys, 'unordered', True)
             for record in stream:
                 revid = record.key[0]
@@ -1132,6 +1160,9 @@ class VersionedFileRepository(Repository):
                 else:
                     text = record.get_bytes_as('fulltext')
                     rev = self._serializer.read_revision_from_string(text)
+                    if cache:
+                        self._revision_cache[revid] = rev
+                        rev = _copy_revision(rev)
                     yield (revid, rev)
 
     def add_signature_text(self, revision_id, signature):
@@ -1612,6 +1643,28 @@ class VersionedFileRepository(Repository):
         with self.lock_read():
             return graph.Graph(self.texts)
 
+    def _get_annotator(self):
+        """Return an Annotator for the file texts in this repository.
+
+        If the repository.annotation_cache option is set, the annotator uses
+        a persistent cache of annotations in the user cache directory. If the
+        repository.annotation_ancestry_index option is set, it resolves heads
+        with an ancestry index.
+        """
+        annotator = self.texts.get_annotator()
+        config_stack = _mod_config.LocationStack(self.user_url)
+        if config_stack.get('repository.annotation_ancestry_index'):
+            annotator.enable_ancestry_index()
+        if config_stack.get('repository.annotation_cache'):
+            from .annotation_cache import AnnotationCache, cache_transport
+            annotator.set_annotation_cache(AnnotationCache(
+                cache_transport(self),
+                min_depth=config_stack.get(
+                    'repository.annotation_cache.min_depth'),
+                max_size=config_stack.get(
+                    'repository.annotation_cache.max_size')))
+        return annotator
+
     def revision_ids_to_search_result(self, result_set):
         """Convert a set of revision ids to a graph SearchResult."""
         result_parents = set(itertools.chain.from_iterable(
@@ -1748,10 +1801,13 @@ class StreamSink(object):
         return self.insert_stream_without_locking(stream,
                                                   self.target_repo._format)
 
-    def insert_stream(self, stream, src_format, resume_tokens):
+    def insert_stream(self, stream, src_format, resume_tokens,
+                      upload_id=None):
         """Insert a stream's content into the target repository.
 
         :param src_format: a bzr repository format.
+        :param upload_id: Identifies the stream, the same when an interrupted
+            insert is retried, for sinks able to resume it. Ignored here.
 
         :return: a list of resume tokens and an  iterable of keys additional
             items required before the insertion can be completed.
@@ -2278,6 +2334,9 @@ class _VersionedFileChecker(object):
 class InterVersionedFileRepository(InterRepository):
 
     _walk_to_common_revisions_batch_size = 50
+    # The batch size doubles, up to this, while the target has none of the
+    # revisions walked, to take fewer round trips when it is remote.
+    _walk_to_common_revisions_max_batch_size = 1600
 
     supports_fetch_spec = True
 
@@ -2318,8 +2377,16 @@ class InterVersionedFileRepository(InterRepository):
         :param revision_ids: The start point for the search.
         :return: A set of revision ids.
         """
-        target_graph = self.target.get_graph()
         revision_ids = frozenset(revision_ids)
+        # A remote source can walk its own graph, rather than sending it to
+        # us a few generations at a time.
+        find_missing = getattr(self.source, '_find_missing_revisions', None)
+        if find_missing is not None:
+            missing_revs = find_missing(
+                revision_ids, if_present_ids, self.target)
+            if missing_revs is not None:
+                return self.source.revision_ids_to_search_result(missing_revs)
+        target_graph = self.target.get_graph()
         if if_present_ids:
             all_wanted_revs = revision_ids.union(if_present_ids)
         else:
@@ -2330,11 +2397,12 @@ class InterVersionedFileRepository(InterRepository):
         searcher = source_graph._make_breadth_first_searcher(all_wanted_revs)
         null_set = frozenset([_mod_revision.NULL_REVISION])
         searcher_exhausted = False
+        batch_size = self._walk_to_common_revisions_batch_size
         while True:
             next_revs = set()
             ghosts = set()
             # Iterate the searcher until we have enough next_revs
-            while len(next_revs) < self._walk_to_common_revisions_batch_size:
+            while len(next_revs) < batch_size:
                 try:
                     next_revs_part, ghosts_part = searcher.next_with_ghosts()
                     next_revs.update(next_revs_part)
@@ -2360,6 +2428,10 @@ class InterVersionedFileRepository(InterRepository):
                     raise errors.NoSuchRevision(
                         self.source, ghosts_to_check.pop())
                 missing_revs.update(next_revs - have_revs)
+                max_batch_size = self._walk_to_common_revisions_max_batch_size
+                if (batch_size < max_batch_size and
+                        not have_revs.intersection(next_revs)):
+                    batch_size = min(batch_size * 2, max_batch_size)
                 # Because we may have walked past the original stop point, make
                 # sure everything is stopped
                 stop_revs = searcher.find_seen_ancestors(have_revs)
@@ -892,7 +892,7 @@ class InventoryWorkingTree(WorkingTree, MutableInventoryTree):
                     file_parent_keys.append(key)
 
             # Now we have the parents of this content
-            annotator = self.branch.repository.texts.get_annotator()
+            annotator = self.branch.repository._get_annotator()
             text = self.get_file_text(path)
             this_key = (file_id, default_revision)
             annotator.add_special_text(this_key, file_parent_keys, text)
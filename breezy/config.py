@@ -2626,6 +2626,44 @@ The default value for ``push --strict``.
 If present, defines the ``--strict`` option default value for checking
 uncommitted changes before sending a merge directive.
 '''))
+option_registry.register(
+    Option('repository.annotation_ancestry_index', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Index the ancestry of files when annotating them?
+
+If true, ``brz annotate`` indexes the ancestry of the annotated file to pick
+the revision lines come from, rather than walking the file graph for every
+line that several revisions introduced. This speeds up annotating files with
+a lot of merged history, at the cost of building the index first.
+'''))
+option_registry.register(
+    Option('repository.annotation_cache', default=False,
+           from_unicode=bool_from_store,
+           help='''\
+Keep a persistent cache of the annotations of the repository?
+
+If true, the annotations computed by ``brz annotate`` are stored in the
+user cache directory, and later annotations of the same file only need to
+look at the history since the nearest cached version.
+'''))
+option_registry.register(
+    Option('repository.annotation_cache.max_size', default=u'50MB',
+           from_unicode=int_SI_from_store, invalid='warning',
+           help='''\
+Maximum size of the annotation cache of a repository.
+
+The oldest annotations are removed once it grows bigger.
+'''))
+option_registry.register(
+    Option('repository.annotation_cache.min_depth', default=100,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+How long a history a text must have taken to annotate to be cached.
+
+Only the annotations of texts whose longest line of ancestors since the root
+or a cached text has at least this many texts are kept.
+'''))
 option_registry.register(
     Option('repository.fdatasync', default=True,
            from_unicode=bool_from_store,
@@ -2664,10 +2702,131 @@ option_registry.register(
            default=300.0, from_unicode=float_from_store,
            help="If we wait for a new request from a client for more than"
                 " X seconds, consider the client idle, and hangup."))
+option_registry.register(
+    Option('serve.max_requests_per_client', default=None,
+           from_unicode=int_from_store,
+           help="""\
+How many requests of a single client host 'brz serve' serves at once.
+
+Only used when serve.max_workers is set. Further requests of the client wait
+until one of its requests is done, so a single busy client cannot take all
+the workers. By default, clients are not limited.
+"""))
+option_registry.register(
+    Option('serve.max_workers', default=None,
+           from_unicode=int_from_store,
+           help="""\
+The number of threads serving the requests of 'brz serve' clients.
+
+When set, the server reads from all its connections on an event loop and
+serves their requests on a pool of that many threads, instead of using a
+thread per connection.
+"""))
+option_registry.register(
+    Option('serve.response_cache_size', default=None,
+           from_unicode=int_SI_from_store,
+           help="""\
+How many bytes of responses 'brz serve' keeps to answer identical requests.
+
+When set, the responses to read-only requests whose result only depends on the
+state of a branch or pack repository, such as the revision streams fetched by
+many clients, are cached and reused until that state changes. Sizes can be
+given as e.g. 64M. By default, responses are not cached.
+"""))
+option_registry.register(
+    Option('serve.stats_port', default=None,
+           from_unicode=int_from_store,
+           help="""\
+The TCP port on which 'brz serve' publishes its statistics.
+
+When set, the statistics of the server, such as the number of requests of each
+verb, how long they took, the bytes transferred and the active connections,
+are served over HTTP at /metrics on that port, in the Prometheus text format.
+Not used with --inet or serve.worker_processes.
+"""))
+option_registry.register(
+    Option('serve.stats_listen', default='127.0.0.1',
+           help="""The interface on which 'brz serve' publishes its statistics.
+
+The statistics are served without authentication, so by default they are only
+available from the local host. See serve.stats_port.
+"""))
+option_registry.register(
+    Option('serve.worker_max_requests', default=None,
+           from_unicode=int_from_store,
+           help="""\
+How many requests a 'brz serve' worker process serves before it is replaced.
+
+Only used when serve.worker_processes is set. A worker that served that many
+requests finishes serving its clients, exits and is replaced by a new one. By
+default, workers are never replaced.
+"""))
+option_registry.register(
+    Option('serve.worker_processes', default=None,
+           from_unicode=int_from_store,
+           help="""\
+The number of processes serving the clients of 'brz serve'.
+
+When set, the server forks that many worker processes sharing its listening
+socket, so that it can use several cores. Sending SIGUSR1 to the server
+replaces its workers once they are done with their clients. This is not
+available on Windows.
+"""))
+option_registry.register(
+    Option('sftp.max_request_size', default=32768,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+Size in bytes of the individual read and write requests sent over sftp.
+
+The sftp specification only requires servers to accept 32KiB requests, but
+most servers (including OpenSSH) accept bigger ones, which need fewer round
+trips.
+'''))
+option_registry.register(
+    Option('sftp.max_requests_in_flight', default=None,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+Number of sftp read requests sent before waiting for their replies.
+
+When unset, all the requests of a read are sent at once. Requires paramiko
+3.3 or later.
+'''))
+option_registry.register(
+    Option('smart.body_compression', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Whether to compress the bodies of smart protocol messages.
+
+When enabled, the bodies of requests and responses exchanged with a bzr://
+or bzr+ssh:// server are compressed with zlib, if the server supports it.
+This mainly helps over slow connections.
+'''))
+option_registry.register(
+    Option('smart.insert_checkpoint_size', default=u'32MB',
+           from_unicode=int_SI_from_store, invalid='warning',
+           help='''\
+Amount of data pushed to a smart server between checkpoints.
+
+Pushes to a bzr:// or bzr+ssh:// server sending more than this are kept by
+the server as they go, so that running an interrupted push again only sends
+what the server doesn't have yet. 0 disables checkpoints.
+'''))
 option_registry.register(
     Option('ssh',
            default=None, override_from_env=['BRZ_SSH'],
            help='SSH vendor to use.'))
+option_registry.register(
+    Option('ssh.multiplex', default=False,
+           from_unicode=bool_from_store, invalid='warning',
+           help='''\
+Whether to share one SSH connection between the sessions to a host.
+
+With paramiko the sessions are channels of the same connection. With OpenSSH
+a ControlMaster is used, its control sockets are kept in the breezy cache
+directory and it exits shortly after its last session, possibly after brz
+itself. This overrides any ControlMaster set up in the ssh configuration, so
+leave it unset to use your own.
+'''))
 option_registry.register(
     Option('stacked_on_location',
            default=None,
@@ -2688,6 +2847,48 @@ option_registry.register(
     ListOption('suppress_warnings',
                default=[],
                help="List of warning classes to suppress."))
+option_registry.register(
+    Option('transport.cache.directory', default=None,
+           help='''\
+Directory used by ``cache+`` transports to keep immutable repository files.
+
+Defaults to a ``transport`` directory in the breezy cache directory.
+'''))
+option_registry.register(
+    Option('transport.cache.max_size', default=u'512MB',
+           from_unicode=int_SI_from_store, invalid='warning',
+           help='''\
+Maximum size of the ``cache+`` transport cache directory.
+
+The least recently used byte ranges are removed once it grows bigger.
+'''))
+option_registry.register(
+    Option('transport.connection_pool.idle_timeout', default=300,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+Seconds after which an idle pooled connection is closed.
+
+See ``transport.connection_pool.max_size``.
+'''))
+option_registry.register(
+    Option('transport.connection_pool.max_size', default=0,
+           from_unicode=int_from_store, invalid='warning',
+           help='''\
+Number of idle connections kept in the process wide connection pool.
+
+Disconnected transports give their connection to the pool, and transports to
+the same scheme, host, port and credentials reuse it rather than each opening
+their own, which mainly helps programs opening many branches on the same host.
+A connection is only used by one transport at a time. Smart server connections
+are not pooled. 0 disables the pool.
+'''))
+option_registry.register(
+    Option('transport.stats_file', default=None,
+           help='''\
+File to export transport statistics to as JSON when brz exits.
+
+Statistics are only collected with the ``transport_stats`` debug flag.
+'''))
 option_registry.register(
     Option('validate_signatures_in_log', default=False,
            from_unicode=bool_from_store, invalid='warning',
@@ -2698,6 +2899,14 @@ option_registry.register_lazy('ssl.ca_certs',
 option_registry.register_lazy('ssl.cert_reqs',
                               'breezy.transport.http', 'opt_ssl_cert_reqs')
 
+option_registry.register_lazy('http.readv.connections',
+                              'breezy.transport.http',
+                              'opt_http_readv_connections')
+
+option_registry.register_lazy('http.readv.adaptive',
+                              'breezy.transport.http',
+                              'opt_http_readv_adaptive')
+
 
 class Section(object):
     """A section defines a dict of option name => value.
@@ -19,6 +19,7 @@ import time
 from . import (
     debug,
     errors,
+    lru_cache,
     osutils,
     revision,
     trace,
@@ -214,6 +215,11 @@ class CachingParentsProvider(object):
         if self._cache_misses:
             self.missing_keys.add(key)
 
+    def note_parent_map(self, parent_map):
+        """Note parents found without asking the provider, if caching."""
+        if self._cache is not None:
+            self._cache.update(parent_map)
+
 
 class CallableToParentsProviderAdapter(object):
     """A parents provider that adapts any callable to the parents provider API.
@@ -255,6 +261,8 @@ class Graph(object):
         if getattr(parents_provider, 'get_parent_map', None) is not None:
             self.get_parent_map = parents_provider.get_parent_map
         self._parents_provider = parents_provider
+        # An optional _SharedHeadsView, see enable_shared_heads_cache()
+        self._heads_cache = None
 
     def __repr__(self):
         return 'Graph(%r)' % self._parents_provider
@@ -424,12 +432,25 @@ class Graph(object):
 
         :param unique_revision: The revision_id whose ancestry we are
             interested in.
-            (XXX: Would this API be better if we allowed multiple revisions on
-            to be searched here?)
         :param common_revisions: Revision_ids of ancestries to exclude.
         :return: A set of revisions in the ancestry of unique_revision
         """
-        if unique_revision in common_revisions:
+        return self.find_all_unique_ancestors([unique_revision],
+                                              common_revisions)
+
+    def find_all_unique_ancestors(self, unique_revisions, common_revisions):
+        """Find the unique ancestors of several revisions versus others.
+
+        This returns the combined ancestry of unique_revisions, excluding all
+        revisions in the ancestry of common_revisions.
+
+        :param unique_revisions: The revision_ids whose ancestry we are
+            interested in.
+        :param common_revisions: Revision_ids of ancestries to exclude.
+        :return: A set of revisions in the ancestry of unique_revisions
+        """
+        unique_revisions = set(unique_revisions).difference(common_revisions)
+        if not unique_revisions:
             return set()
 
         # Algorithm description
@@ -452,7 +473,7 @@ class Graph(object):
         # 8) Search is done when all common searchers have completed.
 
         unique_searcher, common_searcher = self._find_initial_unique_nodes(
-            [unique_revision], common_revisions)
+            unique_revisions, common_revisions)
 
         unique_nodes = unique_searcher.seen.difference(common_searcher.seen)
         if not unique_nodes:
@@ -833,6 +854,12 @@ class Graph(object):
                 return {revision.NULL_REVISION}
         if len(candidate_heads) < 2:
             return candidate_heads
+        if self._heads_cache is not None:
+            return self._heads_cache.heads(candidate_heads, self._find_heads)
+        return self._find_heads(candidate_heads)
+
+    def _find_heads(self, candidate_heads):
+        """Search the ancestry of at least two non-null candidate heads."""
         searchers = dict((c, self._make_breadth_first_searcher([c]))
                          for c in candidate_heads)
         active_searchers = dict(searchers)
@@ -1323,6 +1350,84 @@ class FrozenHeadsCache(object):
         self._heads[frozenset(keys)] = frozenset(heads)
 
 
+class SharedHeadsCache(object):
+    """A process-wide LRU cache of heads() results.
+
+    Entries are keyed by repository location and the keys asked about, so
+    that separate merges and annotations against the same repository can
+    reuse each other's results. Every location has a generation number which
+    is bumped when revisions are added to it; entries from older generations
+    are never returned and age out of the LRU.
+    """
+
+    def __init__(self, max_size=10000):
+        self._cache = lru_cache.LRUCache(max_size)
+        self._generations = {}
+
+    def invalidate(self, location):
+        """Forget all results for location, e.g. after adding revisions."""
+        self._generations[location] = self._generations.get(location, 0) + 1
+
+    def clear(self):
+        self._cache.clear()
+        self._generations.clear()
+
+    def get_view(self, locations):
+        """Return an object caching heads() for a graph over locations.
+
+        :param locations: A tuple of repository locations the graph covers.
+        """
+        return _SharedHeadsView(self, locations)
+
+
+class _SharedHeadsView(object):
+    """The part of a SharedHeadsCache relevant to one Graph."""
+
+    def __init__(self, cache, locations):
+        self._cache = cache
+        self._locations = locations
+
+    def heads(self, keys, find_heads):
+        generations = self._cache._generations
+        cache_key = (tuple((location, generations.get(location, 0))
+                           for location in self._locations),
+                     frozenset(keys))
+        heads = self._cache._cache.get(cache_key)
+        if heads is None:
+            heads = frozenset(find_heads(set(keys)))
+            self._cache._cache[cache_key] = heads
+        return set(heads)
+
+
+_shared_heads_cache = None
+
+
+def enable_shared_heads_cache(max_size=10000):
+    """Share heads() results between all repository graphs in this process.
+
+    This is meant for long-running tools that do many merges or annotations
+    against the same repositories. It has no effect on graphs that have
+    already been created.
+
+    :param max_size: The maximum number of heads() results to keep.
+    :return: The SharedHeadsCache in use.
+    """
+    global _shared_heads_cache
+    _shared_heads_cache = SharedHeadsCache(max_size)
+    return _shared_heads_cache
+
+
+def disable_shared_heads_cache():
+    """Stop sharing heads() results between repository graphs."""
+    global _shared_heads_cache
+    _shared_heads_cache = None
+
+
+def get_shared_heads_cache():
+    """Return the process-wide SharedHeadsCache, or None if not enabled."""
+    return _shared_heads_cache
+
+
 class _BreadthFirstSearcher(object):
     """Parallel search breadth-first the ancestry of revisions.
 
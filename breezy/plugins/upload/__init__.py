@@ -115,6 +115,20 @@ central branch, rather than when you commit to your local branch.
 Note that you will consume more bandwith this way than uploading from a local
 branch.
 
+Concurrent uploads
+------------------
+
+Uploads are latency bound: each file and directory needs at least one round
+trip to the server. To hide that latency, several files are uploaded
+concurrently, each over its own connection. The number of concurrent uploads
+is set with the --jobs option or the 'upload_jobs' configuration variable
+(4 by default, 1 uploads one file at a time):
+
+    brz upload --jobs 8 sftp://example.com/website
+
+Unless --quiet is given, the number of files uploaded and the throughput are
+reported at the end of the upload.
+
 Ignoring certain files
 -----------------------
 
@@ -161,6 +175,7 @@ def register_option(key, member):
 
 register_option('upload_auto', 'auto_option')
 register_option('upload_auto_quiet', 'auto_quiet_option')
+register_option('upload_jobs', 'jobs_option')
 register_option('upload_location', 'location_option')
 register_option('upload_revid_location', 'revid_location_option')
 
@@ -197,7 +212,8 @@ def auto_upload_hook(params):
     last_revision = source_branch.last_revision()
     last_tree = source_branch.repository.revision_tree(last_revision)
     uploader = BzrUploader(source_branch, to_transport, sys.stdout,
-                           last_tree, last_revision, quiet=quiet)
+                           last_tree, last_revision, quiet=quiet,
+                           jobs=conf.get('upload_jobs'))
     uploader.upload_tree()
 
 
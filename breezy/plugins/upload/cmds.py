@@ -16,6 +16,11 @@
 
 """bzr-upload command implementations."""
 
+import contextlib
+from concurrent import futures
+import threading
+import time
+
 from ... import (
     commands,
     config,
@@ -53,6 +58,15 @@ location_option = config.Option(
     help="""\
 The url to upload the working tree to.
 """)
+jobs_option = config.Option(
+    'upload_jobs', default=4, from_unicode=config.int_from_store,
+    invalid='warning',
+    help="""\
+Number of files and directories uploaded concurrently.
+
+Each concurrent upload uses its own connection to the upload location, which
+hides the latency of the individual operations. 1 uploads one file at a time.
+""")
 revid_location_option = config.Option(
     'upload_revid_location', default=u'.bzr-upload.revid',
     help="""\
@@ -89,42 +103,161 @@ branch.conf file:
 class BzrUploader(object):
 
     def __init__(self, branch, to_transport, outf, tree, rev_id,
-                 quiet=False):
+                 quiet=False, jobs=1):
         self.branch = branch
         self.to_transport = to_transport
         self.outf = outf
         self.tree = tree
         self.rev_id = rev_id
         self.quiet = quiet
+        self.jobs = jobs
         self._pending_deletions = []
         self._pending_renames = []
         self._uploaded_revid = None
         self._ignored = None
+        # Concurrent uploads, see _concurrently()
+        self._executor = None
+        self._in_flight = []
+        self._dir_futures = {}
+        self._local = threading.local()
+        self._worker_transports = []
+        self._idle_transports = []
+        self._lock = threading.Lock()
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+
+    def _transport(self):
+        """Return the transport to use in the current thread.
+
+        Each worker uploading concurrently has its own connection.
+        """
+        if self._executor is None:
+            return self.to_transport
+        t = getattr(self._local, 'transport', None)
+        if t is None:
+            with self._lock:
+                t = self._idle_transports.pop()
+            self._local.transport = t
+        return t
+
+    def _open_worker_transport(self):
+        """Open a connection for a worker uploading concurrently.
+
+        This is called from the main thread, the connection reuses the
+        credentials of to_transport and is established right away so that
+        users are not prompted from several workers at once.
+        """
+        to_transport = self.to_transport
+        if isinstance(to_transport, transport.ConnectedTransport):
+            # Same password but a connection of its own
+            t = to_transport.__class__(
+                to_transport.base, _from_transport=to_transport)
+            t._set_shared_connection(transport._SharedConnection(
+                credentials=to_transport._get_credentials()))
+        else:
+            t = transport.get_transport_from_url(to_transport.base)
+        t.has('.')
+        return t
 
     def _up_stat(self, relpath):
-        return self.to_transport.stat(urlutils.escape(relpath))
+        return self._transport().stat(urlutils.escape(relpath))
 
     def _up_rename(self, old_path, new_path):
-        return self.to_transport.rename(urlutils.escape(old_path),
-                                        urlutils.escape(new_path))
+        return self._transport().rename(urlutils.escape(old_path),
+                                          urlutils.escape(new_path))
 
     def _up_delete(self, relpath):
-        return self.to_transport.delete(urlutils.escape(relpath))
+        return self._transport().delete(urlutils.escape(relpath))
 
     def _up_delete_tree(self, relpath):
-        return self.to_transport.delete_tree(urlutils.escape(relpath))
+        return self._transport().delete_tree(urlutils.escape(relpath))
 
     def _up_mkdir(self, relpath, mode):
-        return self.to_transport.mkdir(urlutils.escape(relpath), mode)
+        return self._transport().mkdir(urlutils.escape(relpath), mode)
 
     def _up_rmdir(self, relpath):
-        return self.to_transport.rmdir(urlutils.escape(relpath))
+        return self._transport().rmdir(urlutils.escape(relpath))
 
     def _up_put_bytes(self, relpath, bytes, mode):
-        self.to_transport.put_bytes(urlutils.escape(relpath), bytes, mode)
+        self._transport().put_bytes(urlutils.escape(relpath), bytes, mode)
+        with self._lock:
+            self.uploaded_files += 1
+            self.uploaded_bytes += len(bytes)
 
     def _up_get_bytes(self, relpath):
-        return self.to_transport.get_bytes(urlutils.escape(relpath))
+        return self._transport().get_bytes(urlutils.escape(relpath))
+
+    @contextlib.contextmanager
+    def _concurrently(self):
+        """Run the uploads scheduled in this context concurrently.
+
+        All the scheduled uploads are finished when leaving the context, the
+        first error encountered is raised then.
+        """
+        if self.jobs <= 1:
+            yield
+            return
+        try:
+            for i in range(self.jobs):
+                self._worker_transports.append(self._open_worker_transport())
+            self._idle_transports = list(self._worker_transports)
+            self._executor = futures.ThreadPoolExecutor(self.jobs)
+            yield
+            while self._in_flight:
+                self._in_flight.pop(0).result()
+        finally:
+            for future in self._in_flight:
+                future.cancel()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            self._in_flight = []
+            self._dir_futures = {}
+            for t in self._worker_transports:
+                t.disconnect()
+            self._worker_transports = []
+            self._idle_transports = []
+            self._local = threading.local()
+
+    def _schedule(self, relpath, func, *args):
+        """Call func(*args) once the parent directory of relpath exists.
+
+        Outside of _concurrently(), func is called right away.
+        """
+        if self._executor is None:
+            func(*args)
+            return None
+        # Reading the tree is done by the caller, only the transport
+        # operations are done concurrently. Bound the uploads waiting for a
+        # worker to bound the memory they use.
+        while len(self._in_flight) >= self.jobs * 4:
+            self._in_flight.pop(0).result()
+        parent = self._dir_futures.get(osutils.dirname(relpath))
+
+        def run():
+            if parent is not None:
+                # Raises if the directory could not be created. It was
+                # scheduled before us, so it is already being created.
+                parent.result()
+            func(*args)
+        future = self._executor.submit(run)
+        self._in_flight.append(future)
+        return future
+
+    def _schedule_mkdir(self, relpath, func, *args):
+        future = self._schedule(relpath, func, *args)
+        if future is not None:
+            self._dir_futures[relpath] = future
+
+    def report_throughput(self, start):
+        """Report the files uploaded since start, unless quiet."""
+        if self.quiet or not self.uploaded_files:
+            return
+        elapsed = max(time.time() - start, 0.001)
+        self.outf.write(
+            'Uploaded %d files, %dkB in %.1fs (%dkB/s)\n' % (
+                self.uploaded_files, self.uploaded_bytes // 1024, elapsed,
+                self.uploaded_bytes / 1024 / elapsed))
 
     def set_uploaded_revid(self, rev_id):
         # XXX: Add tests for concurrent updates, etc.
@@ -168,16 +301,20 @@ class BzrUploader(object):
                     dir = os.path.dirname(dir)
         return ignored
 
-    def upload_file(self, old_relpath, new_relpath, mode=None):
+    def _file_mode(self, relpath, mode):
         if mode is None:
-            if self.tree.is_executable(new_relpath):
+            if self.tree.is_executable(relpath):
                 mode = 0o775
             else:
                 mode = 0o664
+        return mode
+
+    def upload_file(self, old_relpath, new_relpath, mode=None):
+        mode = self._file_mode(new_relpath, mode)
         if not self.quiet:
             self.outf.write('Uploading %s\n' % old_relpath)
-        self._up_put_bytes(
-            old_relpath, self.tree.get_file_text(new_relpath), mode)
+        self._schedule(old_relpath, self._up_put_bytes,
+                       old_relpath, self.tree.get_file_text(new_relpath), mode)
 
     def _force_clear(self, relpath):
         try:
@@ -202,11 +339,18 @@ class BzrUploader(object):
         When doing a full upload, it may happen that a directory exists where
         we want to put our file.
         """
-        self._force_clear(relpath)
-        self.upload_file(relpath, relpath, mode)
+        mode = self._file_mode(relpath, mode)
+        if not self.quiet:
+            self.outf.write('Uploading %s\n' % relpath)
+        content = self.tree.get_file_text(relpath)
+
+        def upload():
+            self._force_clear(relpath)
+            self._up_put_bytes(relpath, content, mode)
+        self._schedule(relpath, upload)
 
     def upload_symlink(self, relpath, target):
-        self.to_transport.symlink(target, relpath)
+        self._transport().symlink(target, relpath)
 
     def upload_symlink_robustly(self, relpath, target):
         """Handle uploading symlinks.
@@ -220,10 +364,25 @@ class BzrUploader(object):
         )
         self.upload_symlink(relpath, target)
 
+    def _upload_symlink_if_possible(self, relpath, target, robustly=False):
+        """Upload a symlink, warning if the transport does not support them.
+        """
+        def upload():
+            try:
+                if robustly:
+                    self.upload_symlink_robustly(relpath, target)
+                else:
+                    self.upload_symlink(relpath, target)
+            except errors.TransportNotPossible:
+                if not self.quiet:
+                    self.outf.write('Not uploading symlink %s -> %s\n'
+                                    % (relpath, target))
+        self._schedule(relpath, upload)
+
     def make_remote_dir(self, relpath, mode=None):
         if mode is None:
             mode = 0o775
-        self._up_mkdir(relpath, mode)
+        self._schedule_mkdir(relpath, self._up_mkdir, relpath, mode)
 
     def make_remote_dir_robustly(self, relpath, mode=None):
         """Create a remote directory, clearing the way on the remote side.
@@ -231,6 +390,12 @@ class BzrUploader(object):
         When doing a full upload, it may happen that a file exists where we
         want to create our directory.
         """
+        if mode is None:
+            mode = 0o775
+        self._schedule_mkdir(relpath, self._make_remote_dir_robustly,
+                             relpath, mode)
+
+    def _make_remote_dir_robustly(self, relpath, mode):
         try:
             st = self._up_stat(relpath)
             if not stat.S_ISDIR(st.st_mode):
@@ -243,7 +408,7 @@ class BzrUploader(object):
                 return
         except errors.PathError:
             pass
-        self.make_remote_dir(relpath, mode)
+        self._up_mkdir(relpath, mode)
 
     def delete_remote_file(self, relpath):
         if not self.quiet:
@@ -308,7 +473,8 @@ class BzrUploader(object):
     def upload_full_tree(self):
         self.to_transport.ensure_base()  # XXX: Handle errors (add
         # --create-prefix option ?)
-        with self.tree.lock_read():
+        start = time.time()
+        with self.tree.lock_read(), self._concurrently():
             for relpath, ie in self.tree.iter_entries_by_dir():
                 if relpath in ('', '.bzrignore', '.bzrignore-upload'):
                     # skip root ('')
@@ -322,19 +488,14 @@ class BzrUploader(object):
                 if ie.kind == 'file':
                     self.upload_file_robustly(relpath)
                 elif ie.kind == 'symlink':
-                    try:
-                        self.upload_symlink_robustly(
-                            relpath, ie.symlink_target)
-                    except errors.TransportNotPossible:
-                        if not self.quiet:
-                            target = self.tree.path_content_summary(relpath)[3]
-                            self.outf.write('Not uploading symlink %s -> %s\n'
-                                            % (relpath, target))
+                    self._upload_symlink_if_possible(
+                        relpath, ie.symlink_target, robustly=True)
                 elif ie.kind == 'directory':
                     self.make_remote_dir_robustly(relpath)
                 else:
                     raise NotImplementedError
-            self.set_uploaded_revid(self.rev_id)
+        self.set_uploaded_revid(self.rev_id)
+        self.report_throughput(start)
 
     def upload_tree(self):
         # If we can't find the revid file on the remote location, upload the
@@ -357,6 +518,7 @@ class BzrUploader(object):
         from_tree = self.branch.repository.revision_tree(rev_id)
         self.to_transport.ensure_base()  # XXX: Handle errors (add
         # --create-prefix option ?)
+        start = time.time()
         changes = self.tree.changes_from(from_tree)
         with self.tree.lock_read():
             for change in changes.removed:
@@ -409,41 +571,45 @@ class BzrUploader(object):
                 else:
                     raise NotImplementedError
 
-            for change in changes.added + changes.copied:
-                if self.is_ignored(change.path[1]):
-                    if not self.quiet:
-                        self.outf.write('Ignoring %s\n' % change.path[1])
-                    continue
-                if change.kind[1] == 'file':
-                    self.upload_file(change.path[1], change.path[1])
-                elif change.kind[1] == 'directory':
-                    self.make_remote_dir(change.path[1])
-                elif change.kind[1] == 'symlink':
-                    target = self.tree.get_symlink_target(change.path[1])
-                    try:
-                        self.upload_symlink(change.path[1], target)
-                    except errors.TransportNotPossible:
-                        if not self.quiet:
-                            self.outf.write('Not uploading symlink %s -> %s\n'
-                                            % (change.path[1], target))
-                else:
-                    raise NotImplementedError
+            # Renames and deletions are done, the remaining changes are
+            # independent of each other but for the creation of their parent
+            # directories.
+            with self._concurrently():
+                self._upload_added_and_modified(changes)
 
-            # XXX: Add a test for exec_change
-            for change in changes.modified:
-                if self.is_ignored(change.path[1]):
-                    if not self.quiet:
-                        self.outf.write('Ignoring %s\n' % change.path[1])
-                    continue
-                if change.kind[1] == 'file':
-                    self.upload_file(change.path[1], change.path[1])
-                elif change.kind[1] == 'symlink':
-                    target = self.tree.get_symlink_target(change.path[1])
-                    self.upload_symlink(change.path[1], target)
-                else:
-                    raise NotImplementedError
+        self.set_uploaded_revid(self.rev_id)
+        self.report_throughput(start)
 
-            self.set_uploaded_revid(self.rev_id)
+    def _upload_added_and_modified(self, changes):
+        for change in changes.added + changes.copied:
+            if self.is_ignored(change.path[1]):
+                if not self.quiet:
+                    self.outf.write('Ignoring %s\n' % change.path[1])
+                continue
+            if change.kind[1] == 'file':
+                self.upload_file(change.path[1], change.path[1])
+            elif change.kind[1] == 'directory':
+                self.make_remote_dir(change.path[1])
+            elif change.kind[1] == 'symlink':
+                target = self.tree.get_symlink_target(change.path[1])
+                self._upload_symlink_if_possible(change.path[1], target)
+            else:
+                raise NotImplementedError
+
+        # XXX: Add a test for exec_change
+        for change in changes.modified:
+            if self.is_ignored(change.path[1]):
+                if not self.quiet:
+                    self.outf.write('Ignoring %s\n' % change.path[1])
+                continue
+            if change.kind[1] == 'file':
+                self.upload_file(change.path[1], change.path[1])
+            elif change.kind[1] == 'symlink':
+                target = self.tree.get_symlink_target(change.path[1])
+                self._schedule(change.path[1], self.upload_symlink,
+                               change.path[1], target)
+            else:
+                raise NotImplementedError
 
 
 class CannotUploadToWorkingTree(errors.CommandError):
@@ -482,12 +648,17 @@ class cmd_upload(commands.Command):
                       ),
         option.Option('auto',
                       'Trigger an upload from this branch whenever the tip '
-                      'revision changes.')
+                      'revision changes.'),
+        option.Option('jobs',
+                      help='Number of files to upload concurrently.',
+                      short_name='j',
+                      type=int,
+                      ),
         ]
 
     def run(self, location=None, full=False, revision=None, remember=None,
-            directory=None, quiet=False, auto=None, overwrite=False
-            ):
+            directory=None, quiet=False, auto=None, overwrite=False,
+            jobs=None):
         if directory is None:
             directory = u'.'
 
@@ -544,8 +715,10 @@ class cmd_upload(commands.Command):
 
             tree = branch.repository.revision_tree(rev_id)
 
+            if jobs is None:
+                jobs = conf.get('upload_jobs')
             uploader = BzrUploader(branch, to_transport, self.outf, tree,
-                                   rev_id, quiet=quiet)
+                                   rev_id, quiet=quiet, jobs=jobs)
 
             if not overwrite:
                 prev_uploaded_rev_id = uploader.get_uploaded_revid()
@@ -646,6 +646,10 @@ class Repository(controldir.ControlComponent, _RelockDebugMixin):
                                   (self.get_transaction(), self._write_group))
         result = self._commit_write_group()
         self._write_group = None
+        heads_cache = graph.get_shared_heads_cache()
+        if heads_cache is not None:
+            # New revisions may fill in ghosts, changing earlier results.
+            heads_cache.invalidate(self.user_url)
         return result
 
     def _commit_write_group(self):
@@ -1102,11 +1106,18 @@ class Repository(controldir.ControlComponent, _RelockDebugMixin):
     def get_graph(self, other_repository=None):
         """Return the graph walker for this repository format"""
         parents_provider = self._make_parents_provider()
+        locations = (self.user_url,) + tuple(
+            fallback.user_url for fallback in self._fallback_repositories)
         if (other_repository is not None and
                 not self.has_same_location(other_repository)):
             parents_provider = graph.StackedParentsProvider(
                 [parents_provider, other_repository._make_parents_provider()])
-        return graph.Graph(parents_provider)
+            locations += (other_repository.user_url,)
+        result = graph.Graph(parents_provider)
+        heads_cache = graph.get_shared_heads_cache()
+        if heads_cache is not None:
+            result._heads_cache = heads_cache.get_view(locations)
+        return result
 
     def set_make_working_trees(self, new_value):
         """Set the policy flag for making working trees when creating branches.
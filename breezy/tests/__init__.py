@@ -4042,6 +4042,7 @@ def _test_suite_testmod_names():
         'breezy.tests.test_help',
         'breezy.tests.test_hooks',
         'breezy.tests.test_http',
+        'breezy.tests.test_http2',
         'breezy.tests.test_http_response',
         'breezy.tests.test_https_ca_bundle',
         'breezy.tests.test_https_urllib',
@@ -23,6 +23,7 @@ import sys
 from _thread import interrupt_main
 
 import threading
+from urllib import request as urllib_request
 
 from ... import (
     builtins,
@@ -36,7 +37,9 @@ from ... import (
     )
 from ...branch import Branch
 from ...controldir import ControlDir
-from ...bzr.smart import client, medium
+from ...bzr.smart import client, medium, request, server, stats
+from ...bzr.smart.async_server import AsyncSmartTCPServer
+from ...bzr.smart.prefork import PreforkSmartTCPServer
 from ...bzr.smart.server import (
     BzrServerFactory,
     SmartTCPServer,
@@ -44,6 +47,7 @@ from ...bzr.smart.server import (
 from .. import (
     TestCaseWithMemoryTransport,
     TestCaseWithTransport,
+    TestNotApplicable,
     )
 from ...transport import remote
 
@@ -415,6 +419,112 @@ class TestUserdirExpansion(TestCaseWithMemoryTransport):
         self.assertFalse(
             bzr_server.smart_server.backing_transport.has('~user'))
 
+    def test_max_workers_selects_async_server(self):
+        config.GlobalStack().set('serve.max_workers', '3')
+        config.GlobalStack().set('serve.max_requests_per_client', '2')
+        bzr_server = BzrServerFactory(
+            self.fake_expanduser, lambda t: '/')
+        bzr_server.set_up(self.get_transport(), '127.0.0.1', 0, inet=False,
+                          timeout=4.0)
+        self.addCleanup(bzr_server.tear_down)
+        self.addCleanup(bzr_server.smart_server._server_socket.close)
+        self.assertIsInstance(bzr_server.smart_server, AsyncSmartTCPServer)
+        self.assertEqual(3, bzr_server.smart_server.max_workers)
+        self.assertEqual(2, bzr_server.smart_server.max_requests_per_client)
+
+    def test_worker_processes_selects_prefork_server(self):
+        if getattr(os, 'fork', None) is None:
+            raise TestNotApplicable('os.fork is not available')
+        config.GlobalStack().set('serve.worker_processes', '3')
+        config.GlobalStack().set('serve.worker_max_requests', '100')
+        bzr_server = BzrServerFactory(
+            self.fake_expanduser, lambda t: '/')
+        bzr_server.set_up(self.get_transport(), '127.0.0.1', 0, inet=False,
+                          timeout=4.0)
+        self.addCleanup(bzr_server.tear_down)
+        self.addCleanup(bzr_server.smart_server._server_socket.close)
+        self.assertIsInstance(bzr_server.smart_server, PreforkSmartTCPServer)
+        self.assertEqual(3, bzr_server.smart_server.workers)
+        self.assertEqual(100, bzr_server.smart_server.max_requests)
+
+    def make_stats_server(self, inet=False, stats_port=None,
+                          config_bytes=b'', host='127.0.0.1'):
+        self.overrideAttr(request, 'server_stats', None)
+        self.overrideAttr(config, 'GlobalStack', lambda: config.MemoryStack(
+            config_bytes))
+        bzr_server = BzrServerFactory(
+            self.fake_expanduser, lambda t: '/')
+        if inet:
+            bzr_server.set_up(self.get_transport(), None, None, inet=True,
+                              timeout=4.0, stats_port=stats_port)
+        else:
+            bzr_server.set_up(self.get_transport(), host, 0,
+                              inet=False, timeout=4.0, stats_port=stats_port)
+            self.addCleanup(bzr_server.smart_server._server_socket.close)
+        self.addCleanup(bzr_server.tear_down)
+        return bzr_server
+
+    def test_stats_port_publishes_statistics(self):
+        bzr_server = self.make_stats_server(stats_port=0)
+        self.assertIsInstance(request.server_stats, stats.SmartServerStats)
+        self.assertIs(request.server_stats, bzr_server.stats_server.stats)
+        response = urllib_request.urlopen(
+            'http://127.0.0.1:%d/metrics' % (bzr_server.stats_server.port,),
+            timeout=10)
+        try:
+            self.assertContainsRe(
+                response.read(), b'\nbzr_smart_active_connections 0\n')
+        finally:
+            response.close()
+
+    def test_stats_port_configuration(self):
+        self.make_stats_server(config_bytes=b'serve.stats_port = 0\n')
+        self.assertIsInstance(request.server_stats, stats.SmartServerStats)
+
+    def test_stats_on_localhost_by_default(self):
+        # The server listens on all interfaces when no host is given, the
+        # statistics only on the local one.
+        bzr_server = self.make_stats_server(stats_port=0, host=None)
+        self.assertEqual('127.0.0.1', bzr_server.stats_server.host)
+
+    def test_stats_listen_configuration(self):
+        bzr_server = self.make_stats_server(
+            stats_port=0, host=None,
+            config_bytes=b'serve.stats_listen = 0.0.0.0\n')
+        self.assertEqual('0.0.0.0', bzr_server.stats_server.host)
+
+    def test_no_statistics_by_default(self):
+        bzr_server = self.make_stats_server()
+        self.assertIs(None, request.server_stats)
+        self.assertFalse(hasattr(bzr_server, 'stats_server'))
+
+    def test_no_statistics_with_inet(self):
+        self.make_stats_server(inet=True, stats_port=0)
+        self.assertIs(None, request.server_stats)
+
+    def test_no_statistics_with_worker_processes(self):
+        if getattr(os, 'fork', None) is None:
+            raise TestNotApplicable('os.fork is not available')
+        self.make_stats_server(
+            stats_port=0, config_bytes=b'serve.worker_processes = 2\n')
+        self.assertIs(None, request.server_stats)
+
+    def test_cmd_serve_passes_stats_port(self):
+        def capture_stats_port(transport, host, port, inet, timeout,
+                               stats_port=None):
+            self.stats_port = stats_port
+        self.overrideAttr(server, 'serve_bzr', capture_stats_port)
+        cmd = builtins.cmd_serve()
+        cmd.run(directory='/', protocol=server.serve_bzr, stats_port=9100)
+        self.assertEqual(9100, self.stats_port)
+
+    def test_stats_port_only_for_bzr_protocol(self):
+        def serve_other(transport, host, port, inet, timeout):
+            self.fail('should not be called')
+        cmd = builtins.cmd_serve()
+        self.assertRaises(errors.CommandError, cmd.run, directory='/',
+                          protocol=serve_other, stats_port=9100)
+
     def test_get_base_path(self):
         """cmd_serve will turn the --directory option into a LocalTransport
         (optionally decorated with 'readonly+').  BzrServerFactory can
@@ -397,6 +397,7 @@ apport = ModuleAvailableFeature(
     'apport.report',
     ignore_warnings=[DeprecationWarning, PendingDeprecationWarning])
 gpg = ModuleAvailableFeature('gpg')
+h2 = ModuleAvailableFeature('h2')
 lzma = ModuleAvailableFeature('lzma')
 meliae = ModuleAvailableFeature('meliae.scanner')
 paramiko = ModuleAvailableFeature('paramiko')
@@ -17,6 +17,7 @@
 import errno
 import http.client as http_client
 import http.server as http_server
+from io import BytesIO
 import os
 import posixpath
 import random
@@ -365,6 +366,132 @@ class TestingThreadingHTTPServer(test_server.TestingThreadingTCPServer,
         TestingHTTPServerMixin.__init__(self, test_case_server)
 
 
+class _HTTP2StreamSocket(object):
+    """A socket-like object used to serve a single HTTP/2 stream.
+
+    The request handler reads an HTTP/1.1 request built from the stream and
+    writes its response in a buffer.
+    """
+
+    def __init__(self, request_bytes):
+        self._request = BytesIO(request_bytes)
+        self.response = BytesIO()
+
+    def makefile(self, mode, bufsize=None):
+        if 'r' in mode:
+            return self._request
+        return self.response
+
+    def sendall(self, data):
+        self.response.write(data)
+
+    def settimeout(self, timeout):
+        pass
+
+
+class TestingHTTP2Server(TestingThreadingHTTPServer):
+    """A threading HTTP/2 test server, without TLS.
+
+    Clients must speak HTTP/2 from the start (h2c with prior knowledge). Each
+    stream is served by running the request handler on the equivalent
+    HTTP/1.1 request, so the request handlers used for HTTP/1.x tests can be
+    reused.
+    """
+
+    # Headers that can't be used in HTTP/2 responses
+    _connection_headers = ('connection', 'keep-alive', 'proxy-connection',
+                           'transfer-encoding', 'upgrade')
+
+    def finish_request(self, request, client_address):
+        import h2.config
+        import h2.connection
+        import h2.events
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(
+                client_side=False, header_encoding='utf-8'))
+        conn.initiate_connection()
+        request.sendall(conn.data_to_send())
+        streams = {}
+        # Response data waiting for the flow control window to open
+        outbound = {}
+        while True:
+            data = request.recv(65536)
+            if not data:
+                return
+            events = conn.receive_data(data)
+            # Streams cancelled by the client are not served at all
+            reset = set(event.stream_id for event in events
+                        if isinstance(event, h2.events.StreamReset))
+            for event in events:
+                if getattr(event, 'stream_id', None) in reset:
+                    streams.pop(event.stream_id, None)
+                    outbound.pop(event.stream_id, None)
+                elif isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = (event.headers, [])
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1].append(event.data)
+                    conn.acknowledge_received_data(
+                        event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, body = streams.pop(event.stream_id)
+                    outbound[event.stream_id] = self._serve_stream(
+                        conn, event.stream_id, client_address, headers,
+                        b''.join(body))
+                elif isinstance(event, h2.events.ConnectionTerminated):
+                    request.sendall(conn.data_to_send())
+                    return
+            for stream_id, pending in list(outbound.items()):
+                while pending:
+                    size = min(conn.local_flow_control_window(stream_id),
+                               conn.max_outbound_frame_size, len(pending))
+                    if size <= 0:
+                        break
+                    conn.send_data(stream_id, pending[:size])
+                    pending = pending[size:]
+                if pending:
+                    outbound[stream_id] = pending
+                else:
+                    conn.end_stream(stream_id)
+                    del outbound[stream_id]
+            request.sendall(conn.data_to_send())
+
+    def _serve_stream(self, conn, stream_id, client_address, headers, body):
+        """Serve a request received on a stream.
+
+        :return: The response body, to be sent as the flow control allows.
+        """
+        pseudo = {}
+        lines = []
+        for name, value in headers:
+            if name.startswith(':'):
+                pseudo[name] = value
+            else:
+                lines.append('%s: %s\r\n' % (name, value))
+        lines.insert(0, '%s %s HTTP/1.1\r\n' % (pseudo[':method'],
+                                                  pseudo[':path']))
+        lines.append('Host: %s\r\n' % pseudo[':authority'])
+        if body and 'content-length' not in (
+                name for name, value in headers):
+            lines.append('Content-Length: %d\r\n' % len(body))
+        lines.append('\r\n')
+        sock = _HTTP2StreamSocket(''.join(lines).encode('latin-1') + body)
+        self.RequestHandlerClass(sock, client_address, self)
+        response = sock.response.getvalue()
+        head, body = response.split(b'\r\n\r\n', 1)
+        head_lines = head.decode('latin-1').split('\r\n')
+        status = head_lines[0].split(' ', 2)[1]
+        response_headers = [(':status', status)]
+        for line in head_lines[1:]:
+            name, value = line.split(':', 1)
+            name = name.strip().lower()
+            if name not in self._connection_headers:
+                response_headers.append((name, value.strip()))
+        if pseudo[':method'] == 'HEAD':
+            body = b''
+        conn.send_headers(stream_id, response_headers)
+        return body
+
+
 class HttpServer(test_server.TestingTCPServerInAThread):
     """A test server for http transports.
 
@@ -469,3 +596,17 @@ class HttpServer(test_server.TestingTCPServerInAThread):
         # this is chosen to try to prevent trouble with proxies, weird dns,
         # etc
         return self._url_protocol + '://127.0.0.1:1/'
+
+
+class Http2Server(HttpServer):
+    """A cleartext HTTP/2 test server for http+h2 transports.
+
+    The protocol version is only used by the request handlers, which still
+    produce HTTP/1.x responses that the server translates.
+    """
+
+    http_server_class = {'HTTP/1.0': TestingHTTP2Server,
+                         'HTTP/1.1': TestingHTTP2Server,
+                         }
+
+    _url_protocol = 'http+h2'
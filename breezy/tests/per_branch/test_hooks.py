@@ -111,13 +111,20 @@ class TestOpen(tests.TestCaseWithMemoryTransport):
         self.install_hook()
         b = _mod_branch.Branch.open(branch_url)
         if isinstance(b, remote.RemoteBranch):
-            self.assertEqual(3, len(self.hook_calls))
-            # open_branchV2 RPC
-            self.assertRealBranch(self.hook_calls[0])
-            # create RemoteBranch locally
-            self.assertEqual(b, self.hook_calls[1])
-            # get_stacked_on_url RPC
-            self.assertRealBranch(self.hook_calls[2])
+            if b._client._medium._is_remote_before((3, 3)):
+                self.assertEqual(3, len(self.hook_calls))
+                # open_branchV2 RPC
+                self.assertRealBranch(self.hook_calls[0])
+                # create RemoteBranch locally
+                self.assertEqual(b, self.hook_calls[1])
+                # get_stacked_on_url RPC
+                self.assertRealBranch(self.hook_calls[2])
+            else:
+                self.assertEqual(2, len(self.hook_calls))
+                # open_branchV4 RPC
+                self.assertRealBranch(self.hook_calls[0])
+                # create RemoteBranch locally
+                self.assertEqual(b, self.hook_calls[1])
         else:
             self.assertEqual([b], self.hook_calls)
 
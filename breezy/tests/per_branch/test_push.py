@@ -431,9 +431,7 @@ class EmptyPushSmartEffortTests(per_branch.TestCaseWithBranch):
         self.empty_branch.push(target)
         self.assertEqual(
             [b'BzrDir.open_2.1',
-             b'BzrDir.open_branchV3',
-             b'BzrDir.find_repositoryV3',
-             b'Branch.get_stacked_on_url',
+             b'BzrDir.open_branchV4',
              b'Branch.lock_write',
              b'Branch.last_revision_info',
              b'Branch.unlock'],
@@ -352,15 +352,17 @@ class TestPush(TestCaseWithInterBranch):
         hpss_call_names = [item.call.method for item in self.hpss_calls]
         self.assertIn(b'Repository.insert_stream_1.19', hpss_call_names)
         insert_stream_idx = hpss_call_names.index(
-            b'Repository.insert_stream_1.19')
+            b'Repository.get_insert_checkpoint')
         calls_after_insert_stream = hpss_call_names[insert_stream_idx:]
         # After inserting the stream the client has no reason to query the
         # remote graph any further.
         bzr_core_trace = Equals(
-            [b'Repository.insert_stream_1.19', b'Repository.insert_stream_1.19',
+            [b'Repository.get_insert_checkpoint',
+             b'Repository.insert_stream_1.19',
              b'Branch.set_last_revision_info', b'Branch.unlock'])
         bzr_loom_trace = Equals(
-            [b'Repository.insert_stream_1.19', b'Repository.insert_stream_1.19',
+            [b'Repository.get_insert_checkpoint',
+             b'Repository.insert_stream_1.19',
              b'Branch.set_last_revision_info', b'get', b'Branch.unlock'])
         self.assertThat(calls_after_insert_stream,
                         MatchesAny(bzr_core_trace, bzr_loom_trace))
@@ -370,6 +372,8 @@ class TestPush(TestCaseWithInterBranch):
         # for or receiving more data than the caller asked for.
         self.overrideAttr(vf_repository.InterVersionedFileRepository,
                           '_walk_to_common_revisions_batch_size', 1)
+        self.overrideAttr(vf_repository.InterVersionedFileRepository,
+                          '_walk_to_common_revisions_max_batch_size', 1)
         self.overrideAttr(SmartServerRepositoryGetParentMap,
                           'no_extra_results', True)
 
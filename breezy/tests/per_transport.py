@@ -1680,6 +1680,27 @@ class TransportTests(TestTransportImplementation):
         self.assertListRaises((errors.ShortReadvError, errors.InvalidRange),
                               transport.readv, 'a', [(12, 2)])
 
+    def test_get_async(self):
+        transport = self.get_transport()
+        if transport.is_readonly():
+            with open('a', 'w') as f:
+                f.write('0123456789')
+        else:
+            transport.put_bytes('a', b'0123456789')
+        with transport.get_async() as async_transport:
+            readv = async_transport.readv('a', [(0, 1), (3, 2), (9, 1)])
+            get_bytes = async_transport.get_bytes('a')
+            stat = async_transport.stat('a')
+            missing = async_transport.get_bytes('missing')
+            self.assertEqual([(0, b'0'), (3, b'34'), (9, b'9')],
+                             list(readv.result()))
+            self.assertEqual(b'0123456789', get_bytes.result())
+            try:
+                self.assertEqual(10, stat.result().st_size)
+            except errors.TransportNotPossible:
+                pass
+            self.assertRaises(NoSuchFile, missing.result)
+
     def test_no_segment_parameters(self):
         """Segment parameters should be stripped and stored in
         transport.segment_parameters."""
@@ -1772,3 +1793,37 @@ class TransportTests(TestTransportImplementation):
             self.assertEqual([t1, t3], log)
         else:
             self.assertEqual([], log)
+
+    def get_pooling_transport(self):
+        t = self.get_transport()
+        if (not isinstance(t, ConnectedTransport)
+                or not t._pool_connections):
+            raise TestNotApplicable("transport does not pool connections")
+        self.overrideAttr(_mod_transport, '_connection_pool',
+                          _mod_transport.ConnectionPool())
+
+    def test_hook_post_connection_pooled(self):
+        """A disconnected transport lends its connection to another one"""
+        self.get_pooling_transport()
+        log = []
+        Transport.hooks.install_named_hook("post_connect", log.append, None)
+        t1 = self.get_transport()
+        t1.has("x")
+        t1.disconnect()
+        t2 = self.get_transport()
+        t2.has("x")
+        self.assertEqual([t1], log)
+
+    def test_pooled_connections_interleaved(self):
+        """Transports in use don't share their pooled connection"""
+        self.get_pooling_transport()
+        log = []
+        Transport.hooks.install_named_hook("post_connect", log.append, None)
+        t1 = self.get_transport()
+        t2 = self.get_transport()
+        t1.has("x")
+        t2.has("x")
+        self.assertFalse(t1.has("y"))
+        self.assertFalse(t2.has("y"))
+        self.assertEqual([t1, t2], log)
+        self.assertIsNot(t1._get_connection(), t2._get_connection())
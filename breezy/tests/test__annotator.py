@@ -192,6 +192,14 @@ class TestAnnotator(tests.TestCaseWithMemoryTransport):
                           (self.fc_key, b'content\n'),
                           ], self.ann.annotate_flat(self.fd_key))
 
+    def test_annotate_flat_with_ancestry_index(self):
+        self.make_merge_and_restored_text()
+        self.ann.enable_ancestry_index()
+        self.assertEqual([(self.fa_key, b'simple\n'),
+                          (self.fc_key, b'content\n'),
+                          ], self.ann.annotate_flat(self.fd_key))
+        self.assertIsNot(None, self.ann._heads_provider._ancestry_index)
+
     def test_annotate_common_merge_text(self):
         self.make_common_merge_text()
         # there is no common point, so we just pick the lexicographical lowest
@@ -232,6 +240,80 @@ class TestAnnotator(tests.TestCaseWithMemoryTransport):
         # Calls happen in set iteration order but should keys should be seen
         self.assertEqual({self.fb_key, self.fc_key, self.fe_key}, seen)
 
+    def test_annotate_flat_many(self):
+        self.make_merge_text()
+        self.vf.add_lines((b'g-id', b'a-id'), [], [b'other\n'])
+        keys = [self.fd_key, (b'g-id', b'a-id'), self.fb_key]
+        self.assertEqual(
+            [(key, self.module.Annotator(self.vf).annotate_flat(key))
+             for key in keys],
+            list(self.ann.annotate_flat_many(keys)))
+
+    def test_annotate_flat_many_missing(self):
+        self.make_simple_text()
+        self.assertRaises(errors.RevisionNotPresent, list,
+                          self.ann.annotate_flat_many(
+                              [self.fa_key, (b'not', b'present')]))
+
+    def make_annotation_cache(self):
+        from ..bzr import annotation_cache
+        return annotation_cache.AnnotationCache(
+            self.get_transport().clone('annotation-cache'))
+
+    def test_annotate_flat_stores_in_cache(self):
+        self.make_merge_text()
+        cache = self.make_annotation_cache()
+        self.ann.set_annotation_cache(cache)
+        flat = self.ann.annotate_flat(self.fd_key)
+        # The annotations are cached before ties are resolved
+        annotations, lines = self.ann.annotate(self.fd_key)
+        self.assertEqual((lines, annotations), cache.get(self.fd_key))
+        self.assertEqual([line for ann_key, line in flat], lines)
+        self.assertIs(None, cache.get(self.fb_key))
+
+    def test_annotate_flat_from_cache(self):
+        self.make_merge_and_restored_text()
+        self.vf.add_lines(self.fe_key, [self.fd_key],
+                          [b'simple\n', b'content\n', b'more\n'])
+        expected = self.module.Annotator(self.vf).annotate_flat(self.fe_key)
+        cache = self.make_annotation_cache()
+        ann = self.module.Annotator(self.vf)
+        ann.set_annotation_cache(cache)
+        ann.annotate_flat(self.fd_key)
+        ann = self.module.Annotator(self.vf)
+        ann.set_annotation_cache(cache)
+        keys, ann_keys = ann._get_needed_keys(self.fe_key)
+        # The walk stops at the cached text, without fetching it
+        self.assertEqual([self.fe_key], sorted(keys))
+        self.assertEqual({self.fd_key: (), self.fe_key: (self.fd_key,)},
+                         ann._parent_map)
+        self.assertEqual(expected, ann.annotate_flat(self.fe_key))
+
+    def test_annotate_from_cached_tie(self):
+        # Both sides of the merge introduced 'new content', annotating a
+        # child of the merge from the cache keeps both candidates.
+        self.make_common_merge_text()
+        self.vf.add_lines(self.fe_key, [self.fd_key],
+                          [b'simple\n', b'new content\n', b'more\n'])
+        expected = self.module.Annotator(self.vf).annotate(self.fe_key)
+        self.assertEqual((self.fb_key, self.fc_key), expected[0][1])
+        cache = self.make_annotation_cache()
+        ann = self.module.Annotator(self.vf)
+        ann.set_annotation_cache(cache)
+        ann.annotate_flat(self.fd_key)
+        ann = self.module.Annotator(self.vf)
+        ann.set_annotation_cache(cache)
+        self.assertEqual(expected, ann.annotate(self.fe_key))
+
+    def test_needed_keys_many_shared(self):
+        self.make_merge_text()
+        keys, ann_keys = self.ann._get_needed_keys_many(
+            [self.fb_key, self.fc_key])
+        self.assertEqual([self.fa_key, self.fb_key, self.fc_key],
+                         sorted(keys))
+        self.assertEqual({self.fa_key: 2, self.fb_key: 1, self.fc_key: 1},
+                         self.ann._num_needed_children)
+
     def test_needed_keys_simple(self):
         self.make_simple_text()
         keys, ann_keys = self.ann._get_needed_keys(self.fb_key)
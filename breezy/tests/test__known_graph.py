@@ -52,6 +52,18 @@ def non_caching_scenarios():
     return scenarios
 
 
+def indexed_scenarios():
+    scenarios = [
+        ('python-indexed', {'module': _known_graph_py, 'do_cache': False,
+                            'indexed': True}),
+    ]
+    if compiled_known_graph_feature.available():
+        scenarios.append(
+            ('C-indexed', {'module': compiled_known_graph_feature.module,
+                           'do_cache': False, 'indexed': True}))
+    return scenarios
+
+
 load_tests = load_tests_apply_scenarios
 
 
@@ -73,9 +85,13 @@ class TestCaseWithKnownGraph(tests.TestCase):
 
     scenarios = caching_scenarios()
     module = None  # Set by load_tests
+    indexed = False
 
     def make_known_graph(self, ancestry):
-        return self.module.KnownGraph(ancestry, do_cache=self.do_cache)
+        graph = self.module.KnownGraph(ancestry, do_cache=self.do_cache)
+        if self.indexed:
+            self.assertTrue(graph.build_ancestry_index())
+        return graph
 
 
 class TestKnownGraph(TestCaseWithKnownGraph):
@@ -211,7 +227,8 @@ class TestKnownGraph(TestCaseWithKnownGraph):
 
 class TestKnownGraphHeads(TestCaseWithKnownGraph):
 
-    scenarios = caching_scenarios() + non_caching_scenarios()
+    scenarios = (caching_scenarios() + non_caching_scenarios()
+                 + indexed_scenarios())
     do_cache = None  # Set by load_tests
 
     def test_heads_null(self):
@@ -324,6 +341,38 @@ class TestKnownGraphHeads(TestCaseWithKnownGraph):
         self.assertEqual({b'g'}, graph.heads([b'e', b'g']))
 
 
+class TestKnownGraphAncestryIndex(TestCaseWithKnownGraph):
+
+    def assertHeadsMatchWalk(self, ancestry):
+        walked = self.make_known_graph(ancestry)
+        indexed = self.make_known_graph(ancestry)
+        self.assertTrue(indexed.build_ancestry_index())
+        keys = sorted(walked._nodes)
+        for key1 in keys:
+            for key2 in keys:
+                self.assertEqual(walked.heads([key1, key2]),
+                                 indexed.heads([key1, key2]))
+
+    def test_matches_walk(self):
+        for ancestry in (test_graph.ancestry_1, test_graph.criss_cross,
+                         test_graph.extended_history_shortcut,
+                         test_graph.racing_shortcuts, test_graph.with_ghost,
+                         alt_merge):
+            self.assertHeadsMatchWalk(ancestry)
+
+    def test_max_intervals(self):
+        graph = self.make_known_graph(test_graph.ancestry_1)
+        self.assertFalse(graph.build_ancestry_index(max_intervals=1))
+        self.assertEqual({b'rev3'}, graph.heads([b'rev2a', b'rev3']))
+        self.assertTrue(graph.build_ancestry_index(max_intervals=100))
+
+    def test_add_node_drops_index(self):
+        graph = self.make_known_graph(test_graph.ancestry_1)
+        graph.build_ancestry_index()
+        graph.add_node(b'rev5', [b'rev4'])
+        self.assertEqual({b'rev5'}, graph.heads([b'rev2b', b'rev5']))
+
+
 class TestKnownGraphTopoSort(TestCaseWithKnownGraph):
 
     def assertTopoSortOrder(self, ancestry):
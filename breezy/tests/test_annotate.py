@@ -308,6 +308,26 @@ class TestAnnotate(tests.TestCaseWithTransport):
         self.assertRepoAnnotate(duplicate_D, repo, 'file', b'rev-D')
         self.assertRepoAnnotate(duplicate_E, repo, 'file', b'rev-E')
 
+    def assertAnnotateFlatMany(self, jobs):
+        builder = self.create_duplicate_lines_tree()
+        repo = builder.get_branch().repository
+        with repo.lock_read():
+            keys = []
+            expected = []
+            for revid in [b'rev-C', b'rev-base', b'rev-E']:
+                tree = repo.revision_tree(revid)
+                key = (tree.path2id('file'), tree.get_file_revision('file'))
+                keys.append(key)
+                expected.append((key, tree.annotate_iter('file')))
+        self.assertEqual(expected,
+                         list(annotate.annotate_flat_many(repo, keys, jobs)))
+
+    def test_annotate_flat_many(self):
+        self.assertAnnotateFlatMany(1)
+
+    def test_annotate_flat_many_processes(self):
+        self.assertAnnotateFlatMany(2)
+
     def test_annotate_shows_dotted_revnos(self):
         builder = self.create_merged_trees()
 
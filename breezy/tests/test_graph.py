@@ -1328,6 +1328,43 @@ class TestFindUniqueAncestors(TestGraphBase):
                                        [b'h', b'i', b'j', b'y'], b'j', [b'z'])
 
 
+class TestFindAllUniqueAncestors(TestGraphBase):
+
+    def assertFindAllUniqueAncestors(self, graph, expected, nodes, common):
+        actual = graph.find_all_unique_ancestors(nodes, common)
+        self.assertEqual(expected, sorted(actual))
+
+    def test_single_node(self):
+        graph = self.make_graph(ancestry_1)
+        self.assertFindAllUniqueAncestors(
+            graph, [b'rev3'], [b'rev3'], [b'rev2a'])
+
+    def test_several_nodes(self):
+        graph = self.make_graph(ancestry_1)
+        self.assertFindAllUniqueAncestors(
+            graph, [b'rev2a', b'rev2b', b'rev3'], [b'rev3', b'rev2b'],
+            [b'rev1'])
+
+    def test_node_in_common_ancestry(self):
+        graph = self.make_graph(ancestry_1)
+        self.assertFindAllUniqueAncestors(
+            graph, [b'rev2b'], [b'rev2a', b'rev2b'], [b'rev3'])
+        self.assertFindAllUniqueAncestors(
+            graph, [], [b'rev2a', b'rev3'], [b'rev3'])
+
+    def test_no_common(self):
+        graph = self.make_graph(ancestry_2)
+        self.assertFindAllUniqueAncestors(
+            graph, [NULL_REVISION, b'rev1a', b'rev1b', b'rev2a'],
+            [b'rev2a', b'rev1b'], [])
+
+    def test_complex_shortcut(self):
+        graph = self.make_graph(complex_shortcut)
+        self.assertFindAllUniqueAncestors(
+            graph, [b'e', b'h', b'i', b'j', b'k', b'l', b'm', b'n'],
+            [b'm', b'n'], [b'g'])
+
+
 class TestGraphFindDistanceToNull(TestGraphBase):
     """Test an api that should be able to compute a revno"""
 
@@ -1532,6 +1569,19 @@ class TestCachingParentsProvider(tests.TestCase):
         self.assertEqual([], self.inst_pp.calls)
         self.assertEqual({b'b'}, self.caching_pp.missing_keys)
 
+    def test_note_parent_map(self):
+        """Noted parents are returned from the cache."""
+        self.caching_pp.note_parent_map({b'c': (b'a',)})
+        self.assertEqual({b'c': (b'a',)},
+                         self.caching_pp.get_parent_map([b'c']))
+        self.assertEqual([], self.inst_pp.calls)
+
+    def test_note_parent_map_uncached(self):
+        self.caching_pp.disable_cache()
+        self.caching_pp.note_parent_map({b'c': (b'a',)})
+        self.assertEqual({}, self.caching_pp.get_parent_map([b'c']))
+        self.assertEqual([b'c'], self.inst_pp.calls)
+
     def test_get_cached_parent_map(self):
         self.assertEqual({}, self.caching_pp.get_cached_parent_map([b'a']))
         self.assertEqual([], self.inst_pp.calls)
@@ -1614,6 +1664,80 @@ class TestCachingParentsProviderExtras(tests.TestCaseWithTransport):
         self.assertEqual([b'rev3'], self.inst_pp.calls)
 
 
+class TestSharedHeadsCache(TestGraphBase):
+
+    def make_cached_graph(self, cache, ancestors, locations=('loc',)):
+        graph = self.make_graph(ancestors)
+        graph._heads_cache = cache.get_view(locations)
+        return graph
+
+    def test_shared_between_graphs(self):
+        cache = _mod_graph.SharedHeadsCache()
+        graph = self.make_cached_graph(cache, ancestry_1)
+        self.assertEqual({b'rev3'}, graph.heads([b'rev2a', b'rev3']))
+        graph = self.make_breaking_graph(ancestry_1, [b'rev1', b'rev2a'])
+        graph._heads_cache = cache.get_view(('loc',))
+        self.assertEqual({b'rev3'}, graph.heads([b'rev2a', b'rev3']))
+
+    def test_result_is_mutable_copy(self):
+        cache = _mod_graph.SharedHeadsCache()
+        graph = self.make_cached_graph(cache, ancestry_1)
+        graph.heads([b'rev2a', b'rev2b']).clear()
+        self.assertEqual({b'rev2a', b'rev2b'},
+                         graph.heads([b'rev2a', b'rev2b']))
+
+    def test_keyed_by_location(self):
+        cache = _mod_graph.SharedHeadsCache()
+        graph = self.make_cached_graph(cache, ancestry_1)
+        self.assertEqual({b'rev3'}, graph.heads([b'rev2a', b'rev3']))
+        graph = self.make_cached_graph(cache, ancestry_2, ('other',))
+        self.assertEqual({b'rev2a', b'rev3'},
+                         graph.heads([b'rev2a', b'rev3']))
+
+    def test_invalidate(self):
+        cache = _mod_graph.SharedHeadsCache()
+        graph = self.make_cached_graph(cache, with_ghost)
+        self.assertEqual({b'e', b'g'}, graph.heads([b'e', b'g']))
+        filled = dict(with_ghost)
+        filled[b'g'] = [b'e']
+        graph = self.make_cached_graph(cache, filled)
+        self.assertEqual({b'e', b'g'}, graph.heads([b'e', b'g']))
+        cache.invalidate('loc')
+        self.assertEqual({b'g'}, graph.heads([b'e', b'g']))
+
+    def test_lru_size(self):
+        cache = _mod_graph.SharedHeadsCache(max_size=2)
+        graph = self.make_cached_graph(cache, ancestry_1)
+        graph.heads([b'rev2a', b'rev3'])
+        graph.heads([b'rev2b', b'rev3'])
+        graph.heads([b'rev2a', b'rev2b'])
+        self.assertTrue(len(cache._cache) < 3)
+
+
+class TestSharedHeadsCacheRepository(tests.TestCaseWithTransport):
+
+    def setUp(self):
+        super(TestSharedHeadsCacheRepository, self).setUp()
+        self.cache = _mod_graph.enable_shared_heads_cache()
+        self.addCleanup(_mod_graph.disable_shared_heads_cache)
+
+    def test_get_graph_uses_cache(self):
+        tree = self.make_branch_and_tree('.')
+        rev1 = tree.commit('one')
+        rev2 = tree.commit('two')
+        repo = tree.branch.repository
+        with repo.lock_read():
+            self.assertEqual({rev2}, repo.get_graph().heads([rev1, rev2]))
+        self.assertEqual(1, len(self.cache._cache))
+
+    def test_commit_write_group_invalidates(self):
+        tree = self.make_branch_and_tree('.')
+        repo = tree.branch.repository
+        self.assertEqual({}, self.cache._generations)
+        tree.commit('one')
+        self.assertEqual({repo.user_url: 1}, self.cache._generations)
+
+
 class TestCollapseLinearRegions(tests.TestCase):
 
     def assertCollapsed(self, collapsed, original):
@@ -25,6 +25,7 @@ transport implementation, http protocol versions and authentication schemes.
 
 from http.client import UnknownProtocol, parse_headers
 from http.server import SimpleHTTPRequestHandler
+import gc
 import io
 import socket
 import sys
@@ -32,6 +33,7 @@ import threading
 
 import breezy
 from .. import (
+    branch as _mod_branch,
     config,
     controldir,
     debug,
@@ -469,6 +471,52 @@ class TestHTTPConnections(http_utils.TestCaseWithWebserver):
             socket.setdefaulttimeout(default_timeout)
 
 
+class TestConnectionPool(http_utils.TestCaseWithWebserver):
+    """Test the reuse of http connections by unrelated transports."""
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        # Transports left by earlier tests would be pooled on collection
+        gc.collect()
+        self.pool = transport.ConnectionPool()
+        self.overrideAttr(transport, '_connection_pool', self.pool)
+        self.addCleanup(self.pool.clear)
+        # Pool the connections of the transports the test released
+        self.addCleanup(gc.collect)
+        # The test framework keeps connected transports alive to disconnect
+        # them at cleanup.
+        self.overrideAttr(transport.Transport, 'hooks',
+                          transport.TransportHooks())
+
+    def test_branch_open_reuses_connection(self):
+        self.make_branch('one')
+        self.make_branch('two')
+        branch = _mod_branch.Branch.open(self.get_readonly_url('one'))
+        self.assertIsNot(None, branch.control_transport._get_connection())
+        # Branch.open never disconnects, the connection goes back to the
+        # pool once the branch is released.
+        del branch
+        gc.collect()
+        self.assertEqual(1, len(self.pool))
+        connection = self.pool._idle[0][2]
+        branch = _mod_branch.Branch.open(self.get_readonly_url('two'))
+        self.assertIs(connection, branch.control_transport._get_connection())
+        self.assertEqual(0, len(self.pool))
+
+    def test_not_pooled_while_shared(self):
+        t = self.get_readonly_transport()
+        clone = t.clone('subdir')
+        self.assertFalse(t.has('foo'))
+        t.disconnect()
+        # The clone may still be using the connection
+        self.assertEqual(0, len(self.pool))
+        # Nor once it is released, it was closed
+        del t
+        del clone
+        gc.collect()
+        self.assertEqual(0, len(self.pool))
+
+
 class TestHttpTransportRegistration(tests.TestCase):
     """Test registrations of various http implementations"""
 
@@ -801,6 +849,18 @@ class TestRangeRequestServer(TestSpecificRequestHandler):
         # The server should have issued 3 requests
         self.assertEqual(3, server.GET_request_nb)
 
+    def test_readv_first_range_over_max_size(self):
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        t._get_max_size = 2
+        t._max_readv_combine = 1
+        t._bytes_to_read_before_seek = 0
+        # The first range alone is bigger than the limit, no request should
+        # be issued without ranges: that would get the whole file.
+        self.assertEqual([(0, b'0123'), (6, b'6')],
+                         list(t.readv('a', ((0, 4), (6, 1)))))
+        self.assertEqual(2, server.GET_request_nb)
+
     def test_complete_readv_leave_pipe_clean(self):
         server = self.get_readonly_server()
         t = self.get_readonly_transport()
@@ -882,6 +942,141 @@ class TestNoRangeRequestServer(TestRangeRequestServer):
     _req_handler_class = NoRangeRequestHandler
 
 
+class TestAdaptiveReadv(TestSpecificRequestHandler):
+    """Test readv tuning its coalescing to the measured link speed"""
+
+    def setUp(self):
+        super(TestAdaptiveReadv, self).setUp()
+        self.content = b''.join(b'%06d' % i for i in range(50000))
+        self.build_tree_contents([('a', self.content)])
+
+    def test_disabled_by_default(self):
+        t = self.get_readonly_transport()
+        self.assertIs(None, t._readv_tuner)
+        self.assertEqual({'fudge_factor': t._bytes_to_read_before_seek,
+                          'max_size': 0},
+                         t.get_readv_parameters())
+
+    def test_measures_and_coalesces(self):
+        config.GlobalStack().set('http.readv.adaptive', True)
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        self.assertIs(t._readv_tuner, t.clone('foo')._readv_tuner)
+        self.assertEqual(t._bytes_to_read_before_seek,
+                         t.get_readv_parameters()['fudge_factor'])
+        list(t.readv('a', [(0, len(self.content))]))
+        parameters = t.get_readv_parameters()
+        self.assertIsNot(None, parameters['round_trip_time'])
+        self.assertIsNot(None, parameters['throughput'])
+        # Pretend to be far away
+        t._readv_tuner.round_trip_time = 0.2
+        self.assertEqual(1024 * 1024, t.get_readv_parameters()['fudge_factor'])
+        t._max_get_ranges = 1
+        offsets = [(i, 2) for i in range(0, len(self.content), 10000)]
+        gets = server.GET_request_nb
+        self.assertEqual([(o, self.content[o:o + 2]) for o, s in offsets],
+                         list(t.readv('a', offsets)))
+        # All the ranges are read by a single GET
+        self.assertEqual(gets + 1, server.GET_request_nb)
+
+
+class TestTransportStats(TestSpecificRequestHandler):
+    """Test the transport statistics of http"""
+
+    def test_stats(self):
+        from ..transport import stats
+        self.build_tree_contents([('a', b'0123456789')])
+        collector = stats.TransportStats()
+        self.overrideAttr(stats, '_stats', collector)
+        self.overrideAttr(debug, 'debug_flags', {'transport_stats'})
+        t = self.get_readonly_transport()
+        self.assertEqual(b'0123456789', t.get_bytes('a'))
+        self.assertEqual([(3, b'34')], list(t.readv('a', [(3, 2)])))
+        key = stats._key(t.base)
+        self.assertEqual(self._url_protocol, key[0])
+        host = collector.hosts[key]
+        self.assertEqual(1, host.operation('get_bytes').count)
+        self.assertEqual(1, host.operation('readv').count)
+        self.assertEqual(12, sum(op.bytes for op in host.operations.values()))
+        # The http headers are counted too
+        self.assertTrue(host.wire_bytes_read > 12)
+        self.assertTrue(host.wire_bytes_written > 0)
+
+
+class TestParallelRangeRequestServer(TestRangeRequestServer):
+    """Test readv issuing its GET requests over several connections"""
+
+    def get_readonly_transport(self, relpath=None):
+        t = super(TestParallelRangeRequestServer,
+                  self).get_readonly_transport(relpath)
+        t._readv_pool.max_connections = 3
+        return t
+
+    def test_incomplete_readv_leave_pipe_clean(self):
+        server = self.get_readonly_server()
+        t = self.get_readonly_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        ireadv = iter(t.readv('a', ((0, 1), (1, 1), (3, 2), (9, 1))))
+        self.assertEqual((0, b'0'), next(ireadv))
+        # Stop the pending requests, up to max_connections may have been
+        # issued ahead
+        ireadv.close()
+        issued = server.GET_request_nb
+        self.assertTrue(1 <= issued <= 3)
+        self.assertEqual(b'0123456789', t.get_bytes('a'))
+        self.assertEqual(issued + 1, server.GET_request_nb)
+
+    def test_readv_many_requests_in_order(self):
+        server = self.get_readonly_server()
+        content = b''.join(b'%04d' % i for i in range(100))
+        self.build_tree_contents([('b', content)])
+        t = self.get_readonly_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        offsets = [(i * 4, 4) for i in range(0, 100, 2)]
+        offsets.reverse()
+        self.assertEqual([(o, content[o:o + s]) for o, s in offsets],
+                         list(t.readv('b', offsets)))
+        self.assertEqual(50, server.GET_request_nb)
+
+    def test_connections_reused(self):
+        t = self.get_readonly_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        list(t.readv('a', ((0, 1), (3, 2), (9, 1))))
+        workers = list(t._readv_pool._idle)
+        self.assertTrue(0 < len(workers) <= 3)
+        list(t.readv('a', ((0, 1), (3, 2), (9, 1))))
+        self.assertTrue(len(t._readv_pool._idle) <= 3)
+        # Idle connections are used first
+        self.assertTrue(
+            {w._get_connection() for w in workers}.intersection(
+                w._get_connection() for w in t._readv_pool._idle))
+
+
+    def test_get_async(self):
+        t = self.get_readonly_transport()
+        with t.get_async() as async_t:
+            self.assertTrue(async_t.concurrent)
+            requests = [async_t.readv('a', [(0, 1), (3, 2)]),
+                        async_t.get_bytes('a'),
+                        async_t.readv('a', [(9, 1)])]
+            self.assertEqual([(0, b'0'), (3, b'34')], requests[0].result())
+            self.assertEqual(b'0123456789', requests[1].result())
+            self.assertEqual([(9, b'9')], requests[2].result())
+        # The requests used pooled connections
+        self.assertTrue(0 < len(t._readv_pool._idle) <= 3)
+        self.assertIsNone(t._get_connection())
+
+
+class TestParallelSingleOnlyRangeRequestServer(
+        TestParallelRangeRequestServer):
+    """Test parallel readv against a server only accepting single ranges"""
+
+    _req_handler_class = SingleOnlyRangeRequestHandler
+
+
 class MultipleRangeWithoutContentLengthRequestHandler(
         http_server.TestingHTTPRequestHandler):
     """Reply to multiple range requests without content length header."""
@@ -0,0 +1,162 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Tests for the HTTP/2 implementation of the http transport."""
+
+from .. import (
+    controldir,
+    transport,
+    )
+from ..bzr import (
+    remote as _mod_remote,
+    )
+from . import (
+    features,
+    http_server,
+    http_utils,
+    test_http,
+    )
+
+
+class TestHttp2Transport(http_utils.TestCaseWithWebserver):
+
+    _test_needs_features = [features.h2]
+
+    def setUp(self):
+        super(TestHttp2Transport, self).setUp()
+        self.build_tree_contents([('a', b'0123456789')],)
+
+    def create_transport_readonly_server(self):
+        return http_server.Http2Server()
+
+    def get_http2_transport(self):
+        from ..transport.http.http2 import Http2Transport
+        t = self.get_readonly_transport()
+        self.assertIsInstance(t, Http2Transport)
+        return t
+
+    def test_get(self):
+        t = self.get_http2_transport()
+        self.assertEqual(b'0123456789', t.get_bytes('a'))
+        self.assertTrue(t.has('a'))
+        self.assertFalse(t.has('missing'))
+
+    def test_readv_multiplexed(self):
+        server = self.get_readonly_server()
+        t = self.get_http2_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        self.assertEqual(
+            [(9, b'9'), (0, b'0'), (3, b'34'), (1, b'1')],
+            list(t.readv('a', ((9, 1), (0, 1), (3, 2), (1, 1)))))
+        self.assertEqual(4, server.GET_request_nb)
+        connection = t._get_connection()
+        self.assertEqual({}, connection._streams)
+        # Everything went over a single connection
+        self.assertEqual(b'0123456789', t.clone('.').get_bytes('a'))
+        self.assertIs(connection, t._get_connection())
+
+    def test_readv_stream_window(self):
+        t = self.get_http2_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        t._max_readv_streams = 2
+        self.assertEqual(
+            [(0, b'0'), (2, b'2'), (4, b'4'), (6, b'6'), (8, b'8')],
+            list(t.readv('a', ((0, 1), (2, 1), (4, 1), (6, 1), (8, 1)))))
+
+    def test_incomplete_readv_discards_streams(self):
+        t = self.get_http2_transport()
+        t._max_readv_combine = 1
+        t._max_get_ranges = 1
+        ireadv = iter(t.readv('a', ((0, 1), (1, 1), (3, 2), (9, 1))))
+        self.assertEqual((0, b'0'), next(ireadv))
+        ireadv.close()
+        self.assertEqual({}, t._get_connection()._streams)
+        self.assertEqual(b'0123456789', t.get_bytes('a'))
+
+    def test_large_file(self):
+        # Bigger than the default flow control windows
+        content = b''.join(b'%08d' % i for i in range(20000))
+        self.build_tree_contents([('big', content)])
+        t = self.get_http2_transport()
+        self.assertEqual(content, t.get_bytes('big'))
+        self.assertEqual([(100000, content[100000:100010])],
+                         list(t.readv('big', [(100000, 10)])))
+
+    def test_get_reads_body_as_needed(self):
+        content = b''.join(b'%08d' % i for i in range(20000))
+        self.build_tree_contents([('big', content)])
+        t = self.get_http2_transport()
+        f = t.get('big')
+        self.assertEqual(content[:10], f.read(10))
+        connection = t._get_connection()
+        [stream] = connection._streams.values()
+        # No more than the default stream flow control window is received
+        # ahead of the reader
+        self.assertTrue(
+            sum(len(data) for data, length in stream.chunks) < 65536)
+        self.assertEqual(content[10:], f.read())
+        self.assertEqual({}, connection._streams)
+
+    def test_close_cancels_body(self):
+        content = b''.join(b'%08d' % i for i in range(20000))
+        self.build_tree_contents([('big', content)])
+        t = self.get_http2_transport()
+        response = t.request('GET', t._remote_path('big'))
+        self.assertEqual(content[:10], response.read(10))
+        response.close()
+        self.assertEqual({}, t._get_connection()._streams)
+        self.assertEqual(b'0123456789', t.get_bytes('a'))
+
+
+class TestHttp2SingleOnlyRangeServer(TestHttp2Transport):
+
+    def create_transport_readonly_server(self):
+        return http_server.Http2Server(
+            test_http.SingleOnlyRangeRequestHandler)
+
+
+class Http2ServerWithSmarts(http_server.Http2Server):
+
+    def __init__(self, protocol_version=None):
+        super(Http2ServerWithSmarts, self).__init__(
+            http_utils.SmartRequestHandler, protocol_version=protocol_version)
+
+
+class TestSmartHttp2Tunnelling(http_utils.TestCaseWithWebserver):
+
+    _test_needs_features = [features.h2]
+
+    def setUp(self):
+        super(TestSmartHttp2Tunnelling, self).setUp()
+        self.overrideEnv('BRZ_NO_SMART_VFS', None)
+
+    def create_transport_readonly_server(self):
+        return Http2ServerWithSmarts()
+
+    def test_send_smart_request(self):
+        http_transport = self.get_readonly_transport()
+        medium = http_transport.get_smart_medium()
+        response = medium.send_http_smart_request(b'hello\n')
+        self.assertEqual(b'ok\x012\n', response.read())
+
+    def test_open_controldir(self):
+        self.make_branch('relpath')
+        url = self.get_readonly_server().get_url() + 'relpath'
+        bd = controldir.ControlDir.open(url)
+        self.addCleanup(bd.transport.disconnect)
+        self.assertIsInstance(bd, _mod_remote.RemoteBzrDir)
@@ -188,6 +188,14 @@ class ReadonlyServer(DecoratorServer):
         return readonly.ReadonlyTransportDecorator
 
 
+class CachingServer(DecoratorServer):
+    """Server for the CachingTransport decorator for testing with."""
+
+    def get_decorator_class(self):
+        from breezy.transport import cache
+        return cache.CachingTransport
+
+
 class TraceServer(DecoratorServer):
     """Server for the TransportTraceDecorator for testing with."""
 
@@ -17,6 +17,7 @@
 
 import os
 import socket
+import stat
 import sys
 import time
 
@@ -411,8 +412,11 @@ class ReadvFile(object):
 
     def __init__(self, data):
         self._data = data
+        self.max_concurrent_prefetch_requests = None
 
-    def readv(self, requests):
+    def readv(self, requests, max_concurrent_prefetch_requests=None):
+        self.max_concurrent_prefetch_requests = (
+            max_concurrent_prefetch_requests)
         for start, length in requests:
             yield self._data[start:start + length]
 
@@ -446,6 +450,23 @@ class Test_SFTPReadvHelper(tests.TestCase):
                               [(0, 40000), (40000, 100), (40100, 1900),
                                (42000, 24000)])
 
+    def test__get_requests_max_request_size(self):
+        self.requireFeature(features.paramiko)
+        helper = _mod_sftp._SFTPReadvHelper(
+            [(0, 40000), (40000, 100)], 'artificial_test',
+            _null_report_activity, max_request_size=65536)
+        self.assertEqual([(0, 40100)], helper._get_requests())
+
+    def test_max_requests_in_flight(self):
+        self.requireFeature(features.paramiko)
+        helper = _mod_sftp._SFTPReadvHelper(
+            [(0, 1), (5, 1)], 'artificial_test', _null_report_activity,
+            max_requests_in_flight=4)
+        data_f = ReadvFile(b'abcdefghij')
+        self.assertEqual([(0, b'a'), (5, b'f')],
+                         list(helper.request_and_yield_offsets(data_f)))
+        self.assertEqual(4, data_f.max_concurrent_prefetch_requests)
+
     def checkRequestAndYield(self, expected, data, offsets):
         self.requireFeature(features.paramiko)
         helper = _mod_sftp._SFTPReadvHelper(offsets, 'artificial_test',
@@ -469,6 +490,63 @@ class Test_SFTPReadvHelper(tests.TestCase):
             data, [(0, 1), (10, 1), (4, 3), (1, 3)])
 
 
+class TestSFTPTuning(TestCaseWithSFTPServer):
+
+    def test_default_request_size(self):
+        t = self.get_transport()
+        self.assertEqual(32768, t._max_request_size)
+        self.assertIs(None, t._max_requests_in_flight)
+
+    def test_configured(self):
+        conf = config.GlobalStack()
+        conf.set('sftp.max_request_size', '65536')
+        conf.set('sftp.max_requests_in_flight', '8')
+        content = b''.join(b'%08d' % i for i in range(20000))
+        self.build_tree_contents([('a', content)])
+        t = self.get_transport()
+        self.assertEqual(65536, t._max_request_size)
+        self.assertEqual(8, t._max_requests_in_flight)
+        self.assertEqual(65536, t.clone('.')._max_request_size)
+        self.assertEqual(content, t.get_bytes('a'))
+        self.assertEqual([(70000, content[70000:150000])],
+                         list(t.readv('a', [(70000, 80000)])))
+        t.put_bytes('b', content)
+        t.append_bytes('b', b'more')
+        self.assertEqual(content + b'more', t.get_bytes('b'))
+
+    def test_iter_files_recursive_without_stat(self):
+        self.build_tree(['a', 'dir/', 'dir/b', 'dir/sub/', 'dir/sub/c'])
+        t = self.get_transport()
+
+        def stat(relpath):
+            raise AssertionError('unexpected stat of %s' % relpath)
+        t.stat = stat
+        self.assertEqual(['a', 'dir/b', 'dir/sub/c'],
+                         sorted(t.iter_files_recursive()))
+
+    def test_iter_files_recursive_does_not_follow_symlinks(self):
+        self.requireFeature(features.SymlinkFeature(self.test_dir))
+        self.build_tree(['a', 'dir/', 'dir/b'])
+        os.symlink('dir', 'link')
+        os.symlink('../a', 'dir/c')
+        list_folder = stub_sftp.StubSFTPServer.list_folder
+
+        def lstat_list_folder(server, path):
+            # Like OpenSSH, describe the entries themselves, not their targets
+            out = list_folder(server, path)
+            for attr in out:
+                attr.st_mode = os.lstat(os.path.join(
+                    server._realpath(path), attr.filename)).st_mode
+            return out
+        self.overrideAttr(stub_sftp.StubSFTPServer, 'list_folder',
+                          lstat_list_folder)
+        t = self.get_transport()
+        self.assertEqual(['a', 'dir/b', 'dir/c', 'link'],
+                         sorted(t.iter_files_recursive()))
+        # As when each entry was stat()ed
+        self.assertFalse(stat.S_ISDIR(t.stat('link').st_mode))
+
+
 class TestUsesAuthConfig(TestCaseWithSFTPServer):
     """Test that AuthenticationConfig can supply default usernames."""
 
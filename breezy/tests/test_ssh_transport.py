@@ -14,11 +14,24 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
-from breezy import config
-from breezy.tests import TestCase, TestCaseWithTransport
+import os
+import sys
+
+from breezy import (
+    bedding,
+    config,
+    osutils,
+    )
+from breezy.tests import (
+    features,
+    TestCase,
+    TestCaseInTempDir,
+    TestCaseWithTransport,
+    )
 from breezy.errors import SSHVendorNotFound, UnknownSSH
 from breezy.transport.ssh import (
     OpenSSHSubprocessVendor,
+    ParamikoVendor,
     PLinkSubprocessVendor,
     SSHCorpSubprocessVendor,
     LSHSubprocessVendor,
@@ -316,3 +329,129 @@ class SubprocessVendorsTests(TestCase):
                 "-l", "user",
                 "-s", "host", "sftp"]
             )
+
+
+class OpenSSHMultiplexTests(TestCaseInTempDir):
+
+    def test_openssh_multiplex_arguments(self):
+        config.GlobalStack().set('ssh.multiplex', True)
+        self.overrideAttr(sys, 'platform', 'linux')
+        vendor = OpenSSHSubprocessVendor()
+        path = osutils.pathjoin(bedding.cache_dir(), 'ssh')
+        self.assertEqual(
+            ['-oControlMaster=auto',
+             '-oControlPath=%s' % osutils.pathjoin(path, '%C'),
+             '-oControlPersist=60'],
+            vendor._get_multiplex_argv())
+        self.assertTrue(os.path.isdir(path))
+
+    def test_openssh_multiplex_disabled(self):
+        config.GlobalStack().set('ssh.multiplex', False)
+        vendor = OpenSSHSubprocessVendor()
+        self.assertEqual([], vendor._get_multiplex_argv())
+
+    def test_openssh_multiplex_disabled_by_default(self):
+        self.overrideAttr(sys, 'platform', 'linux')
+        vendor = OpenSSHSubprocessVendor()
+        self.assertEqual([], vendor._get_multiplex_argv())
+
+
+class _FakeChannel(object):
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    def exec_command(self, command):
+        self.command = command
+
+
+class _FakeParamikoTransport(object):
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+    def open_session(self):
+        if not self.active:
+            import paramiko
+            raise paramiko.SSHException('closed')
+        return _FakeChannel(self)
+
+    def close(self):
+        self.active = False
+
+
+class ParamikoMultiplexTests(TestCaseInTempDir):
+
+    def setUp(self):
+        super(ParamikoMultiplexTests, self).setUp()
+        self.requireFeature(features.paramiko)
+        config.GlobalStack().set('ssh.multiplex', True)
+        self.vendor = ParamikoVendor()
+        self.connected = []
+
+        def connect(username, password, host, port):
+            t = _FakeParamikoTransport()
+            self.connected.append((username, host, port))
+            return t
+        self.vendor._connect = connect
+        self.addCleanup(self.vendor.close_transports)
+
+    def connect(self, username='user', host='host', port=None,
+                password=None):
+        return self.vendor.connect_ssh(username, password, host, port,
+                                       ['bzr'])
+
+    def test_shared(self):
+        c1 = self.connect()
+        c2 = self.connect()
+        self.assertIsNot(c1.channel, c2.channel)
+        self.assertIs(c1.channel.transport, c2.channel.transport)
+        self.assertEqual([('user', 'host', None)], self.connected)
+
+    def test_not_shared_across_users_hosts_and_ports(self):
+        self.connect()
+        self.connect(username='other')
+        self.connect(host='other')
+        self.connect(port=2222)
+        self.assertEqual(4, len(self.connected))
+
+    def test_not_shared_across_passwords(self):
+        c1 = self.connect(password='secret')
+        c2 = self.connect(password='other')
+        self.assertIsNot(c1.channel.transport, c2.channel.transport)
+        c3 = self.connect(password='secret')
+        self.assertIs(c1.channel.transport, c3.channel.transport)
+        self.assertEqual(2, len(self.connected))
+
+    def test_reconnect_when_inactive(self):
+        c1 = self.connect()
+        c1.channel.transport.active = False
+        c2 = self.connect()
+        self.assertIsNot(c1.channel.transport, c2.channel.transport)
+        self.assertEqual(2, len(self.connected))
+
+    def test_reconnect_when_channel_fails(self):
+        c1 = self.connect()
+        t1 = c1.channel.transport
+        # Closed by the server but not noticed yet
+        t1.is_active = lambda: True
+        t1.active = False
+        c2 = self.connect()
+        self.assertIsNot(t1, c2.channel.transport)
+        self.assertEqual(2, len(self.connected))
+
+    def test_disabled(self):
+        config.GlobalStack().set('ssh.multiplex', False)
+        c1 = self.connect()
+        c2 = self.connect()
+        self.assertIsNot(c1.channel.transport, c2.channel.transport)
+        self.assertEqual({}, self.vendor._transports)
+
+    def test_close_transports(self):
+        c1 = self.connect()
+        self.vendor.close_transports()
+        self.assertFalse(c1.channel.transport.active)
+        self.assertEqual({}, self.vendor._transports)
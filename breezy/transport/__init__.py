@@ -26,9 +26,12 @@ The Transport returned has methods to read, write and manipulate files within
 it.
 """
 
+from concurrent import futures
 import errno
 from io import BytesIO
 import sys
+import threading
+import time
 
 from stat import S_ISDIR
 
@@ -36,6 +39,7 @@ from ..trace import (
     mutter,
     )
 from .. import (
+    debug,
     errors,
     hooks,
     registry,
@@ -213,6 +217,128 @@ class _CoalescedOffset(object):
                                    self.start, self.length, self.ranges)
 
 
+class ReadvTuner(object):
+    """Pick readv coalescing parameters from the measured speed of a link.
+
+    The round trip time of requests and the throughput of their responses
+    are tracked as exponentially weighted moving averages. Their product,
+    the bandwidth-delay product, is the amount of data that could have been
+    received instead of waiting for one more round trip:
+
+    * gaps between ranges smaller than that are cheaper to read than to
+      request separately, so it is used as the fudge factor passed to
+      Transport._coalesce_offsets (bounded by min_fudge_factor and
+      max_fudge_factor),
+    * when requests can be issued over several connections, requests are
+      limited to a few times that size, big enough for the round trip to be
+      a small part of their cost but small enough to spread a read over the
+      connections.
+
+    Until both have been measured, min_fudge_factor and no size limit are
+    used.
+    """
+
+    # Weight of a new sample in the moving averages
+    smoothing = 0.25
+    # Throughput samples shorter than this are mostly noise
+    min_sample_bytes = 64 * 1024
+    # How many bandwidth-delay products a request spread over several
+    # connections should carry
+    request_size_factor = 8
+
+    def __init__(self, min_fudge_factor=0, max_fudge_factor=1024 * 1024,
+                 min_request_size=1024 * 1024, connections=1):
+        self.min_fudge_factor = min_fudge_factor
+        self.max_fudge_factor = max_fudge_factor
+        self.min_request_size = min_request_size
+        self.connections = connections
+        self.round_trip_time = None
+        self.throughput = None
+        self._lock = threading.Lock()
+
+    def _smooth(self, current, sample):
+        if current is None:
+            return sample
+        return current + self.smoothing * (sample - current)
+
+    def record_round_trip(self, seconds):
+        """Record the time between sending a request and its response."""
+        with self._lock:
+            self.round_trip_time = self._smooth(self.round_trip_time, seconds)
+
+    def record_transfer(self, nbytes, seconds):
+        """Record the time spent receiving nbytes of response bodies."""
+        if nbytes < self.min_sample_bytes or seconds <= 0:
+            return
+        with self._lock:
+            self.throughput = self._smooth(self.throughput, nbytes / seconds)
+
+    def bandwidth_delay_product(self):
+        """Return the bytes received during a round trip, or None."""
+        with self._lock:
+            if self.round_trip_time is None or self.throughput is None:
+                return None
+            return int(self.round_trip_time * self.throughput)
+
+    def fudge_factor(self):
+        """Return the fudge_factor to coalesce readv offsets with."""
+        bdp = self.bandwidth_delay_product()
+        if bdp is None:
+            return self.min_fudge_factor
+        return max(self.min_fudge_factor, min(bdp, self.max_fudge_factor))
+
+    def max_size(self):
+        """Return the maximum size of a request, 0 for no limit."""
+        bdp = self.bandwidth_delay_product()
+        if bdp is None or self.connections <= 1:
+            # With a single connection fewer, bigger, requests are always
+            # faster.
+            return 0
+        return max(self.min_request_size, bdp * self.request_size_factor)
+
+    def parameters(self):
+        """Return the measurements and the parameters picked from them.
+
+        :return: A dict with round_trip_time (in seconds), throughput (in
+            bytes per second), fudge_factor and max_size keys.
+        """
+        with self._lock:
+            round_trip_time = self.round_trip_time
+            throughput = self.throughput
+        return {'round_trip_time': round_trip_time,
+                'throughput': throughput,
+                'fudge_factor': self.fudge_factor(),
+                'max_size': self.max_size()}
+
+
+class _ReadvTimedFile(object):
+    """Report the time spent reading a response body to a ReadvTuner.
+
+    Reads are accumulated into samples of at least min_sample_bytes, so that
+    small reads served from a buffer do not skew the measurement.
+    """
+
+    def __init__(self, f, tuner):
+        self._file = f
+        self._tuner = tuner
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self._file.read(size)
+        self._seconds += time.time() - start
+        self._bytes += len(data)
+        if self._bytes >= self._tuner.min_sample_bytes:
+            self._tuner.record_transfer(self._bytes, self._seconds)
+            self._bytes = 0
+            self._seconds = 0.0
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
 class LateReadError(object):
     """A helper for transports which pretends to be a readable file.
 
@@ -335,6 +461,80 @@ class TransportHooks(hooks.Hooks):
                       "transport or smart medium instance.", (2, 5))
 
 
+class AsyncTransport(object):
+    """Make reads from a transport that return futures.
+
+    Every method returns a concurrent.futures.Future for the result of the
+    matching Transport method. Implementations whose ``concurrent`` attribute
+    is true start the requests without waiting for them, so that a caller can
+    have several requests in flight and overlap them with its own work.
+
+    This implementation does the requests as soon as they are made, on the
+    transport itself: most transports cannot serve two requests at once over
+    their connection (a smart medium raises TooManyConcurrentRequests).
+    Errors are reported by the returned futures. Callers gain nothing from
+    splitting their requests when ``concurrent`` is false.
+
+    An AsyncTransport must be closed once done with.
+    """
+
+    # Whether requests run concurrently with the caller.
+    concurrent = False
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def _submit(self, func, *args, **kwargs):
+        future = futures.Future()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+        return future
+
+    def close(self):
+        """Wait for the pending requests and release their resources."""
+
+    def get_bytes(self, relpath):
+        """Start reading the content of a file.
+
+        :return: A Future for the bytes of the file.
+        """
+        return self._submit(self._transport.get_bytes, relpath)
+
+    def readv(self, relpath, offsets, adjust_for_latency=False,
+              upper_limit=None):
+        """Start reading parts of a file.
+
+        See Transport.readv for the parameters.
+
+        :return: A Future for a list of (offset, data) tuples.
+        """
+        return self._submit(self._readv, self._transport, relpath, offsets,
+                            adjust_for_latency, upper_limit)
+
+    def _readv(self, transport, relpath, offsets, adjust_for_latency,
+               upper_limit):
+        return list(transport.readv(relpath, offsets, adjust_for_latency,
+                                    upper_limit))
+
+    def stat(self, relpath):
+        """Start a stat of a file.
+
+        :return: A Future for the stat result.
+        """
+        return self._submit(self._transport.stat, relpath)
+
+
 class Transport(object):
     """This class encapsulates methods for retrieving or putting a file
     from/to a storage location.
@@ -360,6 +560,9 @@ class Transport(object):
         self.base = base
         (self._raw_base, self._segment_parameters) = (
             urlutils.split_segment_parameters(base))
+        if 'transport_stats' in debug.debug_flags:
+            from . import stats
+            stats.get_stats().instrument(self)
 
     def _translate_error(self, e, path, raise_generic=True):
         """Translate an IOError or OSError into an appropriate bzr error.
@@ -694,6 +897,13 @@ class Transport(object):
             offsets = self._sort_expand_and_combine(offsets, upper_limit)
         return self._readv(relpath, offsets)
 
+    def get_async(self):
+        """Return an AsyncTransport to start requests on this transport.
+
+        The caller must close the returned object when done with it.
+        """
+        return AsyncTransport(self)
+
     def _readv(self, relpath, offsets):
         """Get parts of the file at the given relative path.
 
@@ -1261,7 +1471,12 @@ class Transport(object):
 
 
 class _SharedConnection(object):
-    """A connection shared between several transports."""
+    """A connection shared between several transports.
+
+    :ivar users: The number of transports sharing the connection.
+    """
+
+    _users_lock = threading.Lock()
 
     def __init__(self, connection=None, credentials=None, base=None):
         """Constructor.
@@ -1274,6 +1489,135 @@ class _SharedConnection(object):
         self.connection = connection
         self.credentials = credentials
         self.base = base
+        self.users = 0
+
+    def add_user(self):
+        with self._users_lock:
+            self.users += 1
+
+    def remove_user(self):
+        """Record that a transport stopped sharing the connection.
+
+        :return: True if it was the last transport sharing it.
+        """
+        with self._users_lock:
+            self.users -= 1
+            return self.users == 0
+
+
+class ConnectionPool(object):
+    """A process wide pool of idle connections.
+
+    A connection goes back to the pool when the last transport sharing it is
+    garbage collected, or when it is disconnected and not shared with another
+    transport, rather than being closed. A transport that is not a clone of
+    another one then borrows it if it needs a connection to the same scheme,
+    host, port and credentials. A connection is only ever lent to a single
+    transport and its clones, it is not shared with other transports.
+
+    Connections idle for more than idle_timeout seconds are closed and at most
+    max_size connections are kept, the least recently returned ones are closed
+    first.
+    """
+
+    def __init__(self, max_size=16, idle_timeout=300):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (key, transport class, connection, credentials, time returned),
+        # least recently returned first
+        self._idle = []
+
+    @staticmethod
+    def _key(transport):
+        url = transport._parsed_url
+        return (transport.__class__, url.scheme, url.user, url.password,
+                url.host, url.port)
+
+    def get(self, transport):
+        """Borrow an idle connection for transport.
+
+        :return: A (connection, credentials) tuple, or None if there is no
+            idle connection transport can use.
+        """
+        key = self._key(transport)
+        with self._lock:
+            expired = self._pop_expired()
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][0] == key:
+                    entry = self._idle.pop(i)
+                    break
+            else:
+                entry = None
+        self._close(expired)
+        if entry is None:
+            return None
+        return entry[2], entry[3]
+
+    def put(self, transport, connection, credentials):
+        """Give back the connection transport was using.
+
+        The caller must not use the connection anymore.
+        """
+        entry = (self._key(transport), transport.__class__, connection,
+                 credentials, time.time())
+        with self._lock:
+            expired = self._pop_expired()
+            self._idle.append(entry)
+            while len(self._idle) > self.max_size:
+                expired.append(self._idle.pop(0))
+        self._close(expired)
+
+    def _pop_expired(self):
+        now = time.time()
+        expired = [entry for entry in self._idle
+                   if now - entry[4] > self.idle_timeout]
+        if expired:
+            self._idle = [entry for entry in self._idle
+                          if now - entry[4] <= self.idle_timeout]
+        return expired
+
+    def _close(self, entries):
+        for _, klass, connection, _, _ in entries:
+            try:
+                klass._close_connection(connection)
+            except Exception as e:
+                mutter('unable to close pooled connection: %s', e)
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        self._close(idle)
+
+    def __len__(self):
+        return len(self._idle)
+
+
+_connection_pool = False
+
+
+def get_connection_pool():
+    """Return the process wide connection pool, or None if it is disabled.
+
+    The pool is configured by the ``transport.connection_pool.max_size`` and
+    ``transport.connection_pool.idle_timeout`` options when first needed.
+    """
+    global _connection_pool
+    if _connection_pool is False:
+        import breezy
+        from .. import config
+        # Reading the configuration may create transports
+        _connection_pool = None
+        stack = config.GlobalStack()
+        max_size = stack.get('transport.connection_pool.max_size')
+        if max_size:
+            _connection_pool = ConnectionPool(
+                max_size,
+                stack.get('transport.connection_pool.idle_timeout'))
+            breezy.get_global_state().exit_stack.callback(
+                _connection_pool.clear)
+    return _connection_pool
 
 
 class ConnectedTransport(Transport):
@@ -1284,8 +1628,16 @@ class ConnectedTransport(Transport):
 
     Host and credentials are available as private attributes, cloning preserves
     them and share the underlying, protocol specific, connection.
+
+    Unrelated transports reuse the connections of transports that have been
+    released or disconnected if the connection pool is enabled, see
+    get_connection_pool().
     """
 
+    # Whether the connection can be handed to another transport once this one
+    # is disconnected.
+    _pool_connections = True
+
     def __init__(self, base, _from_transport=None):
         """Constructor.
 
@@ -1312,10 +1664,33 @@ class ConnectedTransport(Transport):
         base = str(self._parsed_url)
 
         super(ConnectedTransport, self).__init__(base)
-        if _from_transport is None:
-            self._shared_connection = _SharedConnection()
+        if _from_transport is not None:
+            self._set_shared_connection(_from_transport._shared_connection)
         else:
-            self._shared_connection = _from_transport._shared_connection
+            self._set_shared_connection(_SharedConnection())
+
+    def __del__(self):
+        shared = self.__dict__.get('_shared_connection')
+        if shared is None or not shared.remove_user():
+            return
+        # The last transport sharing the connection is gone. Don't create
+        # the pool from here, there is no connection if it wasn't needed.
+        pool = _connection_pool
+        if (shared.connection is not None and self._pool_connections
+                and isinstance(pool, ConnectionPool)):
+            connection, shared.connection = shared.connection, None
+            pool.put(self, connection, shared.credentials)
+
+    def _set_shared_connection(self, shared):
+        """Share a connection with other transports.
+
+        :param shared: The _SharedConnection to use from now on.
+        """
+        previous = self.__dict__.get('_shared_connection')
+        if previous is not None:
+            previous.remove_user()
+        shared.add_user()
+        self._shared_connection = shared
 
     @property
     def _user(self):
@@ -1457,7 +1832,47 @@ class ConnectedTransport(Transport):
 
     def _get_connection(self):
         """Returns the transport specific connection object."""
-        return self._shared_connection.connection
+        shared = self._shared_connection
+        if shared.connection is None and self._pool_connections:
+            pool = get_connection_pool()
+            if pool is not None:
+                borrowed = pool.get(self)
+                if borrowed is not None:
+                    shared.connection, shared.credentials = borrowed
+        return shared.connection
+
+    def _release_connection(self):
+        """Hand the connection back to the connection pool, if enabled.
+
+        Daughter classes call this when disconnecting. The transport and its
+        clones will use another connection if they are used again. The
+        connection is only pooled if no clone shares it, a clone may be in
+        the middle of using it.
+
+        :return: The connection the caller should close, or None if there is
+            no connection or the pool took it.
+        """
+        shared = self._shared_connection
+        connection = shared.connection
+        if connection is None or not self._pool_connections:
+            return connection
+        pool = get_connection_pool()
+        if pool is None:
+            return connection
+        shared.connection = None
+        if shared.users > 1:
+            return connection
+        pool.put(self, connection, shared.credentials)
+        return None
+
+    @staticmethod
+    def _close_connection(connection):
+        """Close a connection the connection pool drops.
+
+        :param connection: An opaque object created by the daughter class, as
+            given to _set_connection.
+        """
+        connection.close()
 
     def _get_credentials(self):
         """Returns the credentials used to establish the connection."""
@@ -1681,6 +2096,18 @@ register_transport_proto('https+urllib://',
                          register_netloc=True)
 register_lazy_transport('https+urllib://', 'breezy.transport.http.urllib',
                         'HttpTransport')
+register_transport_proto('http+h2://',
+                         help="Read-only access of branches exported on the web"
+                         " using HTTP/2.",
+                         register_netloc=True)
+register_lazy_transport('http+h2://', 'breezy.transport.http.http2',
+                        'Http2Transport')
+register_transport_proto('https+h2://',
+                         help="Read-only access of branches exported on the web"
+                         " using HTTP/2 and SSL.",
+                         register_netloc=True)
+register_lazy_transport('https+h2://', 'breezy.transport.http.http2',
+                        'Http2Transport')
 # Default http transports (last declared wins (if it can be imported))
 register_transport_proto('http://',
                          help="Read-only access of branches exported on the web.")
@@ -1712,6 +2139,11 @@ register_transport_proto('fakenfs+')
 register_lazy_transport('fakenfs+', 'breezy.transport.fakenfs',
                         'FakeNFSTransportDecorator')
 
+register_transport_proto('cache+',
+                         help="Cache immutable repository files locally.")
+register_lazy_transport('cache+', 'breezy.transport.cache',
+                        'CachingTransport')
+
 register_transport_proto('log+')
 register_lazy_transport('log+', 'breezy.transport.log',
                         'TransportLogDecorator')
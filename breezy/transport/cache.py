@@ -0,0 +1,401 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Implementation of Transport that caches immutable files locally.
+
+Pack and index files of a pack repository (``packs/*.pack`` and
+``indices/*.[rits]ix``) never change once they have been given their final
+name, so byte ranges read from them can be kept in a local directory and
+served from there the next time, rather than being downloaded again.
+
+The cache is requested with the 'cache+' prefix, e.g.
+``cache+https://example.com/repo``. Its location and size are set with the
+``transport.cache.directory`` and ``transport.cache.max_size`` options.
+"""
+
+import bisect
+from collections import OrderedDict
+from io import BytesIO
+import itertools
+import math
+import os
+import re
+import threading
+
+from .. import (
+    bedding,
+    config,
+    iterablefile,
+    osutils,
+    trace,
+    urlutils,
+    )
+from ..transport import decorator
+
+
+# Directories holding immutable files, and the suffixes of those files.
+_IMMUTABLE_DIRS = ('packs', 'indices')
+_IMMUTABLE_SUFFIXES = ('.pack', '.rix', '.iix', '.tix', '.six', '.cix')
+
+# A cached range is named "<start>-<length>"; ".eof" marks a range running up
+# to the end of the file, i.e. the whole file when start is 0.
+_ENTRY_RE = re.compile(r'^(\d+)-(\d+)(\.eof)?$')
+
+
+class ByteRangeCache(object):
+    """A size bounded, least recently used cache of file byte ranges.
+
+    Each cached file has a directory named after the sha1 of its URL, holding
+    one file per cached range. Ranges that overlap or touch are merged into
+    one. The least recently used ranges are removed once the total size of
+    the cache goes over max_size.
+    """
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # (dirname, name) => size, least recently used first
+        self._entries = None
+        # dirname => [(start, length, eof, name)], sorted by start
+        self._ranges = {}
+        self._size = 0
+
+    def _dirname(self, url):
+        return osutils.sha_string(url.encode('utf-8')).decode('ascii')
+
+    def _ensure_loaded(self):
+        if self._entries is not None:
+            return
+        entries = []
+        try:
+            dirnames = os.listdir(self._path)
+        except FileNotFoundError:
+            dirnames = []
+        for dirname in dirnames:
+            dirpath = osutils.pathjoin(self._path, dirname)
+            try:
+                names = os.listdir(dirpath)
+            except (NotADirectoryError, FileNotFoundError):
+                continue
+            for name in names:
+                m = _ENTRY_RE.match(name)
+                if m is None:
+                    continue
+                try:
+                    st = os.stat(osutils.pathjoin(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, dirname, name, st.st_size,
+                                int(m.group(1)), int(m.group(2)),
+                                m.group(3) is not None))
+        entries.sort()
+        self._entries = OrderedDict()
+        for mtime, dirname, name, size, start, length, eof in entries:
+            self._entries[(dirname, name)] = size
+            bisect.insort(self._ranges.setdefault(dirname, []),
+                          (start, length, eof, name))
+            self._size += size
+
+    def _find(self, ranges, start):
+        """Return the index of the last range starting at or before start.
+
+        :return: The index in ranges, or -1 if all ranges start after start.
+        """
+        return bisect.bisect_right(ranges, (start, math.inf)) - 1
+
+    def _forget(self, dirname, name):
+        self._size -= self._entries.pop((dirname, name))
+        ranges = self._ranges[dirname]
+        i = self._find(ranges, int(_ENTRY_RE.match(name).group(1)))
+        del ranges[i]
+        if not ranges:
+            del self._ranges[dirname]
+
+    def _read(self, dirname, name, start, length):
+        """Read part of a cached range, or return None if it disappeared."""
+        path = osutils.pathjoin(self._path, dirname, name)
+        try:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                data = f.read(length)
+            os.utime(path)
+        except FileNotFoundError:
+            self._forget(dirname, name)
+            return None
+        self._entries.move_to_end((dirname, name))
+        return data
+
+    def get_file(self, url):
+        """Return the whole content of url, or None if it is not cached."""
+        dirname = self._dirname(url)
+        with self._lock:
+            self._ensure_loaded()
+            ranges = self._ranges.get(dirname)
+            if ranges:
+                start, length, eof, name = ranges[0]
+                if start == 0 and eof:
+                    data = self._read(dirname, name, 0, length)
+                    if data is not None and len(data) == length:
+                        return data
+        return None
+
+    def get_ranges(self, url, offsets):
+        """Return the offsets of url that can be served from the cache.
+
+        :param offsets: A list of (start, length) tuples.
+        :return: A dict mapping each cached (start, length) tuple to its
+            data.
+        """
+        dirname = self._dirname(url)
+        found = {}
+        with self._lock:
+            self._ensure_loaded()
+            for start, length in offsets:
+                if (start, length) in found:
+                    continue
+                ranges = self._ranges.get(dirname)
+                if not ranges:
+                    break
+                i = self._find(ranges, start)
+                if i < 0:
+                    continue
+                c_start, c_length, eof, name = ranges[i]
+                if start + length <= c_start + c_length:
+                    data = self._read(dirname, name, start - c_start, length)
+                    if data is not None and len(data) == length:
+                        found[(start, length)] = data
+        return found
+
+    def add(self, url, start, data, eof=False):
+        """Store a range of url in the cache.
+
+        The range is merged with the cached ranges it overlaps or touches.
+        Failing to write to the cache directory is not an error.
+
+        :param eof: True if data runs up to the end of the file.
+        """
+        length = len(data)
+        if length == 0 or length > self.max_size:
+            return
+        dirname = self._dirname(url)
+        end = start + length
+        with self._lock:
+            self._ensure_loaded()
+            ranges = self._ranges.get(dirname, [])
+            # The ranges to merge with: from the last one starting at or
+            # before start, if it reaches it, up to the last one starting at
+            # or before end.
+            first = self._find(ranges, start)
+            if first < 0 or ranges[first][0] + ranges[first][1] < start:
+                first += 1
+            merged = ranges[first:self._find(ranges, end) + 1]
+            if len(merged) == 1:
+                c_start, c_length, c_eof, c_name = merged[0]
+                if (c_start <= start and end <= c_start + c_length and
+                        (c_eof or not eof)):
+                    # Already covered.
+                    return
+            head = tail = None
+            if merged and merged[0][0] < start:
+                head = merged[0]
+            if merged and merged[-1][0] + merged[-1][1] >= end:
+                c_start, c_length, c_eof, c_name = merged[-1]
+                eof = eof or c_eof
+                if c_start + c_length > end:
+                    tail = merged[-1]
+            if head is not None:
+                length += start - head[0]
+                start = head[0]
+            if tail is not None:
+                length += tail[0] + tail[1] - end
+            if length > self.max_size:
+                return
+            name = '%d-%d' % (start, length)
+            if eof:
+                name += '.eof'
+            try:
+                self._write(dirname, name, data, end, head, tail)
+            except OSError as e:
+                trace.mutter('unable to write to transport cache %s: %s',
+                             self._path, e)
+                return
+            for c_start, c_length, c_eof, c_name in merged:
+                self._forget(dirname, c_name)
+            self._entries[(dirname, name)] = length
+            bisect.insort(self._ranges.setdefault(dirname, []),
+                          (start, length, eof, name))
+            self._size += length
+            for c_start, c_length, c_eof, c_name in merged:
+                if c_name != name:
+                    self._unlink(dirname, c_name)
+            self._evict()
+
+    def _write(self, dirname, name, data, end, head, tail):
+        """Write a range merged with the cached ranges around it.
+
+        :param data: The bytes of the range to add, up to end.
+        :param head: The cached range data is appended to, if any.
+        :param tail: The cached range following data, if any.
+        """
+        dirpath = osutils.pathjoin(self._path, dirname)
+        path = osutils.pathjoin(dirpath, name)
+        tmp_path = path + '.tmp'
+        os.makedirs(dirpath, exist_ok=True)
+        if head is None:
+            mode = 'wb'
+        else:
+            # Rather than copying it, extend the range data follows, as
+            # ranges are mostly read in order.
+            h_start, h_length, h_eof, h_name = head
+            os.replace(osutils.pathjoin(dirpath, h_name), tmp_path)
+            data = data[h_start + h_length - (end - len(data)):]
+            mode = 'ab'
+        try:
+            with open(tmp_path, mode) as f:
+                f.write(data)
+                if tail is not None:
+                    t_start, t_length, t_eof, t_name = tail
+                    with open(osutils.pathjoin(dirpath, t_name), 'rb') as t:
+                        t.seek(end - t_start)
+                        osutils.pumpfile(t, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def _unlink(self, dirname, name):
+        dirpath = osutils.pathjoin(self._path, dirname)
+        try:
+            os.unlink(osutils.pathjoin(dirpath, name))
+        except FileNotFoundError:
+            pass
+        if dirname not in self._ranges:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._size > self.max_size and self._entries:
+            dirname, name = next(iter(self._entries))
+            self._forget(dirname, name)
+            self._unlink(dirname, name)
+
+    def size(self):
+        """Return the total size of the cached ranges."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._size
+
+
+class CachingTransport(decorator.TransportDecorator):
+    """A decorator that caches reads of immutable repository files.
+
+    This is requested via the 'cache+' prefix to get_transport(). The cache
+    is shared as the transport is cloned.
+    """
+
+    def __init__(self, url, _decorated=None, _from_transport=None):
+        super(CachingTransport, self).__init__(url, _decorated)
+        if _from_transport is None:
+            stack = config.GlobalStack()
+            path = stack.get('transport.cache.directory')
+            if path is None:
+                path = osutils.pathjoin(bedding.cache_dir(), 'transport')
+            self._cache = ByteRangeCache(
+                path, stack.get('transport.cache.max_size'))
+        else:
+            self._cache = _from_transport._cache
+
+    @classmethod
+    def _get_url_prefix(self):
+        """Caching transports are identified by 'cache+'"""
+        return 'cache+'
+
+    def _cache_key(self, relpath):
+        """Return the URL to cache relpath under, or None if it may change."""
+        url = self._decorated.abspath(relpath)
+        dirname, basename = urlutils.split(url)
+        if (urlutils.basename(dirname) in _IMMUTABLE_DIRS and
+                basename.endswith(_IMMUTABLE_SUFFIXES)):
+            return url
+        return None
+
+    def get(self, relpath):
+        """See Transport.get()."""
+        url = self._cache_key(relpath)
+        if url is None:
+            return self._decorated.get(relpath)
+        data = self._cache.get_file(url)
+        if data is None:
+            f = self._decorated.get(relpath)
+            # Files too big to be cached are passed through rather than read
+            # in memory.
+            data = f.read(self._cache.max_size + 1)
+            if len(data) > self._cache.max_size:
+                return iterablefile.IterableFile(
+                    itertools.chain([data], osutils.file_iterator(f)))
+            f.close()
+            self._cache.add(url, 0, data, eof=True)
+        return BytesIO(data)
+
+    def readv(self, relpath, offsets, adjust_for_latency=False,
+              upper_limit=None):
+        """See Transport.readv()."""
+        # we override at the readv() level rather than _readv() so that any
+        # latency adjustments are only done for the ranges that have to be
+        # read from the underlying transport
+        url = self._cache_key(relpath)
+        if url is None:
+            return self._decorated.readv(relpath, offsets, adjust_for_latency,
+                                         upper_limit)
+        return self._cached_readv(url, relpath, offsets, adjust_for_latency,
+                                  upper_limit)
+
+    def _cached_readv(self, url, relpath, offsets, adjust_for_latency,
+                      upper_limit):
+        offsets = [(start, length) for start, length in offsets]
+        cached = self._cache.get_ranges(url, offsets)
+        missing = [offset for offset in offsets if offset not in cached]
+        if adjust_for_latency:
+            # The caller accepts the ranges in any order, and expanded.
+            for offset in offsets:
+                if offset in cached:
+                    yield offset[0], cached[offset]
+            if missing:
+                for start, data in self._decorated.readv(
+                        relpath, missing, True, upper_limit):
+                    self._cache.add(url, start, data)
+                    yield start, data
+            return
+        if missing:
+            fetched = iter(self._decorated.readv(relpath, missing))
+        for offset in offsets:
+            data = cached.get(offset)
+            if data is None:
+                start, data = next(fetched)
+                self._cache.add(url, start, data)
+            yield offset[0], data
+
+
+def get_test_permutations():
+    """Return the permutations to be used in testing."""
+    from breezy.tests import test_server
+    return [(CachingTransport, test_server.CachingServer)]
@@ -238,6 +238,12 @@ class GioTransport(ConnectedTransport):
                                         " %s" % str(e), orig_error=e)
         return connection, (user, password)
 
+    @staticmethod
+    def _close_connection(connection):
+        """See ConnectedTransport._close_connection."""
+        # Like disconnect, there is nothing to close
+        pass
+
     def disconnect(self):
         # FIXME: Nothing seems to be necessary here, which sounds a bit strange
         # -- vila 20100601
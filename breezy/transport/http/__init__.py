@@ -116,3 +116,29 @@ Possible values:
  * none: Certificates ignored
  * required: Certificates required and validated
 """)
+
+opt_http_readv_connections = config.Option(
+    'http.readv.connections', default=1,
+    from_unicode=config.int_from_store, invalid='warning',
+    help="""\
+Number of connections per host used to fetch the ranges of a readv.
+
+A single readv may need several GET requests, which are issued one after
+the other over one connection by default. Setting this above 1 fetches
+those requests in parallel over additional keep-alive connections, which
+helps a lot over high latency links.
+""")
+
+opt_http_readv_adaptive = config.Option(
+    'http.readv.adaptive', default=False,
+    from_unicode=config.bool_from_store, invalid='warning',
+    help="""\
+Whether to tune how readv ranges are combined to the measured link speed.
+
+When enabled, the round trip time and throughput of the connections to a
+host are measured, and ranges closer than what could be received during a
+round trip are combined into a single one (up to 1MiB apart). With
+http.readv.connections above 1, requests are also kept small enough to be
+spread over the connections. Otherwise fixed values suited to most servers
+are used.
+""")
@@ -0,0 +1,671 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Implementation of the http transport over HTTP/2, using the h2 library.
+
+Use it with http+h2:// or https+h2:// urls. Over https, HTTP/2 is negotiated
+with ALPN; over http, the server must accept HTTP/2 without an upgrade (h2c
+with prior knowledge).
+
+All the transports sharing a connection multiplex their requests on it. A
+readv needing several GET requests sends all of them before reading the
+responses, so it costs a single round trip. Smart protocol requests posted
+by SmartClientHTTPMedium use the same connection.
+
+Proxies and authentication schemes other than basic are not supported.
+"""
+
+import cgi
+import collections
+import http.client as http_client
+import socket
+import threading
+import time
+from urllib.parse import urljoin, urlencode, urlparse
+
+from ... import (
+    config,
+    debug,
+    errors,
+    trace,
+    transport,
+    ui,
+    )
+from ...trace import mutter
+from . import default_user_agent, ssl
+from .urllib import (
+    HttpTransport,
+    HTTPBasicAuthHandler,
+    )
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+except ImportError as e:
+    raise errors.DependencyNotPresent('h2', e)
+
+
+class _Stream(object):
+    """The response to a request, as it is received."""
+
+    def __init__(self, stream_id, path):
+        self.stream_id = stream_id
+        self.path = path
+        self.headers = None
+        # (data, flow controlled length) not yet read from the response
+        self.chunks = collections.deque()
+        self.ended = False
+        self.error = None
+        # Whether the response has been handed out by get_response()
+        self.claimed = False
+
+
+class HTTP2Connection(object):
+    """A HTTP/2 connection to a host, shared by several requests.
+
+    Requests are sent as soon as they are issued, responses are claimed
+    with get_response() and their bodies are received as they are read. The
+    underlying h2 state machine is protected by a lock so the connection can
+    be shared between threads.
+
+    The connection flow control window is reopened as soon as data arrives
+    but the window of a stream only once its data has been read, so the
+    server never sends more than a window ahead of the reader of a body.
+    """
+
+    _default_headers = {'Pragma': 'no-cache',
+                        'Cache-control': 'max-age=0',
+                        'User-agent': default_user_agent(),
+                        'Accept': '*/*',
+                        }
+
+    def __init__(self, host, port, use_tls, report_activity=None,
+                 ca_certs=None):
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.ca_certs = ca_certs
+        self._report_activity = report_activity
+        self.sock = None
+        self._conn = None
+        self._lock = threading.RLock()
+        self._streams = {}
+
+    def _mutter_connect(self):
+        mutter('* About to connect() to %s:%s using HTTP/2',
+               self.host, self.port)
+
+    def connect(self):
+        if 'http' in debug.debug_flags:
+            self._mutter_connect()
+        try:
+            sock = socket.create_connection((self.host, self.port))
+        except socket.gaierror as e:
+            raise errors.ConnectionError(
+                "Couldn't resolve host '%s'" % self.host, orig_error=e)
+        except socket.error as e:
+            raise errors.ConnectionError(
+                "Couldn't connect to %s:%s" % (self.host, self.port),
+                orig_error=e)
+        if self.use_tls:
+            sock = self._wrap_tls(sock)
+        self.sock = sock
+        self._conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(
+                client_side=True, header_encoding='utf-8'))
+        self._conn.initiate_connection()
+        self._send()
+
+    def _wrap_tls(self, sock):
+        config_stack = config.GlobalStack()
+        cert_reqs = config_stack.get('ssl.cert_reqs')
+        if cert_reqs == ssl.CERT_NONE:
+            ui.ui_factory.show_user_warning(
+                'not_checking_ssl_cert', host=self.host)
+            ui.ui_factory.suppressed_warnings.add('not_checking_ssl_cert')
+            ca_certs = None
+        elif self.ca_certs is None:
+            ca_certs = config_stack.get('ssl.ca_certs')
+        else:
+            ca_certs = self.ca_certs
+        ssl_context = ssl.create_default_context(
+            purpose=ssl.Purpose.SERVER_AUTH, cafile=ca_certs)
+        ssl_context.check_hostname = cert_reqs != ssl.CERT_NONE
+        ssl_context.verify_mode = cert_reqs
+        ssl_context.set_alpn_protocols(['h2'])
+        ssl_sock = ssl_context.wrap_socket(sock, server_hostname=self.host)
+        if ssl_sock.selected_alpn_protocol() != 'h2':
+            ssl_sock.close()
+            raise errors.ConnectionError(
+                '%s:%s does not support HTTP/2' % (self.host, self.port))
+        return ssl_sock
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close_connection()
+                    self._send()
+                except (errors.ConnectionReset, h2.exceptions.ProtocolError):
+                    pass
+            self._closed(errors.ConnectionReset('Connection closed'))
+
+    def _closed(self, error):
+        """Forget about the connection, failing the pending streams."""
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self._conn = None
+        for stream in self._streams.values():
+            if not stream.ended:
+                stream.error = error
+                stream.ended = True
+
+    def _send(self):
+        data = self._conn.data_to_send()
+        if data:
+            try:
+                self.sock.sendall(data)
+            except socket.error as e:
+                error = errors.ConnectionReset(
+                    'Sending to %s:%s failed' % (self.host, self.port), e)
+                self._closed(error)
+                raise error
+            if self._report_activity is not None:
+                self._report_activity(len(data), 'write')
+
+    def _receive(self):
+        """Read data from the socket and process the resulting events."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            error = errors.ConnectionReset(
+                'Reading from %s:%s failed' % (self.host, self.port), e)
+            self._closed(error)
+            raise error
+        if not data:
+            error = errors.ConnectionReset(
+                'Connection closed by %s:%s' % (self.host, self.port))
+            self._closed(error)
+            raise error
+        if self._report_activity is not None:
+            self._report_activity(len(data), 'read')
+        for event in self._conn.receive_data(data):
+            stream = self._streams.get(getattr(event, 'stream_id', None))
+            if isinstance(event, h2.events.ResponseReceived):
+                if stream is not None:
+                    stream.headers = event.headers
+            elif isinstance(event, h2.events.DataReceived):
+                if stream is not None:
+                    stream.chunks.append(
+                        (event.data, event.flow_controlled_length))
+                if event.flow_controlled_length:
+                    self._conn.increment_flow_control_window(
+                        event.flow_controlled_length)
+            elif isinstance(event, h2.events.StreamEnded):
+                if stream is not None:
+                    self._ended(stream)
+            elif isinstance(event, h2.events.StreamReset):
+                if stream is not None:
+                    stream.error = errors.InvalidHttpResponse(
+                        stream.path,
+                        'Stream reset with error code %s' % event.error_code)
+                    self._ended(stream)
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self._closed(errors.ConnectionReset(
+                    'Connection terminated by %s:%s with error code %s'
+                    % (self.host, self.port, event.error_code)))
+                return
+        self._send()
+
+    def _ended(self, stream):
+        stream.ended = True
+        if stream.claimed:
+            # Nothing more to receive, the response has all that is left
+            del self._streams[stream.stream_id]
+
+    def request(self, method, path, headers=None, body=None):
+        """Send a request.
+
+        :return: A stream id to be given to get_response() or discard().
+        """
+        # HTTP/2 header names are lower case
+        all_headers = {name.lower(): value
+                       for name, value in self._default_headers.items()}
+        if headers is not None:
+            all_headers.update(
+                (name.lower(), value) for name, value in headers.items())
+        if body:
+            all_headers['content-length'] = '%d' % len(body)
+        if self.use_tls:
+            scheme = 'https'
+        else:
+            scheme = 'http'
+        request_headers = [
+            (':method', method), (':scheme', scheme),
+            (':authority', '%s:%s' % (self.host, self.port)),
+            (':path', path)]
+        request_headers.extend(all_headers.items())
+        if 'http' in debug.debug_flags:
+            mutter('> %s %s (HTTP/2)' % (method, path))
+            for name, value in request_headers[4:]:
+                mutter('> %s: %s' % (name, value))
+        with self._lock:
+            if self._conn is None:
+                self.connect()
+            # Stay within the number of streams the server accepts
+            while (self._conn.open_outbound_streams
+                   >= self._conn.remote_settings.max_concurrent_streams):
+                self._receive()
+            stream_id = self._conn.get_next_available_stream_id()
+            self._conn.send_headers(stream_id, request_headers,
+                                    end_stream=not body)
+            self._streams[stream_id] = _Stream(stream_id, path)
+            if body:
+                self._send_body(stream_id, body)
+            self._send()
+        return stream_id
+
+    def _send_body(self, stream_id, body):
+        offset = 0
+        while offset < len(body):
+            try:
+                size = min(self._conn.local_flow_control_window(stream_id),
+                           self._conn.max_outbound_frame_size,
+                           len(body) - offset)
+                if size <= 0:
+                    # Wait for the server to open the flow control window
+                    self._send()
+                    self._receive()
+                    continue
+                self._conn.send_data(stream_id, body[offset:offset + size])
+            except h2.exceptions.StreamClosedError:
+                # The server answered early, the response tells why
+                return
+            offset += size
+        self._conn.end_stream(stream_id)
+
+    def get_response(self, stream_id):
+        """Wait for the headers of the response to a request.
+
+        :return: A Http2Response, its body is received as it is read.
+        """
+        with self._lock:
+            stream = self._streams[stream_id]
+            while stream.headers is None and not stream.ended:
+                self._receive()
+            stream.claimed = True
+            if stream.ended:
+                del self._streams[stream_id]
+        if stream.headers is None:
+            if stream.error is not None:
+                raise stream.error
+            raise errors.InvalidHttpResponse(stream.path, 'No headers')
+        return Http2Response(stream.headers, self, stream)
+
+    def read_data(self, stream):
+        """Read the next part of the body of a claimed response.
+
+        The flow control window of the stream is reopened for the data
+        returned.
+
+        :return: Some bytes, b'' once the whole body has been read.
+        """
+        with self._lock:
+            while True:
+                while not stream.chunks and not stream.ended:
+                    self._receive()
+                if not stream.chunks:
+                    break
+                data, flow_controlled_length = stream.chunks.popleft()
+                if (flow_controlled_length and not stream.ended
+                        and self._conn is not None):
+                    try:
+                        self._conn.increment_flow_control_window(
+                            flow_controlled_length, stream.stream_id)
+                        self._send()
+                    except (h2.exceptions.StreamClosedError,
+                            errors.ConnectionReset):
+                        # Reported when reading the rest of the body
+                        pass
+                if data:
+                    return data
+        if stream.error is not None:
+            raise stream.error
+        return b''
+
+    def discard(self, stream_id):
+        """Cancel a request whose response is not needed anymore."""
+        with self._lock:
+            stream = self._streams.pop(stream_id, None)
+            if stream is None or stream.ended:
+                return
+            stream.chunks.clear()
+            stream.ended = True
+            if self._conn is None:
+                return
+            try:
+                self._conn.reset_stream(
+                    stream_id, error_code=h2.errors.ErrorCodes.CANCEL)
+                self._send()
+            except (h2.exceptions.StreamClosedError, errors.ConnectionReset):
+                pass
+
+
+class Http2Response(object):
+    """A response received on a HTTP/2 stream.
+
+    This provides the same interface as the responses returned by
+    HttpTransport.request(). The body is received from the connection as it
+    is read, close() cancels the part not read yet.
+    """
+
+    def __init__(self, headers, connection, stream):
+        self.status = None
+        self._headers = http_client.HTTPMessage()
+        for name, value in headers:
+            if name == ':status':
+                self.status = int(value)
+            elif not name.startswith(':'):
+                self._headers[name] = value
+        self._connection = connection
+        self._stream = stream
+        self._buffer = b''
+        self._data = None
+        # Whether the connection is dedicated to this response
+        self.close_connection = False
+
+    @property
+    def reason(self):
+        return http_client.responses.get(self.status, '')
+
+    def getheader(self, name, default=None):
+        return self._headers.get(name, default)
+
+    def getheaders(self):
+        return list(self._headers.items())
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self.read()
+        return self._data
+
+    @property
+    def text(self):
+        if self.status == 204:
+            return None
+        charset = cgi.parse_header(
+            self._headers.get('Content-Type', ''))[1].get('charset')
+        if charset:
+            return self.data.decode(charset)
+        else:
+            return self.data.decode()
+
+    def _fill(self, size=None):
+        """Buffer size bytes, or the whole body if size is None.
+
+        :return: False if the body ended before.
+        """
+        chunks = [self._buffer]
+        buffered = len(self._buffer)
+        complete = True
+        while size is None or buffered < size:
+            data = self._connection.read_data(self._stream)
+            if not data:
+                complete = False
+                if self.close_connection:
+                    self._connection.close()
+                break
+            chunks.append(data)
+            buffered += len(data)
+        self._buffer = b''.join(chunks)
+        return complete
+
+    def read(self, amt=None):
+        if amt is None or amt < 0:
+            self._fill()
+            data, self._buffer = self._buffer, b''
+        else:
+            self._fill(amt)
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self._buffer:
+            if 0 <= size <= len(self._buffer):
+                break
+            if not self._fill(len(self._buffer) + 1):
+                break
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size >= 0:
+            end = min(end, size)
+        line, self._buffer = self._buffer[:end], self._buffer[end:]
+        return line
+
+    def readlines(self):
+        return list(iter(self.readline, b''))
+
+    def close(self):
+        self._buffer = b''
+        self._connection.discard(self._stream.stream_id)
+        if self.close_connection:
+            self._connection.close()
+
+
+class Http2Transport(HttpTransport):
+    """HTTP transport multiplexing its requests on a HTTP/2 connection."""
+
+    # The maximum number of GET requests a readv sends before reading their
+    # responses, servers usually accept at least 100 concurrent streams.
+    _max_readv_streams = 100
+
+    # The maximum number of redirections followed when asked to
+    _max_redirections = 8
+
+    def __init__(self, base, _from_transport=None, ca_certs=None):
+        super(Http2Transport, self).__init__(
+            base, _from_transport=_from_transport, ca_certs=ca_certs)
+        if _from_transport is not None:
+            self._ca_certs = _from_transport._ca_certs
+        else:
+            self._ca_certs = ca_certs
+
+    def _create_connection(self, parsed_url):
+        use_tls = parsed_url.scheme.startswith('https')
+        port = parsed_url.port
+        if port is None:
+            if use_tls:
+                port = 443
+            else:
+                port = 80
+        return HTTP2Connection(
+            parsed_url.hostname, port, use_tls,
+            report_activity=self._report_activity, ca_certs=self._ca_certs)
+
+    def _get_h2_connection(self):
+        connection = self._get_connection()
+        if connection is None:
+            connection = self._create_connection(
+                urlparse(self._remote_path('.')))
+            self._set_connection(connection, self._create_auth())
+        return connection
+
+    def _auth_headers(self):
+        auth = self._get_credentials()
+        if auth is not None and auth.get('scheme') == 'basic':
+            return {'Authorization':
+                    HTTPBasicAuthHandler().build_auth_header(auth, None)}
+        return {}
+
+    def _start_request(self, method, url, headers=None, body=None):
+        """Send a request on the shared connection.
+
+        :return: A stream id, see HTTP2Connection.request().
+        """
+        connection = self._get_h2_connection()
+        all_headers = self._auth_headers()
+        if headers:
+            all_headers.update(headers)
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        return connection.request(method, path, all_headers, body)
+
+    def _finish_request(self, stream_id, method, url, headers=None,
+                        body=None):
+        """Get the response to a request, authenticating if needed."""
+        connection = self._get_h2_connection()
+        response = connection.get_response(stream_id)
+        if response.status == 401:
+            auth = self._get_credentials()
+            challenge = response.getheader('WWW-Authenticate')
+            if (challenge is not None and auth.get('scheme') is None
+                    and HTTPBasicAuthHandler().auth_match(challenge, auth)
+                    and auth.get('password') is not None):
+                auth['scheme'] = 'basic'
+                response.close()
+                response = connection.get_response(
+                    self._start_request(method, url, headers, body))
+        return response
+
+    def request(self, method, url, fields=None, headers=None, **urlopen_kw):
+        body = urlopen_kw.pop('body', None)
+        if fields is not None:
+            if body is not None:
+                raise ValueError(
+                    'body and fields are mutually exclusive')
+            body = urlencode(fields).encode()
+        follow_redirections = (urlopen_kw.pop('retries', 0) > 0)
+        if urlopen_kw:
+            raise NotImplementedError(
+                'unknown arguments: %r' % urlopen_kw.keys())
+        if self._debuglevel > 0:
+            print('perform: %s base: %s, url: %s' % (method, self.base, url))
+        response = self._finish_request(
+            self._start_request(method, url, headers, body),
+            method, url, headers, body)
+        redirections = 0
+        while response.status in (301, 302, 303, 307, 308):
+            location = urljoin(url, response.getheader('Location', ''))
+            if not follow_redirections:
+                raise errors.RedirectRequested(
+                    url, location, is_permanent=(response.status in (301, 308)))
+            redirections += 1
+            if redirections > self._max_redirections:
+                raise errors.InvalidHttpResponse(url, 'Too many redirections')
+            trace.mutter('redirected from: %s to: %s' % (url, location))
+            response.close()
+            if response.status == 303:
+                method, body = 'GET', None
+            response = self._redirected_request(method, location, headers,
+                                                body)
+            url = location
+        return response
+
+    def _redirected_request(self, method, url, headers, body):
+        ours = urlparse(self._remote_path('.'))
+        theirs = urlparse(url)
+        if (ours.scheme, ours.netloc) == (theirs.scheme, theirs.netloc):
+            return self._finish_request(
+                self._start_request(method, url, headers, body),
+                method, url, headers, body)
+        # Another host, use a dedicated connection, closed with the response
+        connection = self._create_connection(theirs)
+        try:
+            path = theirs.path or '/'
+            if theirs.query:
+                path += '?' + theirs.query
+            response = connection.get_response(
+                connection.request(method, path, headers, body))
+        except BaseException:
+            connection.close()
+            raise
+        response.close_connection = True
+        return response
+
+    def get_async(self):
+        """See Transport.get_async()."""
+        # The requests of a single readv are already multiplexed over the
+        # single connection, which cannot be shared with another thread.
+        return transport.AsyncTransport(self)
+
+    def _issue_readv_requests(self, relpath, requests):
+        """See HttpTransport._issue_readv_requests.
+
+        All the GET requests (up to _max_readv_streams) are sent before
+        reading the first response.
+        """
+        if len(requests) <= 1:
+            for c, rfile in super(Http2Transport, self)._issue_readv_requests(
+                    relpath, requests):
+                yield c, rfile
+            return
+        abspath = self._remote_path(relpath)
+        connection = self._get_h2_connection()
+        pending = collections.deque()
+        requests = iter(requests)
+        response = None
+
+        def start(ranges):
+            headers, range_header = self._range_request_headers(ranges, 0)
+            stream_id = self._start_request('GET', abspath, headers)
+            pending.append((ranges, headers, range_header, stream_id))
+
+        try:
+            started = time.time()
+            for ranges in requests:
+                start(ranges)
+                if len(pending) >= self._max_readv_streams:
+                    break
+            while pending:
+                ranges, headers, range_header, stream_id = pending.popleft()
+                response = self._finish_request(
+                    stream_id, 'GET', abspath, headers)
+                if started is not None and self._readv_tuner is not None:
+                    # Only the first response is not delayed by others
+                    self._readv_tuner.record_round_trip(
+                        time.time() - started)
+                started = None
+                if 300 <= response.status < 400:
+                    raise errors.RedirectRequested(
+                        abspath,
+                        urljoin(abspath, response.getheader('Location', '')),
+                        is_permanent=(response.status in (301, 308)))
+                code, rfile = self._handle_get_response(
+                    abspath, range_header, response)
+                rfile = self._timed(rfile)
+                for coal in ranges:
+                    yield coal, rfile
+                response.close()
+                for ranges in requests:
+                    start(ranges)
+                    break
+        finally:
+            if response is not None:
+                response.close()
+            for ranges, headers, range_header, stream_id in pending:
+                connection.discard(stream_id)
+
+
+def get_test_permutations():
+    """Return the permutations to be used in testing."""
+    from breezy.tests import http_server
+    return [(Http2Transport, http_server.Http2Server)]
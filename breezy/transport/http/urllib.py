@@ -25,12 +25,16 @@ DEBUG = 0
 
 import base64
 import cgi
+import collections
+from concurrent import futures
 import errno
+from io import BytesIO
 import os
 import re
 import socket
 import ssl
 import sys
+import threading
 import time
 import urllib
 import weakref
@@ -69,6 +73,7 @@ from ...transport import (
     ConnectedTransport,
     UnusableRedirect,
     NoSuchFile,
+    _SharedConnection,
     )
 
 from . import default_user_agent, ssl
@@ -1765,6 +1770,135 @@ class Opener(object):
             pprint.pprint(self._opener.__dict__)
 
 
+class _ReadvConnectionPool(object):
+    """Extra connections to a host, used to issue readv GETs in parallel.
+
+    Each connection is held by a worker transport which shares the opener
+    and credentials of the transport it was created from, but not its
+    connection. Idle workers are kept around so their connection can be
+    reused by later readvs.
+    """
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def get(self, transport):
+        """Get a worker transport with the same base as transport."""
+        with self._lock:
+            try:
+                worker = self._idle.pop()
+            except IndexError:
+                worker = None
+        if worker is None:
+            worker = transport.__class__(
+                transport.base, _from_transport=transport)
+            credentials = transport._get_credentials()
+            if credentials is not None:
+                credentials = tuple(dict(c) for c in credentials)
+            worker._set_shared_connection(
+                _SharedConnection(credentials=credentials))
+        elif worker.base != transport.base:
+            # Share the worker connection with a transport at the right base
+            worker = transport.__class__(
+                transport.base, _from_transport=worker)
+        worker._range_hint = transport._range_hint
+        return worker
+
+    def put(self, worker):
+        """Give back a worker whose connection can be reused."""
+        with self._lock:
+            if len(self._idle) < self.max_connections:
+                self._idle.append(worker)
+                return
+        self.discard(worker)
+
+    def discard(self, worker):
+        """Close the connection of a worker that is not given back."""
+        connection = worker._get_connection()
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            self.discard(worker)
+
+
+class _ReadRange(object):
+    """The data of a coalesced offset, read ahead of being used.
+
+    This provides the subset of the RangeFile interface used by
+    HttpTransport._readv.
+    """
+
+    def __init__(self, start, data):
+        self._start = start
+        self._file = BytesIO(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence != os.SEEK_SET:
+            raise AssertionError('Only absolute seeks are supported')
+        self._file.seek(offset - self._start)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+
+class _HttpAsyncTransport(transport.AsyncTransport):
+    """Start http requests over the connections of the readv pool.
+
+    Each request runs in a worker thread holding its own pooled connection,
+    so up to http.readv.connections requests are in flight at once.
+    """
+
+    concurrent = True
+
+    def __init__(self, transport):
+        super(_HttpAsyncTransport, self).__init__(transport)
+        self._executor = None
+
+    def _submit(self, func, *args, **kwargs):
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(
+                max_workers=max(1, self._transport._readv_pool.max_connections))
+        return self._executor.submit(self._pooled, func, *args, **kwargs)
+
+    def _pooled(self, func, *args, **kwargs):
+        pool = self._transport._readv_pool
+        worker = pool.get(self._transport)
+        try:
+            result = func(worker, *args, **kwargs)
+        except BaseException:
+            pool.discard(worker)
+            raise
+        pool.put(worker)
+        return result
+
+    def close(self):
+        """See AsyncTransport.close."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def get_bytes(self, relpath):
+        """See AsyncTransport.get_bytes."""
+        return self._submit(lambda worker: worker.get_bytes(relpath))
+
+    def readv(self, relpath, offsets, adjust_for_latency=False,
+              upper_limit=None):
+        """See AsyncTransport.readv."""
+        return self._submit(self._readv, relpath, offsets,
+                            adjust_for_latency, upper_limit)
+
+    def stat(self, relpath):
+        """See AsyncTransport.stat."""
+        return self._submit(lambda worker: worker.stat(relpath))
+
+
 class HttpTransport(ConnectedTransport):
     """HTTP Client implementations.
 
@@ -1798,10 +1932,21 @@ class HttpTransport(ConnectedTransport):
         if _from_transport is not None:
             self._range_hint = _from_transport._range_hint
             self._opener = _from_transport._opener
+            self._readv_pool = _from_transport._readv_pool
+            self._readv_tuner = _from_transport._readv_tuner
         else:
             self._range_hint = 'multi'
             self._opener = Opener(
                 report_activity=self._report_activity, ca_certs=ca_certs)
+            stack = config.GlobalStack()
+            self._readv_pool = _ReadvConnectionPool(
+                stack.get('http.readv.connections'))
+            if stack.get('http.readv.adaptive'):
+                self._readv_tuner = transport.ReadvTuner(
+                    min_fudge_factor=self._bytes_to_read_before_seek,
+                    connections=self._readv_pool.max_connections)
+            else:
+                self._readv_tuner = None
 
     def request(self, method, url, fields=None, headers=None, **urlopen_kw):
         body = urlopen_kw.pop('body', None)
@@ -1827,6 +1972,9 @@ class HttpTransport(ConnectedTransport):
             # Clean the httplib.HTTPConnection pipeline in case the previous
             # request couldn't do it
             connection.cleanup_pipe()
+        elif self._get_credentials() is not None:
+            # A new connection for known credentials, see _ReadvConnectionPool
+            (auth, proxy_auth) = self._get_credentials()
         else:
             # First request, initialize credentials.
             # scheme and realm will be set by the _urllib2_wrappers.AuthHandler
@@ -1916,9 +2064,10 @@ class HttpTransport(ConnectedTransport):
         return Urllib3LikeResponse(response)
 
     def disconnect(self):
-        connection = self._get_connection()
+        connection = self._release_connection()
         if connection is not None:
             connection.close()
+        self._readv_pool.close()
 
     def has(self, relpath):
         """Does the target location exist?
@@ -1950,6 +2099,20 @@ class HttpTransport(ConnectedTransport):
         :returns: (http_code, result_file)
         """
         abspath = self._remote_path(relpath)
+        headers, range_header = self._range_request_headers(
+            offsets, tail_amount)
+        if self._readv_tuner is not None:
+            start = time.time()
+        response = self.request('GET', abspath, headers=headers)
+        if self._readv_tuner is not None:
+            self._readv_tuner.record_round_trip(time.time() - start)
+        return self._handle_get_response(abspath, range_header, response)
+
+    def _range_request_headers(self, offsets, tail_amount):
+        """Get the headers of a GET request for offsets of a file.
+
+        :returns: (headers, range_header)
+        """
         headers = {}
         if offsets or tail_amount:
             range_header = self._attempted_range_header(offsets, tail_amount)
@@ -1958,9 +2121,13 @@ class HttpTransport(ConnectedTransport):
                 headers = {'Range': bytes}
         else:
             range_header = None
+        return headers, range_header
 
-        response = self.request('GET', abspath, headers=headers)
+    def _handle_get_response(self, abspath, range_header, response):
+        """Check the response to a GET request and wrap its body.
 
+        :returns: (http_code, result_file)
+        """
         if response.status == 404:  # not found
             raise NoSuchFile(abspath)
         elif response.status == 416:
@@ -2063,10 +2230,10 @@ class HttpTransport(ConnectedTransport):
 
             # Coalesce the offsets to minimize the GET requests issued
             sorted_offsets = sorted(offsets)
+            fudge_factor, max_size = self._readv_parameters()
             coalesced = self._coalesce_offsets(
                 sorted_offsets, limit=self._max_readv_combine,
-                fudge_factor=self._bytes_to_read_before_seek,
-                max_size=self._get_max_size)
+                fudge_factor=fudge_factor, max_size=max_size)
 
             # Turn it into a list, we will iterate it several times
             coalesced = list(coalesced)
@@ -2138,54 +2305,152 @@ class HttpTransport(ConnectedTransport):
                 retried_offset = cur_offset_and_size
                 try_again = True
 
-    def _coalesce_readv(self, relpath, coalesced):
-        """Issue several GET requests to satisfy the coalesced offsets"""
+    def _readv_parameters(self):
+        """Return the fudge factor and maximum GET size to coalesce with."""
+        if self._readv_tuner is None:
+            return self._bytes_to_read_before_seek, self._get_max_size
+        return self._readv_tuner.fudge_factor(), self._readv_tuner.max_size()
 
-        def get_and_yield(relpath, coalesced):
-            if coalesced:
-                # Note that the _get below may raise
-                # errors.InvalidHttpRange. It's the caller's responsibility to
-                # decide how to retry since it may provide different coalesced
-                # offsets.
-                code, rfile = self._get(relpath, coalesced)
-                for coal in coalesced:
-                    yield coal, rfile
+    def get_readv_parameters(self):
+        """Return how readv currently coalesces ranges.
+
+        :return: A dict with the fudge_factor and max_size used to combine
+            ranges and, when http.readv.adaptive is enabled, the measured
+            round_trip_time (in seconds) and throughput (in bytes per second)
+            they were picked from (None until measured).
+        """
+        if self._readv_tuner is not None:
+            return self._readv_tuner.parameters()
+        fudge_factor, max_size = self._readv_parameters()
+        return {'fudge_factor': fudge_factor, 'max_size': max_size}
+
+    def _timed(self, rfile):
+        """Wrap a response body to measure its throughput if needed."""
+        if self._readv_tuner is None:
+            return rfile
+        return transport._ReadvTimedFile(rfile, self._readv_tuner)
 
+    def _coalesce_readv(self, relpath, coalesced):
+        """Issue several GET requests to satisfy the coalesced offsets"""
         if self._range_hint is None:
             # Download whole file
-            for c, rfile in get_and_yield(relpath, coalesced):
-                yield c, rfile
+            if coalesced:
+                for c, rfile in self._issue_readv_requests(
+                        relpath, [coalesced]):
+                    yield c, rfile
+            return
+        total = len(coalesced)
+        if self._range_hint == 'multi':
+            max_ranges = self._max_get_ranges
+        elif self._range_hint == 'single':
+            max_ranges = total
         else:
-            total = len(coalesced)
-            if self._range_hint == 'multi':
-                max_ranges = self._max_get_ranges
-            elif self._range_hint == 'single':
-                max_ranges = total
+            raise AssertionError("Unknown _range_hint %r"
+                                 % (self._range_hint,))
+        # TODO: Some web servers may ignore the range requests and return
+        # the whole file, we may want to detect that and avoid further
+        # requests.
+        # Hint: test_readv_multiple_get_requests will fail once we do that
+        max_size = self._readv_parameters()[1]
+        cumul = 0
+        ranges = []
+        requests = []
+        for coal in coalesced:
+            if ((max_size > 0
+                 and cumul + coal.length > max_size) or
+                    len(ranges) >= max_ranges):
+                # A first offset bigger than _get_max_size is requested on
+                # its own: a request without ranges would get the whole file.
+                if ranges:
+                    requests.append(ranges)
+                # Restart with the current offset
+                ranges = [coal]
+                cumul = coal.length
             else:
-                raise AssertionError("Unknown _range_hint %r"
-                                     % (self._range_hint,))
-            # TODO: Some web servers may ignore the range requests and return
-            # the whole file, we may want to detect that and avoid further
-            # requests.
-            # Hint: test_readv_multiple_get_requests will fail once we do that
-            cumul = 0
-            ranges = []
-            for coal in coalesced:
-                if ((self._get_max_size > 0
-                     and cumul + coal.length > self._get_max_size) or
-                        len(ranges) >= max_ranges):
-                    # Get that much and yield
-                    for c, rfile in get_and_yield(relpath, ranges):
-                        yield c, rfile
-                    # Restart with the current offset
-                    ranges = [coal]
-                    cumul = coal.length
-                else:
-                    ranges.append(coal)
-                    cumul += coal.length
-            # Get the rest and yield
-            for c, rfile in get_and_yield(relpath, ranges):
+                ranges.append(coal)
+                cumul += coal.length
+        if ranges:
+            requests.append(ranges)
+        for c, rfile in self._issue_readv_requests(relpath, requests):
+            yield c, rfile
+
+    def _issue_readv_requests(self, relpath, requests):
+        """Issue the GET requests needed by a readv.
+
+        :param requests: A list of lists of coalesced offsets, one per GET.
+        :return: An iterator over (coalesced offset, file) tuples, in the
+            order of the requests.
+        """
+        if len(requests) > 1 and self._readv_pool.max_connections > 1:
+            for c, rfile in self._parallel_readv(relpath, requests):
                 yield c, rfile
+            return
+        for ranges in requests:
+            # Note that the _get below may raise errors.InvalidHttpRange.
+            # It's the caller's responsibility to decide how to retry since it
+            # may provide different coalesced offsets.
+            code, rfile = self._get(relpath, ranges)
+            rfile = self._timed(rfile)
+            for coal in ranges:
+                yield coal, rfile
+
+    def _get_ranges(self, relpath, coalesced):
+        """Get the data for coalesced offsets using a pooled connection.
+
+        :return: A list of (coalesced offset, _ReadRange) tuples.
+        """
+        worker = self._readv_pool.get(self)
+        try:
+            code, rfile = worker._get(relpath, coalesced)
+            rfile = self._timed(rfile)
+            result = []
+            for coal in coalesced:
+                rfile.seek(coal.start, os.SEEK_SET)
+                # A short read is reported when the offsets are served
+                result.append(
+                    (coal, _ReadRange(coal.start, rfile.read(coal.length))))
+        except BaseException:
+            self._readv_pool.discard(worker)
+            raise
+        self._readv_pool.put(worker)
+        return result
+
+    def _parallel_readv(self, relpath, requests):
+        """Issue the GET requests for a readv over several connections.
+
+        At most max_connections requests are in flight, their results are
+        yielded in the order of the requests.
+
+        :param requests: A list of lists of coalesced offsets, one per GET.
+        """
+        max_connections = self._readv_pool.max_connections
+        if 'http' in debug.debug_flags:
+            mutter('http readv of %s in %d requests over %d connections',
+                   relpath, len(requests), max_connections)
+        pending = collections.deque()
+        requests = iter(requests)
+        executor = futures.ThreadPoolExecutor(max_workers=max_connections)
+        try:
+            for ranges in requests:
+                pending.append(
+                    executor.submit(self._get_ranges, relpath, ranges))
+                if len(pending) >= max_connections:
+                    break
+            while pending:
+                for c, rfile in pending.popleft().result():
+                    yield c, rfile
+                for ranges in requests:
+                    pending.append(
+                        executor.submit(self._get_ranges, relpath, ranges))
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def get_async(self):
+        """See Transport.get_async()."""
+        return _HttpAsyncTransport(self)
 
     def recommended_page_size(self):
         """See Transport.recommended_page_size().
@@ -65,6 +65,11 @@ class RemoteTransport(transport.ConnectedTransport):
     # When making a readv request, cap it at requesting 5MB of data
     _max_readv_bytes = 5 * 1024 * 1024
 
+    # The medium is also used by the objects opened over it (RemoteBzrDir,
+    # RemoteRepository, ...) which keep using it after the transport is
+    # disconnected, so it can't be lent to another transport.
+    _pool_connections = False
+
     # IMPORTANT FOR IMPLEMENTORS: RemoteTransport MUST NOT be given encoding
     # responsibilities: Put those on SmartClient or similar. This is vital for
     # the ability to support multiple versions of the smart protocol over time:
@@ -110,9 +115,8 @@ class RemoteTransport(transport.ConnectedTransport):
                 if 'hpss' in debug.debug_flags:
                     trace.mutter('hpss: Built a new medium: %s',
                                  medium.__class__.__name__)
-            self._shared_connection = transport._SharedConnection(medium,
-                                                                  credentials,
-                                                                  self.base)
+            self._set_shared_connection(transport._SharedConnection(
+                medium, credentials, self.base))
         elif medium is None:
             # No medium was specified, so share the medium from the
             # _from_transport.
@@ -37,6 +37,7 @@ from .. import (
     config,
     debug,
     errors,
+    osutils,
     urlutils,
     )
 from ..errors import (TransportError,
@@ -157,7 +158,8 @@ class _SFTPReadvHelper(object):
     # See _get_requests for an explanation.
     _max_request_size = 32768
 
-    def __init__(self, original_offsets, relpath, _report_activity):
+    def __init__(self, original_offsets, relpath, _report_activity,
+                 max_request_size=None, max_requests_in_flight=None):
         """Create a new readv helper.
 
         :param original_offsets: The original requests given by the caller of
@@ -165,10 +167,17 @@ class _SFTPReadvHelper(object):
         :param relpath: The name of the file (if known)
         :param _report_activity: A Transport._report_activity bound method,
             to be called as data arrives.
+        :param max_request_size: The size of the individual read requests,
+            defaults to _max_request_size.
+        :param max_requests_in_flight: The number of read requests sent before
+            waiting for their replies, None lets paramiko decide.
         """
         self.original_offsets = list(original_offsets)
         self.relpath = relpath
         self._report_activity = _report_activity
+        if max_request_size is not None:
+            self._max_request_size = max_request_size
+        self._max_requests_in_flight = max_requests_in_flight
 
     def _get_requests(self):
         """Break up the offsets into individual requests over sftp.
@@ -227,11 +236,16 @@ class _SFTPReadvHelper(object):
         # This is used to buffer chunks which we couldn't process yet
         # It is (start, end, data) tuples.
         data_chunks = []
+        if self._max_requests_in_flight is not None:
+            data = fp.readv(
+                requests,
+                max_concurrent_prefetch_requests=self._max_requests_in_flight)
+        else:
+            data = fp.readv(requests)
         # Create an 'unlimited' data stream, so we stop based on requests,
         # rather than just because the data stream ended. This lets us detect
         # short readv.
-        data_stream = itertools.chain(fp.readv(requests),
-                                      itertools.repeat(None))
+        data_stream = itertools.chain(data, itertools.repeat(None))
         for (start, length), data in zip(requests, data_stream):
             if data is None:
                 if cur_coalesced is not None:
@@ -364,9 +378,35 @@ class SFTPTransport(ConnectedTransport):
     # to be at least 32K. paramiko.readv() does an async request
     # for the chunks. So we need to keep it within a single request
     # size for paramiko <= 1.6.1. paramiko 1.6.2 will probably chop
-    # up the request itself, rather than us having to worry about it
+    # up the request itself, rather than us having to worry about it.
+    # Servers known to accept more can be given a bigger size with the
+    # sftp.max_request_size option.
     _max_request_size = 32768
 
+    def __init__(self, base, _from_transport=None):
+        super(SFTPTransport, self).__init__(base,
+                                            _from_transport=_from_transport)
+        if _from_transport is not None:
+            self._max_request_size = _from_transport._max_request_size
+            self._max_requests_in_flight = (
+                _from_transport._max_requests_in_flight)
+        else:
+            conf = config.LocationStack(self.base)
+            self._max_request_size = conf.get('sftp.max_request_size')
+            self._max_requests_in_flight = conf.get(
+                'sftp.max_requests_in_flight')
+
+    def _open_file(self, path, mode):
+        """Open a remote file, using the configured request size."""
+        f = self._get_sftp().file(path, mode=mode)
+        f.MAX_REQUEST_SIZE = self._max_request_size
+        return f
+
+    def _pump(self, from_file, to_file):
+        # Writes are split into requests of the configured size anyway
+        return osutils.pumpfile(from_file, to_file,
+                                buff_size=self._max_request_size)
+
     def _remote_path(self, relpath):
         """Return the path to be passed along the sftp protocol for relpath.
 
@@ -412,7 +452,7 @@ class SFTPTransport(ConnectedTransport):
         return connection, (user, password)
 
     def disconnect(self):
-        connection = self._get_connection()
+        connection = self._release_connection()
         if connection is not None:
             connection.close()
 
@@ -444,10 +484,13 @@ class SFTPTransport(ConnectedTransport):
         """
         try:
             path = self._remote_path(relpath)
-            f = self._get_sftp().file(path, mode='rb')
+            f = self._open_file(path, mode='rb')
             size = f.stat().st_size
             if getattr(f, 'prefetch', None) is not None:
-                f.prefetch(size)
+                if self._max_requests_in_flight is not None:
+                    f.prefetch(size, self._max_requests_in_flight)
+                else:
+                    f.prefetch(size)
             return f
         except (IOError, paramiko.SSHException) as e:
             self._translate_io_exception(e, path, ': error retrieving',
@@ -470,7 +513,7 @@ class SFTPTransport(ConnectedTransport):
 
         try:
             path = self._remote_path(relpath)
-            fp = self._get_sftp().file(path, mode='rb')
+            fp = self._open_file(path, mode='rb')
             readv = getattr(fp, 'readv', None)
             if readv:
                 return self._sftp_readv(fp, offsets, relpath)
@@ -495,7 +538,10 @@ class SFTPTransport(ConnectedTransport):
         does not support ranges > 64K, so it caps the request size, and
         just reads until it gets all the stuff it wants.
         """
-        helper = _SFTPReadvHelper(offsets, relpath, self._report_activity)
+        helper = _SFTPReadvHelper(
+            offsets, relpath, self._report_activity,
+            max_request_size=self._max_request_size,
+            max_requests_in_flight=self._max_requests_in_flight)
         return helper.request_and_yield_offsets(fp)
 
     def put_file(self, relpath, f, mode=None):
@@ -572,7 +618,7 @@ class SFTPTransport(ConnectedTransport):
             fout = None
             try:
                 try:
-                    fout = self._get_sftp().file(abspath, mode='wb')
+                    fout = self._open_file(abspath, mode='wb')
                     fout.set_pipelined(True)
                     writer(fout)
                 except (paramiko.SSHException, IOError) as e:
@@ -640,15 +686,21 @@ class SFTPTransport(ConnectedTransport):
                                     dir_mode=dir_mode)
 
     def iter_files_recursive(self):
-        """Walk the relative paths of all files in this transport."""
-        # progress is handled by list_dir
-        queue = list(self.list_dir('.'))
+        """Walk the relative paths of all files in this transport.
+
+        Symlinks are not followed: like stat(), the attributes in directory
+        listings describe the links themselves, so links to directories are
+        yielded as files.
+        """
+        # The directory listings include the attributes of their entries, so
+        # no stat round trip is needed per entry.
+        queue = self._list_dir_attr('.')
         while queue:
-            relpath = queue.pop(0)
-            st = self.stat(relpath)
+            relpath, st = queue.pop(0)
             if stat.S_ISDIR(st.st_mode):
-                for i, basename in enumerate(self.list_dir(relpath)):
-                    queue.insert(i, relpath + '/' + basename)
+                for i, (basename, child_st) in enumerate(
+                        self._list_dir_attr(relpath)):
+                    queue.insert(i, (relpath + '/' + basename, child_st))
             else:
                 yield relpath
 
@@ -699,7 +751,7 @@ class SFTPTransport(ConnectedTransport):
         #       But for now, we just chmod later anyway.
         handle = None
         try:
-            handle = self._get_sftp().file(abspath, mode='wb')
+            handle = self._open_file(abspath, mode='wb')
             handle.set_pipelined(True)
         except (paramiko.SSHException, IOError) as e:
             self._translate_io_exception(e, abspath,
@@ -753,11 +805,17 @@ class SFTPTransport(ConnectedTransport):
         """
         try:
             path = self._remote_path(relpath)
-            fout = self._get_sftp().file(path, 'ab')
-            if mode is not None:
-                self._get_sftp().chmod(path, mode)
-            result = fout.tell()
-            self._pump(f, fout)
+            fout = self._open_file(path, 'ab')
+            try:
+                # Don't wait for each write to be acknowledged, errors are
+                # reported when closing the file.
+                fout.set_pipelined(True)
+                if mode is not None:
+                    self._get_sftp().chmod(path, mode)
+                result = fout.tell()
+                self._pump(f, fout)
+            finally:
+                fout.close()
             return result
         except (IOError, paramiko.SSHException) as e:
             self._translate_io_exception(e, relpath, ': unable to append')
@@ -824,6 +882,21 @@ class SFTPTransport(ConnectedTransport):
             self._translate_io_exception(e, path, ': failed to list_dir')
         return [urlutils.escape(entry) for entry in entries]
 
+    def _list_dir_attr(self, relpath):
+        """List a directory with the attributes of its entries.
+
+        :return: A list of (relpath, SFTPAttributes) for the entries of the
+            directory, relative to relpath.
+        """
+        path = self._remote_path(relpath)
+        try:
+            entries = self._get_sftp().listdir_attr(path)
+            self._report_activity(
+                sum(len(entry.filename) for entry in entries), 'read')
+        except (IOError, paramiko.SSHException) as e:
+            self._translate_io_exception(e, path, ': failed to list_dir')
+        return [(urlutils.escape(entry.filename), entry) for entry in entries]
+
     def rmdir(self, relpath):
         """See Transport.rmdir."""
         path = self._remote_path(relpath)
@@ -920,7 +993,9 @@ class SFTPTransport(ConnectedTransport):
             if t != CMD_HANDLE:
                 raise TransportError('Expected an SFTP handle')
             handle = msg.get_string()
-            return SFTPFile(self._get_sftp(), handle, 'wb', -1)
+            f = SFTPFile(self._get_sftp(), handle, 'wb', -1)
+            f.MAX_REQUEST_SIZE = self._max_request_size
+            return f
         except (paramiko.SSHException, IOError) as e:
             self._translate_io_exception(e, abspath, ': unable to open',
                                          failure_exc=FileExists)
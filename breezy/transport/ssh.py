@@ -24,6 +24,7 @@ import os
 import socket
 import subprocess
 import sys
+import threading
 from binascii import hexlify
 
 from .. import (
@@ -265,11 +266,72 @@ register_ssh_vendor('loopback', LoopbackVendor())
 
 
 class ParamikoVendor(SSHVendor):
-    """Vendor that uses paramiko."""
+    """Vendor that uses paramiko.
+
+    When the ``ssh.multiplex`` option is set, the connections to a host are
+    made over channels of a single authenticated paramiko transport.
+    """
+
+    def __init__(self):
+        # (username, password, host, port) => paramiko.Transport
+        self._transports = {}
+        self._lock = threading.Lock()
+        self._cleanup_registered = False
 
     def _hexify(self, s):
         return hexlify(s).upper()
 
+    def _get_transport(self, username, password, host, port):
+        """Return an authenticated transport and whether it is shared."""
+        if not config.GlobalStack().get('ssh.multiplex'):
+            return self._connect(username, password, host, port), False
+        # A transport authenticated with other credentials is not reused
+        key = (username, password, host, port)
+        with self._lock:
+            t = self._transports.get(key)
+            if t is not None and t.is_active():
+                return t, True
+        t = self._connect(username, password, host, port)
+        with self._lock:
+            self._transports[key] = t
+            if not self._cleanup_registered:
+                import breezy
+                breezy.get_global_state().exit_stack.callback(
+                    self.close_transports)
+                self._cleanup_registered = True
+        return t, False
+
+    def _forget_transport(self, t):
+        with self._lock:
+            for key, cached in list(self._transports.items()):
+                if cached is t:
+                    del self._transports[key]
+
+    def _open_channel(self, username, password, host, port, open_channel):
+        """Open a channel with open_channel on a transport to host.
+
+        If a shared transport fails to open a channel, it is dropped and a new
+        one is tried.
+        """
+        t, shared = self._get_transport(username, password, host, port)
+        if shared:
+            try:
+                return open_channel(t)
+            except (paramiko.SSHException, EOFError, socket.error) as e:
+                trace.mutter('reconnecting to %s, shared ssh connection '
+                             'failed: %s', host, e)
+                self._forget_transport(t)
+                t, shared = self._get_transport(username, password, host, port)
+        return open_channel(t)
+
+    def close_transports(self):
+        """Close the transports kept to be shared."""
+        with self._lock:
+            transports = list(self._transports.values())
+            self._transports.clear()
+        for t in transports:
+            t.close()
+
     def _connect(self, username, password, host, port):
         global SYSTEM_HOSTKEYS, BRZ_HOSTKEYS
 
@@ -314,19 +376,22 @@ class ParamikoVendor(SSHVendor):
         return t
 
     def connect_sftp(self, username, password, host, port):
-        t = self._connect(username, password, host, port)
         try:
-            return t.open_sftp_client()
+            return self._open_channel(
+                username, password, host, port,
+                lambda t: t.open_sftp_client())
         except paramiko.SSHException as e:
             self._raise_connection_error(host, port=port, orig_error=e,
                                          msg='Unable to start sftp client')
 
     def connect_ssh(self, username, password, host, port, command):
-        t = self._connect(username, password, host, port)
-        try:
+        def open_session(t):
             channel = t.open_session()
-            cmdline = ' '.join(command)
-            channel.exec_command(cmdline)
+            channel.exec_command(' '.join(command))
+            return channel
+        try:
+            channel = self._open_channel(username, password, host, port,
+                                         open_session)
             return _ParamikoSSHConnection(channel)
         except paramiko.SSHException as e:
             self._raise_connection_error(host, port=port, orig_error=e,
@@ -383,6 +448,7 @@ class SubprocessVendor(SSHVendor):
         try:
             argv = self._get_vendor_specific_argv(username, host, port,
                                                   subsystem='sftp')
+            argv[1:1] = self._get_multiplex_argv()
             sock = self._connect(argv)
             return SFTPClient(SocketAsChannelAdapter(sock))
         except _ssh_connection_errors as e:
@@ -392,10 +458,18 @@ class SubprocessVendor(SSHVendor):
         try:
             argv = self._get_vendor_specific_argv(username, host, port,
                                                   command=command)
+            argv[1:1] = self._get_multiplex_argv()
             return self._connect(argv)
         except _ssh_connection_errors as e:
             self._raise_connection_error(host, port=port, orig_error=e)
 
+    def _get_multiplex_argv(self):
+        """Returns the options sharing one connection between subprocesses.
+
+        They are inserted right after the executable.
+        """
+        return []
+
     def _get_vendor_specific_argv(self, username, host, port, subsystem=None,
                                   command=None):
         """Returns the argument list to run the subprocess with.
@@ -410,6 +484,29 @@ class OpenSSHSubprocessVendor(SubprocessVendor):
 
     executable_path = 'ssh'
 
+    # Seconds a master connection is kept after its last session ended
+    control_persist = 60
+
+    def _get_multiplex_argv(self):
+        """Share connections with a ControlMaster when ssh.multiplex is set.
+
+        The control sockets are kept in the breezy cache directory.
+        """
+        if (sys.platform == 'win32'
+                or not config.GlobalStack().get('ssh.multiplex')):
+            return []
+        path = osutils.pathjoin(bedding.cache_dir(), 'ssh')
+        try:
+            os.makedirs(path, mode=0o700, exist_ok=True)
+        except OSError as e:
+            trace.mutter('not multiplexing ssh connections: %s', e)
+            return []
+        # %C is a hash of the local host, remote host, port and user
+        return ['-oControlMaster=auto',
+                '-oControlPath=%s' % osutils.pathjoin(
+                    path.replace('%', '%%'), '%C'),
+                '-oControlPersist=%d' % self.control_persist]
+
     def _get_vendor_specific_argv(self, username, host, port, subsystem=None,
                                   command=None):
         args = [self.executable_path,
@@ -0,0 +1,347 @@
+# Copyright (C) 2026 Breezy Developers
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""Statistics about the transport operations of a process.
+
+When the ``transport_stats`` debug flag is set (``-Dtransport_stats``),
+every transport records, per URL scheme and host, how many times each
+operation was called, how long it took (with a histogram of the latencies)
+and how many bytes it read or wrote, along with the bytes that crossed the
+network. A summary is shown when brz exits, and the
+``transport.stats_file`` option names a file to export the statistics to as
+JSON.
+
+Only the outermost operation is counted when transport methods call each
+other (e.g. get_bytes calling get). Decorated transports (``readonly+``,
+``cache+``, ...) are counted apart from the transports they decorate.
+"""
+
+import json
+import re
+import threading
+import time
+
+import breezy
+
+from .. import (
+    config,
+    trace,
+    )
+
+
+# Upper bounds, in seconds, of the latency histogram buckets, the last one
+# collects everything slower.
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0)
+
+# Operations whose result is data read from the transport.
+_READ_OPERATIONS = ('get_bytes', 'readv')
+# Operations whose bytes argument is written to the transport.
+_WRITE_OPERATIONS = ('put_bytes', 'put_bytes_non_atomic', 'append_bytes')
+_OTHER_OPERATIONS = (
+    'append_file', 'copy', 'delete', 'delete_tree', 'get', 'has',
+    'iter_files_recursive', 'list_dir', 'mkdir', 'move', 'put_file',
+    'put_file_non_atomic', 'rename', 'rmdir', 'stat')
+
+_URL_RE = re.compile(r'^([^:/]+)://(?:[^@/]*@)?([^/]*)')
+
+
+def _key(base):
+    """Return the (scheme, host) statistics of a transport are kept under."""
+    m = _URL_RE.match(base)
+    if m is None:
+        return (base, '')
+    return m.group(1), m.group(2)
+
+
+class OperationStats(object):
+    """The statistics of one operation on one host."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds, nbytes=0, failed=False):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.seconds += seconds
+        self.bytes += nbytes
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                break
+        else:
+            i = len(LATENCY_BUCKETS)
+        self.histogram[i] += 1
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors,
+                'seconds': self.seconds, 'bytes': self.bytes,
+                'histogram': list(self.histogram)}
+
+
+class HostStats(object):
+    """The statistics of the transports to one scheme and host."""
+
+    def __init__(self):
+        self.operations = {}
+        self.wire_bytes_read = 0
+        self.wire_bytes_written = 0
+        self.readv_offsets = 0
+        self.readv_bytes_requested = 0
+
+    def operation(self, name):
+        try:
+            return self.operations[name]
+        except KeyError:
+            stats = self.operations[name] = OperationStats()
+            return stats
+
+    def readv_amplification(self):
+        """Return the bytes returned by readv per byte requested, or None."""
+        if not self.readv_bytes_requested:
+            return None
+        return (self.operation('readv').bytes /
+                float(self.readv_bytes_requested))
+
+    def read_amplification(self):
+        """Return the bytes received per byte read by callers, or None.
+
+        This includes the protocol overhead and the data read and thrown
+        away when combining readv ranges. It is only known for transports
+        reporting their network activity.
+        """
+        nbytes = sum(self.operation(name).bytes for name in _READ_OPERATIONS)
+        if not nbytes or not self.wire_bytes_read:
+            return None
+        return self.wire_bytes_read / float(nbytes)
+
+    def as_dict(self):
+        return {
+            'operations': {name: stats.as_dict()
+                           for name, stats in sorted(self.operations.items())},
+            'wire_bytes_read': self.wire_bytes_read,
+            'wire_bytes_written': self.wire_bytes_written,
+            'readv_offsets': self.readv_offsets,
+            'readv_bytes_requested': self.readv_bytes_requested,
+            'readv_amplification': self.readv_amplification(),
+            'read_amplification': self.read_amplification(),
+            }
+
+
+class TransportStats(object):
+    """Statistics about the operations of transports, per scheme and host."""
+
+    def __init__(self, path=None):
+        """Create a TransportStats.
+
+        :param path: The file report() exports the statistics to, if any.
+        """
+        self.path = path
+        self.hosts = {}
+        self._lock = threading.Lock()
+        # Operations in progress on this thread, by transport id
+        self._local = threading.local()
+
+    def _host(self, key):
+        try:
+            return self.hosts[key]
+        except KeyError:
+            stats = self.hosts[key] = HostStats()
+            return stats
+
+    def _enter(self, transport):
+        depths = getattr(self._local, 'depths', None)
+        if depths is None:
+            depths = self._local.depths = {}
+        depth = depths.get(id(transport), 0)
+        depths[id(transport)] = depth + 1
+        return depth == 0
+
+    def _exit(self, transport):
+        depths = self._local.depths
+        depth = depths.pop(id(transport)) - 1
+        if depth:
+            depths[id(transport)] = depth
+
+    def record(self, key, operation, seconds, nbytes=0, failed=False):
+        """Record a call of operation taking seconds and moving nbytes."""
+        with self._lock:
+            self._host(key).operation(operation).add(seconds, nbytes, failed)
+
+    def record_activity(self, key, nbytes, direction):
+        """Record bytes sent or received over the network."""
+        with self._lock:
+            host = self._host(key)
+            if direction == 'read':
+                host.wire_bytes_read += nbytes
+            else:
+                host.wire_bytes_written += nbytes
+
+    def record_readv_request(self, key, offsets):
+        with self._lock:
+            host = self._host(key)
+            host.readv_offsets += len(offsets)
+            host.readv_bytes_requested += sum(
+                length for start, length in offsets)
+
+    def instrument(self, transport):
+        """Record the operations of transport from now on."""
+        key = _key(transport.base)
+        for name in _READ_OPERATIONS + _WRITE_OPERATIONS + _OTHER_OPERATIONS:
+            method = getattr(transport, name, None)
+            if method is not None:
+                setattr(transport, name,
+                        self._wrap(transport, key, name, method))
+        report_activity = transport._report_activity
+
+        def _report_activity(nbytes, direction):
+            self.record_activity(key, nbytes, direction)
+            return report_activity(nbytes, direction)
+        transport._report_activity = _report_activity
+
+    def _wrap(self, transport, key, name, method):
+        if name == 'readv':
+            def readv(relpath, offsets, *args, **kwargs):
+                offsets = list(offsets)
+                return self._timed_readv(
+                    transport, key, offsets,
+                    lambda: method(relpath, offsets, *args, **kwargs))
+            return readv
+
+        def call(*args, **kwargs):
+            if not self._enter(transport):
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    self._exit(transport)
+            start = time.time()
+            failed = True
+            nbytes = 0
+            try:
+                result = method(*args, **kwargs)
+                failed = False
+                if name in _READ_OPERATIONS:
+                    nbytes = len(result)
+                elif name in _WRITE_OPERATIONS:
+                    if len(args) > 1:
+                        nbytes = len(args[1])
+                    else:
+                        nbytes = len(kwargs.get('raw_bytes',
+                                                kwargs.get('bytes', b'')))
+                return result
+            finally:
+                self._exit(transport)
+                self.record(key, name, time.time() - start, nbytes, failed)
+        return call
+
+    def _timed_readv(self, transport, key, offsets, start_readv):
+        """Time a readv, only counting the time spent producing its data."""
+        outermost = self._enter(transport)
+        seconds = 0.0
+        nbytes = 0
+        failed = True
+        start = time.time()
+        try:
+            result = iter(start_readv())
+            while True:
+                try:
+                    offset, data = next(result)
+                except StopIteration:
+                    failed = False
+                    break
+                seconds += time.time() - start
+                nbytes += len(data)
+                # The caller may use the transport before asking for more
+                self._exit(transport)
+                try:
+                    yield offset, data
+                except GeneratorExit:
+                    failed = False
+                    raise
+                finally:
+                    self._enter(transport)
+                    start = time.time()
+        finally:
+            seconds += time.time() - start
+            self._exit(transport)
+            if outermost:
+                self.record_readv_request(key, offsets)
+                self.record(key, 'readv', seconds, nbytes, failed)
+
+    def as_dict(self):
+        """Return the statistics as a dict, ready to be dumped as JSON."""
+        with self._lock:
+            return {'%s://%s' % key: host.as_dict()
+                    for key, host in sorted(self.hosts.items())}
+
+    def summary(self):
+        """Return a human readable summary of the statistics, as lines."""
+        lines = []
+        with self._lock:
+            items = sorted(self.hosts.items())
+        for (scheme, host), stats in items:
+            lines.append('Transport statistics for %s://%s' % (scheme, host))
+            for name, op in sorted(stats.operations.items()):
+                lines.append(
+                    '  %-22s %6d calls %10d bytes %8.3fs%s' % (
+                        name, op.count, op.bytes, op.seconds,
+                        ' (%d failed)' % op.errors if op.errors else ''))
+            if stats.wire_bytes_read or stats.wire_bytes_written:
+                lines.append('  network: %d bytes read, %d bytes written' % (
+                    stats.wire_bytes_read, stats.wire_bytes_written))
+            if stats.readv_offsets:
+                lines.append(
+                    '  readv: %d offsets, %d bytes requested, '
+                    'amplification %.2f' % (
+                        stats.readv_offsets, stats.readv_bytes_requested,
+                        stats.readv_amplification()))
+            amplification = stats.read_amplification()
+            if amplification is not None:
+                lines.append('  read amplification %.2f' % amplification)
+        return lines
+
+    def report(self):
+        """Log the summary and export the statistics as configured."""
+        for line in self.summary():
+            trace.note(line)
+        if self.path:
+            try:
+                with open(self.path, 'w') as f:
+                    json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+            except EnvironmentError as e:
+                trace.warning('Unable to write transport statistics to %s: %s',
+                              self.path, e)
+
+
+_stats = None
+
+
+def get_stats():
+    """Return the statistics of the process, created on the first call.
+
+    The statistics are reported when breezy's global state exits.
+    """
+    global _stats
+    if _stats is None:
+        _stats = TransportStats()
+        # Reading the configuration uses transports, which need _stats
+        _stats.path = config.GlobalStack().get('transport.stats_file')
+        breezy.get_global_state().exit_stack.callback(_stats.report)
+    return _stats